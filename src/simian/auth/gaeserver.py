@@ -48,6 +48,7 @@ from simian import auth
 from simian.auth import base
 from simian.auth import util
 from simian.mac import models
+from simian.mac.common import gae_util
 
 
 # Level values supplied to DoMunkiAuth() and used in session data
@@ -160,16 +161,8 @@ class Auth1ServerDatastoreSession(base.Auth1ServerSession):
     else:
       q = self.model.all()
 
-    cursor = None
-    while True:
-      if cursor:
-        q.with_cursor(cursor)
-      sessions = q.fetch(500)
-      if not sessions:
-        raise StopIteration  # or should we just break?
-      for s in sessions:
-        yield s
-      cursor = q.cursor()
+    for s in gae_util.QueryIterator(q, step=500):
+      yield s
 
 
 class Auth1ServerDatastoreMemcacheSession(Auth1ServerDatastoreSession):
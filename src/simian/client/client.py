@@ -23,6 +23,7 @@
 import datetime
 import getpass
 import httplib
+import json
 import logging
 import mimetools
 import os
@@ -166,6 +167,34 @@ class Response(object):
     return self.status >= 400 and self.status <= 599
 
 
+class ReportBatch(object):
+  """A batch of reports to post to the server in a single request."""
+
+  def __init__(self):
+    self._reports = []
+
+  def __len__(self):
+    return len(self._reports)
+
+  def Add(self, report_type, params, feedback=False):
+    """Add a report to the batch.
+
+    Args:
+      report_type: str, like 'install_report'
+      params: dict, parameters to pass; values may be str or list of str.
+      feedback: bool, default False, request feedback response from server
+    """
+    report = dict(params)
+    report['_report_type'] = report_type
+    if feedback:
+      report['_feedback'] = '1'
+    self._reports.append(report)
+
+  def GetBody(self):
+    """Returns the str serialized batch, to POST to /reports/batch."""
+    return json.dumps(self._reports)
+
+
 class MultiBodyConnection:  # pylint: disable=g-old-style-class,no-init
   """Connection which can send multiple items as request body."""
 
@@ -1779,6 +1808,24 @@ class SimianClient(HttpsAuthClient):
       body = str(body)
     return self._SimianRequest('POST', url, body)
 
+  def PostReportBatch(self, batch):
+    """Post a batch of reports to the server in a single request.
+
+    Args:
+      batch: ReportBatch instance.
+    Returns:
+      list of str feedback responses, one per report in batch order; the
+      feedback is an empty str for reports that did not request it.
+    Raises:
+      SimianServerError: if the Simian server returned an error (status != 200)
+        or an invalid response.
+    """
+    body = self._SimianRequest('POST', '/reports/batch', str(batch.GetBody()))
+    try:
+      return json.loads(body)
+    except ValueError:
+      raise SimianServerError('Invalid report batch response: %s' % body)
+
   def UploadFile(self, file_path, file_type, _open=open):
     """Uploads a given log file to the server.
 
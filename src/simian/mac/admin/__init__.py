@@ -78,11 +78,15 @@ MENU = [
           'name': 'ACL Groups'},
          {'type': 'config', 'url': '/admin/config',
           'name': 'Configuration'},
+         {'type': 'instrumentation', 'url': '/admin/instrumentation',
+          'name': 'Instrumentation'},
          {'type': 'ip_blacklist', 'url': '/admin/ip_blacklist',
           'name': 'IP Blacklist'},
          {'type': 'lock_admin', 'url': '/admin/lock_admin',
           'name': 'Lock Admin'},
          {'type': 'panic', 'url': '/admin/panic', 'name': 'Panic Mode'},
+         {'type': 'retention', 'url': '/admin/retention',
+          'name': 'Log Retention'},
     ]},
 
     {'type': 'tags', 'url': '/admin/tags', 'name': 'Tags'},
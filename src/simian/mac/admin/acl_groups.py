@@ -71,6 +71,7 @@ class ACLGroups(admin.AdminHandler):
           return
       models.KeyValueCache.MemcacheWrappedSet(group, 'text_value',
                                               util.Serialize(members))
+      auth.ACL_INDEX.Invalidate()
       self.redirect('/admin/acl_groups?msg=Group%20saved')
 
   def GetMembers(self, group_name):
@@ -175,8 +175,10 @@ class AppleSUSAdmin(admin.AdminHandler):
       products.append(p)
 
     catalogs = []
-    for os_version in applesus.OS_VERSIONS:
-      c = models.AppleSUSCatalog.MemcacheWrappedGet('%s_untouched' % os_version)
+    os_versions = list(applesus.OS_VERSIONS)
+    untouched = models.AppleSUSCatalog.MemcacheWrappedGetMulti(
+        ['%s_untouched' % os_version for os_version in os_versions])
+    for os_version, c in zip(os_versions, untouched):
       if c:
         catalogs.append({'version': os_version, 'download_datetime': c.mtime})
 
@@ -58,8 +58,7 @@ class Host(admin.AdminHandler):
       if not c:
         self.response.out.write('UUID not found')
         return
-      c.active = False
-      c.put(update_active=False)
+      models.ComputerSummaryShard.PutInactive([c])
       msg = 'Host set as inactive.'
 
     elif action == 'set_loststolen':
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""Instrumentation admin handler."""
+
+
+
+
+from simian.mac import admin
+from simian.mac.common import instrumentation
+
+
+class Instrumentation(admin.AdminHandler):
+  """Handler for /admin/instrumentation."""
+
+  def get(self):
+    """GET handler."""
+    if not self.IsAdminUser():
+      return
+
+    stats = instrumentation.GetStats()
+    handlers = []
+    # hits and misses of each cache, summed over all handlers.
+    caches = {}
+    for handler in sorted(stats):
+      metrics = []
+      for name in sorted(stats[handler]):
+        metric = stats[handler][name]
+        metrics.append(dict(metric, name=name))
+        cache, _, kind = name.rpartition('.')
+        if kind in ['hit', 'miss', 'instance_hit']:
+          counts = caches.setdefault(cache, {'hit': 0, 'miss': 0})
+          counts[kind == 'miss' and 'miss' or 'hit'] += metric['count']
+      handlers.append({'name': handler, 'metrics': metrics})
+
+    cache_list = []
+    for cache in sorted(caches):
+      counts = caches[cache]
+      cache_list.append({
+          'name': cache, 'hit': counts['hit'], 'miss': counts['miss'],
+          'hit_percent': 100.0 * counts['hit'] / (
+              counts['hit'] + counts['miss']),
+      })
+
+    values = {
+        'report_type': 'instrumentation', 'handlers': handlers,
+        'caches': cache_list,
+        'flush_secs': instrumentation.FLUSH_SECS,
+    }
+    self.Render('instrumentation.html', values)
@@ -27,6 +27,7 @@ from simian.mac.admin import applesus
 from simian.mac.admin import broken_clients
 from simian.mac.admin import config
 from simian.mac.admin import host
+from simian.mac.admin import instrumentation
 from simian.mac.admin import ip_blacklist
 from simian.mac.admin import lock_admin
 from simian.mac.admin import manifest_modifications
@@ -35,6 +36,7 @@ from simian.mac.admin import panic
 from simian.mac.admin import package_alias
 from simian.mac.admin import packages
 from simian.mac.admin import package
+from simian.mac.admin import retention
 from simian.mac.admin import summary
 from simian.mac.admin import tags
 from simian.mac.admin import uploadpkg
@@ -61,6 +63,8 @@ app = webapp2.WSGIApplication([
 
     (r'/admin/host/([\w\-\_\.\=\|\%, ]+)/?$', host.Host),
 
+    (r'/admin/instrumentation/?$', instrumentation.Instrumentation),
+
     (r'/admin/ip_blacklist/?$', ip_blacklist.IPBlacklist),
 
     (r'/admin/lock_admin/?$', lock_admin.LockAdmin),
@@ -78,6 +82,8 @@ app = webapp2.WSGIApplication([
 
     (r'/admin/panic/?$', panic.AdminPanic),
 
+    (r'/admin/retention/?$', retention.Retention),
+
     (r'/admin/tags/?$', tags.Tags),
 
     (r'/admin/uploadpkg/?$', uploadpkg.UploadPackage),
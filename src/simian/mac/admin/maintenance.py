@@ -50,6 +50,7 @@ or rebuilding various caches.
 
 
 
+import datetime
 import logging
 
 from google.appengine.ext import deferred
@@ -61,18 +62,32 @@ from simian.mac.cron import reports_cache
 
 
 INSTALL_LOG_MAX_FETCH = 2000
+REBUILD_LOCK_SECS = 30
 
 
 def RebuildInstallCounts():
-  """Rebuilds "install_counts" dictionary from all InstallLog entities."""
-  lock = models.KeyValueCache.get_by_key_name('pkgs_list_cron_lock')
-  if lock:
-    lock.delete()
-  cursor_obj = models.KeyValueCache.get_by_key_name('pkgs_list_cursor')
-  if cursor_obj:
-    cursor_obj.delete()
-  models.ReportsCache.SetInstallCounts({})
-  deferred.defer(reports_cache._GenerateInstallCounts)
+  """Rebuilds InstallRollup entities and install counts from InstallLog.
+
+  Returns:
+    True if the rebuild was started, False if install counts are being
+    generated and the rebuild should be retried later.
+  """
+  lock = gae_util.Lock('pkgs_list_cron_lock', ttl=gae_util.LOCK_TASK_SECS)
+  if not lock.Acquire(timeout=REBUILD_LOCK_SECS):
+    logging.warning('RebuildInstallCounts: lock found; exiting.')
+    return False
+  try:
+    until = datetime.datetime.utcnow()
+    gae_util.BatchDatastoreOp(
+        models.db.delete, list(models.InstallRollup.all(keys_only=True)))
+    # counts are not folded until the backfill clears backfill_until.
+    models.ReportsCache.SetInstallCountsFolded(
+        {'hour': None, 'pkgs': {}, 'backfill_until': str(until)})
+    models.ReportsCache.SetInstallCounts({})
+    deferred.defer(reports_cache._BackfillInstallRollups, until)
+  finally:
+    lock.Release()
+  return True
 
 
 def ConvertLegacyAppleUpdateInstallLogEntities():
@@ -117,7 +117,8 @@ class Misc(admin.AdminHandler):
       elif action == 'update_legacy_apple_updates':
         maintenance.ConvertLegacyAppleUpdateInstallLogEntities()
       elif action == 'rebuild_install_counts':
-        maintenance.RebuildInstallCounts()
+        if not maintenance.RebuildInstallCounts():
+          self.response.set_status(503)
       else:
         self.response.set_status(404)
     else:
@@ -231,7 +232,7 @@ class Misc(admin.AdminHandler):
       m = models.ReportsCache.get_by_key_name(key)
       if not m or not m.blob_value:
         continue
-      summary = util.Deserialize(m.blob_value)
+      summary = util.Decode(m.blob_value)
       summary_list = []
       keys = summary.keys()
       keys.sort(cmp=lambda x, y: cmp(summary[x], summary[y]), reverse=True)
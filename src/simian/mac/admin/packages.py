@@ -67,6 +67,11 @@ class Packages(admin.AdminHandler):
       pkg['pending_count'] = pending.get(p.munki_name, 'N/A')
       pkg['duration_seconds_avg'] = installs.get(p.munki_name, {}).get(
           'duration_seconds_avg', None) or 'N/A'
+      for name in ['duration', 'dl_kbytes_per_sec']:
+        for percentile in ['p50', 'p90', 'p99']:
+          key = '%s_%s' % (name, percentile)
+          value = installs.get(p.munki_name, {}).get(key, None)
+          pkg[key] = 'N/A' if value is None else value
       pkg['unattended'] = p.plist.get('unattended_install', False)
       force_install_after_date = p.plist.get('force_install_after_date', None)
       if force_install_after_date:
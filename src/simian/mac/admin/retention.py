@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""Log Retention admin handler."""
+
+
+
+
+from simian.mac import admin
+from simian.mac.common import retention
+
+
+class Retention(admin.AdminHandler):
+  """Handler for /admin/retention."""
+
+  def get(self):
+    """GET handler."""
+    if not self.IsAdminUser():
+      return
+
+    policies = []
+    runs = []
+    for kind_name in sorted(retention.POLICIES):
+      policy = retention.POLICIES[kind_name]
+      state = retention.GetState(kind_name)
+      if state and state.get('finished'):
+        state = None
+      kind_runs = retention.GetRuns(kind_name)
+      for run in kind_runs:
+        run['kind_name'] = kind_name
+      runs.extend(kind_runs)
+      policies.append({
+          'kind_name': kind_name, 'days': policy.days,
+          'rollup': policy.rollup, 'running': state,
+          'deleted': sum(r['deleted'] for r in kind_runs),
+          'bytes_reclaimed': sum(
+              r['bytes_reclaimed'] or 0 for r in kind_runs),
+      })
+    runs.sort(key=lambda r: r['finished'], reverse=True)
+
+    values = {'report_type': 'retention', 'policies': policies, 'runs': runs}
+    self.Render('retention.html', values)
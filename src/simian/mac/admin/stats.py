@@ -82,8 +82,7 @@ class Stats(webapp.RequestHandler):
       if not c:
         self.response.out.write('UUID not found')
         return
-      c.active = False
-      c.put(update_active=False)
+      models.ComputerSummaryShard.PutInactive([c])
     elif action == 'set_loststolen':
       models.ComputerLostStolen.SetLostStolen(uuid)
     elif action == 'upload_logs':
@@ -185,7 +184,8 @@ class Stats(webapp.RequestHandler):
       elif action == 'update_legacy_apple_updates':
         maintenance.ConvertLegacyAppleUpdateInstallLogEntities()
       elif action == 'rebuild_install_counts':
-        maintenance.RebuildInstallCounts()
+        if not maintenance.RebuildInstallCounts():
+          self.response.set_status(503)
       else:
         self.response.set_status(404)
     else:
@@ -617,7 +617,7 @@ class Stats(webapp.RequestHandler):
       human_since = 'forever'
 
     m = models.ReportsCache.get_by_key_name(key)
-    summary = util.Deserialize(m.blob_value)
+    summary = util.Decode(m.blob_value)
     summary_list = []
     keys = summary.keys()
     keys.sort(cmp=lambda x,y: cmp(summary[x], summary[y]))
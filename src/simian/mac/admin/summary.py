@@ -33,12 +33,16 @@ from simian.mac import admin
 from simian.mac import common
 from simian.mac import models
 from simian.mac.common import auth
+from simian.mac.common import fleet_snapshot
 
 
 ACTIVE_DAY_COUNTS = [30, 14, 7, 1]
 DEFAULT_COMPUTER_FETCH_LIMIT = 500
 REPORT_TYPES = [
     'owner', 'hostname', 'serial', 'uuid', 'client_version', 'os_version']
+# report types with summaries of all matching clients cached by the
+# stats_views cron, see reports_cache.StatsViewsJob.
+STATS_VIEW_TYPES = ['track', 'site', 'os_version', 'client_version']
 
 
 class Summary(admin.AdminHandler):
@@ -49,7 +53,10 @@ class Summary(admin.AdminHandler):
     auth.DoUserAuth()
     report_type = self.request.get('filter-type')
     report_filter = self.request.get('filter')
-    if report_type and report_filter:
+    if self.request.get('format') == 'csv':
+      include_inactive = self.request.get('include-inactive') != ''
+      self._DisplayCsv(report_type, report_filter, include_inactive)
+    elif report_type and report_filter:
       report_filter = urllib.unquote(report_filter)
       report_filter = report_filter.strip()
       include_inactive = self.request.get('include-inactive') != ''
@@ -73,6 +80,37 @@ class Summary(admin.AdminHandler):
     }
     self.Render('summary.html', values)
 
+  def _DisplayCsv(self, report_type, report_filter, include_inactive):
+    """Writes clients as CSV from the latest fleet snapshot.
+
+    Args:
+      report_type: str, optional, snapshot column to filter on.
+      report_filter: str, value of the column to filter on.
+      include_inactive: bool, True to include inactive hosts.
+    """
+    snapshot = fleet_snapshot.Load()
+    if snapshot is None:
+      self.response.set_status(404)
+      self.response.out.write('fleet snapshot not built yet')
+      return
+
+    filters = {}
+    if not include_inactive:
+      filters['active'] = True
+    if report_type:
+      if report_type not in fleet_snapshot.STR_COLUMNS:
+        self.response.set_status(400)
+        self.response.out.write('unknown report_type: %s' % report_type)
+        return
+      if report_type == 'site' and report_filter == 'None':
+        report_filter = None
+      filters[report_type] = report_filter
+
+    self.response.headers['Content-Type'] = 'text/csv'
+    self.response.headers['Content-Disposition'] = (
+        'attachment; filename=computers.csv')
+    snapshot.WriteCsv(self.response.out, snapshot.Filter(**filters))
+
   def _DisplaySummary(self, report_type, report_filter, include_inactive):
     """Displays stats summary for a given track or site.
 
@@ -88,13 +126,23 @@ class Summary(admin.AdminHandler):
     else:
       query = models.Computer.AllActive()
 
+    summary = None
+    view_mtime = None
+    if report_type in STATS_VIEW_TYPES and not include_inactive:
+      summary, view_mtime = models.ReportsCache.GetStatsView(
+          report_type, report_filter)
+    if not view_mtime:
+      summary, view_mtime = _GetSnapshotSummary(
+          report_type, report_filter, include_inactive)
+
     if report_type == 'track':
       query.filter('track =', report_filter).order('-preflight_datetime')
     elif report_type == 'site':
       if report_filter == 'None':
         report_filter = None
       query.filter('site =', report_filter).order('-preflight_datetime')
-      default_limit = 2000  # Show all clients in most sites.
+      if not view_mtime:
+        default_limit = 2000  # Show all clients in most sites.
     elif report_type == 'tag':
       tag = models.Tag.get_by_key_name(report_filter)
       if tag:
@@ -124,38 +172,52 @@ class Summary(admin.AdminHandler):
     except AttributeError:
       owner_lookup_url = None
 
-    summary = GetComputerSummary(computers=computers)
+    if not view_mtime:
+      # no cached view or snapshot, so summarize the clients on this page only.
+      summary = GetComputerSummary(computers=computers)
     values = {
         'computers': computers, 'summary': summary, 'report_type': 'search',
         'search_type': report_type, 'search_term': report_filter,
-        'owner_lookup_url': owner_lookup_url,
+        'owner_lookup_url': owner_lookup_url, 'view_mtime': view_mtime,
     }
     self.Render('summary.html', values)
 
 
-def GetComputerSummary(computers=None, query=None):
-  """Generates a summary overview of all computers in a given query.
+def _GetSnapshotSummary(report_type, report_filter, include_inactive):
+  """Returns a summary of all clients of a search from the fleet snapshot.
 
   Args:
-    computers: optional, list of Computer objects to generate a summary of.
-      OR
-    query: optional, db.Query object, if neither computer not query are passed,
-        query defaults to models.Computer.AllActive().
+    report_type: str report type being requested.
+    report_filter: str report filter to apply to the type.
+    include_inactive: bool, True to include inactive hosts.
   Returns:
-    dict, stats summary data used to pass to summary template.
+    tuple of summary dict and datetime of the snapshot, or (None, None) if
+    no snapshot was built or it lacks the report type.
   """
-  if computers is None and query is None:
-    query = models.Computer.AllActive()
-
-  total_client_count = 0
+  if report_type not in fleet_snapshot.STR_COLUMNS:
+    return None, None
+  snapshot = fleet_snapshot.Load()
+  if snapshot is None:
+    return None, None
+  if report_type == 'site' and report_filter == 'None':
+    report_filter = None
+  filters = {report_type: report_filter}
+  if not include_inactive:
+    filters['active'] = True
+  computers = snapshot.GetComputers(snapshot.Filter(**filters))
+  return GetComputerSummary(computers=computers), snapshot.mtime
+
+
+def _NewSummary():
+  """Returns a summary dict with counts initialized, for _FinishSummary()."""
   summary = {
       'active': {},
       'all_pkgs_installed': {},
       'all_pkgs_installed_percent': {},
       'all_apple_updates_installed': {},
       'all_apple_updates_installed_percent': {},
-      'conns_on_corp': None,
-      'conns_off_corp': None,
+      'conns_on_corp': 0,
+      'conns_off_corp': 0,
       'conns_on_corp_percent': None,
       'conns_off_corp_percent': None,
       'tracks': {},
@@ -164,11 +226,6 @@ def GetComputerSummary(computers=None, query=None):
       'off_corp_conns_histogram': {},
       'sites_histogram': {},
   }
-  os_versions = {}
-  client_versions = {}
-  connections_on_corp = 0
-  connections_off_corp = 0
-  off_corp_connections_histogram = {}
 
   # initialize active counts dictionaries.
   for days in ACTIVE_DAY_COUNTS:
@@ -182,9 +239,82 @@ def GetComputerSummary(computers=None, query=None):
   # intialize corp connections histogram buckets.
   for i in xrange(0, 10):
     bucket = ' %s0-%s9' % (i, i)
-    off_corp_connections_histogram[bucket] = 0
-  off_corp_connections_histogram['100'] = 0
-  off_corp_connections_histogram[' -never-'] = 0
+    summary['off_corp_conns_histogram'][bucket] = 0
+  summary['off_corp_conns_histogram']['100'] = 0
+  summary['off_corp_conns_histogram'][' -never-'] = 0
+  return summary
+
+
+def _FinishSummary(summary, total_client_count):
+  """Converts summary counts from _NewSummary() to the template format.
+
+  Args:
+    summary: dict, summary counts.
+    total_client_count: int, number of computers counted.
+  Returns:
+    dict, stats summary data used to pass to summary template.
+  """
+  # Convert connections histogram to percentages.
+  off_corp_connections_histogram_percent = []
+  for bucket, count in DictToList(summary['off_corp_conns_histogram']):
+    if not total_client_count:
+      percent = 0
+    else:
+      percent = float(count) / total_client_count * 100
+    off_corp_connections_histogram_percent.append((bucket, percent))
+  summary['off_corp_conns_histogram'] = off_corp_connections_histogram_percent
+
+  summary['sites_histogram'] = DictToList(
+      summary['sites_histogram'], reverse=True, by_value=True)
+  #summary['tracks'] = DictToList(tracks, reverse=False)
+  summary['os_versions'] = DictToList(summary['os_versions'])
+  summary['client_versions'] = DictToList(summary['client_versions'])
+
+  # set summary connection percentages.
+  connections_on_corp = summary['conns_on_corp']
+  connections_off_corp = summary['conns_off_corp']
+  total_connections = connections_on_corp + connections_off_corp
+  if total_connections:
+    summary['conns_on_corp_percent'] = (
+        connections_on_corp * 100.0 / total_connections)
+    summary['conns_off_corp_percent'] = (
+        connections_off_corp * 100.0 / total_connections)
+  else:
+    summary['conns_on_corp_percent'] = 0
+    summary['conns_off_corp_percent'] = 0
+
+  # calculate all_(apple_updates|pkgs)_installed_percent values.
+  for days in ACTIVE_DAY_COUNTS:
+    summary['all_pkgs_installed_percent'][days] = GetPercentage(
+        summary['all_pkgs_installed'][days], summary['active'][days])
+    summary['all_apple_updates_installed_percent'][days] = GetPercentage(
+        summary['all_apple_updates_installed'][days], summary['active'][days])
+
+  if summary['active'][30]:
+    return summary
+  else:
+    return {}
+
+
+def GetComputerSummary(computers=None, query=None):
+  """Generates a summary overview of all computers in a given query.
+
+  Args:
+    computers: optional, list of Computer objects to generate a summary of.
+      OR
+    query: optional, db.Query object, if neither computer not query are passed,
+        query defaults to models.Computer.AllActive().
+  Returns:
+    dict, stats summary data used to pass to summary template.
+  """
+  if computers is None and query is None:
+    query = models.Computer.AllActive()
+
+  total_client_count = 0
+  summary = _NewSummary()
+  os_versions = summary['os_versions']
+  client_versions = summary['client_versions']
+  off_corp_connections_histogram = summary['off_corp_conns_histogram']
 
   # even though Tasks can now run up to 10 minutes, Datastore queries are
   # still limited to 30 seconds (2010-10-27). Treating a QuerySet as an
@@ -218,8 +348,8 @@ def GetComputerSummary(computers=None, query=None):
       client_version = str(c.client_version)
       site = str(c.site)
 
-      connections_on_corp += c.connections_on_corp
-      connections_off_corp += c.connections_off_corp
+      summary['conns_on_corp'] += c.connections_on_corp
+      summary['conns_off_corp'] += c.connections_off_corp
       os_versions[os_version] = os_versions.get(os_version, 0) + 1
       client_versions[client_version] = (
           client_versions.get(client_version, 0) + 1)
@@ -248,46 +378,57 @@ def GetComputerSummary(computers=None, query=None):
       # if there was no query, we finished iterating through all computers.
       break
 
-  # Convert connections histogram to percentages.
-  off_corp_connections_histogram_percent = []
-  for bucket, count in DictToList(off_corp_connections_histogram):
-    if not total_client_count:
-      percent = 0
-    else:
-      percent = float(count) / total_client_count * 100
-    off_corp_connections_histogram_percent.append((bucket, percent))
-  summary['off_corp_conns_histogram'] = off_corp_connections_histogram_percent
+  return _FinishSummary(summary, total_client_count)
 
-  summary['sites_histogram'] = DictToList(
-      summary['sites_histogram'], reverse=True, by_value=True)
-  #summary['tracks'] = DictToList(tracks, reverse=False)
-  summary['os_versions'] = DictToList(os_versions)
-  summary['client_versions'] = DictToList(client_versions)
 
-  # set summary connection counts and percentages.
-  summary['conns_on_corp'] = connections_on_corp
-  summary['conns_off_corp'] = connections_off_corp
-  total_connections = connections_on_corp + connections_off_corp
-  if total_connections:
-    summary['conns_on_corp_percent'] = (
-        connections_on_corp * 100.0 / total_connections)
-    summary['conns_off_corp_percent'] = (
-        connections_off_corp * 100.0 / total_connections)
-  else:
-    summary['conns_on_corp_percent'] = 0
-    summary['conns_off_corp_percent'] = 0
+def GetComputerSummaryFromCounters(daily_counts=None, today=None):
+  """Generates a summary overview of all active computers from counters.
 
-  # calculate all_(apple_updates|pkgs)_installed_percent values.
-  for days in ACTIVE_DAY_COUNTS:
-    summary['all_pkgs_installed_percent'][days] = GetPercentage(
-        summary['all_pkgs_installed'][days], summary['active'][days])
-    summary['all_apple_updates_installed_percent'][days] = GetPercentage(
-        summary['all_apple_updates_installed'][days], summary['active'][days])
+  Counters are maintained by LogClientConnection, see
+  models.ComputerSummaryShard. Unlike GetComputerSummary(), active days are
+  calendar days, today included.
 
-  if summary['active'][30]:
-    return summary
-  else:
-    return {}
+  Args:
+    daily_counts: optional, dict of datetime.date: dict of counter name: int;
+      defaults to models.ComputerSummaryShard.GetDailyCounts().
+    today: datetime.date, optional, date to count active days from.
+  Returns:
+    dict, stats summary data used to pass to summary template.
+  """
+  if daily_counts is None:
+    daily_counts = models.ComputerSummaryShard.GetDailyCounts(
+        max(ACTIVE_DAY_COUNTS))
+  today = today or datetime.datetime.utcnow().date()
+  summary = _NewSummary()
+  histograms = {
+      'os_version': summary['os_versions'],
+      'client_version': summary['client_versions'],
+      'site': summary['sites_histogram'],
+      'off_corp_bucket': summary['off_corp_conns_histogram'],
+  }
+
+  for date, counts in daily_counts.iteritems():
+    age = (today - date).days
+    if age >= max(ACTIVE_DAY_COUNTS):
+      continue
+    for name, value in counts.iteritems():
+      kind, _, key = name.partition(':')
+      if kind in histograms:
+        histograms[kind][key] = histograms[kind].get(key, 0) + value
+      elif kind in ('conns_on_corp', 'conns_off_corp'):
+        summary[kind] += value
+      else:
+        for days in ACTIVE_DAY_COUNTS:
+          if age >= days:
+            continue
+          if kind == 'track':
+            if key in summary['tracks']:
+              track_count = summary['tracks'][key].get(days, 0)
+              summary['tracks'][key][days] = track_count + value
+          elif kind in summary:
+            summary[kind][days] += value
+
+  return _FinishSummary(summary, summary['active'][max(ACTIVE_DAY_COUNTS)])
 
 
 def GetPercentage(number, total):
@@ -129,8 +129,8 @@ class UploadPackage(
     blobstore_key = str(blob_info.key())
 
     # Obtain a lock on the PackageInfo entity for this package.
-    lock = 'pkgsinfo_%s' % blob_info.filename
-    if not gae_util.ObtainLock(lock, timeout=5.0):
+    lock = gae_util.Lock('pkgsinfo', blob_info.filename)
+    if not lock.Acquire(timeout=5.0):
       gae_util.SafeBlobDel(blobstore_key)
       self.redirect(
           '/admin/uploadpkg?mode=error&msg=PackageInfo is locked')
@@ -138,7 +138,7 @@ class UploadPackage(
 
     p = models.PackageInfo.get_by_key_name(blob_info.filename)
     if not p:
-      gae_util.ReleaseLock(lock)
+      lock.Release()
       gae_util.SafeBlobDel(blobstore_key)
       self.redirect(
           '/admin/uploadpkg?mode=error&msg=PackageInfo not found')
@@ -146,7 +146,7 @@ class UploadPackage(
 
 
     if not p.IsSafeToModify():
-      gae_util.ReleaseLock(lock)
+      lock.Release()
       gae_util.SafeBlobDel(blobstore_key)
       self.redirect(
           '/admin/uploadpkg?mode=error&msg=PackageInfo is not modifiable')
@@ -155,7 +155,7 @@ class UploadPackage(
     installer_item_size = p.plist['installer_item_size']
     size_difference = int(blob_info.size / 1024) - installer_item_size
     if abs(size_difference) > 1:
-      gae_util.ReleaseLock(lock)
+      lock.Release()
       gae_util.SafeBlobDel(blobstore_key)
       msg = 'Blob size (%s) does not match PackageInfo plist size (%s)' % (
           blob_info.size, installer_item_size)
@@ -181,7 +181,7 @@ class UploadPackage(
     # an orphan.
     if error is not None:
       gae_util.SafeBlobDel(blobstore_key)
-      gae_util.ReleaseLock(lock)
+      lock.Release()
       self.redirect('/admin/uploadpkg?mode=error&msg=%s' % error)
       return
 
@@ -190,7 +190,7 @@ class UploadPackage(
     if old_blobstore_key:
       gae_util.SafeBlobDel(old_blobstore_key)
 
-    gae_util.ReleaseLock(lock)
+    lock.Release()
 
     user = users.get_current_user().email()
     # Log admin upload to Datastore.
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""Fleet metrics API URL handlers."""
+
+
+
+import datetime
+import json
+import logging
+import webapp2
+
+from simian import settings
+from simian.mac import models
+
+API_INFO_KEY = settings.API_INFO_KEY
+
+DEFAULT_DAYS = 90
+DEFAULT_MAX_POINTS = 180
+
+
+def Downsample(points, max_points):
+  """Averages runs of consecutive points down to at most max_points.
+
+  Args:
+    points: list of (str date, int or float value) tuples, sorted by date.
+    max_points: int, maximum number of points to return.
+  Returns:
+    list of (str date of the first point in the run, float average) tuples,
+    or points if there are no more than max_points.
+  """
+  if len(points) <= max_points:
+    return points
+  run = -(-len(points) // max_points)  # ceil of the division.
+  output = []
+  for i in xrange(0, len(points), run):
+    values = [value for unused_date, value in points[i:i + run]]
+    output.append((points[i][0], round(float(sum(values)) / len(values), 2)))
+  return output
+
+
+class FleetMetrics(webapp2.RequestHandler):
+  """Handler for /api/fleet_metrics/
+
+  Query parameters:
+    metric: str metric name, i.e. active_30d or os_version:10.7.4; may be
+      repeated.
+    start: str date like 2012-01-01, default DEFAULT_DAYS ago.
+    end: str date like 2012-03-31, default today.
+    points: int, maximum points per metric, default DEFAULT_MAX_POINTS.
+  """
+
+  def get(self):
+    key = self.request.get('key')
+
+    if not API_INFO_KEY:
+      logging.warning('API_INFO_KEY is unset; blocking all API info requests.')
+      self.response.set_status(401)
+      return
+    elif key != API_INFO_KEY:
+      self.response.set_status(401)
+      return
+
+    metrics = self.request.get_all('metric')
+    end = self.request.get('end')
+    start = self.request.get('start')
+    try:
+      if end:
+        end = datetime.datetime.strptime(
+            end, models.FleetMetric.DATE_FORMAT).date()
+      else:
+        end = datetime.datetime.utcnow().date()
+      if start:
+        start = datetime.datetime.strptime(
+            start, models.FleetMetric.DATE_FORMAT).date()
+      else:
+        start = end - datetime.timedelta(days=DEFAULT_DAYS - 1)
+      max_points = int(self.request.get('points', DEFAULT_MAX_POINTS))
+    except ValueError:
+      self.response.set_status(400)
+      return
+    if not metrics or start > end or max_points < 1:
+      self.response.set_status(400)
+      return
+
+    output = {}
+    for metric in metrics:
+      output[metric] = Downsample(
+          models.FleetMetric.GetRange(metric, start, end), max_points)
+
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps(output))
@@ -23,6 +23,7 @@ import webapp2
 
 from simian import settings
 from simian.mac.api import dynamic_manifest
+from simian.mac.api import fleet_metrics
 from simian.mac.api import info
 from simian.mac.api import packages
 
@@ -41,6 +42,7 @@ app = webapp2.WSGIApplication([
      dynamic_manifest.DynamicManifest),
     (r'/api/dynamic_manifest/([^/]+)/([^/]+)/([^/]+)/?',
      dynamic_manifest.DynamicManifest),
+    (r'/api/fleet_metrics/?', fleet_metrics.FleetMetrics),
     (r'/api/info/?', info.InfoHandler),
     (r'/api/info/([^/]+)/?', info.InfoHandler),
     (r'/api/packages/?', packages.PackageInfo),
@@ -31,6 +31,7 @@ from simian import settings
 from simian.auth import gaeserver
 from simian.auth import base
 from simian.mac import models
+from simian.mac.common import gae_util
 from simian.mac.common import util
 
 
@@ -40,6 +41,11 @@ ACL_GROUPS = {
     'security_users': 'Security Users',
     'physical_security_users': 'Physical Security Users',
 }
+# Groups of the ACL index; ACL_GROUPS are those with read access to the UI.
+ACL_INDEX_GROUPS = ['admins', 'oauth_users'] + sorted(ACL_GROUPS)
+# Seconds between checks of the ACL index version, so group changes made on
+# another instance are seen within this many seconds.
+ACL_INDEX_SECS = 5
 
 
 class Error(Exception):
@@ -62,7 +68,8 @@ def _GetGroupMembers(group_name):
   Returns:
     List of email addresses of members, or an empty list for unknown groups.
   """
-  members = getattr(settings, group_name.upper(), [])
+  # copy, as the settings list is shared between requests.
+  members = list(getattr(settings, group_name.upper(), []))
   try:
     json_members = models.KeyValueCache.MemcacheWrappedGet(
         group_name, 'text_value')
@@ -73,6 +80,56 @@ def _GetGroupMembers(group_name):
   return members
 
 
+def _BuildAclIndex():
+  """Returns the ACL index of all ACL_INDEX_GROUPS.
+
+  Members come from settings plus the KeyValueCache row of each group, which
+  are all fetched at once from Datastore. The memcache and instance tiers
+  are bypassed, so an index rebuilt after ACL_INDEX is invalidated does not
+  keep a group change that another instance has not seen yet.
+
+  Returns:
+    dict with 'roles', a dict of email address to frozenset of group names,
+    and 'groups', a frozenset of the group names that have any members.
+  """
+  try:
+    entities = models.KeyValueCache.get_by_key_name(ACL_INDEX_GROUPS)
+  except db.Error:
+    logging.exception('Error fetching ACL groups.')
+    entities = [None] * len(ACL_INDEX_GROUPS)
+  json_groups = [e.text_value if e else None for e in entities]
+
+  roles = {}
+  for group_name, json_members in zip(ACL_INDEX_GROUPS, json_groups):
+    members = list(getattr(settings, group_name.upper(), []))
+    if json_members:
+      try:
+        members.extend(util.Deserialize(json_members))
+      except util.DeserializeError:
+        logging.warning('Invalid ACL group: %s', group_name)
+    for email in members:
+      roles.setdefault(email, set()).add(group_name)
+
+  return {
+      'roles': dict((e, frozenset(r)) for e, r in roles.iteritems()),
+      'groups': frozenset().union(*roles.values()),
+  }
+
+
+ACL_INDEX = gae_util.InstanceSnapshot(
+    'acl_index', _BuildAclIndex, ttl=ACL_INDEX_SECS)
+
+
+def _GetAclIndex():
+  """Returns the ACL index; see _BuildAclIndex()."""
+  return ACL_INDEX.Get()
+
+
+def GetRoles(email):
+  """Returns a frozenset of the ACL_INDEX_GROUPS email is a member of."""
+  return _GetAclIndex()['roles'].get(email, frozenset())
+
+
 def DoUserAuth(is_admin=None):
   """Verify user auth has occured.
 
@@ -95,13 +152,7 @@ def DoUserAuth(is_admin=None):
   if settings.ALLOW_ALL_DOMAIN_USERS_READ_ACCESS:
     return user
 
-  if IsAdminUser(email):
-    return user
-  elif IsSupportUser(email):
-    return user
-  elif IsSecurityUser(email):
-    return user
-  elif IsPhysicalSecurityUser(email):
+  if IsAdminUser(email) or GetRoles(email).intersection(ACL_GROUPS):
     return user
   else:
     raise NotAuthenticated
@@ -131,7 +182,7 @@ def DoOAuthAuth(is_admin=None, require_level=None):
   if is_admin is not None and not IsAdminUser(email):
     raise IsAdminMismatch
 
-  if email in _GetGroupMembers('oauth_users'):
+  if 'oauth_users' in GetRoles(email):
     return user
 
   logging.warning('OAuth user unknown: %s', email)
@@ -191,6 +242,8 @@ def IsGroupMember(email=None, group_name=None, remote_group_lookup=False):
   if not email:
     email = users.get_current_user().email()
 
+  if group_name in ACL_INDEX_GROUPS:
+    return group_name in GetRoles(email)
 
   if email in _GetGroupMembers(group_name):
     return True
@@ -210,13 +263,13 @@ def IsAdminUser(email=None):
   if not email:
     email = users.get_current_user().email()
 
-  admin_users = _GetGroupMembers('admins')
-  if email in admin_users:
+  acl_index = _GetAclIndex()
+  if 'admins' in acl_index['roles'].get(email, ()):
     return True
 
   # If there are no defined admins in settings or KeyValueCache, provide GAE
   # Developers/etc. admin access for bootstrapping purposes.
-  if not admin_users:
+  if 'admins' not in acl_index['groups']:
     logging.warning(
         'No admins defined! Configure admins in Admin Tools -> ACL Groups.')
     return users.is_current_user_admin()
@@ -25,8 +25,106 @@ import zlib
 
 MAGIC = '!@#zlib'
 MAGIC_LEN = len(MAGIC)
+# Dictionary compressed output is DICT_MAGIC + chr(dictionary id) + zlib data.
+DICT_MAGIC = '!@#zdic'
+DICT_MAGIC_LEN = len(DICT_MAGIC)
 INTERNAL_ENCODING = 'utf-8'
 COMPRESSION_THRESHOLD = 665600  # 650K
+# Shortest text compressed when a dictionary is used.
+DICTIONARY_COMPRESSION_THRESHOLD = 64
+
+# Preset dictionaries of text common to the documents compressed with them,
+# by int id. Compressed values reference their dictionary id, so never change
+# or remove a dictionary in use; to rotate, add one with a new id and point
+# users, like PLIST_DICTIONARY_ID, at it. Strings at the end of a dictionary
+# are the cheapest to reference, so the most common go last.
+_PLIST_KEYS_V1 = [
+    'preinstall_script', 'postinstall_script', 'uninstall_script',
+    'blocking_applications', 'supported_architectures', 'x86_64', 'i386',
+    'requires', 'update_for', 'forced_install', 'forced_uninstall',
+    'RestartAction', 'RequireRestart', 'RequireLogout', 'uninstallable',
+    'uninstall_method', 'removepackages', 'autoremove', 'maximum_os_version',
+    'minimum_os_version', 'CFBundleName', 'CFBundleVersion',
+    'CFBundleShortVersionString', 'CFBundleIdentifier',
+    'version_comparison_key',
+    'md5checksum', 'application', 'bundle', 'file', 'path', 'type', 'installs',
+    'installed_size', 'installer_item_size', 'installer_item_hash',
+    'installer_item_location', 'installer_type', 'unattended_install',
+    'unattended_uninstall', 'packageid', 'receipts', 'display_name',
+    'description', 'catalogs', 'name', 'version', 'ServerMetadataURL',
+    'MetadataURL', 'Distributions', 'English', 'Packages', 'PostDate', 'Size',
+    'URL', 'Digest', 'Products', 'CatalogVersion', 'ApplePostURL', 'IndexDate',
+    'managed_installs', 'managed_uninstalls', 'managed_updates',
+    'optional_installs', 'included_manifests', 'stable', 'testing', 'unstable',
+]
+PLIST_DICTIONARY_V1 = ''.join(
+    ['<?xml version="1.0" encoding="UTF-8"?>\n'
+     '<!DOCTYPE plist PUBLIC "-//Apple Computer//DTD PLIST 1.0//EN" '
+     '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+     '<plist version="1.0">\n</plist>\n<data>\n</data>\n<date></date>\n'
+     '<real></real>\n<integer></integer>\n<false/>\n<true/>\n'
+     '<array>\n</array>\n<dict>\n</dict>\n'] +
+    ['    <key>%s</key>\n' % key for key in _PLIST_KEYS_V1] +
+    ['      <string>com.apple.pkg.</string>\n      <string></string>\n'])
+DICTIONARIES = {
+    1: PLIST_DICTIONARY_V1,
+}
+PLIST_DICTIONARY_ID = 1
+
+# dictionary id: (compressor, decompressor) already fed the dictionary.
+_primed = {}
+
+
+class Error(Exception):
+  """Base error."""
+
+
+class UnknownDictionaryError(Error):
+  """Compressed data references a dictionary that does not exist."""
+
+
+def _GetPrimed(dictionary_id):
+  """Returns a zlib (compressor, decompressor) primed with a dictionary.
+
+  Python 2 zlib has no preset dictionary support, so a stream is started with
+  the dictionary and flushed to a byte boundary instead; data compressed by a
+  copy of the compressor after that point can refer back into the dictionary,
+  and is decompressed by a copy of a decompressor fed the same start.
+
+  Args:
+    dictionary_id: int, key of DICTIONARIES.
+  Returns:
+    tuple of zlib compress and decompress objects, to copy() before use.
+  Raises:
+    UnknownDictionaryError: dictionary_id is not in DICTIONARIES.
+  """
+  primed = _primed.get(dictionary_id)
+  if primed is None:
+    if dictionary_id not in DICTIONARIES:
+      raise UnknownDictionaryError(dictionary_id)
+    compressor = zlib.compressobj(6)
+    start = compressor.compress(DICTIONARIES[dictionary_id])
+    start += compressor.flush(zlib.Z_SYNC_FLUSH)
+    decompressor = zlib.decompressobj()
+    decompressor.decompress(start)
+    primed = _primed[dictionary_id] = (compressor, decompressor)
+  return primed
+
+
+def DictionaryCompress(data, dictionary_id):
+  """Returns DICT_MAGIC + id + zlib output of data, using a dictionary."""
+  compressor = _GetPrimed(dictionary_id)[0].copy()
+  return '%s%s%s%s' % (
+      DICT_MAGIC, chr(dictionary_id), compressor.compress(data),
+      compressor.flush())
+
+
+def DictionaryDecompress(data):
+  """Returns the data of DictionaryCompress() output."""
+  dictionary_id = ord(data[DICT_MAGIC_LEN])
+  decompressor = _GetPrimed(dictionary_id)[1].copy()
+  return (decompressor.decompress(data[DICT_MAGIC_LEN + 1:]) +
+          decompressor.flush())
 
 
 class CompressedText(object):
@@ -37,15 +135,22 @@ class CompressedText(object):
   MAGIC + ZLIB COMPRESSED OUTPUT
 
   But only if len(text) > COMPRESSION_THRESHOLD
+
+  Or, with a dictionary_id, for any text of at least
+  DICTIONARY_COMPRESSION_THRESHOLD that compression makes smaller:
+
+  DICT_MAGIC + DICTIONARY ID BYTE + ZLIB COMPRESSED OUTPUT
   """
 
   def __init__(
       self, arg=None,
-      encoding=None, compression_threshold=COMPRESSION_THRESHOLD):
+      encoding=None, compression_threshold=COMPRESSION_THRESHOLD,
+      dictionary_id=None):
     self.MAGIC = MAGIC
     self.MAGIC_LEN = MAGIC_LEN
     self.INTERNAL_ENCODING = INTERNAL_ENCODING
     self.COMPRESSION_THRESHOLD = compression_threshold
+    self.DICTIONARY_ID = dictionary_id
 
     if arg is None:
       arg = ''
@@ -53,7 +158,7 @@ class CompressedText(object):
 
   def _IsCompressed(self, data):
     """Returns true if data is already compressed."""
-    return data.startswith(self.MAGIC)
+    return data.startswith(self.MAGIC) or data.startswith(DICT_MAGIC)
 
   def _Compress(self, data):
     """Returns MAGIC + zlib compressed output for data.
@@ -64,12 +169,24 @@ class CompressedText(object):
     If data is fewer bytes than COMPRESSION_THRESHOLD, returns the data
     variable unchanged.
 
+    With a DICTIONARY_ID, data is compressed with that dictionary instead,
+    unless it is fewer bytes than DICTIONARY_COMPRESSION_THRESHOLD or would
+    not get smaller.
+
     Args:
       data: str, data to compress
     Returns:
       str of compressed data
     """
-    if self._IsCompressed(data) or len(data) < self.COMPRESSION_THRESHOLD:
+    if self._IsCompressed(data):
+      return data
+    elif self.DICTIONARY_ID is not None:
+      if len(data) >= DICTIONARY_COMPRESSION_THRESHOLD:
+        compressed = DictionaryCompress(data, self.DICTIONARY_ID)
+        if len(compressed) < len(data):
+          return compressed
+      return data
+    elif len(data) < self.COMPRESSION_THRESHOLD:
       return data
     else:
       return '%s%s' % (self.MAGIC, zlib.compress(data))
@@ -84,7 +201,9 @@ class CompressedText(object):
     Returns:
       str of decompressed data
     """
-    if self._IsCompressed(data):
+    if data.startswith(DICT_MAGIC):
+      return DictionaryDecompress(data)
+    elif self._IsCompressed(data):
       return zlib.decompress(data[self.MAGIC_LEN:])
     else:
       return data
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""Columnar snapshots of all Computers, for reports reading a few properties.
+
+A snapshot is a Blobstore blob of row groups, each a length prefixed, zlib
+compressed, serialized dict of column name: list of values for up to
+ROW_GROUP_SIZE Computers. Build() writes a new snapshot in deferred batches;
+Load() returns the latest one as a Snapshot of parallel column arrays.
+
+Appends to a Files API file cannot be read back until it is finalized, so
+Build() checkpoints its cursor and the number of row groups written before
+each append. A retried task continues from the checkpoint; each row group
+carries its index, so Parse() skips one written twice when an append
+succeeded but its task failed before the next checkpoint.
+"""
+
+
+
+import array
+import calendar
+import csv
+import datetime
+import logging
+import struct
+import time
+import zlib
+
+from google.appengine.api import files
+from google.appengine.ext import blobstore
+from google.appengine.ext import deferred
+
+from simian.mac import models
+from simian.mac.common import gae_util
+from simian.mac.common import util
+
+
+MAGIC = 'fleet_snapshot_1\n'
+LENGTH_FORMAT = '>I'
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+ROW_GROUP_SIZE = 1000
+# Seconds a Build() task runs before continuing in a new task.
+RUNTIME_MAX_SECS = 300
+LOCK_KIND = 'fleet_snapshot_build'
+# Seconds a build holds its lock unless it extends it; longer than its tasks
+# wait between each other in the queue.
+LOCK_SECS = 3600
+BLOB_KEY_NAME = 'fleet_snapshot_blob_key'
+CHECKPOINT_NAME = 'fleet_snapshot_checkpoint'
+# row group key of the int index of the row group in its snapshot.
+INDEX_KEY = 'index'
+
+STR_COLUMNS = (
+    'uuid', 'hostname', 'serial', 'owner', 'track', 'site', 'office',
+    'os_version', 'client_version')
+# int columns, with epoch seconds for datetimes; None is stored as 0.
+INT_COLUMNS = (
+    'preflight_epoch', 'postflight_epoch', 'connections_on_corp',
+    'connections_off_corp')
+BOOL_COLUMNS = ('active', 'all_pkgs_installed', 'all_apple_updates_installed')
+COLUMNS = STR_COLUMNS + INT_COLUMNS + BOOL_COLUMNS
+DATETIME_COLUMNS = {
+    'preflight_epoch': 'preflight_datetime',
+    'postflight_epoch': 'postflight_datetime',
+}
+
+_cache = {}  # blob key: Snapshot, of the last snapshot loaded.
+
+
+def _ToEpoch(dt):
+  """Returns int epoch seconds of a UTC datetime, or 0 for None."""
+  if dt is None:
+    return 0
+  return calendar.timegm(dt.utctimetuple())
+
+
+def _FromEpoch(epoch):
+  """Returns a UTC datetime of epoch seconds, or None for 0."""
+  if not epoch:
+    return None
+  return datetime.datetime.utcfromtimestamp(epoch)
+
+
+def GetRowGroup(computers, index=None):
+  """Returns the str row group of a list of Computer entities.
+
+  Args:
+    computers: list of Computer entities.
+    index: int, optional, index of the row group in its snapshot.
+  Returns:
+    str row group.
+  """
+  columns = dict((name, []) for name in COLUMNS)
+  columns[INDEX_KEY] = index
+  for c in computers:
+    for name in STR_COLUMNS:
+      columns[name].append(getattr(c, name))
+    for name, dt_name in DATETIME_COLUMNS.iteritems():
+      columns[name].append(_ToEpoch(getattr(c, dt_name)))
+    columns['connections_on_corp'].append(c.connections_on_corp or 0)
+    columns['connections_off_corp'].append(c.connections_off_corp or 0)
+    for name in BOOL_COLUMNS:
+      columns[name].append(bool(getattr(c, name, False)))
+  data = zlib.compress(util.Serialize(columns))
+  return struct.pack(LENGTH_FORMAT, len(data)) + data
+
+
+class SnapshotComputer(object):
+  """Computer-like row of a Snapshot, i.e. for summary.GetComputerSummary()."""
+
+  def __init__(self, **kwargs):
+    for name, value in kwargs.iteritems():
+      setattr(self, name, value)
+    for name, dt_name in DATETIME_COLUMNS.iteritems():
+      setattr(self, dt_name, _FromEpoch(kwargs[name]))
+
+
+class Snapshot(object):
+  """Computer properties as parallel columns; row i is one Computer."""
+
+  def __init__(self, mtime=None):
+    self.mtime = mtime
+    self.columns = {}
+    for name in STR_COLUMNS:
+      self.columns[name] = []
+    for name in INT_COLUMNS:
+      self.columns[name] = array.array('l')
+    for name in BOOL_COLUMNS:
+      self.columns[name] = array.array('b')
+
+  def __len__(self):
+    return len(self.columns['uuid'])
+
+  def AddRowGroup(self, columns):
+    """Appends a deserialized row group to the columns."""
+    for name in COLUMNS:
+      self.columns[name].extend(columns[name])
+
+  @classmethod
+  def Parse(cls, data, mtime=None):
+    """Returns a Snapshot of str snapshot data.
+
+    Raises:
+      ValueError: data is not a snapshot.
+    """
+    if not data.startswith(MAGIC):
+      raise ValueError('not a fleet snapshot')
+    snapshot = cls(mtime=mtime)
+    indexes = set()
+    i = len(MAGIC)
+    while i < len(data):
+      length = struct.unpack(LENGTH_FORMAT, data[i:i + LENGTH_SIZE])[0]
+      i += LENGTH_SIZE
+      columns = util.Deserialize(zlib.decompress(data[i:i + length]))
+      i += length
+      index = columns.get(INDEX_KEY)
+      if index is not None:
+        if index in indexes:
+          continue  # written again by a retried Build() task.
+        indexes.add(index)
+      snapshot.AddRowGroup(columns)
+    return snapshot
+
+  def Filter(self, rows=None, **filters):
+    """Returns indexes of rows with column values matching all filters.
+
+    Args:
+      rows: list of int row indexes, optional, to filter; default all rows.
+      **filters: column name: value to equal, or function returning True
+        for values to keep, i.e. preflight_epoch=lambda e: e > since.
+    Returns:
+      list of int row indexes.
+    """
+    if rows is None:
+      rows = xrange(len(self))
+    for name, value in filters.iteritems():
+      column = self.columns[name]
+      if callable(value):
+        rows = [i for i in rows if value(column[i])]
+      else:
+        rows = [i for i in rows if column[i] == value]
+    return list(rows)
+
+  def Count(self, name, rows=None):
+    """Returns a dict of column value: number of rows, i.e. a histogram."""
+    column = self.columns[name]
+    if rows is None:
+      rows = xrange(len(self))
+    counts = {}
+    for i in rows:
+      counts[column[i]] = counts.get(column[i], 0) + 1
+    return counts
+
+  def Sum(self, name, rows=None):
+    """Returns the sum of an int or bool column over rows."""
+    column = self.columns[name]
+    if rows is None:
+      return sum(column)
+    return sum(column[i] for i in rows)
+
+  def GetComputers(self, rows=None):
+    """Returns a list of SnapshotComputer of rows, default all rows."""
+    if rows is None:
+      rows = xrange(len(self))
+    return [
+        SnapshotComputer(**dict(
+            (name, self.columns[name][i]) for name in COLUMNS))
+        for i in rows]
+
+  def WriteCsv(self, f, rows=None, columns=COLUMNS):
+    """Writes rows as CSV with a header, i.e. for exports.
+
+    Args:
+      f: file-like object to write to.
+      rows: list of int row indexes, optional, default all rows.
+      columns: sequence of column names, optional, default all columns.
+    """
+    writer = csv.writer(f)
+    writer.writerow(columns)
+    if rows is None:
+      rows = xrange(len(self))
+    for i in rows:
+      row = []
+      for name in columns:
+        value = self.columns[name][i]
+        if isinstance(value, unicode):
+          value = value.encode('utf-8')
+        row.append(value)
+      writer.writerow(row)
+
+
+def Load():
+  """Returns the latest Snapshot, or None if none was built yet."""
+  blob_key, mtime = models.KeyValueCache.GetItem(BLOB_KEY_NAME)
+  if not blob_key:
+    return None
+  if blob_key not in _cache:
+    data = blobstore.BlobReader(blob_key).read()
+    _cache.clear()
+    _cache[blob_key] = Snapshot.Parse(data, mtime=mtime)
+  return _cache[blob_key]
+
+
+def _GetCheckpoint(filename):
+  """Returns a tuple (str cursor, int row groups) of a build, or None."""
+  # read from Datastore, not memcache, as a stale checkpoint loses rows.
+  entity = models.KeyValueCache.get_by_key_name(CHECKPOINT_NAME)
+  if not entity or not entity.text_value:
+    return None
+  checkpoint = util.Deserialize(entity.text_value)
+  if checkpoint['filename'] != filename:
+    return None
+  return checkpoint['cursor'], checkpoint['groups']
+
+
+def _SetCheckpoint(filename, cursor, groups):
+  """Stores the cursor of a build and the number of row groups before it."""
+  checkpoint = {'filename': filename, 'cursor': cursor, 'groups': groups}
+  models.KeyValueCache(
+      key_name=CHECKPOINT_NAME, text_value=util.Serialize(checkpoint)).put()
+
+
+def Build(filename=None, cursor=None, lock_token=None, groups=0):
+  """Builds a new snapshot of all Computers, continuing in new tasks.
+
+  Args:
+    filename: str, Files API file being written, or None to start a build.
+    cursor: str, Computer query cursor to continue from.
+    lock_token: str, owner token of the lock of the build being continued.
+    groups: int, number of row groups written before cursor.
+  """
+  lock = gae_util.Lock(LOCK_KIND, ttl=LOCK_SECS, token=lock_token)
+  start = filename is None
+  if start:
+    if not lock.Acquire():
+      logging.warning('Fleet snapshot build is running; exiting.')
+      return
+  try:
+    if start:
+      filename = files.blobstore.create(
+          mime_type='application/octet-stream',
+          _blobinfo_uploaded_filename='fleet_snapshot')
+      with files.open(filename, 'a') as f:
+        f.write(MAGIC)
+    else:
+      # a retried task continues from where it failed.
+      checkpoint = _GetCheckpoint(filename)
+      if checkpoint:
+        cursor, groups = checkpoint
+    _Build(lock, filename, cursor, groups)
+  except:
+    # the cron request starting a build is not retried, so do not keep
+    # the next build waiting for the lock to expire.
+    if start:
+      lock.Release()
+    raise
+
+
+def _Build(lock, filename, cursor, groups):
+  """Writes row groups of a build, see Build()."""
+  begin = time.time()
+  while True:
+    query = models.Computer.all()
+    if cursor:
+      query.with_cursor(cursor)
+    computers = query.fetch(ROW_GROUP_SIZE)
+    # a build whose lock expired may have been replaced by a new build.
+    if not lock.Extend():
+      logging.warning('Fleet snapshot build lost its lock; exiting.')
+      return
+    if computers:
+      _SetCheckpoint(filename, cursor, groups)
+      with files.open(filename, 'a') as f:
+        f.write(GetRowGroup(computers, groups))
+      groups += 1
+    if len(computers) < ROW_GROUP_SIZE:
+      break
+    cursor = str(query.cursor())
+    if time.time() - begin > RUNTIME_MAX_SECS:
+      deferred.defer(
+          Build, filename=filename, cursor=cursor, lock_token=lock.token,
+          groups=groups)
+      return
+
+  files.finalize(filename)
+  blob_key = files.blobstore.get_blob_key(filename)
+  old_blob_key, unused_mtime = models.KeyValueCache.GetItem(BLOB_KEY_NAME)
+  models.KeyValueCache.SetItem(BLOB_KEY_NAME, str(blob_key))
+  if old_blob_key:
+    gae_util.SafeBlobDel(old_blob_key)
+  lock.Release()
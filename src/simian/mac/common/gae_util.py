@@ -20,15 +20,50 @@
 
 
 
+import collections
 import logging
+import math
+import random
 import time
+import uuid
 
 from google.appengine.api import memcache
 from google.appengine.ext import blobstore
 from google.appengine.ext import db
 
+from simian.mac.common import instrumentation
+
 
 LOCK_NAME = 'lock_%s'
+LOCK_QUEUE_NAME = 'lock_queue_%s'
+# Value of a lock released by its owner.
+LOCK_RELEASED = ''
+# Seconds a lock is held unless released or extended.
+LOCK_SECS = 60
+# Seconds a lock is held by an offline task, which may run for 10 minutes.
+LOCK_TASK_SECS = 600
+# Seconds a waiter keeps the head of the queue without polling the lock.
+LOCK_QUEUE_SECS = 3
+LOCK_BACKOFF_MIN_SECS = 0.05
+LOCK_BACKOFF_MAX_SECS = 0.8
+SNAPSHOT_GENERATION_NAME = 'snapshot_gen_%s'
+SNAPSHOT_SECS = 30
+INSTANCE_CACHE_GENERATION_NAME = 'instance_cache_gen_%s'
+LEASE_NAME = 'lease_%s'
+# Seconds a cache refill lease is held before another caller may refill.
+LEASE_SECS = 10
+# Seconds callers without a stale copy wait on another caller's refill.
+LEASE_WAIT_SECS = 1
+LEASE_POLL_SECS = 0.05
+# Seconds cached values stay in memcache after they are due for a refill, so
+# that a stale copy can be served while one caller refills them.
+STALE_SECS = 60
+# Weight of the early refresh; higher values refresh earlier.
+EARLY_REFRESH_BETA = 1.0
+CACHE_VALUE_TAG = 'lcv1'
+# Results fetched per Datastore RPC by QueryIterator; smaller than its step,
+# so that later batches are fetched while earlier ones are processed.
+QUERY_BATCH_SIZE = 100
 
 
 def BatchDatastoreOp(op, entities_or_keys, batch_size=25):
@@ -92,60 +127,448 @@ def GetBlobAndDel(blobstore_key):
 class QueryIterator(object):
   """Class to assist with iterating over big App Engine Datastore queries.
 
+  The query is run in segments of step results, each resumed from the cursor
+  of the last, to avoid 30s query limitations. Each segment is run with
+  query.run(), which fetches its next batch of batch_size results
+  asynchronously as soon as a batch is handed out, so Datastore RPCs overlap
+  the caller processing the results before them. Keys-only queries are
+  supported too.
+
+  With a time_budget, iteration stops once that many seconds have passed;
+  cursor is then a str cursor to resume from with a new QueryIterator, or
+  None once all results were returned.
+
   NOTE: this class is not compatible with queries using filters with IN or !=.
   """
 
-  def __init__(self, query, step=1000):
+  def __init__(self, query, step=1000, batch_size=QUERY_BATCH_SIZE,
+               time_budget=None, cursor=None):
+    """Initialize the iterator.
+
+    Args:
+      query: db.Query to iterate over.
+      step: int, results per segment of the query.
+      batch_size: int, results fetched per Datastore RPC.
+      time_budget: float, optional, seconds to iterate for.
+      cursor: str, optional, cursor to resume the query from.
+    """
     self._query = query
     self._step = step
+    self._batch_size = min(batch_size, step)
+    self._time_budget = time_budget
+    self.cursor = cursor
 
   def __iter__(self):
-    """Iterate over query results safely avoiding 30s query limitations."""
+    """Iterate over query results, until done or the time budget is spent."""
+    begin = time.time()
     while True:
-      entities = self._query.fetch(self._step)
-      if not entities:
-        raise StopIteration
-      for entity in entities:
+      if self.cursor:
+        self._query.with_cursor(self.cursor)
+      count = 0
+      for entity in self._query.run(
+          limit=self._step, batch_size=self._batch_size):
+        count += 1
         yield entity
-      self._query.with_cursor(self._query.cursor())
+        if (self._time_budget is not None and
+            time.time() - begin > self._time_budget):
+          self.cursor = str(self._query.cursor())
+          return
+      if count < self._step:
+        self.cursor = None
+        return
+      self.cursor = str(self._query.cursor())
+
+
+class InstanceSnapshot(object):
+  """Instance-local copy of a value, shared between requests on an instance.
+
+  The value is reloaded with loader() once a generation counter in memcache
+  changes. The counter is only checked every ttl seconds, so requests in
+  between cost no RPCs at all; Invalidate() bumps the counter and drops the
+  local copy, so the invalidating instance sees the change immediately and
+  all others within ttl seconds.
+  """
 
+  def __init__(self, name, loader, ttl=SNAPSHOT_SECS):
+    """Initialize the snapshot.
+
+    Args:
+      name: str, unique name of the snapshot.
+      loader: func, returns the current value; called without arguments.
+      ttl: int, seconds between generation counter checks.
+    """
+    self._memcache_key = SNAPSHOT_GENERATION_NAME % name
+    self._loader = loader
+    self._ttl = ttl
+    self._value = None
+    self._generation = None
+    self._expires = 0
+
+  def _GetGeneration(self):
+    """Returns the current generation counter, creating it if missing."""
+    generation = memcache.get(self._memcache_key)
+    if generation is None:
+      # seed with the time so an evicted counter does not restart at a
+      # generation some instance still holds.
+      generation = int(time.time())
+      if not memcache.add(self._memcache_key, generation):
+        generation = memcache.get(self._memcache_key)
+    return generation
+
+  def Get(self):
+    """Returns the value, reloading it if the generation changed."""
+    now = time.time()
+    if now < self._expires:
+      return self._value
+    generation = self._GetGeneration()
+    if generation is None or generation != self._generation:
+      self._value = self._loader()
+      self._generation = generation
+    self._expires = now + self._ttl
+    return self._value
+
+  def Invalidate(self):
+    """Drops the value on all instances after it has changed."""
+    memcache.incr(self._memcache_key, initial_value=int(time.time()))
+    self._value = None
+    self._generation = None
+    self._expires = 0
+
+
+class InstanceCache(object):
+  """Instance-local LRU cache of values, in front of memcache.
+
+  Values are kept per namespace, e.g. a model kind, each with its own byte
+  budget and entry ttl, and are shared between requests on an instance, so
+  they must not be modified by callers. A generation counter per namespace in
+  memcache is checked at most every GENERATION_CHECK_SECS; Invalidate() bumps
+  it and drops the namespace locally, so the invalidating instance sees a
+  change immediately and all others within GENERATION_CHECK_SECS.
+  """
 
+  GENERATION_CHECK_SECS = 5
+
+  def __init__(self):
+    self._namespaces = {}
+
+  def _NewNamespace(self, hits=0, misses=0):
+    """Returns the state dict of an empty namespace."""
+    return {
+        'entries': collections.OrderedDict(), 'bytes': 0, 'generation': None,
+        'checked': 0, 'hits': hits, 'misses': misses,
+    }
+
+  def _GetNamespace(self, namespace, now):
+    """Returns the state dict of a namespace, dropped if its generation moved.
+
+    Args:
+      namespace: str, namespace name.
+      now: float, current time.
+    Returns:
+      dict with entries, bytes, generation, checked, hits and misses.
+    """
+    ns = self._namespaces.get(namespace)
+    if ns is None:
+      ns = self._namespaces[namespace] = self._NewNamespace()
+    if now - ns['checked'] >= self.GENERATION_CHECK_SECS:
+      generation = memcache.get(INSTANCE_CACHE_GENERATION_NAME % namespace)
+      if generation != ns['generation']:
+        ns['entries'].clear()
+        ns['bytes'] = 0
+        ns['generation'] = generation
+      ns['checked'] = now
+    return ns
+
+  def Get(self, namespace, key):
+    """Returns a cached value, or None if it is not cached or has expired."""
+    now = time.time()
+    ns = self._GetNamespace(namespace, now)
+    entry = ns['entries'].pop(key, None)
+    if entry is None or entry[0] <= now:
+      if entry is not None:
+        ns['bytes'] -= entry[1]
+      ns['misses'] += 1
+      return None
+    ns['entries'][key] = entry  # most recently used entries are last.
+    ns['hits'] += 1
+    return entry[2]
+
+  def Set(self, namespace, key, value, size, ttl, max_bytes):
+    """Caches a value, evicting least recently used values over max_bytes.
+
+    Args:
+      namespace: str, namespace name.
+      key: str, key of the value within the namespace.
+      value: any, value to cache; None is not cached.
+      size: int, approximate bytes of the value.
+      ttl: int, seconds to cache the value.
+      max_bytes: int, bytes of values to keep in the namespace.
+    """
+    if value is None or size > max_bytes:
+      return
+    now = time.time()
+    ns = self._GetNamespace(namespace, now)
+    old = ns['entries'].pop(key, None)
+    if old is not None:
+      ns['bytes'] -= old[1]
+    ns['entries'][key] = (now + ttl, size, value)
+    ns['bytes'] += size
+    while ns['bytes'] > max_bytes:
+      unused_key, evicted = ns['entries'].popitem(last=False)
+      ns['bytes'] -= evicted[1]
+
+  def Invalidate(self, namespace):
+    """Drops all values of a namespace on all instances after a change."""
+    memcache.incr(
+        INSTANCE_CACHE_GENERATION_NAME % namespace,
+        initial_value=int(time.time()))
+    ns = self._namespaces.get(namespace)
+    if ns is not None:
+      # keep hit ratios across invalidations.
+      self._namespaces[namespace] = self._NewNamespace(
+          hits=ns['hits'], misses=ns['misses'])
+
+  def GetStats(self):
+    """Returns a dict of namespace name to a dict of its cache statistics.
+
+    Statistics are entries, bytes, hits, misses and hit_ratio, a float from 0
+    to 1 or None before the first lookup.
+    """
+    stats = {}
+    for namespace, ns in self._namespaces.iteritems():
+      lookups = ns['hits'] + ns['misses']
+      if lookups:
+        hit_ratio = float(ns['hits']) / lookups
+      else:
+        hit_ratio = None
+      stats[namespace] = {
+          'entries': len(ns['entries']), 'bytes': ns['bytes'],
+          'hits': ns['hits'], 'misses': ns['misses'],
+          'hit_ratio': hit_ratio,
+      }
+    return stats
+
+
+def WrapCacheValue(value, secs, delta=0):
+  """Wraps a value to be cached by memcache with its refresh time.
 
-def LockExists(name):
-  """Returns True if a lock with the given str name exists, False otherwise."""
-  memcache_key = LOCK_NAME % name
-  return memcache.get(memcache_key) is not None
+  Args:
+    value: any, value to cache.
+    secs: int, seconds until the value is due to be refilled.
+    delta: float, seconds it took to compute the value.
+  Returns:
+    tuple of (wrapped value, int seconds to keep it in memcache).
+  """
+  return ((CACHE_VALUE_TAG, value, time.time() + secs, delta),
+          secs + STALE_SECS)
+
+
+def _UnwrapCacheValue(cached):
+  """Returns a tuple of (value, refresh time or None, delta) of a cached value.
+
+  Values not wrapped by WrapCacheValue are never due to be refilled.
+  """
+  if (isinstance(cached, tuple) and len(cached) == 4 and
+      cached[0] == CACHE_VALUE_TAG):
+    return cached[1:]
+  return cached, None, 0
+
+
+def UnwrapCacheValue(cached):
+  """Returns the value of a cached value wrapped by WrapCacheValue."""
+  return _UnwrapCacheValue(cached)[0]
 
 
-def ObtainLock(name, timeout=0):
-  """Obtain a lock, given a name.
+def LeasedCacheGet(memcache_key):
+  """Gets a value from memcache, coordinating refills between callers.
+
+  A value is refilled by one caller only, the one to take its lease: when the
+  value is missing, other callers wait up to LEASE_WAIT_SECS for the refill,
+  and when it is due for a refill they keep being served the stale copy.
+  Callers still waiting when the refill times out try to take the lease once
+  more, i.e. if its holder failed; those who do not get it read the value
+  without caching it, so a slow refill does not turn into a stampede.
+  Values are also refilled early with a probability that rises towards their
+  refresh time and with the time they took to compute, so that popular
+  values are usually refilled before they are due at all.
 
   Args:
-    name: str, name of lock
-    timeout: int, if >0, wait timeout seconds for a lock if it cannot
-      be obtained at first attempt.  NOTE:  Using a timeout near or greater
-      than the AppEngine deadline will be hazardous to your health.
-      The deadline is 30s for live http, 10m for offline tasks as of
-      this note.
+    memcache_key: str, memcache key of a value set by LeasedCacheSet.
   Returns:
-    True if lock was obtained
-    False if lock was not obtained, some other process has the lock
+    tuple of (value or None if missing, bool True if the caller holds the
+    lease, and should compute the value and LeasedCacheSet or ReleaseLease
+    it). A missing value without the lease is computed but not cached.
+  """
+  cached = memcache.get(memcache_key)
+  if cached is not None:
+    value, refresh_time, delta = _UnwrapCacheValue(cached)
+    if refresh_time is None:
+      return value, False
+    # 1 - random.random() is in (0, 1], so the log is defined.
+    early = -delta * EARLY_REFRESH_BETA * math.log(1 - random.random())
+    if time.time() + early < refresh_time:
+      return value, False
+    return value, memcache.add(LEASE_NAME % memcache_key, 1, LEASE_SECS)
+
+  if memcache.add(LEASE_NAME % memcache_key, 1, LEASE_SECS):
+    return None, True
+  deadline = time.time() + LEASE_WAIT_SECS
+  while time.time() < deadline:
+    time.sleep(LEASE_POLL_SECS)
+    cached = memcache.get(memcache_key)
+    if cached is not None:
+      return UnwrapCacheValue(cached), False
+  logging.warning('Timed out waiting on the refill of %s', memcache_key)
+  return None, memcache.add(LEASE_NAME % memcache_key, 1, LEASE_SECS)
+
+
+def LeasedCacheSet(memcache_key, value, secs, delta=0):
+  """Sets a value to memcache and releases its refill lease.
+
+  Args:
+    memcache_key: str, memcache key.
+    value: any, value to cache.
+    secs: int, seconds until the value is due to be refilled.
+    delta: float, seconds it took to compute the value.
+  Raises:
+    ValueError: the value could not be set, e.g. it is too large.
   """
+  cached, cache_secs = WrapCacheValue(value, secs, delta=delta)
+  try:
+    memcache.set(memcache_key, cached, cache_secs)
+  finally:
+    ReleaseLease(memcache_key)
+
+
+def ReleaseLease(memcache_key):
+  """Releases the refill lease of a memcache key without setting a value."""
+  memcache.delete(LEASE_NAME % memcache_key)
+
+
+
+def LockExists(name):
+  """Returns True if a lock with the given str name is held, False otherwise."""
   memcache_key = LOCK_NAME % name
-  while 1:
-    locked = memcache.incr(memcache_key, initial_value=0) == 1
-    timeout -= 1
-    if locked or timeout < 0:
-      return locked
-    time.sleep(1)
-  return False
+  return bool(memcache.get(memcache_key))
 
 
-def ReleaseLock(name):
-  """Release a lock, given its name.
+class Lock(object):
+  """Leased lock shared between instances, held by one owner at a time.
 
-  Args:
-    name: str, name of lock
+  The lock is a memcache value holding the token of its owner, set with the
+  lease ttl so that the lock of a crashed owner expires on its own. Only the
+  owner can Release() or Extend() it; both compare-and-set the value, so an
+  owner whose lease expired cannot release the lock of the next owner.
+
+  Callers waiting on the lock poll it with jittered exponential backoff. The
+  first waiter takes a slot at the head of the queue, and callers arriving
+  later do not try to take the lock while the head waiter is still polling,
+  so a busy lock is not taken over and over by newcomers.
   """
-  memcache_key = LOCK_NAME % name
-  memcache.delete(memcache_key)
\ No newline at end of file
+
+  def __init__(self, kind, key=None, ttl=LOCK_SECS, token=None):
+    """Initialize the lock.
+
+    Args:
+      kind: str, kind of lock, like 'pkgsinfo'; used to name metrics.
+      key: str, optional, what is locked within the kind, like a filename.
+      ttl: int, seconds the lease lasts unless released or extended.
+      token: str, optional, owner token of a lock acquired earlier, i.e. by
+        another task, to Extend() or Release() it.
+    """
+    self.name = kind if key is None else '%s_%s' % (kind, key)
+    self.ttl = ttl
+    self.token = token or uuid.uuid4().hex
+    self._memcache_key = LOCK_NAME % self.name
+    self._metric = 'Lock.%s.%%s' % kind
+    self._acquired = None
+
+  def _Queue(self, client, head):
+    """Takes or keeps the head of the queue, unless another waiter has it."""
+    queue_key = LOCK_QUEUE_NAME % self.name
+    if head is None:
+      client.add(queue_key, self.token, time=LOCK_QUEUE_SECS)
+    elif head == self.token:
+      client.set(queue_key, self.token, time=LOCK_QUEUE_SECS)
+
+  def _LeaveQueue(self, client):
+    """Gives up the head of the queue, if this caller holds it."""
+    queue_key = LOCK_QUEUE_NAME % self.name
+    if client.get(queue_key) == self.token:
+      client.delete(queue_key)
+
+  def _TryAcquire(self, client):
+    """Returns True if the lock was free and is now held by this caller."""
+    held = client.gets(self._memcache_key)
+    if held is None:
+      return client.add(self._memcache_key, self.token, time=self.ttl)
+    if held == LOCK_RELEASED:
+      return client.cas(self._memcache_key, self.token, time=self.ttl)
+    return False
+
+  def Acquire(self, timeout=0):
+    """Acquires the lock.
+
+    Args:
+      timeout: float, seconds to wait for the lock if it is held. NOTE: Using
+        a timeout near or greater than the AppEngine deadline will be
+        hazardous to your health.
+    Returns:
+      True if the lock was acquired, False if another owner holds it.
+    """
+    client = memcache.Client()
+    begin = time.time()
+    backoff = LOCK_BACKOFF_MIN_SECS
+    queued = False
+    while True:
+      head = client.get(LOCK_QUEUE_NAME % self.name)
+      if head in (None, self.token) and self._TryAcquire(client):
+        break
+      remaining = begin + timeout - time.time()
+      if remaining <= 0:
+        if queued:
+          self._LeaveQueue(client)
+        instrumentation.Record(self._metric % 'failed')
+        return False
+      self._Queue(client, head)
+      queued = True
+      time.sleep(min(random.uniform(0, backoff), remaining))
+      backoff = min(backoff * 2, LOCK_BACKOFF_MAX_SECS)
+
+    if queued:
+      self._LeaveQueue(client)
+    self._acquired = time.time()
+    instrumentation.Record(self._metric % 'obtained')
+    instrumentation.Record(
+        self._metric % 'wait_ms', int((self._acquired - begin) * 1000))
+    return True
+
+  def Extend(self):
+    """Renews the lease for another ttl seconds.
+
+    Returns:
+      True if the lease was renewed, False if this owner no longer holds it.
+    """
+    client = memcache.Client()
+    if client.gets(self._memcache_key) != self.token:
+      instrumentation.Record(self._metric % 'lost')
+      return False
+    return client.cas(self._memcache_key, self.token, time=self.ttl)
+
+  def Release(self):
+    """Releases the lock.
+
+    Returns:
+      True if the lock was released, False if this owner no longer held it,
+      i.e. its lease expired.
+    """
+    client = memcache.Client()
+    if client.gets(self._memcache_key) != self.token:
+      logging.warning('Lock %s expired before it was released.', self.name)
+      instrumentation.Record(self._metric % 'lost')
+      return False
+    released = client.cas(self._memcache_key, LOCK_RELEASED, time=self.ttl)
+    if released and self._acquired:
+      instrumentation.Record(
+          self._metric % 'hold_ms', int((time.time() - self._acquired) * 1000))
+    return released
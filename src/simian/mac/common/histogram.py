@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""Log-bucketed histograms of non-negative values.
+
+A histogram is a dict of str bucket number: int count, so it serializes with
+util.Serialize(). Bucket 0 holds values below 1, and bucket n holds values in
+[GROWTH ** (n - 1), GROWTH ** n). Histograms merge by adding counts, and
+percentiles are accurate to about GROWTH ** 0.5, i.e. within 12%.
+"""
+
+
+
+import math
+
+
+GROWTH = 1.25
+PERCENTILES = (50, 90, 99)
+
+
+def GetBucket(value):
+  """Returns the str bucket number of a value."""
+  if value < 1:
+    return '0'
+  return str(int(math.log(value) / math.log(GROWTH)) + 1)
+
+
+def GetBucketValue(bucket):
+  """Returns the int value representing a str bucket number."""
+  bucket = int(bucket)
+  if not bucket:
+    return 0
+  return int(round(GROWTH ** (bucket - 0.5)))
+
+
+def Add(histogram, value, count=1):
+  """Adds a value to a histogram.
+
+  Args:
+    histogram: dict histogram, to update.
+    value: int or float, non-negative value.
+    count: int, optional, number of times to add the value.
+  """
+  bucket = GetBucket(value)
+  histogram[bucket] = histogram.get(bucket, 0) + count
+
+
+def Merge(histogram, other):
+  """Adds all counts of another histogram to a histogram, and returns it."""
+  for bucket, count in other.iteritems():
+    histogram[bucket] = histogram.get(bucket, 0) + count
+  return histogram
+
+
+def GetPercentile(histogram, percentile):
+  """Returns the approximate value at a percentile of a histogram.
+
+  Args:
+    histogram: dict histogram.
+    percentile: int or float, between 0 and 100.
+  Returns:
+    int value, or None if the histogram is empty.
+  """
+  total = sum(histogram.itervalues())
+  if not total:
+    return None
+  rank = total * percentile / 100.0
+  seen = 0
+  for bucket in sorted(histogram, key=int):
+    seen += histogram[bucket]
+    if seen >= rank:
+      return GetBucketValue(bucket)
+  return GetBucketValue(max(histogram, key=int))
+
+
+def GetPercentiles(histogram, percentiles=PERCENTILES):
+  """Returns a dict of int percentile: value of a histogram."""
+  return dict((p, GetPercentile(histogram, p)) for p in percentiles)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""Lightweight counters and timers of cache and RPC work, per handler.
+
+Record() and Timer() aggregate in instance memory, keyed by the webapp2
+handler of the current request, and are flushed to memcache counters at most
+every FLUSH_SECS, so recording costs no RPCs. GetStats() returns the counters
+of all instances.
+
+Metric names are like 'MemcacheWrappedGet.miss'; each has a count of
+records and a total of recorded values, e.g. bytes or milliseconds.
+"""
+
+
+
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+import webapp2
+
+
+FLUSH_SECS = 60
+# Seconds flushed counters are kept in memcache, unless flushed again.
+MEMCACHE_SECS = 7 * 86400
+NAMES_KEY = 'instrumentation_names'
+# Attempts to add names to NAMES_KEY while other instances update it.
+NAMES_RETRIES = 5
+COUNTER_KEY = 'instrumentation_%s_%s_%s'
+NO_HANDLER = 'none'
+
+_lock = threading.Lock()
+# (handler, metric name): [count, total] recorded since the last flush.
+_pending = {}
+_next_flush = time.time() + FLUSH_SECS
+
+
+def _GetHandlerName():
+  """Returns the str name of the handler of the current request."""
+  try:
+    request = webapp2.get_request()
+  except AssertionError:
+    return NO_HANDLER
+  handler = getattr(getattr(request, 'route', None), 'handler', None)
+  if handler is None:
+    return NO_HANDLER
+  if isinstance(handler, basestring):  # lazily imported, like 'pkg.mod.Cls'.
+    return '.'.join(handler.split('.')[-2:])
+  return '%s.%s' % (handler.__module__.rsplit('.', 1)[-1], handler.__name__)
+
+
+def Record(name, value=1):
+  """Records a value of a metric for the handler of the current request.
+
+  Args:
+    name: str, metric name, like 'MemcacheWrappedGet.miss'.
+    value: int or float, value to add to the metric total.
+  """
+  global _next_flush
+  key = (_GetHandlerName(), name)
+  now = time.time()
+  with _lock:
+    metric = _pending.setdefault(key, [0, 0])
+    metric[0] += 1
+    metric[1] += value
+    if now < _next_flush:
+      return
+    _next_flush = now + FLUSH_SECS
+    pending = _pending.copy()
+    _pending.clear()
+  Flush(pending)
+
+
+class Timer(object):
+  """Context manager to Record the milliseconds its block takes."""
+
+  def __init__(self, name):
+    self.name = name
+    self.begin = None
+
+  def __enter__(self):
+    self.begin = time.time()
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    Record(self.name, int((time.time() - self.begin) * 1000))
+
+
+def Flush(pending):
+  """Adds pending metrics to the counters in memcache shared by instances.
+
+  Flushing is best effort; metrics that fail to flush are dropped.
+
+  Args:
+    pending: dict of (handler, metric name) to [count, total].
+  """
+  if not pending:
+    return
+  offsets = {}
+  for (handler, name), (count, total) in pending.iteritems():
+    offsets[COUNTER_KEY % (handler, name, 'count')] = count
+    offsets[COUNTER_KEY % (handler, name, 'total')] = int(total)
+  try:
+    memcache.offset_multi(offsets, initial_value=0)
+    _AddNames(pending)
+  except Exception:  # pylint: disable=broad-except
+    logging.exception('instrumentation.Flush failed.')
+
+
+def _AddNames(names):
+  """Adds metric names to NAMES_KEY, so that GetStats() finds them.
+
+  Instances flush concurrently, so the set is compare-and-set rather than
+  overwritten, which would drop the names another instance just added.
+
+  Args:
+    names: iterable of (handler, metric name) tuples.
+  """
+  client = memcache.Client()
+  for _ in xrange(NAMES_RETRIES):
+    known = client.gets(NAMES_KEY)
+    if known is None:
+      if client.add(NAMES_KEY, set(names), time=MEMCACHE_SECS):
+        return
+    elif known.issuperset(names):
+      return
+    elif client.cas(NAMES_KEY, known.union(names), time=MEMCACHE_SECS):
+      return
+  logging.warning('instrumentation names not added after %d attempts.',
+                  NAMES_RETRIES)
+
+
+def GetStats():
+  """Returns flushed metrics of all instances.
+
+  Returns:
+    dict of handler name to a dict of metric name to a dict with count,
+    total and avg.
+  """
+  names = memcache.get(NAMES_KEY) or set()
+  keys = []
+  for handler, name in names:
+    keys.append(COUNTER_KEY % (handler, name, 'count'))
+    keys.append(COUNTER_KEY % (handler, name, 'total'))
+  counters = memcache.get_multi(keys) if keys else {}
+
+  stats = {}
+  for handler, name in names:
+    count = counters.get(COUNTER_KEY % (handler, name, 'count'))
+    if not count:
+      continue
+    total = counters.get(COUNTER_KEY % (handler, name, 'total'), 0)
+    stats.setdefault(handler, {})[name] = {
+        'count': count, 'total': total, 'avg': float(total) / count}
+  return stats
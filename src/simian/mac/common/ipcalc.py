@@ -75,4 +75,135 @@ def IpMaskMatch(ip, ip_mask):
   """
   (ip_int_mask, ip_int_mask_bits) = IpMaskToInts(ip_mask)
   ip_int = IpToInt(ip)
-  return (ip_int & ip_int_mask_bits) == ip_int_mask
\ No newline at end of file
+  return (ip_int & ip_int_mask_bits) == ip_int_mask
+
+
+IPV4_BITS = 32
+IPV6_BITS = 128
+
+
+def Ipv6ToInt(ip):
+  """Return a integer for an IPv6 string.
+
+  Args:
+    ip: str, IPv6 address, like "2620::1003:1004:129a:ddff:fe60:fb46"
+  Returns:
+    int
+  Raises:
+    ValueError: if ip is not a valid IPv6 address.
+  """
+  if ip.count('::') > 1:
+    raise ValueError(ip)
+  head, sep, tail = ip.partition('::')
+  head = head and head.split(':') or []
+  tail = tail and tail.split(':') or []
+  groups = head + tail
+  # an embedded IPv4 address, like ::ffff:10.0.0.1, fills the last 2 groups.
+  if groups and groups[-1].find('.') > -1:
+    ipv4_int = IpToInt(groups.pop())
+    groups.extend(['%x' % (ipv4_int >> 16), '%x' % (ipv4_int & 0xffff)])
+  if sep:
+    missing = 8 - len(groups)
+    if missing < 1:
+      raise ValueError(ip)
+    groups = groups[:len(head)] + ['0'] * missing + groups[len(head):]
+  if len(groups) != 8:
+    raise ValueError(ip)
+  ip_int = 0
+  for group in groups:
+    if not 0 < len(group) <= 4:
+      raise ValueError(ip)
+    ip_int = (ip_int << 16) + int(group, 16)
+  return ip_int
+
+
+def IpToIntAndBits(ip):
+  """Return a integer and its bit length for an IPv4 or IPv6 string.
+
+  Args:
+    ip: str, IP address, like "192.168.0.1" or "2620::1003"
+  Returns:
+    (int ip, int bits), bits being IPV4_BITS or IPV6_BITS
+  Raises:
+    ValueError: if ip is not a valid IP address.
+  """
+  if ip.find(':') > -1:
+    return Ipv6ToInt(ip), IPV6_BITS
+  a = ip.split('.')
+  if len(a) != 4 or not all(i.isdigit() and int(i) < 256 for i in a):
+    raise ValueError(ip)
+  return IpToInt(ip), IPV4_BITS
+
+
+class IpPrefixTrie(object):
+  """Binary prefix trie to match IPv4 and IPv6 addresses against networks.
+
+  Each node is a list [child for bit 0, child for bit 1, is_network_end].
+  A lookup walks at most one node per prefix bit of the networks, however
+  many networks the trie holds.
+  """
+
+  def __init__(self, ip_masks=()):
+    """Initialize the trie.
+
+    Args:
+      ip_masks: sequence, optional, of str networks to Add().
+    Raises:
+      ValueError: if a network is invalid.
+    """
+    self._roots = {
+        IPV4_BITS: [None, None, False],
+        IPV6_BITS: [None, None, False],
+    }
+    for ip_mask in ip_masks:
+      self.Add(ip_mask)
+
+  def Add(self, ip_mask):
+    """Add a network to the trie.
+
+    Args:
+      ip_mask: str, network like "192.168.0.0/24" or "2620:0:1003::/48"; an
+        address without a mask is added as a single host.
+    Raises:
+      ValueError: if ip_mask is invalid.
+    """
+    net, _, prefix = ip_mask.strip().partition('/')
+    net_int, bits = IpToIntAndBits(net)
+    if not prefix:
+      prefix = bits
+    elif prefix.isdigit() and int(prefix) <= bits:
+      prefix = int(prefix)
+    else:
+      raise ValueError(ip_mask)
+
+    node = self._roots[bits]
+    for i in xrange(bits - 1, bits - 1 - prefix, -1):
+      if node[2]:
+        return  # a shorter network already covers this one.
+      bit = (net_int >> i) & 1
+      if node[bit] is None:
+        node[bit] = [None, None, False]
+      node = node[bit]
+    # this network covers any longer ones below it, so drop them.
+    node[0] = node[1] = None
+    node[2] = True
+
+  def Contains(self, ip):
+    """Check if an IP is inside any network of the trie.
+
+    Args:
+      ip: str, like "192.168.0.1" or "2620::1003"
+    Returns:
+      True or False
+    Raises:
+      ValueError: if ip is not a valid IP address.
+    """
+    ip_int, bits = IpToIntAndBits(ip)
+    node = self._roots[bits]
+    i = bits - 1
+    while node is not None:
+      if node[2]:
+        return True
+      node = node[(ip_int >> i) & 1]
+      i -= 1
+    return False
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""Retention of log kinds, which otherwise grow without bound.
+
+Each log kind has a Policy with the number of days of logs to keep and,
+optionally, counters to roll old logs up into before they are deleted. A run
+of a policy is a chain of tasks: the rollup phase counts logs older than the
+cutoff into models.LogRollup, then the delete phase deletes them with
+keys-only queries and parallel batched deletes. Run state is checkpointed
+after every batch, so a task killed by a deadline resumes from its last
+checkpoint.
+
+Start a run with Start(kind_name).
+"""
+
+
+
+import datetime
+import logging
+import time
+import zlib
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.ext.db import stats
+
+from simian.mac import models
+from simian.mac.common import gae_util
+from simian.mac.common import util
+
+
+LOCK_KIND = 'retention'
+# Seconds a run holds its lock unless it extends it; longer than its tasks
+# wait between each other in the queue.
+LOCK_SECS = 3600
+STATE_NAME = 'retention_%s'
+RUNS_NAME = 'retention_runs_%s'
+# Finished runs kept per kind for the admin UI.
+MAX_RUNS = 30
+DATE_FORMAT = '%Y-%m-%d'
+ROLLUP = 'rollup'
+DELETE = 'delete'
+ROLLUP_BATCH_SIZE = 500
+DELETE_BATCH_SIZE = 100
+# Delete batches issued in parallel per keys-only query.
+DELETE_BATCHES = 5
+# Seconds a task runs before checkpointing and continuing in a new one.
+RUNTIME_MAX_SECS = 300
+MAX_COUNTER_LENGTH = 100
+
+
+class Policy(object):
+  """Base class for the retention policy of a log kind."""
+
+  model = None  # db.Model class of the logs.
+  days = None  # int, days of logs to keep.
+  date_property = 'mtime'
+  rollup = False  # True to roll logs up with GetCounters() before deleting.
+
+  def GetCounters(self, entity):
+    """Returns a list of counter names to add 1 to for a log entity."""
+    raise NotImplementedError
+
+
+class InstallLogPolicy(Policy):
+  """InstallLogs are rolled up into models.InstallRollup as they are logged.
+
+  Note that RebuildInstallCounts only backfills from InstallLogs still kept.
+  """
+
+  model = models.InstallLog
+  days = 730
+
+
+class ClientLogPolicy(Policy):
+
+  model = models.ClientLog
+  days = 180
+  rollup = True
+
+  def GetCounters(self, entity):
+    return ['action:%s' % entity.action]
+
+
+class PreflightExitLogPolicy(Policy):
+
+  model = models.PreflightExitLog
+  days = 180
+  rollup = True
+
+  def GetCounters(self, entity):
+    return ['exit_reason:%s' % (entity.exit_reason or '')[:MAX_COUNTER_LENGTH]]
+
+
+class ComputerMSULogPolicy(Policy):
+
+  model = models.ComputerMSULog
+  days = 365
+  rollup = True
+
+  def GetCounters(self, entity):
+    return ['event:%s' % entity.event]
+
+
+class ClientLogFilePolicy(Policy):
+  """Log files are large and only useful recently, so are not rolled up."""
+
+  model = models.ClientLogFile
+  days = 30
+
+
+POLICIES = dict((p.model.kind(), p) for p in [
+    InstallLogPolicy(), ClientLogPolicy(), PreflightExitLogPolicy(),
+    ComputerMSULogPolicy(), ClientLogFilePolicy()])
+
+
+def GetState(kind_name):
+  """Returns the state dict of the current or last run of a kind, or None."""
+  entity = models.KeyValueCache.get_by_key_name(STATE_NAME % kind_name)
+  if entity and entity.blob_value:
+    return util.Deserialize(zlib.decompress(entity.blob_value))
+
+
+def _SetState(kind_name, state):
+  """Saves the state dict of a run as one compressed entity."""
+  models.KeyValueCache(
+      key_name=STATE_NAME % kind_name,
+      blob_value=db.Blob(zlib.compress(util.Serialize(state)))).put()
+
+
+def GetRuns(kind_name):
+  """Returns a list of finished run dicts of a kind, newest first."""
+  runs, unused_mtime = models.KeyValueCache.GetSerializedItem(
+      RUNS_NAME % kind_name)
+  return runs or []
+
+
+def _GetEntityBytes(kind_name):
+  """Returns the average int bytes of an entity of a kind, or None.
+
+  Datastore statistics are updated about daily, and may not exist yet.
+  """
+  stat = stats.KindStat.all().filter('kind_name =', kind_name).get()
+  if stat and stat.count:
+    return stat.bytes / stat.count
+
+
+def Start(kind_name, now=None):
+  """Starts a retention run of a kind, unless one is in progress.
+
+  Args:
+    kind_name: str, kind in POLICIES.
+    now: datetime.datetime, optional, time to count retained days from.
+  Returns:
+    str run id, or None if a run is in progress.
+  """
+  lock = gae_util.Lock(LOCK_KIND, kind_name, ttl=LOCK_SECS)
+  if not lock.Acquire():
+    logging.warning('Retention of %s is running; exiting.', kind_name)
+    return
+
+  policy = POLICIES[kind_name]
+  now = now or datetime.datetime.utcnow()
+  run = now.strftime('%Y-%m-%d-%H-%M-%S-%f')
+  cutoff = now.date() - datetime.timedelta(days=policy.days)
+  state = {
+      'run': run, 'started': now.strftime('%Y-%m-%d %H:%M'),
+      'cutoff': cutoff.strftime(DATE_FORMAT),
+      'phase': policy.rollup and ROLLUP or DELETE, 'cursor': None,
+      'counts': {}, 'rolled_up': 0, 'deleted': 0,
+      'entity_bytes': _GetEntityBytes(kind_name), 'lock': lock.token,
+  }
+  _SetState(kind_name, state)
+  deferred.defer(Run, kind_name, run)
+  return run
+
+
+def _GetQuery(policy, state, keys_only=False):
+  """Returns a query of the logs of a run older than its cutoff."""
+  cutoff = datetime.datetime.strptime(state['cutoff'], DATE_FORMAT)
+  query = policy.model.all(keys_only=keys_only)
+  query.filter('%s <' % policy.date_property, cutoff)
+  if state['cursor']:
+    query.with_cursor(state['cursor'])
+  return query
+
+
+def _RollupBatch(policy, state):
+  """Rolls up a batch of logs; returns True once all logs are rolled up."""
+  query = _GetQuery(policy, state)
+  entities = query.fetch(ROLLUP_BATCH_SIZE)
+  for entity in entities:
+    date = getattr(entity, policy.date_property).strftime(DATE_FORMAT)
+    counts = state['counts'].setdefault(date, {})
+    for name in policy.GetCounters(entity):
+      counts[name] = counts.get(name, 0) + 1
+  state['rolled_up'] += len(entities)
+  if len(entities) < ROLLUP_BATCH_SIZE:
+    return True
+  state['cursor'] = str(query.cursor())
+  return False
+
+
+def _DeleteBatch(policy, state):
+  """Deletes a batch of logs; returns True once all logs are deleted."""
+  query = _GetQuery(policy, state, keys_only=True)
+  keys = query.fetch(DELETE_BATCH_SIZE * DELETE_BATCHES)
+  rpcs = [db.delete_async(keys[i:i + DELETE_BATCH_SIZE])
+          for i in xrange(0, len(keys), DELETE_BATCH_SIZE)]
+  for rpc in rpcs:
+    rpc.get_result()
+  state['deleted'] += len(keys)
+  if len(keys) < DELETE_BATCH_SIZE * DELETE_BATCHES:
+    return True
+  state['cursor'] = str(query.cursor())
+  return False
+
+
+def Run(kind_name, run):
+  """Runs a retention run from its last checkpoint.
+
+  Args:
+    kind_name: str, kind in POLICIES.
+    run: str, run id from Start().
+  """
+  state = GetState(kind_name)
+  if not state or state['run'] != run or state.get('finished'):
+    logging.warning('Retention run %s of %s is stale.', run, kind_name)
+    return
+
+  policy = POLICIES[kind_name]
+  lock = gae_util.Lock(
+      LOCK_KIND, kind_name, ttl=LOCK_SECS, token=state.get('lock'))
+  begin = time.time()
+  while True:
+    if state['phase'] == ROLLUP:
+      if _RollupBatch(policy, state):
+        models.LogRollup.SetCounts(kind_name, run, state['counts'])
+        state.update({'phase': DELETE, 'cursor': None, 'counts': {}})
+    elif _DeleteBatch(policy, state):
+      break
+    # a run whose lock expired may have been replaced by a new run, whose
+    # state must not be overwritten.
+    if not lock.Extend():
+      logging.warning('Retention run %s of %s lost its lock.', run, kind_name)
+      return
+    _SetState(kind_name, state)
+    if time.time() - begin > RUNTIME_MAX_SECS:
+      deferred.defer(Run, kind_name, run)
+      return
+
+  _Finish(kind_name, state, lock)
+
+
+def _Finish(kind_name, state, lock):
+  """Records a finished run for the admin UI, and releases the lock."""
+  state['finished'] = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M')
+  if state['entity_bytes'] is None:
+    state['bytes_reclaimed'] = None
+  else:
+    state['bytes_reclaimed'] = state['deleted'] * state['entity_bytes']
+  _SetState(kind_name, state)
+
+  runs = GetRuns(kind_name)
+  runs.insert(0, dict(
+      (k, state[k]) for k in [
+          'run', 'started', 'finished', 'cutoff', 'rolled_up', 'deleted',
+          'bytes_reclaimed']))
+  models.KeyValueCache.SetSerializedItem(
+      RUNS_NAME % kind_name, runs[:MAX_RUNS])
+  lock.Release()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""Scatter-gather jobs over key range shards of a Datastore query.
+
+A job splits its query into key ranges, or ranges of a property with
+split_property, and runs each range as its own task which maps entities into
+a partial result. Shards checkpoint their cursor and
+partial result to Datastore after every batch, so a task killed by a deadline
+is retried from its last checkpoint. Once all shards are done, their partial
+results are merged and handed to the job to save. Job.Finish() may be
+retried, so must be idempotent.
+
+Subclass Job, and start it with Start(job).
+"""
+
+
+
+import datetime
+import logging
+import time
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from simian.mac import models
+from simian.mac.common import gae_util
+from simian.mac.common import util
+
+
+LOCK_KIND = 'scatter_gather'
+# Seconds a run holds its lock unless a shard extends it; longer than shard
+# tasks wait between each other in the queue.
+LOCK_SECS = 3600
+SHARD_STATE_NAME = 'scatter_gather_%s_%d'
+FINISHED_RUN_NAME = 'scatter_gather_finished_%s'
+GATHER_NAME = 'scatter_gather_gather_%s_%s'
+# Seconds a gather guards against concurrent gathers of its run; a gather
+# whose task was killed is retried once the guard expires.
+GATHER_SECS = gae_util.LOCK_TASK_SECS
+# Split keys sampled per shard; more samples give more even shards.
+OVERSAMPLING = 32
+
+
+class Job(object):
+  """Base class for a scatter-gather job.
+
+  Job instances are pickled into tasks, so keep their attributes small.
+  Partial results are stored with util.Serialize(), so must be JSON friendly.
+  """
+
+  name = None  # str, unique name of the job.
+  model = None  # db.Model class to run over.
+  # str, optional, property to split shards on and order by instead of the
+  # key, so entities with equal values are mapped contiguously by one shard.
+  split_property = None
+  shards = 8
+  batch_size = 500
+  # Seconds a shard task runs before checkpointing and continuing in a new one.
+  runtime_max_secs = 300
+  # Seconds shards wait after Begin() before they start.
+  start_delay_secs = 0
+
+  def Begin(self):
+    """Prepares a new run before its shards start.
+
+    Attributes set here are pickled into the shard tasks.
+    """
+
+  def GetQuery(self):
+    """Returns a db.Query of model to run over, without sort orders."""
+    return self.model.all()
+
+  def AlignSplitKey(self, key):
+    """Returns key moved to where a shard may start, e.g. a group boundary."""
+    return key
+
+  def NewPartial(self):
+    """Returns an empty partial result."""
+    return {}
+
+  def Map(self, partial, entity):
+    """Adds an entity to a partial result.
+
+    Args:
+      partial: partial result of this shard, to update.
+      entity: db.Model entity of the query.
+    """
+    raise NotImplementedError
+
+  def FinishShard(self, partial):
+    """Completes a partial result after its shard ran out of entities."""
+
+  def Merge(self, result, partial):
+    """Merges a partial result into result, and returns result.
+
+    The default merges dicts of int counts.
+    """
+    for k, v in partial.iteritems():
+      result[k] = result.get(k, 0) + v
+    return result
+
+  def Finish(self, result):
+    """Saves the merged result of all shards; may be retried."""
+    raise NotImplementedError
+
+
+def GetSplitKeys(job):
+  """Returns sorted keys splitting the job query into roughly equal shards.
+
+  Args:
+    job: Job instance.
+  Returns:
+    list of up to job.shards - 1 db.Key split points, or split_property
+    values if the job has one.
+  """
+  limit = job.shards * OVERSAMPLING
+  if job.split_property:
+    sample = job.model.all().order('__scatter__').fetch(limit)
+    sample = set(getattr(e, job.split_property) for e in sample)
+    sample.discard(None)
+    sample = sorted(sample)
+  else:
+    sample = job.model.all(keys_only=True).order('__scatter__').fetch(limit)
+    sample = sorted(set(job.AlignSplitKey(k) for k in sample))
+  if len(sample) < job.shards:
+    return sample
+  step = float(len(sample)) / job.shards
+  return sorted(set(sample[int(step * i)] for i in xrange(1, job.shards)))
+
+
+def _GetShardQuery(job, state):
+  """Returns the job query restricted to a shard's key or property range."""
+  query = job.GetQuery()
+  if job.split_property:
+    name, start, end = job.split_property, state['start'], state['end']
+  else:
+    name, start, end = '__key__', state['start'], state['end']
+    start = start and db.Key(start)
+    end = end and db.Key(end)
+  if start is not None:
+    query.filter('%s >=' % name, start)
+  if end is not None:
+    query.filter('%s <' % name, end)
+  query.order(name)
+  if state['cursor']:
+    query.with_cursor(state['cursor'])
+  return query
+
+
+def _GetShardState(job, shard):
+  """Returns the state dict of a shard, or None."""
+  entity = models.KeyValueCache.get_by_key_name(
+      SHARD_STATE_NAME % (job.name, shard))
+  if entity and entity.blob_value:
+    return util.Deserialize(zlib.decompress(entity.blob_value))
+
+
+def _SetShardState(job, shard, state):
+  """Saves the state dict of a shard as one compressed entity.
+
+  Checkpoints are written after every batch, so this is a single blind put
+  rather than a transactional get_or_insert, and skips Memcache as states
+  are only read when a task starts or gathers.
+  """
+  models.KeyValueCache(
+      key_name=SHARD_STATE_NAME % (job.name, shard),
+      blob_value=db.Blob(zlib.compress(util.Serialize(state)))).put()
+
+
+def _GetFinishedRun(job):
+  """Returns the str run id of the last finished run of a job, or None."""
+  entity = models.KeyValueCache.get_by_key_name(FINISHED_RUN_NAME % job.name)
+  if entity:
+    return entity.text_value
+
+
+def _SetFinishedRun(job, run):
+  """Records a run of a job as finished."""
+  models.KeyValueCache(
+      key_name=FINISHED_RUN_NAME % job.name, text_value=run).put()
+
+
+def Start(job):
+  """Starts a job, unless a previous run of it is still in progress.
+
+  Args:
+    job: Job instance.
+  Returns:
+    str run id, or None if the job is already running.
+  """
+  lock = gae_util.Lock(LOCK_KIND, job.name, ttl=LOCK_SECS)
+  if not lock.Acquire():
+    logging.warning('Scatter-gather job %s is running; exiting.', job.name)
+    return
+
+  job.Begin()
+  run = datetime.datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S-%f')
+  split_keys = GetSplitKeys(job)
+  if not job.split_property:
+    split_keys = [str(k) for k in split_keys]
+  bounds = [None] + split_keys + [None]
+  shards = len(bounds) - 1
+  for shard in xrange(shards):
+    state = {
+        'run': run, 'shards': shards, 'start': bounds[shard],
+        'end': bounds[shard + 1], 'cursor': None,
+        'partial': job.NewPartial(), 'done': False, 'lock': lock.token,
+    }
+    _SetShardState(job, shard, state)
+    deferred.defer(RunShard, job, run, shard, _countdown=job.start_delay_secs)
+  return run
+
+
+def RunShard(job, run, shard):
+  """Runs a shard from its last checkpoint, and gathers if all are done.
+
+  Args:
+    job: Job instance.
+    run: str, run id from Start().
+    shard: int, shard number.
+  """
+  state = _GetShardState(job, shard)
+  if not state or state['run'] != run:
+    logging.warning(
+        'Scatter-gather job %s shard %d of run %s is stale.', job.name, shard,
+        run)
+    return
+
+  lock = gae_util.Lock(LOCK_KIND, job.name, ttl=LOCK_SECS,
+                       token=state.get('lock'))
+  if state['done']:
+    # a retried task may have finished its shard but not gathered.
+    _Gather(job, run, state['shards'], lock)
+    return
+
+  begin = time.time()
+  while True:
+    query = _GetShardQuery(job, state)
+    entities = query.fetch(job.batch_size)
+    for entity in entities:
+      job.Map(state['partial'], entity)
+    # a run whose lock expired may have been replaced by a new run, whose
+    # states must not be overwritten.
+    if not lock.Extend():
+      logging.warning(
+          'Scatter-gather job %s run %s lost its lock; exiting.', job.name,
+          run)
+      return
+    if len(entities) < job.batch_size:
+      job.FinishShard(state['partial'])
+      state['done'] = True
+      _SetShardState(job, shard, state)
+      break
+    state['cursor'] = str(query.cursor())
+    _SetShardState(job, shard, state)
+    if time.time() - begin > job.runtime_max_secs:
+      deferred.defer(RunShard, job, run, shard)
+      return
+
+  _Gather(job, run, state['shards'], lock)
+
+
+def _Gather(job, run, shards, lock):
+  """Merges the partial results of all shards once all are done.
+
+  The run is recorded as finished only after job.Finish() returns, so a
+  failed gather is retried by the task of any done shard.
+
+  Raises:
+    deferred.SingularTaskFailure: another task is gathering, or died while
+      gathering; the task is retried until the run is recorded finished.
+  """
+  states = [_GetShardState(job, shard) for shard in xrange(shards)]
+  for state in states:
+    if not state or state['run'] != run or not state['done']:
+      return  # the last shard to finish gathers.
+  if _GetFinishedRun(job) == run:
+    lock.Release()  # in case a gather died after finishing.
+    return
+  # shards finishing at the same time may both see all shards done.
+  guard = GATHER_NAME % (job.name, run)
+  if not memcache.add(guard, 1, time=GATHER_SECS):
+    # retry rather than succeed, as the gather holding the guard may have
+    # died without deleting it.
+    raise deferred.SingularTaskFailure(
+        'Scatter-gather job %s run %s is gathering.' % (job.name, run))
+
+  try:
+    result = job.NewPartial()
+    for state in states:
+      result = job.Merge(result, state['partial'])
+    job.Finish(result)
+    _SetFinishedRun(job, run)
+  except:
+    memcache.delete(guard)
+    raise
+  lock.Release()
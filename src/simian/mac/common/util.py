@@ -23,8 +23,10 @@
 import datetime
 import cPickle as pickle
 import re
+import struct
 import time
 import urllib
+import zlib
 
 
 USE_JSON = False
@@ -59,6 +61,19 @@ PICKLE_RE = re.compile(
     r'^(\(dp[01]|\(lp[01]|S\'|I\d|ccopy_reg|c.*p1).*\.$',
     re.MULTILINE|re.DOTALL)
 
+# Encode() values start with a tag byte of CODEC_VERSION in the high nibble,
+# the value type in the low 3 bits, and CODEC_ZLIB set if zlib compressed.
+# Serialize() JSON never starts with a byte in 0x10-0x1f, so Decode() reads it
+# too.
+CODEC_VERSION = 1
+CODEC_JSON = 0
+CODEC_INT_ARRAY = 1  # list of ints, as little-endian signed 64-bit ints.
+CODEC_ZLIB = 0x08
+# Encoded values of at least this many bytes are zlib compressed.
+CODEC_COMPRESS_MIN_BYTES = 1024
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
 
 class Error(Exception):
   """Base error."""
@@ -186,6 +201,81 @@ def Deserialize(
     raise DeserializeError(e)
 
 
+def _IsIntArray(obj):
+  """Returns True if obj is a non-empty list of 64-bit ints."""
+  if type(obj) is not list or not obj:
+    return False
+  for i in obj:
+    if type(i) not in (int, long) or not _INT64_MIN <= i <= _INT64_MAX:
+      return False
+  return True
+
+
+def Encode(obj, binary=True, compress_min_bytes=CODEC_COMPRESS_MIN_BYTES):
+  """Return a compact, versioned serialized version of object.
+
+  Lists of ints are packed as 64-bit ints, and anything else Serialize()
+  supports is stored as JSON without whitespace. Values of at least
+  compress_min_bytes are zlib compressed, when that makes them smaller.
+
+  Args:
+    obj: any object Serialize() supports.
+    binary: bool, default True, False to only use JSON without compression,
+      so the value is text, e.g. for a TextProperty.
+    compress_min_bytes: int, optional, smallest value to compress.
+  Returns:
+    str, for Decode().
+  Raises:
+    SerializeError: if an error occured during serialization
+  """
+  if binary and _IsIntArray(obj):
+    codec = CODEC_INT_ARRAY
+    data = struct.pack('<%dq' % len(obj), *obj)
+  else:
+    codec = CODEC_JSON
+    try:
+      data = json.dumps(obj, separators=(',', ':'))
+    except TypeError, e:
+      raise SerializeError(e)
+
+  if binary and len(data) >= compress_min_bytes:
+    compressed = zlib.compress(data)
+    if len(compressed) < len(data):
+      codec |= CODEC_ZLIB
+      data = compressed
+  return chr(CODEC_VERSION << 4 | codec) + data
+
+
+def Decode(s, parse_float=float):
+  """Return an object for an Encode() or Serialize() serialized version.
+
+  Args:
+    s: str
+    parse_float: callable, optional, to translate floating point values
+  Returns:
+    any object that was serialized
+  Raises:
+    DeserializeError: if an error occured during deserialization
+  """
+  if not s or not 0x10 <= ord(s[0]) <= 0x1f:
+    return Deserialize(s, parse_float=parse_float)
+
+  tag = ord(s[0])
+  data = s[1:]
+  try:
+    if tag & CODEC_ZLIB:
+      data = zlib.decompress(data)
+    codec = tag & 0x07
+    if codec == CODEC_JSON:
+      return json.loads(data, parse_float=parse_float)
+    elif codec == CODEC_INT_ARRAY:
+      return list(struct.unpack('<%dq' % (len(data) / 8), data))
+    else:
+      raise DeserializeError('Unknown codec: %d' % tag)
+  except (zlib.error, struct.error, ValueError), e:
+    raise DeserializeError(e)
+
+
 def UrlUnquote(s):
   """Return unquoted version of a url string."""
   return urllib.unquote(s)
\ No newline at end of file
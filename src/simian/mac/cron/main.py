@@ -44,6 +44,7 @@ app = webapp2.WSGIApplication([
     ('/cron/maintenance/verify_packages', maintenance.VerifyPackages),
     ('/cron/maintenance/update_avg_install_durations',
      maintenance.UpdateAverageInstallDurations),
+    ('/cron/maintenance/log_retention', maintenance.LogRetention),
 
     # Reports Cache
     (r'/cron/reports_cache/([a-z_]+)$', reports_cache.ReportsCache),
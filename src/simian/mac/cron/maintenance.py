@@ -39,6 +39,7 @@ from simian.auth import gaeserver
 from simian.mac import common
 from simian.mac import models
 from simian.mac.common import gae_util
+from simian.mac.common import retention
 from simian.mac.munki import plist
 
 
@@ -63,6 +64,15 @@ class MarkComputersInactive(webapp2.RequestHandler):
     #logging.debug('Complete! Marked %s inactive.' % count)
 
 
+class LogRetention(webapp2.RequestHandler):
+  """Class to roll up and delete logs older than their retention policy."""
+
+  def get(self):
+    """Handle GET."""
+    for kind_name in sorted(retention.POLICIES):
+      retention.Start(kind_name)
+
+
 class UpdateAverageInstallDurations(webapp2.RequestHandler):
   """Class to update average install duration pkginfo descriptions reguarly."""
 
@@ -82,8 +92,8 @@ class UpdateAverageInstallDurations(webapp2.RequestHandler):
         continue
 
       # Obtain a lock on the PackageInfo entity for this package, or skip.
-      lock = 'pkgsinfo_%s' % p.filename
-      if not gae_util.ObtainLock(lock, timeout=5.0):
+      lock = gae_util.Lock('pkgsinfo', p.filename)
+      if not lock.Acquire(timeout=5.0):
         continue  # Skip; it'll get updated next time around.
 
       # Append the avg duration text to the description; in the future the
@@ -98,7 +108,7 @@ class UpdateAverageInstallDurations(webapp2.RequestHandler):
       p.description = '%s\n\n%s' % (p.description, avg_duration_text)
       if p.plist['description'] != old_desc:
         p.put()  # Only bother putting the entity if the description changed.
-      gae_util.ReleaseLock(lock)
+      lock.Release()
 
     # Asyncronously regenerate all Catalogs to include updated pkginfo plists.
     delay = 0
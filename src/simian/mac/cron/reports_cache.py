@@ -25,20 +25,27 @@ Classes:
 
 
 import datetime
+import hashlib
 import logging
-import time
 import webapp2
 
+from google.appengine.ext import db
 from google.appengine.ext import deferred
-from google.appengine.api import taskqueue
 
 from simian.mac import models
+from simian.mac.common import fleet_snapshot
 from simian.mac.common import gae_util
+from simian.mac.common import histogram
+from simian.mac.common import scatter_gather
 from simian.mac.admin import summary as summary_module
 
 
 TRENDING_INSTALLS_LIMIT = 5
-RUNTIME_MAX_SECS = 30
+# strftime format of InstallRollup hours folded into install counts.
+HOUR_FORMAT = '%Y-%m-%d %H:%M'
+# InstallLog entities rolled up per task of an InstallRollup backfill.
+BACKFILL_FETCH_LIMIT = 250
+BACKFILL_LOCK_SECS = 30
 
 
 class ReportsCache(webapp2.RequestHandler):
@@ -54,14 +61,20 @@ class ReportsCache(webapp2.RequestHandler):
       'conflicting_apps'
   ]
 
-  FETCH_LIMIT = 500
-
   def get(self, name=None, arg=None):
     """Handle GET"""
 
     if name == 'summary':
-      summary = summary_module.GetComputerSummary()
+      summary = summary_module.GetComputerSummaryFromCounters()
       models.ReportsCache.SetStatsSummary(summary)
+      _RecordFleetMetrics(summary)
+    elif name == 'summary_reconcile':
+      scatter_gather.Start(ComputerSummaryJob())
+    elif name == 'fleet_snapshot':
+      fleet_snapshot.Build()
+    elif name == 'stats_views':
+      for report_type in summary_module.STATS_VIEW_TYPES:
+        scatter_gather.Start(StatsViewsJob(report_type))
     elif name == 'installcounts':
       _GenerateInstallCounts()
     elif name == 'trendinginstalls':
@@ -74,7 +87,7 @@ class ReportsCache(webapp2.RequestHandler):
         kwargs = {}
       _GenerateTrendingInstallsCache(**kwargs)
     elif name == 'pendingcounts':
-      self._GeneratePendingCounts()
+      _GeneratePendingCounts()
     elif name == 'msu_user_summary':
       if arg:
         try:
@@ -96,224 +109,392 @@ class ReportsCache(webapp2.RequestHandler):
       now: datetime.datetime, optional, supply an alternative
         value for the current date/time
     """
-    lock_name = 'msu_user_summary_lock'
-    cursor_name = 'msu_user_summary_cursor'
-    if since_days is None:
-      since = None
-    else:
-      since = '%dD' % since_days
-      lock_name = '%s_%s' % (lock_name, since)
-      cursor_name = '%s_%s' % (cursor_name, since)
+    scatter_gather.Start(
+        MsuUserSummaryJob(self.USER_EVENTS, since_days=since_days, now=now))
+
+
+def _RecordFleetMetrics(summary, today=None):
+  """Records daily fleet metrics of a stats summary.
+
+  The summary cron runs many times a day, so the day's last summary wins.
 
-    lock = gae_util.ObtainLock(lock_name)
-    if not lock:
-      logging.warning('GenerateMsuUserSummary lock found; exiting.')
+  Args:
+    summary: dict, GetComputerSummaryFromCounters() output, which is empty
+      when no computers were active.
+    today: datetime.date, optional, date to record the metrics for.
+  """
+  today = today or datetime.datetime.utcnow().date()
+  days = max(summary_module.ACTIVE_DAY_COUNTS)
+  metrics = {}
+  for active_days in summary_module.ACTIVE_DAY_COUNTS:
+    metrics['active_%dd' % active_days] = (
+        summary['active'][active_days] if summary else 0)
+  if not summary:
+    # percentages are undefined without active computers.
+    models.FleetMetric.SetDay(today, metrics)
+    return
+  for name in ['all_pkgs_installed_percent',
+               'all_apple_updates_installed_percent']:
+    metrics[name] = round(summary[name][days], 2)
+  metrics['conns_on_corp_percent'] = round(summary['conns_on_corp_percent'], 2)
+  for track, counts in summary['tracks'].iteritems():
+    metrics['track:%s' % track] = counts.get(days, 0)
+  for name in ['os_version', 'client_version']:
+    for version, count in summary['%ss' % name]:
+      metrics['%s:%s' % (name, version)] = count
+  models.FleetMetric.SetDay(today, metrics)
+
+
+class ComputerSummaryJob(scatter_gather.Job):
+  """Recounts fleet summary counters and the stats summary from Computers."""
+
+  name = 'computer_summary'
+  model = models.Computer
+  generation = None
+  # live updates read the generations from an instance cache, so wait until
+  # all instances add them to the pending generation.
+  start_delay_secs = models.COMPUTER_SUMMARY_RECONCILE_DELAY_SECS
+
+  def Begin(self):
+    self.generation = models.ComputerSummaryShard.BeginReconcile()
+
+  def GetQuery(self):
+    return models.Computer.AllActive()
+
+  def Map(self, partial, computer):
+    computer_counts = models.ComputerSummaryShard.GetReconcileCounts(
+        computer, self.generation)
+    if not computer_counts:
       return
+    date, counts = computer_counts
+    day_counts = partial.setdefault(str(date), {})
+    for name, value in counts.iteritems():
+      day_counts[name] = day_counts.get(name, 0) + value
+
+  def Merge(self, result, partial):
+    for date, counts in partial.iteritems():
+      day_counts = result.setdefault(date, {})
+      for name, value in counts.iteritems():
+        day_counts[name] = day_counts.get(name, 0) + value
+    return result
+
+  def Finish(self, result):
+    daily_counts = {}
+    for date, counts in result.iteritems():
+      date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+      daily_counts[date] = counts
+    if not models.ComputerSummaryShard.SetDailyCounts(
+        daily_counts, self.generation):
+      logging.warning(
+          'ComputerSummaryJob: generation %d was replaced.', self.generation)
+      return
+    # the current generation includes updates made while the job ran.
+    summary = summary_module.GetComputerSummaryFromCounters()
+    models.ReportsCache.SetStatsSummary(summary)
+    _GeneratePendingCounts()
 
-    interested_events = self.USER_EVENTS
 
-    lquery = models.ComputerMSULog.all()
-    cursor = models.KeyValueCache.MemcacheWrappedGet(
-        cursor_name, 'text_value')
-    summary, unused_dt = models.ReportsCache.GetMsuUserSummary(
-        since=since, tmp=True)
+class StatsViewsJob(scatter_gather.Job):
+  """Summarizes active Computers for each value of a property, i.e. each site.
 
-    if cursor and summary:
-      lquery.with_cursor(cursor)
-    else:
-      summary = {}
-      for event in interested_events:
-        summary[event] = 0
-      summary['total_events'] = 0
-      summary['total_users'] = 0
-      summary['total_uuids'] = 0
-      models.ReportsCache.SetMsuUserSummary(
-          summary, since=since, tmp=True)
-
-    begin = time.time()
-    if now is None:
-      now = datetime.datetime.utcnow()
-
-    while True:
-      reports = lquery.fetch(self.FETCH_LIMIT)
-      if not reports:
-        break
-
-      userdata = {}
-      last_user = None
-      last_user_cursor = None
-      prev_user_cursor = None
-
-      n = 0
-      for report in reports:
-        userdata.setdefault(report.user, {})
-        userdata[report.user].setdefault(
-            report.uuid, {}).update(
-                {report.event: report.mtime})
-        if last_user != report.user:
-          last_user = report.user
-          prev_user_cursor = last_user_cursor
-          last_user_cursor = str(lquery.cursor())
-        n += 1
-
-      if n == self.FETCH_LIMIT:
-        # full fetch, might not have finished this user -- rewind
-        del(userdata[last_user])
-        last_user_cursor = prev_user_cursor
-
-      for user in userdata:
-        events = 0
-        for uuid in userdata[user]:
-          if 'launched' not in userdata[user][uuid]:
-            continue
-          for event in userdata[user][uuid]:
-            if since_days is None or IsTimeDelta(
-                userdata[user][uuid][event], now, days=since_days):
-              summary.setdefault(event, 0)
-              summary[event] += 1
-              summary['total_events'] += 1
-              events += 1
-          if events:
-            summary['total_uuids'] += 1
-        if events:
-          summary['total_users'] += 1
-          summary.setdefault('total_users_%d_events' % events, 0)
-          summary['total_users_%d_events' % events] += 1
-
-      lquery = models.ComputerMSULog.all()
-      lquery.with_cursor(last_user_cursor)
-
-      end = time.time()
-      if (end - begin) > RUNTIME_MAX_SECS:
-        break
-
-    if reports:
-      models.ReportsCache.SetMsuUserSummary(
-          summary, since=since, tmp=True)
-      models.KeyValueCache.MemcacheWrappedSet(
-          cursor_name, 'text_value', last_user_cursor)
-      if since_days:
-        args = '/%d' % since_days
-      else:
-        args = ''
-      taskqueue.add(
-          url='/cron/reports_cache/msu_user_summary%s' % args,
-          method='GET',
-          countdown=5)
-    else:
-      models.ReportsCache.SetMsuUserSummary(
-          summary, since=since)
-      models.KeyValueCache.DeleteMemcacheWrap(
-          cursor_name, prop_name='text_value')
-      summary_tmp = models.ReportsCache.DeleteMsuUserSummary(
-          since=since, tmp=True)
-
-    gae_util.ReleaseLock(lock_name)
-
-  def _GeneratePendingCounts(self):
-    """Generates a dictionary of all install names and their pending count."""
-    d = {}
-    for munki_name in [p.munki_name for p in models.PackageInfo.all()]:
-      d[munki_name] = models.Computer.AllActive(keys_only=True).filter(
-          'pkgs_to_install =', munki_name).count(999999)
-    models.ReportsCache.SetPendingCounts(d)
-
-
-def _GenerateInstallCounts():
-    """Generates a dictionary of all installs names and the count of each."""
-    #logging.debug('Generating install counts....')
-
-    # Obtain a lock.
-    lock_name = 'pkgs_list_cron_lock'
-    lock = gae_util.ObtainLock(lock_name)
-    if not lock:
-      logging.warning('GenerateInstallCounts: lock found; exiting.')
+  Partial results are counters by view and by age bucket, where ages between
+  two of summary_module.ACTIVE_DAY_COUNTS share a bucket.
+  """
+
+  model = models.Computer
+
+  def __init__(self, report_type, now=None):
+    self.report_type = report_type
+    self.name = 'stats_views_%s' % report_type
+    self.today = (now or datetime.datetime.utcnow()).date()
+
+  def GetQuery(self):
+    return models.Computer.AllActive()
+
+  def Map(self, partial, computer):
+    computer_counts = models.ComputerSummaryShard.GetComputerCounts(
+        computer, connections=True)
+    if not computer_counts:
       return
+    date, counts = computer_counts
+    age = (self.today - date).days
+    bucket = max([0] + [
+        days for days in summary_module.ACTIVE_DAY_COUNTS if days <= age])
+    view = str(getattr(computer, self.report_type))
+    bucket_counts = partial.setdefault(view, {}).setdefault(str(bucket), {})
+    for name, value in counts.iteritems():
+      if not name.startswith('pending:'):
+        bucket_counts[name] = bucket_counts.get(name, 0) + value
+
+  def Merge(self, result, partial):
+    for view, buckets in partial.iteritems():
+      result_buckets = result.setdefault(view, {})
+      for bucket, counts in buckets.iteritems():
+        bucket_counts = result_buckets.setdefault(bucket, {})
+        for name, value in counts.iteritems():
+          bucket_counts[name] = bucket_counts.get(name, 0) + value
+    return result
+
+  def Finish(self, result):
+    views = {}
+    for view, buckets in result.iteritems():
+      daily_counts = {}
+      for bucket, counts in buckets.iteritems():
+        date = self.today - datetime.timedelta(days=int(bucket))
+        daily_counts[date] = counts
+      views[view] = summary_module.GetComputerSummaryFromCounters(
+          daily_counts, today=self.today)
+    models.ReportsCache.SetStatsViews(self.report_type, views)
+
+
+class MsuUserSummaryJob(scatter_gather.Job):
+  """Summarizes MSU user events from ComputerMSULog.
+
+  Shards are split on and ordered by user, so all logs of a user are mapped
+  contiguously by one shard. Only the current user's logs are kept in the
+  partial result; finished users are folded into counts, so checkpoints stay
+  the same size however many users and logs there are.
+  """
+
+  model = models.ComputerMSULog
+  split_property = 'user'
+
+  def __init__(self, user_events, since_days=None, now=None):
+    self.user_events = user_events
+    self.since_days = since_days
+    if since_days is None:
+      self.since = None
+      self.name = 'msu_user_summary'
+    else:
+      self.since = '%dD' % since_days
+      self.name = 'msu_user_summary_%s' % self.since
+    self.now = now or datetime.datetime.utcnow()
+
+  def NewPartial(self):
+    return {
+        'events': dict((event, 0) for event in self.user_events),
+        'total_events': 0,
+        'total_uuids': 0,
+        'total_users': 0,
+        'user_events_counts': {},  # str events of a user: int users.
+        'user': None,
+        'uuid_events': {},  # uuid: {event: 1 if within since_days else 0}.
+    }
+
+  def _FlushUser(self, partial):
+    """Adds the events of the last mapped user to partial."""
+    user_count = 0
+    for events in partial['uuid_events'].itervalues():
+      if 'launched' not in events:
+        continue
+      count = 0
+      for event, within_since in events.iteritems():
+        if within_since:
+          partial['events'][event] = partial['events'].get(event, 0) + 1
+          count += 1
+      if count:
+        partial['total_uuids'] += 1
+        user_count += count
+    if user_count:
+      partial['total_events'] += user_count
+      partial['total_users'] += 1
+      counts = partial['user_events_counts']
+      counts[str(user_count)] = counts.get(str(user_count), 0) + 1
+    partial['uuid_events'] = {}
+
+  def Map(self, partial, report):
+    if report.user != partial['user']:
+      self._FlushUser(partial)
+      partial['user'] = report.user
+    within_since = self.since_days is None or IsTimeDelta(
+        report.mtime, self.now, days=self.since_days) is not None
+    events = partial['uuid_events'].setdefault(report.uuid, {})
+    events[report.event] = int(within_since)
+
+  def FinishShard(self, partial):
+    self._FlushUser(partial)
+
+  def Merge(self, result, partial):
+    for name in ['events', 'user_events_counts']:
+      for k, count in partial[name].iteritems():
+        result[name][k] = result[name].get(k, 0) + count
+    for name in ['total_events', 'total_uuids', 'total_users']:
+      result[name] += partial[name]
+    return result
+
+  def Finish(self, result):
+    summary = dict(result['events'])
+    for name in ['total_events', 'total_uuids', 'total_users']:
+      summary[name] = result[name]
+    for count, users in result['user_events_counts'].iteritems():
+      summary['total_users_%s_events' % count] = users
+    models.ReportsCache.SetMsuUserSummary(summary, since=self.since)
+
+
+def _AddInstallCounts(pkgs, more_pkgs):
+  """Adds InstallRollup.GetInstallCounts() output to install counts."""
+  for pkg_name, more in more_pkgs.iteritems():
+    pkg = pkgs.setdefault(pkg_name, {'applesus': more['applesus']})
+    for name in models.InstallRollup.COUNT_PROPERTIES:
+      pkg[name] = pkg.get(name, 0) + more[name]
+    for name in models.InstallRollup.HISTOGRAM_PROPERTIES:
+      pkg[name] = histogram.Merge(pkg.get(name, {}), more[name])
+  return pkgs
+
+
+def _GenerateInstallCounts(now=None):
+  """Generates a dictionary of all installs names and the count of each.
+
+  Counts of InstallRollup hours which no longer receive installs are folded
+  into a stored total, so each run only sums the rollups of recent hours.
+  While a rebuild backfills rollups of past hours, nothing is folded and all
+  rollups are summed, as backfilled hours may already be behind the fold.
+
+  Args:
+    now: datetime.datetime, optional, supply an alternative
+      value for the current date/time
+  """
+  lock = gae_util.Lock('pkgs_list_cron_lock', ttl=gae_util.LOCK_TASK_SECS)
+  if not lock.Acquire():
+    logging.warning('GenerateInstallCounts: lock found; exiting.')
+    return
+
+  now = now or datetime.datetime.utcnow()
+  # installs are rolled up in the hour they are logged in, so hours before
+  # the previous one are complete.
+  fold_until = models.InstallRollup.GetHour(now) - datetime.timedelta(hours=1)
 
-    # Get a list of all packages that have previously been pushed.
+  folded, unused_dt = models.ReportsCache.GetInstallCountsFolded()
+  if 'pkgs' not in folded:
+    # first run; counts from before rollups existed are kept as the total.
     pkgs, unused_dt = models.ReportsCache.GetInstallCounts()
+    folded = {'hour': None, 'pkgs': pkgs}
+  since = None
+  if folded['hour']:
+    since = datetime.datetime.strptime(folded['hour'], HOUR_FORMAT)
+  if folded.get('backfill_until'):
+    logging.info(
+        'GenerateInstallCounts: backfill until %s running; not folding.',
+        folded['backfill_until'])
+  elif not since or since < fold_until:
+    _AddInstallCounts(
+        folded['pkgs'],
+        models.InstallRollup.GetInstallCounts(since=since, until=fold_until))
+    since = fold_until
+    folded['hour'] = since.strftime(HOUR_FORMAT)
+    models.ReportsCache.SetInstallCountsFolded(folded)
+
+  pkgs = _AddInstallCounts(
+      folded['pkgs'], models.InstallRollup.GetInstallCounts(since=since))
+  install_counts = {}
+  for pkg_name, pkg in pkgs.iteritems():
+    pkg = dict(pkg)
+    if pkg.get('duration_count'):
+      pkg['duration_seconds_avg'] = int(
+          pkg['duration_total_seconds'] / pkg['duration_count'])
+    else:
+      pkg['duration_seconds_avg'] = None
+    # i.e. duration_p90 from duration_histogram. Only the folded state keeps
+    # histograms, as those of all packages may not fit in one entity.
+    for name in ['duration', 'dl_kbytes_per_sec']:
+      percentiles = histogram.GetPercentiles(
+          pkg.pop('%s_histogram' % name, {}))
+      for percentile, value in percentiles.iteritems():
+        pkg['%s_p%d' % (name, percentile)] = value
+    install_counts[pkg_name] = pkg
+  models.ReportsCache.SetInstallCounts(install_counts)
+  models.InstallRollupBatch.DeleteOld(now)
 
-    # Generate a query of all InstallLog entites that haven't been read yet.
-    query = models.InstallLog.all().order('server_datetime')
-    cursor_obj = models.KeyValueCache.get_by_key_name('pkgs_list_cursor')
-    if cursor_obj:
-      query.with_cursor(cursor_obj.text_value)
-      #logging.debug('Continuing with cursor: %s', cursor_obj.text_value)
-
-    # Loop over new InstallLog entries.
-    installs = query.fetch(1000)
-    if not installs:
-      #logging.debug('No more installs to process.')
-      models.ReportsCache.SetInstallCounts(pkgs)
-      gae_util.ReleaseLock(lock_name)
-      return
+  lock.Release()
 
-    i = 0
-    for install in installs:
-      i += 1
-      pkg_name = install.package
-      if pkg_name not in pkgs:
-        pkgs[pkg_name] = {
-            'install_count': 0,
-            'install_fail_count': 0,
-            'applesus': install.applesus,
-        }
-      if install.IsSuccess():
-        pkgs[pkg_name]['install_count'] = (
-            pkgs[pkg_name].setdefault('install_count', 0) + 1)
-        # (re)calculate avg_duration_seconds for this package.
-        if 'duration_seconds_avg' not in pkgs[pkg_name]:
-          pkgs[pkg_name]['duration_count'] = 0
-          pkgs[pkg_name]['duration_total_seconds'] = 0
-          pkgs[pkg_name]['duration_seconds_avg'] = None
-        # only proceed if entity has "duration_seconds" property != None.
-        if getattr(install, 'duration_seconds', None) is not None:
-          pkgs[pkg_name]['duration_count'] += 1
-          pkgs[pkg_name]['duration_total_seconds'] += (
-              install.duration_seconds)
-          pkgs[pkg_name]['duration_seconds_avg'] = int(
-              pkgs[pkg_name]['duration_total_seconds'] /
-              pkgs[pkg_name]['duration_count'])
-      else:
-        pkgs[pkg_name]['install_fail_count'] = (
-            pkgs[pkg_name].setdefault('install_fail_count', 0) + 1)
 
+def _BackfillInstallRollups(until, cursor=None):
+  """Rolls up InstallLog entities logged before a time, i.e. on a rebuild.
+
+  Each hop adds its installs as one batch, so a retried hop is not counted
+  twice. The last hop clears the backfill_until value that stops
+  _GenerateInstallCounts() from folding hours while the backfill runs.
+
+  Args:
+    until: datetime.datetime, roll up installs logged before this time.
+    cursor: str, optional, query cursor to continue from.
+  """
+  folded, unused_dt = models.ReportsCache.GetInstallCountsFolded()
+  if folded.get('backfill_until') != str(until):
+    logging.warning('BackfillInstallRollups: backfill %s is stale.', until)
+    return
 
-    # Update any changed packages.
-    models.ReportsCache.SetInstallCounts(pkgs)
-    #logging.debug('Processed %d installs and saved to ReportsCache.', i)
+  query = models.InstallLog.all().filter('server_datetime <', until).order(
+      'server_datetime')
+  if cursor:
+    query.with_cursor(cursor)
+  installs = query.fetch(BACKFILL_FETCH_LIMIT)
+  models.InstallRollup.AddInstalls(
+      installs, batch=hashlib.sha1('%s_%s' % (until, cursor)).hexdigest())
+  if len(installs) == BACKFILL_FETCH_LIMIT:
+    deferred.defer(_BackfillInstallRollups, until, str(query.cursor()))
+    return
 
-    if not cursor_obj:
-      cursor_obj = models.KeyValueCache(key_name='pkgs_list_cursor')
+  lock = gae_util.Lock('pkgs_list_cron_lock', ttl=gae_util.LOCK_TASK_SECS)
+  if not lock.Acquire(timeout=BACKFILL_LOCK_SECS):
+    # raise so the task is retried; rollups of this hop are not added twice.
+    raise db.TransactionFailedError('BackfillInstallRollups: lock busy.')
+  try:
+    folded, unused_dt = models.ReportsCache.GetInstallCountsFolded()
+    if folded.get('backfill_until') == str(until):
+      del folded['backfill_until']
+      models.ReportsCache.SetInstallCountsFolded(folded)
+  finally:
+    lock.Release()
 
-    cursor_txt = str(query.cursor())
-    #logging.debug('Saving new cursor: %s', cursor_txt)
-    cursor_obj.text_value = cursor_txt
-    cursor_obj.put()
 
-    # Delete the lock.
-    gae_util.ReleaseLock(lock_name)
+def _GeneratePendingCounts(daily_counts=None):
+  """Generates a dictionary of all install names and their pending count.
 
-    deferred.defer(_GenerateInstallCounts)
+  Counts are read from the pending counters of models.ComputerSummaryShard,
+  which include Apple updates as "AppleSUS: <product_id>".
 
+  Args:
+    daily_counts: optional, dict of datetime.date: dict of counter name: int;
+      defaults to models.ComputerSummaryShard.GetDailyCounts().
+  """
+  if daily_counts is None:
+    daily_counts = models.ComputerSummaryShard.GetDailyCounts()
+  d = dict((p.munki_name, 0) for p in models.PackageInfo.all())
+  for counts in daily_counts.itervalues():
+    for name, value in counts.iteritems():
+      kind, _, pkg = name.partition(':')
+      if kind == 'pending':
+        d[pkg] = d.get(pkg, 0) + value
+  models.ReportsCache.SetPendingCounts(d)
 
-def _GenerateTrendingInstallsCache(since_hours=None):
-  """Generates trending install and failure data."""
+
+def _GenerateTrendingInstallsCache(since_hours=None, now=None):
+  """Generates trending install and failure data.
+
+  Args:
+    since_hours: int, optional, number of hours to report on, default 1.
+      Counts include the rest of the hour since_hours ago.
+    now: datetime.datetime, optional, supply an alternative
+      value for the current date/time
+  """
   trending = {'success': {}, 'failure': {}}
   total_success = 0
   total_failure = 0
   if not since_hours:
     since_hours = 1
-  dt = datetime.datetime.utcnow() - datetime.timedelta(minutes=since_hours * 60)
-  query = models.InstallLog.all().filter('mtime >', dt)
-  for install in gae_util.QueryIterator(query):
-    pkg = str(install.package)
-    if install.IsSuccess():
-      trending['success'][pkg] = trending['success'].setdefault(pkg, 0) + 1
-      total_success += 1
-    else:
-      trending['failure'][pkg] = trending['failure'].setdefault(pkg, 0) + 1
-      total_failure +=1
+  now = now or datetime.datetime.utcnow()
+  since = models.InstallRollup.GetHour(
+      now - datetime.timedelta(hours=since_hours))
+  pkgs = models.InstallRollup.GetInstallCounts(since=since)
+  for pkg, counts in pkgs.iteritems():
+    pkg = str(pkg)
+    if counts['install_count']:
+      trending['success'][pkg] = counts['install_count']
+      total_success += counts['install_count']
+    if counts['install_fail_count']:
+      trending['failure'][pkg] = counts['install_fail_count']
+      total_failure += counts['install_fail_count']
 
   # Get the top trending installs and failures.
   success = sorted(
@@ -21,9 +21,10 @@
 
 import datetime
 import difflib
-import gc
 import logging
+import random
 import re
+import time
 
 from google.appengine import runtime
 from google.appengine.api import memcache
@@ -36,6 +37,8 @@ from google.appengine.runtime import apiproxy_errors
 from simian.mac.common import ipcalc
 from simian.mac import common
 from simian.mac.common import gae_util
+from simian.mac.common import histogram
+from simian.mac.common import instrumentation
 from simian.mac.common import util
 from simian.mac.models import constants
 from simian.mac.models import properties
@@ -52,13 +55,41 @@ class InvalidArgumentsError(Error):
 
 # The number of days a client is silent before being considered inactive.
 COMPUTER_ACTIVE_DAYS = 30
+# Seconds MarkInactive runs before continuing in a deferred task.
+MARK_INACTIVE_SECS = 300
 # Default memcache seconds for memcache-backed datastore entities
 MEMCACHE_SECS = 300
+# Number of ComputerSummaryShard entities per day of summary counts.
+COMPUTER_SUMMARY_SHARDS = 20
+# Seconds between checks of the summary generations by each instance.
+COMPUTER_SUMMARY_GENERATIONS_SECS = 5
+# Seconds a reconcile waits after it begins before counting Computers; much
+# longer than instances take to see its pending generation.
+COMPUTER_SUMMARY_RECONCILE_DELAY_SECS = 60
+# Number of InstallRollup entities per hour and package.
+INSTALL_ROLLUP_SHARDS = 20
+# Times an InstallRollup transaction is retried on contention before the
+# rollups are added by a deferred task instead.
+INSTALL_ROLLUP_RETRIES = 5
+# Days InstallRollupBatch markers are kept, i.e. while deferred tasks adding
+# rollups may still be retried.
+INSTALL_ROLLUP_BATCH_DAYS = 7
+# Max number of entity groups a cross-group transaction may touch.
+MAX_XG_ENTITY_GROUPS = 5
+# Instance-local tier in front of memcache for MemcacheWrappedGet, per kind.
+INSTANCE_CACHE = gae_util.InstanceCache()
 
 
 class BaseModel(db.Model):
   """Abstract base model with useful generic methods."""
 
+  # Seconds MemcacheWrappedGet keeps entities and properties in the instance
+  # tier, INSTANCE_CACHE; 0 disables it. Only enable it for kinds which are
+  # read often, change rarely and whose entities callers do not modify.
+  INSTANCE_CACHE_SECS = 0
+  # Bytes of entities and properties of the kind kept in the instance tier.
+  INSTANCE_CACHE_BYTES = 1024 * 1024
+
   @classmethod
   def MemcacheAddAutoUpdateTask(cls, func, *args, **kwargs):
     """Sets a memcache auto update task.
@@ -106,6 +137,13 @@ class BaseModel(db.Model):
     else:
       memcache_key = 'mwg_%s_%s' % (cls.kind(), key_name)
     memcache.delete(memcache_key)
+    cls._InvalidateInstanceCache()
+
+  @classmethod
+  def _InvalidateInstanceCache(cls):
+    """Drops cached entities of the kind from the instance tier everywhere."""
+    if cls.INSTANCE_CACHE_SECS:
+      INSTANCE_CACHE.Invalidate(cls.kind())
 
   @classmethod
   def ResetMemcacheWrap(
@@ -127,6 +165,13 @@ class BaseModel(db.Model):
       retry=False):
     """Fetches an entity by key name from model wrapped by Memcache.
 
+    Refills are leased with gae_util.LeasedCacheGet, so that when a popular
+    entity expires only one caller fetches it from Datastore.
+
+    If INSTANCE_CACHE_SECS is set, decoded entities and property values are
+    also kept in the instance tier, INSTANCE_CACHE, in front of memcache. These
+    are shared between requests, so must not be modified.
+
     Args:
       key_name: str key name of the entity to fetch.
       prop_name: optional property name to return the value for instead of
@@ -147,34 +192,18 @@ class BaseModel(db.Model):
     else:
       memcache_key = 'mwg_%s_%s' % (cls.kind(), key_name)
 
-    cached = memcache.get(memcache_key)
-
-    if cached is None:
-      entity = cls.get_by_key_name(key_name)
-      if not entity:
-        return
+    if cls.INSTANCE_CACHE_SECS:
+      output = INSTANCE_CACHE.Get(cls.kind(), memcache_key)
+      if output is not None:
+        instrumentation.Record('MemcacheWrappedGet.instance_hit')
+        return output
 
-      if prop_name:
-        try:
-          output = getattr(entity, prop_name)
-        except AttributeError:
-          logging.error(
-              'Retrieving missing property %s on %s',
-              prop_name,
-              entity.__class__.__name__)
-          return
-        to_cache = output
-      else:
-        output = entity
-        to_cache = db.model_to_protobuf(entity).SerializeToString()
+    with instrumentation.Timer('MemcacheWrappedGet.memcache_ms'):
+      cached, refill = gae_util.LeasedCacheGet(memcache_key)
 
-      try:
-        memcache.set(memcache_key, to_cache, memcache_secs)
-      except ValueError, e:
-        logging.warning(
-            'MemcacheWrappedGet: failure to memcache.set(%s, ...): %s',
-            memcache_key, str(e))
-    else:
+    if cached is not None:
+      if isinstance(cached, basestring):
+        instrumentation.Record('MemcacheWrappedGet.bytes', len(cached))
       if prop_name:
         output = cached
       else:
@@ -188,6 +217,8 @@ class BaseModel(db.Model):
           # classes.
           output = None
           memcache.delete(memcache_key)
+          if refill:
+            gae_util.ReleaseLease(memcache_key)
           if e.__class__.__name__ == 'ProtocolBufferDecodeError':
             logging.warning('Invalid protobuf at key %s', key_name)
           elif retry:
@@ -198,14 +229,175 @@ class BaseModel(db.Model):
                 retry=True)
           else:
             return cls.get_by_key_name(key_name)
+      if not refill:
+        instrumentation.Record('MemcacheWrappedGet.hit')
+        cls._SetInstanceCache(memcache_key, output, cached)
+        return output
+
+    # cache miss, or this caller holds the lease to refill a stale copy.
+    # a miss without the lease is only read, as another caller refills it.
+    instrumentation.Record('MemcacheWrappedGet.miss')
+    begin = time.time()
+    with instrumentation.Timer('MemcacheWrappedGet.datastore_ms'):
+      entity = cls.get_by_key_name(key_name)
+    if not entity:
+      if refill:
+        gae_util.ReleaseLease(memcache_key)
+      return
+
+    if prop_name:
+      try:
+        output = getattr(entity, prop_name)
+      except AttributeError:
+        logging.error(
+            'Retrieving missing property %s on %s',
+            prop_name,
+            entity.__class__.__name__)
+        if refill:
+          gae_util.ReleaseLease(memcache_key)
+        return
+      to_cache = output
+    else:
+      output = entity
+      to_cache = db.model_to_protobuf(entity).SerializeToString()
+
+    if refill:
+      try:
+        gae_util.LeasedCacheSet(
+            memcache_key, to_cache, memcache_secs, delta=time.time() - begin)
+      except ValueError, e:
+        logging.warning(
+            'MemcacheWrappedGet: failure to memcache.set(%s, ...): %s',
+            memcache_key, str(e))
+    cls._SetInstanceCache(memcache_key, output, to_cache)
 
     return output
 
+  @classmethod
+  def MemcacheWrappedGetMulti(
+      cls, key_names, prop_name=None, memcache_secs=MEMCACHE_SECS):
+    """Fetches entities by key names from model wrapped by Memcache.
+
+    Like MemcacheWrappedGet, but with one memcache.get_multi, one Datastore
+    get for all misses and one memcache.set_multi to backfill them. Corrupt
+    cached protobufs are deleted from memcache and fetched from Datastore.
+    Refills are not leased, so copies due for a refill are served until they
+    expire, up to gae_util.STALE_SECS later.
+
+    Args:
+      key_names: list of str key names of the entities to fetch.
+      prop_name: optional property name to return the values for instead of
+        returning the entire entities.
+      memcache_secs: int seconds to store in memcache; default MEMCACHE_SECS.
+    Returns:
+      list in the order of key_names of db.Model entities, or prop_name
+      property values if prop_name is given, with None for entities that do
+      not exist.
+    """
+    if prop_name:
+      memcache_keys = ['mwgpn_%s_%s_%s' % (cls.kind(), key_name, prop_name)
+                       for key_name in key_names]
+    else:
+      memcache_keys = ['mwg_%s_%s' % (cls.kind(), key_name)
+                       for key_name in key_names]
+
+    outputs = {}
+    if cls.INSTANCE_CACHE_SECS:
+      for memcache_key in memcache_keys:
+        output = INSTANCE_CACHE.Get(cls.kind(), memcache_key)
+        if output is not None:
+          outputs[memcache_key] = output
+
+    to_get = [k for k in memcache_keys if k not in outputs]
+    cached = {}
+    if to_get:
+      cached = memcache.get_multi(to_get)
+    corrupt = []
+    for memcache_key, value in cached.iteritems():
+      value = gae_util.UnwrapCacheValue(value)
+      if prop_name:
+        outputs[memcache_key] = value
+      else:
+        try:
+          outputs[memcache_key] = db.model_from_protobuf(value)
+        except Exception, e:  # pylint: disable=broad-except
+          # see MemcacheWrappedGet for why the exception class is not trapped.
+          corrupt.append(memcache_key)
+          if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            logging.warning('Invalid protobuf at key %s', memcache_key)
+          else:
+            logging.exception('Unexpected exception in MemcacheWrappedGet')
+          continue
+      cls._SetInstanceCache(memcache_key, outputs[memcache_key], value)
+    if corrupt:
+      memcache.delete_multi(corrupt)
+
+    missing = [(key_name, memcache_key)
+               for key_name, memcache_key in zip(key_names, memcache_keys)
+               if memcache_key not in outputs]
+    if missing:
+      entities = cls.get_by_key_name([m[0] for m in missing])
+      to_cache = {}
+      cache_secs = None
+      for (key_name, memcache_key), entity in zip(missing, entities):
+        if not entity:
+          continue
+        if prop_name:
+          try:
+            output = getattr(entity, prop_name)
+          except AttributeError:
+            logging.error(
+                'Retrieving missing property %s on %s',
+                prop_name,
+                entity.__class__.__name__)
+            continue
+          to_cache[memcache_key] = output
+        else:
+          output = entity
+          to_cache[memcache_key] = db.model_to_protobuf(
+              entity).SerializeToString()
+        outputs[memcache_key] = output
+        cls._SetInstanceCache(memcache_key, output, to_cache[memcache_key])
+        to_cache[memcache_key], cache_secs = gae_util.WrapCacheValue(
+            to_cache[memcache_key], memcache_secs)
+
+      if to_cache:
+        try:
+          memcache.set_multi(to_cache, time=cache_secs)
+        except ValueError, e:
+          logging.warning(
+              'MemcacheWrappedGetMulti: failure to memcache.set_multi: %s',
+              str(e))
+
+    return [outputs.get(memcache_key) for memcache_key in memcache_keys]
+
+  @classmethod
+  def _SetInstanceCache(cls, memcache_key, output, cached):
+    """Keeps a MemcacheWrappedGet result in the instance tier, if enabled.
+
+    Args:
+      memcache_key: str, memcache key of the result.
+      output: db.Model entity or property value to keep.
+      cached: value stored in memcache for output, used to size it.
+    """
+    if not cls.INSTANCE_CACHE_SECS:
+      return
+    if isinstance(cached, basestring):
+      size = len(cached)
+    else:
+      size = len(repr(cached))
+    INSTANCE_CACHE.Set(
+        cls.kind(), memcache_key, output, size, cls.INSTANCE_CACHE_SECS,
+        cls.INSTANCE_CACHE_BYTES)
+
   @classmethod
   def MemcacheWrappedGetAllFilter(
       cls, filters=(), limit=1000, memcache_secs=MEMCACHE_SECS):
     """Fetches all entities for a filter set, wrapped by Memcache.
 
+    Refills are leased with gae_util.LeasedCacheGet, so only one caller at a
+    time runs the query.
+
     Args:
       filters: tuple, optional, filter arguments, e.g.
         ( ( "foo =", True ),
@@ -218,13 +410,21 @@ class BaseModel(db.Model):
     filter_str = '|'.join(map(lambda x: '_%s,%s_' % (x[0], x[1]), filters))
     memcache_key = 'mwgaf_%s%s' % (cls.kind(), filter_str)
 
-    entities = memcache.get(memcache_key)
-    if entities is None:
+    with instrumentation.Timer('MemcacheWrappedGetAllFilter.memcache_ms'):
+      entities, refill = gae_util.LeasedCacheGet(memcache_key)
+    if entities is None or refill:
+      instrumentation.Record('MemcacheWrappedGetAllFilter.miss')
+      begin = time.time()
       query = cls.all()
       for filt, value in filters:
         query = query.filter(filt, value)
-      entities = query.fetch(limit)
-      memcache.set(memcache_key, entities, memcache_secs)
+      with instrumentation.Timer('MemcacheWrappedGetAllFilter.datastore_ms'):
+        entities = query.fetch(limit)
+      if refill:
+        gae_util.LeasedCacheSet(
+            memcache_key, entities, memcache_secs, delta=time.time() - begin)
+    else:
+      instrumentation.Record('MemcacheWrappedGetAllFilter.hit')
 
     return entities
 
@@ -258,8 +458,11 @@ class BaseModel(db.Model):
     setattr(entity, prop_name, value)
     entity.put()
     entity_protobuf = db.model_to_protobuf(entity).SerializeToString()
-    memcache.set(memcache_key, value, memcache_secs)
-    memcache.set(memcache_entity_key, entity_protobuf, memcache_secs)
+    cached, cache_secs = gae_util.WrapCacheValue(value, memcache_secs)
+    memcache.set(memcache_key, cached, cache_secs)
+    cached, cache_secs = gae_util.WrapCacheValue(entity_protobuf, memcache_secs)
+    memcache.set(memcache_entity_key, cached, cache_secs)
+    cls._InvalidateInstanceCache()
 
   @classmethod
   def MemcacheWrappedDelete(cls, key_name=None, entity=None):
@@ -289,6 +492,7 @@ class BaseModel(db.Model):
       entity.delete()
     memcache_key = 'mwg_%s_%s' % (cls.kind(), key_name)
     memcache.delete(memcache_key)
+    cls._InvalidateInstanceCache()
 
   def put(self, *args, **kwargs):
     """Perform datastore put operation.
@@ -309,13 +513,15 @@ class BasePlistModel(BaseModel):
 
   PLIST_LIB_CLASS = plist_lib.ApplePlist
 
-  _plist = db.TextProperty()  # catalog/manifest/pkginfo plist file.
+  # catalog/manifest/pkginfo plist file.
+  _plist = properties.CompressedTextProperty()
 
   def _ParsePlist(self):
     """Parses the self._plist XML into a plist_lib.ApplePlist object."""
     self._plist_obj = self.PLIST_LIB_CLASS(self._plist.encode('utf-8'))
     try:
-      self._plist_obj.Parse()
+      with instrumentation.Timer('plist.parse_ms'):
+        self._plist_obj.Parse()
     except plist_lib.PlistError, e:
       logging.exception('Error parsing self._plist: %s', str(e))
       self._plist_obj = None
@@ -418,6 +624,9 @@ class Computer(db.Model):
   # The number of preflight connections since the last successful postflight
   # connection. Resets to 0 when a postflight connection is posted.
   preflight_count_since_postflight = db.IntegerProperty(default=0)
+  # serialized summary counts from before the Computer first changed during
+  # a reconcile, see ComputerSummaryShard.PrepareUpdate().
+  summary_base = db.TextProperty()
 
   def _GetUserSettings(self):
     """Returns the user setting dictionary, or None."""
@@ -447,28 +656,31 @@ class Computer(db.Model):
     return cls.all(keys_only=keys_only).filter('active =', True)
 
   @classmethod
-  def MarkInactive(cls):
-    """Marks any inactive computers as such."""
-    count = 0
-    now = datetime.datetime.utcnow()
-    earliest_active_date = now - datetime.timedelta(days=COMPUTER_ACTIVE_DAYS)
+  def MarkInactive(cls, earliest_active_date=None, cursor=None):
+    """Marks any inactive computers as such.
+
+    Runs for up to MARK_INACTIVE_SECS, then continues in a deferred task.
+
+    Args:
+      earliest_active_date: datetime.datetime, optional, preflight time
+          before which computers are inactive; passed on to continuations.
+      cursor: str, optional, query cursor to continue from.
+    Returns:
+      int, number of computers marked inactive by this call.
+    """
+    if earliest_active_date is None:
+      now = datetime.datetime.utcnow()
+      earliest_active_date = now - datetime.timedelta(days=COMPUTER_ACTIVE_DAYS)
     query = cls.AllActive().filter('preflight_datetime <', earliest_active_date)
-    gc.collect()
-    while True:
-      computers = query.fetch(500)
-      if not computers:
-        break
-      for c in computers:
-        c.active = False  # this isn't neccessary, but makes more obvious.
-        c.put()
-        count += 1
-      cursor = str(query.cursor())
-      del(computers)
-      del(query)
-      gc.collect()
-      query = cls.AllActive().filter(
-          'preflight_datetime <', earliest_active_date)
-      query.with_cursor(cursor)
+    computers = gae_util.QueryIterator(
+        query, step=500, time_budget=MARK_INACTIVE_SECS, cursor=cursor)
+    inactive = [c for c in computers]
+    ComputerSummaryShard.PutInactive(inactive)
+    count = len(inactive)
+    if computers.cursor:
+      deferred.defer(
+          cls.MarkInactive, earliest_active_date=earliest_active_date,
+          cursor=computers.cursor)
     return count
 
   def put(self, update_active=True):
@@ -525,10 +737,15 @@ class ComputerLostStolen(db.Model):
       memcache.set('loststolen_uuids', uuids)
     return uuids
 
+  @classmethod
+  def _GetUuidSet(cls):
+    """Returns a frozenset of lost/stolen UUIDs for the instance snapshot."""
+    return frozenset(cls._GetUuids())
+
   @classmethod
   def IsLostStolen(cls, uuid):
     """Returns True if the given str UUID is lost/stolen, False otherwise."""
-    return uuid in cls._GetUuids()
+    return uuid in LOST_STOLEN_SNAPSHOT.Get()
 
   @classmethod
   def AddUuid(cls, uuid):
@@ -540,6 +757,7 @@ class ComputerLostStolen(db.Model):
     ls = cls(key_name=computer.uuid, computer=computer, uuid=uuid)
     ls.put()
     cls._GetUuids(force_refresh=True)
+    LOST_STOLEN_SNAPSHOT.Invalidate()
 
   @classmethod
   def RemoveUuid(cls, uuid):
@@ -550,6 +768,7 @@ class ComputerLostStolen(db.Model):
       return  # do nothing; the UUID is already not set as lost/stolen.
     computer.delete()
     cls._GetUuids(force_refresh=True)
+    LOST_STOLEN_SNAPSHOT.Invalidate()
 
   @classmethod
   def LogLostStolenConnection(cls, computer, ip_address):
@@ -563,6 +782,10 @@ class ComputerLostStolen(db.Model):
     ls.put()
 
 
+LOST_STOLEN_SNAPSHOT = gae_util.InstanceSnapshot(
+    'loststolen_uuids', ComputerLostStolen._GetUuidSet)
+
+
 class ComputerMSULog(db.Model):
   """Store MSU logs as state information.
 
@@ -652,6 +875,232 @@ class InstallLog(ClientLogBase):
     return super(InstallLog, self).put()
 
 
+class InstallRollup(BaseModel):
+  """Sharded install counts of a package in an hour.
+
+  key = hour_package_shard, like 2012-03-09-10_Firefox_3
+  """
+
+  COUNT_PROPERTIES = (
+      'install_count', 'install_fail_count', 'duration_count',
+      'duration_total_seconds')
+  HISTOGRAM_PROPERTIES = ('duration_histogram', 'dl_kbytes_per_sec_histogram')
+
+  hour = db.DateTimeProperty()
+  package = db.StringProperty()
+  applesus = db.BooleanProperty(default=False)
+  install_count = db.IntegerProperty(default=0)
+  install_fail_count = db.IntegerProperty(default=0)
+  duration_count = db.IntegerProperty(default=0)
+  duration_total_seconds = db.IntegerProperty(default=0)
+  # serialized histograms of successful installs, see common.histogram.
+  duration_histogram = db.TextProperty()
+  dl_kbytes_per_sec_histogram = db.TextProperty()
+  mtime = db.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def GetHour(cls, dt):
+    """Returns a datetime.datetime truncated to the hour."""
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+  def GetHistogram(self, name):
+    """Returns the dict histogram of a histogram property name."""
+    value = getattr(self, name)
+    if value:
+      return util.Deserialize(value)
+    return {}
+
+  def _AddToHistogram(self, name, value):
+    """Adds a value to the histogram of a histogram property name."""
+    h = self.GetHistogram(name)
+    histogram.Add(h, value)
+    setattr(self, name, util.Serialize(h))
+
+  def _AddInstall(self, install):
+    """Adds an InstallLog entity to the counts of this rollup."""
+    if install.IsSuccess():
+      self.install_count += 1
+      if install.duration_seconds is not None:
+        self.duration_count += 1
+        self.duration_total_seconds += install.duration_seconds
+        self._AddToHistogram('duration_histogram', install.duration_seconds)
+      if install.dl_kbytes_per_sec is not None:
+        self._AddToHistogram(
+            'dl_kbytes_per_sec_histogram', install.dl_kbytes_per_sec)
+    else:
+      self.install_fail_count += 1
+
+  def _AddRollup(self, rollup):
+    """Adds the counts of another rollup of the same key to this rollup."""
+    for name in self.COUNT_PROPERTIES:
+      setattr(self, name, getattr(self, name) + getattr(rollup, name))
+    for name in self.HISTOGRAM_PROPERTIES:
+      h = histogram.Merge(self.GetHistogram(name), rollup.GetHistogram(name))
+      setattr(self, name, util.Serialize(h))
+
+  @classmethod
+  def _AddRollups(cls, rollups, batch):
+    """Adds rollups to the stored ones of the same keys, once per batch.
+
+    Args:
+      rollups: list of up to MAX_XG_ENTITY_GROUPS - 1 InstallRollup entities.
+      batch: str, unique id of the rollups; adding them again is harmless.
+    """
+    def _Add():
+      if InstallRollupBatch.get_by_key_name(batch):
+        return  # added already, i.e. by a transaction reported as failed.
+      stored = db.get([rollup.key() for rollup in rollups])
+      for i, rollup in enumerate(rollups):
+        if stored[i]:
+          stored[i]._AddRollup(rollup)
+        else:
+          stored[i] = rollup
+      db.put(stored + [InstallRollupBatch(key_name=batch)])
+
+    options = db.create_transaction_options(
+        xg=True, retries=INSTALL_ROLLUP_RETRIES)
+    db.run_in_transaction_options(options, _Add)
+
+  @classmethod
+  def AddInstalls(cls, installs, batch=None):
+    """Adds a batch of installs to the rollups of their hours.
+
+    Rollups are added in cross-group transactions, each marked done by an
+    InstallRollupBatch entity. Rollups of a transaction which fails are
+    added by a deferred task, which retries until they are added once.
+
+    Args:
+      installs: list of InstallLog entities; installs which are not stored
+        yet are counted in the current hour.
+      batch: str, optional, unique id of the installs, so adding them again
+        is harmless; defaults to a random id.
+    """
+    batch = batch or '%016x' % random.getrandbits(64)
+    now = datetime.datetime.utcnow()
+    shard = random.randrange(INSTALL_ROLLUP_SHARDS)
+    rollups = {}
+    for install in installs:
+      if not install.package:
+        continue
+      hour = cls.GetHour(install.server_datetime or now)
+      key_name = '%s_%s_%d' % (
+          hour.strftime('%Y-%m-%d-%H'), install.package, shard)
+      if key_name not in rollups:
+        rollups[key_name] = cls(
+            key_name=key_name, hour=hour, package=install.package,
+            applesus=bool(install.applesus))
+      rollups[key_name]._AddInstall(install)
+
+    # one entity group of each transaction is its InstallRollupBatch.
+    size = MAX_XG_ENTITY_GROUPS - 1
+    rollups = [rollups[k] for k in sorted(rollups)]
+    for i in xrange(0, len(rollups), size):
+      chunk = rollups[i:i + size]
+      chunk_batch = '%s_%d' % (batch, i / size)
+      try:
+        cls._AddRollups(chunk, chunk_batch)
+      except (db.Error, apiproxy_errors.Error) as e:
+        logging.warning(
+            'InstallRollup._AddRollups() error %s: %s; deferring.',
+            e.__class__.__name__, str(e))
+        deferred.defer(cls._AddRollups, chunk, chunk_batch, _countdown=10)
+
+  @classmethod
+  def GetInstallCounts(cls, since=None, until=None):
+    """Returns install counts of packages summed over a range of hours.
+
+    Args:
+      since: datetime.datetime, optional, first hour to count.
+      until: datetime.datetime, optional, hour to stop counting before.
+    Returns:
+      dict of package name: dict of install counts; install_count,
+      install_fail_count, duration_count, duration_total_seconds, applesus,
+      and dict histograms duration_histogram and dl_kbytes_per_sec_histogram.
+    """
+    query = cls.all()
+    if since:
+      query.filter('hour >=', since)
+    if until:
+      query.filter('hour <', until)
+    pkgs = {}
+    for rollup in gae_util.QueryIterator(query):
+      pkg = pkgs.setdefault(rollup.package, {'applesus': rollup.applesus})
+      for name in cls.COUNT_PROPERTIES:
+        pkg[name] = pkg.get(name, 0) + getattr(rollup, name)
+      for name in cls.HISTOGRAM_PROPERTIES:
+        pkg[name] = histogram.Merge(
+            pkg.get(name, {}), rollup.GetHistogram(name))
+    return pkgs
+
+
+class InstallRollupBatch(BaseModel):
+  """Marks a batch of rollups as added to InstallRollup entities.
+
+  key = batch id, like 1f0c3a9be2d47a68_0
+  """
+
+  mtime = db.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def DeleteOld(cls, now=None):
+    """Deletes markers older than INSTALL_ROLLUP_BATCH_DAYS.
+
+    Args:
+      now: datetime.datetime, optional, supply an alternative
+        value for the current date/time
+    """
+    now = now or datetime.datetime.utcnow()
+    earliest = now - datetime.timedelta(days=INSTALL_ROLLUP_BATCH_DAYS)
+    query = cls.all(keys_only=True).filter('mtime <', earliest)
+    gae_util.BatchDatastoreOp(db.delete, list(gae_util.QueryIterator(query)))
+
+
+class LogRollup(BaseModel):
+  """Counts of log entities of a day, rolled up by a retention run.
+
+  key = kind_date_run, like ClientLog_2012-03-09_2012-06-09-00-00-00-000000
+  """
+
+  kind_name = db.StringProperty()
+  date = db.DateProperty()
+  counts = db.TextProperty()  # serialized dict of counter name: int.
+  mtime = db.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def SetCounts(cls, kind_name, run, daily_counts):
+    """Saves the counts of a retention run; putting them again is harmless.
+
+    Args:
+      kind_name: str, kind of the logs counted.
+      run: str, retention run id.
+      daily_counts: dict of str date like 2012-03-09: dict of counter: int.
+    """
+    rollups = []
+    for date, counts in daily_counts.iteritems():
+      rollups.append(cls(
+          key_name='%s_%s_%s' % (kind_name, date, run), kind_name=kind_name,
+          date=datetime.datetime.strptime(date, '%Y-%m-%d').date(),
+          counts=util.Serialize(counts)))
+    gae_util.BatchDatastoreOp(db.put, rollups)
+
+  @classmethod
+  def GetCounts(cls, kind_name):
+    """Returns rolled up counts of a kind, summed over all runs.
+
+    Args:
+      kind_name: str, kind of the logs counted.
+    Returns:
+      dict of datetime.date: dict of counter name: int.
+    """
+    daily_counts = {}
+    query = cls.all().filter('kind_name =', kind_name)
+    for rollup in gae_util.QueryIterator(query):
+      counts = daily_counts.setdefault(rollup.date, {})
+      for name, value in util.Deserialize(rollup.counts).iteritems():
+        counts[name] = counts.get(name, 0) + value
+    return daily_counts
+
+
 class AdminLogBase(Log):
   """AdminLogBase model for all admin interaction."""
 
@@ -746,6 +1195,11 @@ class KeyValueCache(BaseModel):
   blob_value = db.BlobProperty()
   mtime = db.DateTimeProperty(auto_now=True)
 
+  INSTANCE_CACHE_SECS = 30
+
+  # compiled IpInList() networks per instance, key_name: (mtime, trie).
+  _ip_prefix_tries = {}
+
   @classmethod
   def IpInList(cls, key_name, ip):
     """Check whether IP is in serialized IP/mask list in key_name.
@@ -755,61 +1209,67 @@ class KeyValueCache(BaseModel):
 
     [ "200.0.0.0/24",
       "10.0.0.0/8",
+      "2620:0:1003::/48",
       etc ...
     ]
 
-    Note that this function is not IPv6 safe and will always return False
-    if the input ip is IPv6 format.
+    The list is compiled into an ipcalc.IpPrefixTrie which is cached on the
+    instance until the entity mtime changes, so most calls only walk the
+    trie and do not deserialize anything.
 
     Args:
       key_name: str, like 'auth_bad_ip_blocks'
-      ip: str, like '127.0.0.1'
+      ip: str, like '127.0.0.1' or '2620:0:1003:1007:216:36ff:feee:f090'
     Returns:
       True if the ip is inside a mask in the list, False if not
     """
     if not ip:
       return False  # lenient response
 
-    # TODO(user): Once the underlying util.Ip* methods support ipv6
-    # this method can go away. Until then, this stops all of the churn
-    # and exits early.
-    if ip.find(':') > -1:  # ipv6
-      return False
-
     try:
-      ip_blocks_str = cls.MemcacheWrappedGet(key_name, 'text_value')
-      if not ip_blocks_str:
-        return False
-      ip_blocks = util.Deserialize(ip_blocks_str)
-    except (util.DeserializeError, db.Error):
+      entity = cls.MemcacheWrappedGet(key_name)
+    except db.Error:
       logging.exception('IpInList(%s)', ip)
       return False  # lenient response
+    if not entity or not entity.text_value:
+      return False
 
-    # Note: The method below, parsing a serialized list of networks
-    # expressed as strings, might seem silly. But the total time to
-    # deserialize and translate the strings back into IP network/mask
-    # integers is actually faster than storing them already split, e.g. a
-    # list of 2 item lists (network,mask). Apparently JSON isn't as
-    # efficient at parsing ints or nested lists.
-    #
-    # (pickle is 2X+ faster but not secure & deprecated inside util module)
-
-    ip_int = ipcalc.IpToInt(ip)
-
-    for ip_mask_str in ip_blocks:
-      ip_mask = ipcalc.IpMaskToInts(ip_mask_str)
-      if (ip_int & ip_mask[1]) == ip_mask[0]:
-        return True
+    cached = cls._ip_prefix_tries.get(key_name)
+    if cached and cached[0] == entity.mtime:
+      trie = cached[1]
+    else:
+      try:
+        ip_blocks = util.Deserialize(entity.text_value)
+      except util.DeserializeError:
+        logging.exception('IpInList(%s)', ip)
+        return False  # lenient response
+      trie = ipcalc.IpPrefixTrie()
+      for ip_mask_str in ip_blocks:
+        try:
+          trie.Add(ip_mask_str)
+        except ValueError:
+          logging.warning('IpInList(%s): invalid network %s', key_name,
+                          ip_mask_str)
+      cls._ip_prefix_tries[key_name] = (entity.mtime, trie)
 
-    return False
+    try:
+      return trie.Contains(ip)
+    except ValueError:
+      logging.warning('IpInList(%s): invalid ip %s', key_name, ip)
+      return False
 
   @classmethod
   def GetSerializedItem(cls, key):
     """Returns the deserialized value of a serialized cache."""
     entity = cls.MemcacheWrappedGet(key)
     if entity and entity.blob_value:
-      return util.Deserialize(entity.blob_value), entity.mtime
+      instrumentation.Record('GetSerializedItem.hit')
+      instrumentation.Record(
+          'GetSerializedItem.bytes', len(entity.blob_value))
+      with instrumentation.Timer('GetSerializedItem.deserialize_ms'):
+        return util.Decode(entity.blob_value), entity.mtime
     else:
+      instrumentation.Record('GetSerializedItem.miss')
       return {}, None
 
   @classmethod
@@ -820,7 +1280,7 @@ class KeyValueCache(BaseModel):
       key: str, key_name for the ReportsCache entity.
       value: any, a value of any kind to serialize and cache.
     """
-    value = util.Serialize(value)
+    value = util.Encode(value)
     cls.MemcacheWrappedSet(key, 'blob_value', value)
 
   @classmethod
@@ -841,9 +1301,12 @@ class ReportsCache(KeyValueCache):
 
   _SUMMARY_KEY = 'summary'
   _INSTALL_COUNTS_KEY = 'install_counts'
+  _INSTALL_COUNTS_FOLDED_KEY = 'install_counts_folded'
   _TRENDING_INSTALLS_KEY = 'trending_installs_%d_hours'
   _PENDING_COUNTS_KEY = 'pending_counts'
   _MSU_USER_SUMMARY_KEY = 'msu_user_summary'
+  _STATS_VIEW_KEY = 'stats_view_%s_%s'
+  _STATS_VIEW_FILTERS_KEY = 'stats_view_filters_%s'
 
   int_value = db.IntegerProperty()
 
@@ -877,6 +1340,20 @@ class ReportsCache(KeyValueCache):
     """
     return cls.SetSerializedItem(cls._INSTALL_COUNTS_KEY, d)
 
+  @classmethod
+  def GetInstallCountsFolded(cls):
+    """Returns tuple (folded install counts dict, datetime) from Datastore."""
+    return cls.GetSerializedItem(cls._INSTALL_COUNTS_FOLDED_KEY)
+
+  @classmethod
+  def SetInstallCountsFolded(cls, d):
+    """Sets the install counts of InstallRollup hours folded so far.
+
+    Args:
+      d: dict with "hour", str hour folded up to, and "pkgs", install counts.
+    """
+    return cls.SetSerializedItem(cls._INSTALL_COUNTS_FOLDED_KEY, d)
+
   @classmethod
   def GetTrendingInstalls(cls, since_hours):
     key = cls._TRENDING_INSTALLS_KEY % since_hours
@@ -901,6 +1378,35 @@ class ReportsCache(KeyValueCache):
     """
     return cls.SetSerializedItem(cls._PENDING_COUNTS_KEY, d)
 
+  @classmethod
+  def GetStatsView(cls, report_type, report_filter):
+    """Returns tuple (stats summary dict, datetime) of a filtered view.
+
+    Args:
+      report_type: str, Computer property the view filters on, i.e. site.
+      report_filter: str, value of the property, i.e. NYC.
+    """
+    return cls.GetSerializedItem(
+        cls._STATS_VIEW_KEY % (report_type, report_filter))
+
+  @classmethod
+  def SetStatsViews(cls, report_type, views):
+    """Sets all filtered views of a report type, deleting stale ones.
+
+    Args:
+      report_type: str, Computer property the views filter on, i.e. site.
+      views: dict of str report filter: dict stats summary.
+    """
+    key = cls._STATS_VIEW_FILTERS_KEY % report_type
+    old_filters, unused_dt = cls.GetSerializedItem(key)
+    for report_filter, summary in views.iteritems():
+      cls.SetSerializedItem(
+          cls._STATS_VIEW_KEY % (report_type, report_filter), summary)
+    for report_filter in set(old_filters) - set(views):
+      cls.MemcacheWrappedDelete(
+          cls._STATS_VIEW_KEY % (report_type, report_filter))
+    cls.SetSerializedItem(key, sorted(views))
+
   @classmethod
   def _GetMsuUserSummaryKey(cls, since, tmp):
     if since is not None:
@@ -948,6 +1454,404 @@ class ReportsCache(KeyValueCache):
     entity.delete()
 
 
+class ComputerSummaryShard(BaseModel):
+  """Sharded counts of Computers, by the date of their last preflight.
+
+  Each Computer adds its GetComputerCounts() to the counts of one date, so the
+  counts of the last N dates summarize the Computers active in the past N
+  days.
+
+  Counts belong to a generation, and readers only read the current one. A
+  reconcile counts Computers into a new pending generation, which live updates
+  are added to as well until the reconcile switches readers over to it, so
+  updates made while the reconcile runs are kept; see PrepareUpdate(). Live
+  updates read the generations from an instance snapshot, and the reconcile
+  only starts counting once all instances have seen its pending generation.
+
+  key = generation_date_shard, like 3_2012-03-09_7, or generation_date_base
+  for the counts of a reconcile.
+  """
+
+  GENERATIONS_KEY = 'computer_summary_generations'
+
+  generation = db.IntegerProperty()
+  date = db.DateProperty()
+  counts = db.TextProperty()  # serialized dict of counter name: int.
+  mtime = db.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def GetComputerCounts(cls, c, connections=False):
+    """Returns the summary counters of a Computer.
+
+    Args:
+      c: models.Computer entity.
+      connections: bool, optional, include the conns_on_corp and
+        conns_off_corp totals. They change on every postflight, so are only
+        counted by reconciles rather than by UpdateCounts().
+    Returns:
+      tuple (datetime.date of the last preflight, dict of counter name: int),
+      or None if the computer never had a preflight or is inactive.
+    """
+    if not c.preflight_datetime or not c.active:
+      return None
+
+    connections_on_corp = c.connections_on_corp or 0
+    connections_off_corp = c.connections_off_corp or 0
+    if connections_off_corp:
+      # group percentage off corp into buckets; 0-9, 10-19, ..., 90-99, 100.
+      bucket_number = int(float(connections_off_corp) / (
+          connections_off_corp + connections_on_corp) * 10)
+      if bucket_number == 10:  # bucket 100% into their own
+        bucket = '100'
+      else:
+        bucket = ' %s0-%s9' % (bucket_number, bucket_number)
+    else:
+      bucket = ' -never-'
+
+    counts = {
+        'active': 1,
+        'track:%s' % c.track: 1,
+        'os_version:%s' % c.os_version: 1,
+        'client_version:%s' % c.client_version: 1,
+        'site:%s' % c.site: 1,
+        'off_corp_bucket:%s' % bucket: 1,
+    }
+    if connections:
+      counts['conns_on_corp'] = connections_on_corp
+      counts['conns_off_corp'] = connections_off_corp
+    if c.all_pkgs_installed:
+      counts['all_pkgs_installed'] = 1
+    if getattr(c, 'all_apple_updates_installed', False):
+      counts['all_apple_updates_installed'] = 1
+    # pkgs_to_install includes Apple updates, as "AppleSUS: <product_id>".
+    for pkg in set(c.pkgs_to_install or []):
+      counts['pending:%s' % pkg] = 1
+    return c.preflight_datetime.date(), counts
+
+  @classmethod
+  def _GetGenerations(cls):
+    """Returns a dict of the int current and pending generations.
+
+    pending is None unless a reconcile is running.
+    """
+    entity = KeyValueCache.get_by_key_name(cls.GENERATIONS_KEY)
+    if entity and entity.text_value:
+      return util.Deserialize(entity.text_value)
+    return {'current': 0, 'pending': None}
+
+  @classmethod
+  def _SetGenerations(cls, generations):
+    """Saves a dict of the current and pending generations.
+
+    Call GENERATIONS_SNAPSHOT.Invalidate() once the change is committed.
+    """
+    KeyValueCache(
+        key_name=cls.GENERATIONS_KEY,
+        text_value=util.Serialize(generations)).put()
+
+  @classmethod
+  def GetCachedGenerations(cls):
+    """Returns _GetGenerations() output from an instance snapshot.
+
+    The snapshot is at most COMPUTER_SUMMARY_GENERATIONS_SECS old, and costs
+    no RPCs between checks, so live updates do not all read one entity.
+    """
+    return dict(GENERATIONS_SNAPSHOT.Get())
+
+  @classmethod
+  def PrepareUpdate(cls, c, old):
+    """Prepares a change of a Computer for UpdateCounts().
+
+    Call in the transaction which changes the Computer. While a reconcile
+    runs, the counts the Computer had before its first change are saved on
+    it, so the reconcile counts it as it was when the reconcile began, and
+    the changes since are added by UpdateCounts(). Otherwise the Computer is
+    left as it is.
+
+    Args:
+      c: models.Computer entity, to be put by the transaction.
+      old: GetComputerCounts() output before the Computer changed.
+    Returns:
+      dict of generations to pass to UpdateCounts().
+    """
+    generations = cls.GetCachedGenerations()
+    pending = generations['pending']
+    if pending is not None:
+      base = c.summary_base and util.Deserialize(c.summary_base)
+      if not base or base['generation'] != pending:
+        if old:
+          old = [str(old[0]), old[1]]
+        c.summary_base = util.Serialize({'generation': pending, 'counts': old})
+    return generations
+
+  @classmethod
+  def _AddToShards(cls, generations, date, delta):
+    """Adds a dict of counter deltas to a random shard of a date.
+
+    Args:
+      generations: dict, PrepareUpdate() output; deltas are added to both
+        the current and pending generations.
+      date: datetime.date of the counters.
+      delta: dict of counter name: int delta.
+    """
+    shard = random.randrange(COMPUTER_SUMMARY_SHARDS)
+    generations = [g for g in (generations['current'], generations['pending'])
+                   if g is not None]
+    key_names = ['%d_%s_%d' % (g, date, shard) for g in generations]
+
+    def _Add():
+      to_put = []
+      entities = cls.get_by_key_name(key_names)
+      for generation, key_name, entity in zip(
+          generations, key_names, entities):
+        if entity:
+          counts = util.Deserialize(entity.counts)
+        else:
+          entity = cls(key_name=key_name, generation=generation, date=date)
+          counts = {}
+        for name, value in delta.iteritems():
+          counts[name] = counts.get(name, 0) + value
+          if not counts[name]:
+            del counts[name]
+        entity.counts = util.Serialize(counts)
+        to_put.append(entity)
+      db.put(to_put)
+
+    if len(key_names) > 1:
+      db.run_in_transaction_options(
+          db.create_transaction_options(xg=True), _Add)
+    else:
+      db.run_in_transaction(_Add)
+
+  @classmethod
+  def UpdateCounts(cls, old, new, generations=None):
+    """Moves a Computer from its old summary counters to its new ones.
+
+    Args:
+      old: GetComputerCounts() output before the Computer changed.
+      new: GetComputerCounts() output after the Computer changed.
+      generations: dict, optional, PrepareUpdate() output of the change.
+    """
+    if old == new:
+      return
+    deltas = {}
+    if old:
+      deltas[old[0]] = dict((k, -v) for k, v in old[1].iteritems())
+    if new:
+      delta = deltas.setdefault(new[0], {})
+      for name, value in new[1].iteritems():
+        delta[name] = delta.get(name, 0) + value
+
+    if generations is None:
+      generations = cls.GetCachedGenerations()
+    earliest = datetime.datetime.utcnow().date() - datetime.timedelta(
+        days=COMPUTER_ACTIVE_DAYS)
+    for date, delta in sorted(deltas.iteritems()):
+      delta = dict((k, v) for k, v in delta.iteritems() if v)
+      # dates before the summary window are not read, so skip them.
+      if delta and date >= earliest:
+        cls._AddToShards(generations, date, delta)
+
+  @classmethod
+  def PutInactive(cls, computers):
+    """Marks active Computers inactive, and removes them from the counters.
+
+    A reconcile running meanwhile may have counted them already, or not at
+    all as it only reads active Computers, so they are only removed from
+    the current generation; the pending one is at most off until the next
+    reconcile.
+
+    Args:
+      computers: list of models.Computer entities.
+    """
+    olds = [cls.GetComputerCounts(c) for c in computers]
+    for c in computers:
+      c.active = False
+    # db.put() skips Computer.put(), so active is not recalculated.
+    gae_util.BatchDatastoreOp(db.put, computers)
+    generations = cls.GetCachedGenerations()
+    generations['pending'] = None
+    for old in olds:
+      # summary counters are reconciled regularly, so don't fail the put.
+      try:
+        cls.UpdateCounts(old, None, generations)
+      except (db.Error, apiproxy_errors.Error) as e:
+        logging.warning(
+            'ComputerSummaryShard.UpdateCounts() error %s: %s',
+            e.__class__.__name__, str(e))
+
+  @classmethod
+  def GetDailyCounts(cls, days=COMPUTER_ACTIVE_DAYS):
+    """Returns summary counts of the past days.
+
+    Args:
+      days: int, number of days including today to return counts for.
+    Returns:
+      dict of datetime.date: dict of counter name: int.
+    """
+    since = datetime.datetime.utcnow().date() - datetime.timedelta(
+        days=days - 1)
+    query = cls.all().filter('generation =', cls._GetGenerations()['current'])
+    daily_counts = {}
+    for shard in query.filter('date >=', since):
+      counts = daily_counts.setdefault(shard.date, {})
+      for name, value in util.Deserialize(shard.counts).iteritems():
+        counts[name] = counts.get(name, 0) + value
+    return daily_counts
+
+  @classmethod
+  def BeginReconcile(cls):
+    """Begins a pending generation for a reconcile to count Computers into.
+
+    Returns:
+      int, the pending generation.
+    """
+    def _Begin():
+      generations = cls._GetGenerations()
+      generations['pending'] = max(
+          generations['current'], generations['pending'] or 0) + 1
+      cls._SetGenerations(generations)
+      return generations['pending']
+
+    generation = db.run_in_transaction(_Begin)
+    GENERATIONS_SNAPSHOT.Invalidate()
+    return generation
+
+  @classmethod
+  def GetReconcileCounts(cls, c, generation):
+    """Returns the counts a reconcile counts a Computer with.
+
+    Args:
+      c: models.Computer entity.
+      generation: int, BeginReconcile() output.
+    Returns:
+      GetComputerCounts() output with connection totals, of the Computer as
+      it was when the reconcile began.
+    """
+    base = c.summary_base and util.Deserialize(c.summary_base)
+    if not base or base['generation'] != generation:
+      return cls.GetComputerCounts(c, connections=True)
+    if not base['counts']:
+      return None
+    date, counts = base['counts']
+    counts = dict(counts)
+    # connection totals are not updated live, so any date may hold them.
+    counts['conns_on_corp'] = c.connections_on_corp or 0
+    counts['conns_off_corp'] = c.connections_off_corp or 0
+    return datetime.datetime.strptime(date, '%Y-%m-%d').date(), counts
+
+  @classmethod
+  def SetDailyCounts(cls, daily_counts, generation):
+    """Saves reconciled counts to a pending generation and makes it current.
+
+    Reconciled counts are put to their own shard of each date, so saving
+    them again, i.e. from a retried reconcile, is harmless.
+
+    Args:
+      daily_counts: dict of datetime.date: dict of counter name: int.
+      generation: int, BeginReconcile() output.
+    Returns:
+      True if the generation is current, False if a newer reconcile began
+      since.
+    """
+    shards = []
+    for date, counts in daily_counts.iteritems():
+      shard = cls(
+          key_name='%d_%s_base' % (generation, date), generation=generation,
+          date=date)
+      shard.counts = util.Serialize(counts)
+      shards.append(shard)
+    gae_util.BatchDatastoreOp(db.put, shards)
+
+    def _Switch():
+      generations = cls._GetGenerations()
+      if generations['current'] == generation:
+        return True
+      if generations['pending'] != generation:
+        return False
+      cls._SetGenerations({'current': generation, 'pending': None})
+      return True
+
+    if not db.run_in_transaction(_Switch):
+      return False
+    GENERATIONS_SNAPSHOT.Invalidate()
+    prefix = '%d_' % generation
+    stale = [k for k in cls.all(keys_only=True)
+             if not k.name().startswith(prefix)]
+    gae_util.BatchDatastoreOp(db.delete, stale)
+    return True
+
+
+GENERATIONS_SNAPSHOT = gae_util.InstanceSnapshot(
+    'computer_summary_generations', ComputerSummaryShard._GetGenerations,
+    ttl=COMPUTER_SUMMARY_GENERATIONS_SECS)
+
+
+class FleetMetric(BaseModel):
+  """Daily values of one fleet metric in one year, i.e. active clients.
+
+  key = metric_year, like active_30d_2012
+  """
+
+  DATE_FORMAT = '%Y-%m-%d'
+
+  metric = db.StringProperty()
+  year = db.IntegerProperty()
+  values = db.TextProperty()  # serialized dict of str date: int or float.
+  mtime = db.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def SetDay(cls, date, metrics):
+    """Sets the values of metrics for a day, putting only changed ones.
+
+    Args:
+      date: datetime.date of the values.
+      metrics: dict of str metric name: int or float value.
+    """
+    names = sorted(metrics)
+    day = date.strftime(cls.DATE_FORMAT)
+    key_names = ['%s_%d' % (name, date.year) for name in names]
+    to_put = []
+    for name, key_name, entity in zip(
+        names, key_names, cls.get_by_key_name(key_names)):
+      if entity:
+        values = util.Deserialize(entity.values)
+      else:
+        entity = cls(key_name=key_name, metric=name, year=date.year)
+        values = {}
+      if values.get(day) != metrics[name]:
+        values[day] = metrics[name]
+        entity.values = util.Serialize(values)
+        to_put.append(entity)
+    gae_util.BatchDatastoreOp(db.put, to_put)
+
+  @classmethod
+  def GetRange(cls, metric, start, end):
+    """Returns the daily values of a metric between two dates.
+
+    Args:
+      metric: str metric name.
+      start: datetime.date, first date to return.
+      end: datetime.date, last date to return.
+    Returns:
+      list of (str date, int or float value) tuples, sorted by date. Days
+      without a value are skipped.
+    """
+    key_names = [
+        '%s_%d' % (metric, year) for year in xrange(start.year, end.year + 1)]
+    start = start.strftime(cls.DATE_FORMAT)
+    end = end.strftime(cls.DATE_FORMAT)
+    points = []
+    for entity in cls.get_by_key_name(key_names):
+      if not entity:
+        continue
+      for day, value in util.Deserialize(entity.values).iteritems():
+        if start <= day <= end:
+          points.append((day, value))
+    points.sort()
+    return points
+
+
 # Munki ########################################################################
 
 
@@ -1060,9 +1964,13 @@ class Tag(BaseModel):
     """Returns a list of all tag names."""
     tags = memcache.get(cls.ALL_TAGS_MEMCACHE_KEY)
     if not tags:
-      tags = [key.name() for key in cls.all(keys_only=True)]
+      instrumentation.Record('GetAllTagNames.miss')
+      with instrumentation.Timer('GetAllTagNames.datastore_ms'):
+        tags = [key.name() for key in cls.all(keys_only=True)]
       tags = sorted(tags, key=unicode.lower)
       memcache.set(cls.ALL_TAGS_MEMCACHE_KEY, tags)
+    else:
+      instrumentation.Record('GetAllTagNames.hit')
     return tags
 
   @classmethod
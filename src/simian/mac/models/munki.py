@@ -87,6 +87,8 @@ class Catalog(BaseMunkiModel):
   package_names = db.StringListProperty()
 
   PLIST_LIB_CLASS = plist_lib.MunkiPlist
+  INSTANCE_CACHE_SECS = 60
+  INSTANCE_CACHE_BYTES = 8 * 1024 * 1024
 
   @classmethod
   def Generate(cls, name, delay=0):
@@ -104,9 +106,9 @@ class Catalog(BaseMunkiModel):
       deferred.defer(cls.Generate, name, _name=deferred_name, _countdown=delay)
       return
 
-    lock = 'catalog_lock_%s' % name
+    lock = gae_util.Lock('catalog_lock', name, ttl=gae_util.LOCK_TASK_SECS)
     # Obtain a lock on the catalog name.
-    if not gae_util.ObtainLock(lock):
+    if not lock.Acquire():
       # If catalog creation for this name is already in progress then delay.
       logging.debug('Catalog creation for %s is locked. Delaying....', name)
       cls.Generate(name, delay=10)
@@ -133,6 +135,7 @@ class Catalog(BaseMunkiModel):
       c.plist = catalog
       c.put()
       cls.DeleteMemcacheWrap(name, prop_name='plist_xml')
+      cls.DeleteMemcacheWrap(name, prop_name='package_names')
       #logging.debug('Generated catalog successfully: %s', name)
       # Generate manifest for newly generated catalog.
       Manifest.Generate(name, delay=1)
@@ -140,7 +143,7 @@ class Catalog(BaseMunkiModel):
       logging.exception('Catalog.Generate failure for catalog: %s', name)
       raise
     finally:
-      gae_util.ReleaseLock(lock)
+      lock.Release()
 
 
 class Manifest(BaseMunkiModel):
@@ -151,6 +154,7 @@ class Manifest(BaseMunkiModel):
   """
 
   PLIST_LIB_CLASS = plist_lib.MunkiManifestPlist
+  INSTANCE_CACHE_SECS = 60
 
   enabled = db.BooleanProperty(default=True)
 
@@ -170,8 +174,8 @@ class Manifest(BaseMunkiModel):
       deferred.defer(cls.Generate, name, _name=deferred_name, _countdown=delay)
       return
 
-    lock = 'manifest_lock_%s' % name
-    if not gae_util.ObtainLock(lock):
+    lock = gae_util.Lock('manifest_lock', name, ttl=gae_util.LOCK_TASK_SECS)
+    if not lock.Acquire():
       logging.debug(
           'Manifest.Generate for %s is locked. Delaying....', name)
       cls.Generate(name, delay=5)
@@ -209,7 +213,7 @@ class Manifest(BaseMunkiModel):
       logging.exception('Manifest.Generate failure: %s', name)
       raise
     finally:
-      gae_util.ReleaseLock(lock)
+      lock.Release()
 
 
 class PackageInfo(BaseMunkiModel):
@@ -355,8 +359,10 @@ class PackageInfo(BaseMunkiModel):
     Raises:
       PackageInfoUpdateError: a new catalog contains a pkg with the same name.
     """
-    for catalog in new_catalogs:
-      if self.name in Catalog.get_by_key_name(catalog).package_names:
+    package_names = Catalog.MemcacheWrappedGetMulti(
+        new_catalogs, prop_name='package_names')
+    for catalog, names in zip(new_catalogs, package_names):
+      if names and self.name in names:
         raise PackageInfoUpdateError(
             '%r already exists in %r catalog' % (self.name, catalog))
 
@@ -433,14 +439,14 @@ class PackageInfo(BaseMunkiModel):
 
     filename = plist['installer_item_location']
 
-    lock = 'pkgsinfo_%s' % filename
-    if not gae_util.ObtainLock(lock, timeout=5.0):
+    lock = gae_util.Lock('pkgsinfo', filename)
+    if not lock.Acquire(timeout=5.0):
       raise PackageInfoLockError('This PackageInfo is locked.')
 
 
     if create_new:
       if cls.get_by_key_name(filename):
-        gae_util.ReleaseLock(lock)
+        lock.Release()
         raise PackageInfoUpdateError(
             'An existing pkginfo exists for: %s' % filename)
       pkginfo = cls._New(filename)
@@ -451,12 +457,12 @@ class PackageInfo(BaseMunkiModel):
     else:
       pkginfo = cls.get_by_key_name(filename)
       if not pkginfo:
-        gae_util.ReleaseLock(lock)
+        lock.Release()
         raise PackageInfoNotFoundError('pkginfo not found: %s' % filename)
       original_plist = pkginfo.plist.GetXml()
 
     if not pkginfo.IsSafeToModify():
-      gae_util.ReleaseLock(lock)
+      lock.Release()
       raise PackageInfoUpdateError(
           'PackageInfo is not safe to modify; move to unstable first.')
 
@@ -469,10 +475,10 @@ class PackageInfo(BaseMunkiModel):
       cls._PutAndLogPackageInfoUpdate(
           pkginfo, original_plist, original_catalogs)
     except PackageInfoUpdateError:
-      gae_util.ReleaseLock(lock)
+      lock.Release()
       raise
 
-    gae_util.ReleaseLock(lock)
+    lock.Release()
 
     return pkginfo
 
@@ -515,8 +521,8 @@ class PackageInfo(BaseMunkiModel):
 
     original_plist = self.plist.GetXml()
 
-    lock = 'pkgsinfo_%s' % self.filename
-    if not gae_util.ObtainLock(lock, timeout=5.0):
+    lock = gae_util.Lock('pkgsinfo', self.filename)
+    if not lock.Acquire(timeout=5.0):
       raise PackageInfoLockError
 
     if self.IsSafeToModify():
@@ -565,7 +571,7 @@ class PackageInfo(BaseMunkiModel):
       # If not safe to modify, only catalogs/manifests can be changed.
       for k, v in kwargs.iteritems():
         if v and k not in ['catalogs', 'manifests']:
-          gae_util.ReleaseLock(lock)
+          lock.Release()
           raise PackageInfoUpdateError(
               'PackageInfo is not safe to modify; move to unstable first.')
 
@@ -582,10 +588,10 @@ class PackageInfo(BaseMunkiModel):
     try:
       self._PutAndLogPackageInfoUpdate(self, original_plist, original_catalogs)
     except PackageInfoUpdateError:
-      gae_util.ReleaseLock(lock)
+      lock.Release()
       raise
 
-    gae_util.ReleaseLock(lock)
+    lock.Release()
 
   @classmethod
   def GetManifestModPkgNames(
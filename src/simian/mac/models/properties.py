@@ -35,7 +35,7 @@ class SerializedProperty(db.TextProperty):
     if self._obj is None:
       return None
     else:
-      return db.Text(util.Serialize(self._obj))
+      return db.Text(util.Encode(self._obj, binary=False))
 
   # pylint: disable=g-bad-name
   def __get__(self, model_instance, model_class):
@@ -56,7 +56,7 @@ class SerializedProperty(db.TextProperty):
       super(SerializedProperty, self).__set__(model_instance, None)
     elif type(value) is db.Text:
       # If the value is is db.Text, deserialize it to init _obj.
-      self._obj = util.Deserialize(value)
+      self._obj = util.Decode(value)
     else:
       # If the incoming value is a not db.Text, it's an obj so just store it.
       self._obj = value
@@ -79,8 +79,9 @@ class CompressedUtf8BlobProperty(db.BlobProperty):
       self.length = 0
     else:
       self.length = len(value)
-    return db.Blob(
-        compress.CompressedText(value, encoding='utf-8').Compressed())
+    return db.Blob(compress.CompressedText(
+        value, encoding='utf-8',
+        dictionary_id=compress.PLIST_DICTIONARY_ID).Compressed())
 
   # pylint: disable=g-bad-name
   def __get__(self, model_instance, model_class):
@@ -103,10 +104,44 @@ class CompressedUtf8BlobProperty(db.BlobProperty):
       super(CompressedUtf8BlobProperty, self).__set__(model_instance, value)
     else:
       self.length = len(value)
-      value = compress.CompressedText(value, encoding='utf-8').Compressed()
+      value = compress.CompressedText(
+          value, encoding='utf-8',
+          dictionary_id=compress.PLIST_DICTIONARY_ID).Compressed()
       super(CompressedUtf8BlobProperty, self).__set__(model_instance, value)
 
   # pylint: disable=g-bad-name
   def __len__(self):
     """Returns the length of the uncompressed blob data."""
     return self.length
+
+
+class CompressedTextProperty(db.TextProperty):
+  """TextProperty class that is stored as a dictionary compressed Blob.
+
+  Values are compressed with a compress.DICTIONARIES dictionary on their way
+  to Datastore and decompressed when loaded, so the property is otherwise
+  used like a TextProperty. Values stored by a TextProperty load as is.
+  """
+
+  def __init__(
+      self, verbose_name=None, dictionary_id=compress.PLIST_DICTIONARY_ID,
+      **kwargs):
+    super(CompressedTextProperty, self).__init__(verbose_name, **kwargs)
+    self.dictionary_id = dictionary_id
+
+  # pylint: disable=g-bad-name
+  def get_value_for_datastore(self, model_instance):
+    """Compresses the text value on its way to Datastore."""
+    value = super(CompressedTextProperty, self).get_value_for_datastore(
+        model_instance)
+    if value is None:
+      return None
+    return db.Blob(compress.CompressedText(
+        value, dictionary_id=self.dictionary_id).Compressed())
+
+  # pylint: disable=g-bad-name
+  def make_value_from_datastore(self, value):
+    """Decompresses Blob values loaded from Datastore to Text."""
+    if isinstance(value, db.Blob):
+      return db.Text(unicode(compress.CompressedText(value, encoding='utf-8')))
+    return value
@@ -20,12 +20,19 @@
 
 
 
+import copy
 import logging
 
 from google.appengine.ext import db
 
+from simian.mac.common import gae_util
+from simian.mac.common import util
 from simian.mac.models import base
 
+# Seconds between checks of the settings version counter, so changes made on
+# another instance are seen within this many seconds.
+SNAPSHOT_SECS = 5
+
 SETTINGS = {
     'api_info_key': {
         'type': 'random_str',
@@ -179,9 +186,64 @@ class Settings(base.KeyValueCache):
       value: str, value
     """
     if Settings.GetType(name) in ['pem', 'string', 'random_str']:
-      return super(Settings, cls).SetItem(name, value)
+      super(Settings, cls).SetItem(name, value)
     else:
-      return cls.SetSerializedItem(name, value)
+      cls.SetSerializedItem(name, value)
+    SETTINGS_SNAPSHOT.Invalidate()
+
+  @classmethod
+  def _LoadItems(cls, names):
+    """Returns a dict of the stored settings of names, fetched at once.
+
+    Args:
+      names: list of str setting names.
+    Returns:
+      dict of setting name to tuple (value, datetime time of last change).
+    """
+    items = {}
+    for name, entity in zip(names, cls.get_by_key_name(names)):
+      if not entity:
+        continue
+      if Settings.GetType(name) in ['pem', 'string', 'random_str']:
+        items[name] = entity.text_value, entity.mtime
+      elif entity.blob_value:
+        items[name] = util.Decode(entity.blob_value), entity.mtime
+    return items
+
+  @classmethod
+  def _LoadSnapshot(cls):
+    """Returns a dict of all SETTINGS that are stored.
+
+    Settings are fetched by key, not with a query, so a snapshot reloaded
+    right after SetItem() includes the value just set.
+
+    Returns:
+      dict of setting name to tuple (value, datetime time of last change).
+    """
+    return cls._LoadItems(sorted(SETTINGS))
+
+  @classmethod
+  def GetSnapshotItem(cls, name):
+    """Get an item from the instance snapshot of all settings.
+
+    Like GetItem(), but costs no RPCs unless the snapshot is due for a
+    version check, or the settings have changed since it was loaded.
+
+    Args:
+      name: str, like 'ca_public_cert_pem' or 'required_issuer'
+    Returns:
+      (value for that setting, datetime time of last change)
+    """
+    items = SETTINGS_SNAPSHOT.Get()
+    if name not in SETTINGS and name not in items and cls.GetType(name):
+      # names of settings with suffix==True are not known in advance, so
+      # they are added to the snapshot on first use; None if not stored.
+      items[name] = cls._LoadItems([name]).get(name)
+    item = items.get(name)
+    if item is None:
+      return SETTINGS.get(name, {}).get('default'), None
+    # the snapshot is shared between requests, so callers get their own copy.
+    return copy.deepcopy(item[0]), item[1]
 
   @classmethod
   def GetAll(cls):
@@ -199,4 +261,8 @@ class Settings(base.KeyValueCache):
       value, mtime = cls.GetItem(setting)
       settings[setting]['value'] = value
       settings[setting]['mtime'] = mtime
-    return settings
\ No newline at end of file
+    return settings
+
+
+SETTINGS_SNAPSHOT = gae_util.InstanceSnapshot(
+    'settings', Settings._LoadSnapshot, ttl=SNAPSHOT_SECS)
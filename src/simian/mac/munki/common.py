@@ -20,14 +20,18 @@
 
 
 import base64
+import calendar
 import datetime
 import logging
 import os
+import re
+import sys
 import time
 
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine import runtime
 from google.appengine.runtime import apiproxy_errors
 
@@ -62,6 +66,24 @@ APPLESUS_PKGS_TO_INSTALL_FORMAT = 'AppleSUS: %s'
 # Serial numbers for which first connection de-duplication should be skipped.
 DUPE_SERIAL_NUMBER_EXCEPTIONS = [
       'SystemSerialNumb', 'System Serial#', 'Not Available', None]
+# Pull queue holding the UUIDs of new clients, processed in batches.
+FIRST_CONNECTION_QUEUE = 'first-pull'
+FIRST_CONNECTION_BATCH_SIZE = 100
+FIRST_CONNECTION_LEASE_SECS = 300
+# New clients are batched over windows of this many seconds.
+FIRST_CONNECTION_DELAY = 300
+# Datastore limit of values in an IN filter.
+MAX_IN_FILTER_VALUES = 30
+
+INSTALL_RESULT_FAILED = 'FAILED with return code'
+INSTALL_RESULT_SUCCESSFUL = 'SUCCESSFUL'
+
+# InstallResults legacy string matching regex.
+LEGACY_INSTALL_RESULTS_STRING_REGEX = re.compile(
+    r'^Install of (.*)-(\d+.*): (%s|%s: (\-?\d+))$' % (
+        INSTALL_RESULT_SUCCESSFUL, INSTALL_RESULT_FAILED))
+# Future install times over this many seconds ahead of now are logged.
+INSTALL_RESULT_FUTURE_LOG_SECS = 66 * 60
 
 
 class Error(Exception):
@@ -100,32 +122,109 @@ class ReportFeedback(object):
   UPLOAD_LOGS = 'UPLOAD_LOGS'
 
 
-def _SaveFirstConnection(client_id, computer):
-  """Function to save first connection of a given client.
+def _SaveFirstConnections(computers):
+  """Saves first connections of new clients.
+
+  Older active computers with the same serial number as a new client are
+  marked inactive.
 
   Args:
-    client_id: dict client id.
-    computer: models.Computer entity.
+    computers: list of models.Computer entities of new clients.
   """
-  #logging.debug('Saving first connection for: %s' % client_id)
-  e = models.FirstClientConnection(key_name=client_id['uuid'])
-  e.computer = computer
-  e.owner = client_id['owner']
-  e.hostname = client_id['hostname']
-  e.office = client_id['office']
-  e.site = client_id['site']
-  e.put()
+  to_put = []
+  dupes = []
+  newest_by_serial = {}
+  for c in computers:
+    to_put.append(models.FirstClientConnection(
+        key_name=c.uuid, computer=c, owner=c.owner, hostname=c.hostname,
+        office=c.office, site=c.site))
+    if c.serial in DUPE_SERIAL_NUMBER_EXCEPTIONS:
+      continue
+    newest = newest_by_serial.get(c.serial)
+    if newest is None or newest.preflight_datetime < c.preflight_datetime:
+      newest_by_serial[c.serial] = c
 
   # Set older computers with the same serial number as inactive.
-  if computer.serial not in DUPE_SERIAL_NUMBER_EXCEPTIONS:
-    for dupe in models.Computer.AllActive().filter('serial =', computer.serial):
+  serials = newest_by_serial.keys()
+  for i in xrange(0, len(serials), MAX_IN_FILTER_VALUES):
+    query = models.Computer.AllActive().filter(
+        'serial IN', serials[i:i + MAX_IN_FILTER_VALUES])
+    for dupe in query:
+      newest = newest_by_serial[dupe.serial]
       # skip over the new client.
-      if dupe.uuid == computer.uuid:
+      if dupe.uuid == newest.uuid:
         continue
       # if the dupe is clearly older, mark as inactive.
-      if dupe.preflight_datetime < computer.preflight_datetime:
-        dupe.active = False
-        dupe.put(update_active=False)
+      if dupe.preflight_datetime < newest.preflight_datetime:
+        dupes.append(dupe)
+
+  gae_util.BatchDatastoreOp(db.put, to_put)
+  if dupes:
+    models.ComputerSummaryShard.PutInactive(dupes)
+
+
+def _SaveFirstConnection(client_id, computer):
+  """Function to save first connection of a given client.
+
+  Only tasks deferred before first connections were batched still call this.
+
+  Args:
+    client_id: dict client id.
+    computer: models.Computer entity.
+  """
+  _SaveFirstConnections([computer])
+
+
+def _ProcessFirstConnections():
+  """Saves first connections for a batch of new clients in the pull queue."""
+  queue = taskqueue.Queue(FIRST_CONNECTION_QUEUE)
+  tasks = queue.lease_tasks(
+      FIRST_CONNECTION_LEASE_SECS, FIRST_CONNECTION_BATCH_SIZE)
+  if not tasks:
+    return
+
+  try:
+    uuids = list(set(task.payload for task in tasks))
+    computers = [c for c in models.Computer.get_by_key_name(uuids) if c]
+    _SaveFirstConnections(computers)
+  except Exception:
+    # release the leases, so the retry of this task leases them again.
+    exc_type, exc_value, exc_tb = sys.exc_info()
+    for task in tasks:
+      try:
+        queue.modify_task_lease(task, 0)
+      except (taskqueue.Error, apiproxy_errors.Error) as e:
+        logging.warning(
+            'Releasing first connection task %s failed: %s', task.name, e)
+    raise exc_type, exc_value, exc_tb
+  queue.delete_tasks(tasks)
+
+  if len(tasks) == FIRST_CONNECTION_BATCH_SIZE:  # there may be more.
+    deferred.defer(_ProcessFirstConnections, _queue='first')
+
+
+def _QueueFirstConnection(uuid):
+  """Queues a new client for first connection processing.
+
+  Only the UUID is queued, and transactionally, so it must be called from
+  the transaction creating the Computer entity.
+
+  Args:
+    uuid: str, uuid of the new client.
+  """
+  taskqueue.Queue(FIRST_CONNECTION_QUEUE).add(
+      taskqueue.Task(payload=uuid, method='PULL'), transactional=True)
+
+
+def _ScheduleFirstConnections():
+  """Schedules one _ProcessFirstConnections task per FIRST_CONNECTION_DELAY."""
+  window = int(time.time()) / FIRST_CONNECTION_DELAY
+  try:
+    deferred.defer(
+        _ProcessFirstConnections, _name='first-connections-%d' % window,
+        _countdown=FIRST_CONNECTION_DELAY, _queue='first')
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass  # already scheduled in this window.
 
 
 def LogClientConnection(
@@ -178,6 +277,9 @@ def LogClientConnection(
     if c is None:  # First time this client has connected.
       c = models.Computer(key_name=_client_id['uuid'])
       is_new_client = True
+      old_counts = None
+    else:
+      old_counts = models.ComputerSummaryShard.GetComputerCounts(c)
     c.uuid = _client_id['uuid']
     c.hostname = _client_id['hostname']
     c.serial= _client_id['serial']
@@ -270,18 +372,20 @@ def LogClientConnection(
     else:
       logging.warning('Unknown event value: %s', event)
 
+    generations = models.ComputerSummaryShard.PrepareUpdate(c, old_counts)
     c.put()
     if is_new_client:  # Queue welcome email to be sent.
-      #logging.debug('Deferring _SaveFirstConnection....')
-      deferred.defer(
-          _SaveFirstConnection, client_id=_client_id, computer=c,
-          _countdown=300, _queue='first')
+      _QueueFirstConnection(c.uuid)
+    new_counts = models.ComputerSummaryShard.GetComputerCounts(c)
+    return is_new_client, old_counts, new_counts, generations
 
   try:
-    db.run_in_transaction(
-        __UpdateComputerEntity,
-        event, client_id, user_settings, pkgs_to_install,
-        apple_updates_to_install, ip_address, report_feedback, c=computer)
+    is_new_client, old_counts, new_counts, generations = (
+        db.run_in_transaction(
+            __UpdateComputerEntity,
+            event, client_id, user_settings, pkgs_to_install,
+            apple_updates_to_install, ip_address, report_feedback,
+            c=computer))
   except (db.Error, apiproxy_errors.Error, runtime.DeadlineExceededError) as e:
     logging.warning(
         'LogClientConnection put() error %s: %s', e.__class__.__name__, str(e))
@@ -289,6 +393,19 @@ def LogClientConnection(
         event, client_id, user_settings, pkgs_to_install,
         apple_updates_to_install, ip_address, report_feedback,
         delay=DATASTORE_NOWRITE_DELAY)
+    return
+
+  if is_new_client:
+    _ScheduleFirstConnections()
+
+  # summary counters are reconciled regularly, so don't fail the connection.
+  try:
+    models.ComputerSummaryShard.UpdateCounts(
+        old_counts, new_counts, generations)
+  except (db.Error, apiproxy_errors.Error) as e:
+    logging.warning(
+        'ComputerSummaryShard.UpdateCounts() error %s: %s',
+        e.__class__.__name__, str(e))
 
 
 def WriteClientLog(model, uuid, **kwargs):
@@ -415,16 +532,138 @@ def KeyValueStringToDict(s, delimiter='|'):
   d = {}
   pairs = s.split(delimiter)
   for pair in pairs:
-    try:
-      key, value = pair.split('=', 1)
-      if not value or value == 'None':
-        value = None  # Convert empty strings to None.
-      d[key] = value
-    except ValueError:
+    key, sep, value = pair.partition('=')
+    if not sep:
       logging.debug('Ignoring invalid key/value pair: %s', pair)
+      continue
+    if not value or value == 'None':
+      value = None  # Convert empty strings to None.
+    d[key] = value
   return d
 
 
+_BOOL_STRING_VALUES = {'true': True, '1': True, 'false': False, '0': False}
+
+
+def _ParseInstallBool(value):
+  """Returns True/False for a true/1 or false/0 str value, None otherwise."""
+  return _BOOL_STRING_VALUES.get(value.lower())
+
+
+def _ParseInstallInt(value):
+  """Returns the int for a str value, or None if it is not an integer >= 0."""
+  if value.isdigit():
+    return int(value)
+
+
+def _ParseInstallKbytesPerSec(value):
+  """Returns int download speed, or None as Munki reports 0 for unknown."""
+  if value.isdigit():
+    return int(value) or None
+
+
+# Dispatch table of install result field to (row key, value parser); fields
+# not in this table are ignored.  A value of None or "" is stored as None.
+_INSTALL_RESULT_FIELDS = {
+    'name': ('name', None),
+    'display_name': ('display_name', None),
+    'version': ('version', None),
+    'time': ('time', None),
+    'status': ('status', None),
+    'applesus': ('applesus', _ParseInstallBool),
+    'unattended': ('unattended', _ParseInstallBool),
+    'duration_seconds': ('duration_seconds', _ParseInstallInt),
+    'download_kbytes_per_sec': ('dl_kbytes_per_sec', _ParseInstallKbytesPerSec),
+}
+
+# Default row values for install result fields missing from a str.
+_INSTALL_RESULT_DEFAULTS = {
+    'name': '', 'display_name': None, 'version': '', 'time': None,
+    'status': '', 'applesus': False, 'unattended': False,
+    'duration_seconds': None, 'dl_kbytes_per_sec': None,
+}
+
+
+def _ParseLegacyInstallResult(install):
+  """Parses an old 'Install of FooPkg-1.0: SUCCESSFUL' style str to a row."""
+  row = _INSTALL_RESULT_DEFAULTS.copy()
+  m = LEGACY_INSTALL_RESULTS_STRING_REGEX.match(install)
+  if not m:
+    logging.warning('Unknown install string format: %s', install)
+    row['name'] = install
+    row['status'] = 'UNKNOWN'
+    return row
+  row['name'] = m.group(1)
+  row['version'] = m.group(2)
+  if m.group(3) == INSTALL_RESULT_SUCCESSFUL:
+    row['status'] = '0'
+  else:
+    row['status'] = m.group(4)
+  return row
+
+
+def ParseInstallResults(installs, now=None):
+  """Parses all install result strs of a client report into typed rows.
+
+  Both 'name=pkg|version=foo|...' style and legacy
+  'Install of FooPkg-1.0: SUCCESSFUL' style strs are supported.  Invalid
+  or future install times are replaced with now.
+
+  Args:
+    installs: list of str install results from an install report.
+    now: datetime.datetime, optional, the current UTC time.
+  Returns:
+    list of dicts with InstallLog property values for keys package, status,
+    applesus, unattended, duration_seconds, dl_kbytes_per_sec and mtime.
+  """
+  if now is None:
+    now = datetime.datetime.utcnow()
+  now_epoch = calendar.timegm(now.utctimetuple())
+  utcfromtimestamp = datetime.datetime.utcfromtimestamp
+  fields = _INSTALL_RESULT_FIELDS
+  defaults = _INSTALL_RESULT_DEFAULTS
+
+  rows = []
+  for install in installs:
+    if install.startswith('Install of'):
+      row = _ParseLegacyInstallResult(install)
+    else:
+      row = defaults.copy()
+      for pair in install.split('|'):
+        key, _, value = pair.partition('=')
+        if key not in fields:
+          continue
+        row_key, parse = fields[key]
+        if not value or value == 'None':
+          row[row_key] = None
+        elif parse is None:
+          row[row_key] = value
+        else:
+          row[row_key] = parse(value)
+
+    row['package'] = '%s-%s' % (
+        row.pop('display_name') or row.pop('name') or '', row.pop('version'))
+    row.pop('name', None)
+    row['status'] = str(row['status'])
+
+    install_time = row.pop('time') or ''
+    epoch, _, fraction = install_time.partition('.')
+    if not epoch.isdigit() or (fraction and not fraction.isdigit()):
+      if install_time:
+        logging.warning('Ignoring invalid install time: %s', install_time)
+      row['mtime'] = now
+    else:
+      epoch = int(epoch)
+      if epoch <= now_epoch:
+        row['mtime'] = utcfromtimestamp(epoch)
+      else:
+        if epoch > now_epoch + INSTALL_RESULT_FUTURE_LOG_SECS:
+          logging.warning('Ignoring future install time: %s', install_time)
+        row['mtime'] = now
+    rows.append(row)
+  return rows
+
+
 def ParseClientId(client_id, uuid=None):
   """Splits a client id string and converts all key/value pairs to a dict.
 
@@ -477,6 +716,17 @@ def ParseClientId(client_id, uuid=None):
   return out
 
 
+def _GetPanicModes():
+  """Returns a frozenset of the enabled panic modes from Datastore."""
+  key_names = ['%s%s' % (PANIC_MODE_PREFIX, mode) for mode in PANIC_MODES]
+  entities = models.KeyValueCache.get_by_key_name(key_names)
+  return frozenset(
+      mode for mode, entity in zip(PANIC_MODES, entities) if entity)
+
+
+PANIC_MODE_SNAPSHOT = gae_util.InstanceSnapshot('panic_modes', _GetPanicModes)
+
+
 def IsPanicMode(mode):
   """Returns True if panic mode, False if not.
 
@@ -488,12 +738,7 @@ def IsPanicMode(mode):
   if mode not in PANIC_MODES:
     raise ValueError(mode)
 
-  m = models.KeyValueCache.MemcacheWrappedGet(
-      '%s%s' % (PANIC_MODE_PREFIX, mode))
-  if m:
-    return True
-  else:
-    return False
+  return mode in PANIC_MODE_SNAPSHOT.Get()
 
 
 def SetPanicMode(mode, enabled):
@@ -518,6 +763,7 @@ def SetPanicMode(mode, enabled):
       q.delete()
 
   models.KeyValueCache.ResetMemcacheWrap('%s%s' % (PANIC_MODE_PREFIX, mode))
+  PANIC_MODE_SNAPSHOT.Invalidate()
 
 
 def IsPanicModeNoPackages():
@@ -604,8 +850,10 @@ def GetComputerManifest(uuid=None, client_id=None, packagemap=False):
     elif not m.enabled:
       raise ManifestDisabledError(manifest_name)
 
+    # pass the XML, as m may be shared through the instance cache and
+    # GenerateDynamicManifest modifies plist objects.
     manifest_plist_xml = GenerateDynamicManifest(
-        m.plist, client_id, user_settings=user_settings)
+        m.plist_xml.encode('utf-8'), client_id, user_settings=user_settings)
 
   if not manifest_plist_xml:
     raise ManifestNotFoundError(manifest_name)
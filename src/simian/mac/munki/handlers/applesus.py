@@ -88,8 +88,8 @@ class AppleSUS(handlers.AuthenticationHandler):
       return
     del(c)
 
-    lock = 'applesus_%s' % name
-    if not gae_util.ObtainLock(lock, timeout=5.0):
+    lock = gae_util.Lock('applesus', name)
+    if not lock.Acquire(timeout=5.0):
       self.response.set_status(403)
       self.response.out.write('Could not lock applesus')
       return
@@ -104,4 +104,4 @@ class AppleSUS(handlers.AuthenticationHandler):
       self.response.out.write(str(e))
       pass
 
-    gae_util.ReleaseLock(lock)
\ No newline at end of file
+    lock.Release()
\ No newline at end of file
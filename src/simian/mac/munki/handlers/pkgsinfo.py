@@ -70,8 +70,8 @@ class PackagesInfo(handlers.AuthenticationHandler):
       hash_str = self.request.get('hash')
 
       if hash_str:
-        lock = 'pkgsinfo_%s' % filename
-        if not gae_util.ObtainLock(lock, timeout=5.0):
+        lock = gae_util.Lock('pkgsinfo', filename)
+        if not lock.Acquire(timeout=5.0):
           self.response.set_status(403)
           self.response.out.write('Could not lock pkgsinfo')
           return
@@ -84,12 +84,12 @@ class PackagesInfo(handlers.AuthenticationHandler):
         self.response.out.write(pkginfo.plist)
       else:
         if hash_str:
-          gae_util.ReleaseLock(lock)
+          lock.Release()
         self.response.set_status(404)
         return
 
       if hash_str:
-        gae_util.ReleaseLock(lock)
+        lock.Release()
     else:
       query = models.PackageInfo.all()
 
@@ -161,8 +161,8 @@ class PackagesInfo(handlers.AuthenticationHandler):
       self.response.out.write(str(e))
       return
 
-    lock = 'pkgsinfo_%s' % filename
-    if not gae_util.ObtainLock(lock, timeout=5.0):
+    lock = gae_util.Lock('pkgsinfo', filename)
+    if not lock.Acquire(timeout=5.0):
       self.response.set_status(403)
       self.response.out.write('Could not lock pkgsinfo')
       return
@@ -175,7 +175,7 @@ class PackagesInfo(handlers.AuthenticationHandler):
           'pkginfo "%s" does not exist; PUT only allows updates.', filename)
       self.response.set_status(403)
       self.response.out.write('Only updates supported')
-      gae_util.ReleaseLock(lock)
+      lock.Release()
       return
 
     # If the pkginfo is not modifiable, ensure only manifests have changed.
@@ -186,7 +186,7 @@ class PackagesInfo(handlers.AuthenticationHandler):
             filename)
         self.response.set_status(403)
         self.response.out.write('Changes to pkginfo not allowed')
-        gae_util.ReleaseLock(lock)
+        lock.Release()
         return
 
     # If the update parameter asked for a careful update, by supplying
@@ -196,7 +196,7 @@ class PackagesInfo(handlers.AuthenticationHandler):
       if self._Hash(pkginfo.plist) != hash_str:
         self.response.set_status(409)
         self.response.out.write('Update hash does not match')
-        gae_util.ReleaseLock(lock)
+        lock.Release()
         return
 
     # All verification has passed, so let's create the PackageInfo entity.
@@ -210,7 +210,7 @@ class PackagesInfo(handlers.AuthenticationHandler):
       pkginfo.install_types = install_types
     pkginfo.put()
 
-    gae_util.ReleaseLock(lock)
+    lock.Release()
 
     for track in pkginfo.catalogs:
       models.Catalog.Generate(track, delay=1)
@@ -22,9 +22,10 @@
 import datetime
 import logging
 import os
-import re
+import sys
 import time
 import urllib
+import webapp2
 
 from google.appengine.runtime import apiproxy_errors
 
@@ -44,13 +45,11 @@ FORCE_CONTINUE_POSTFLIGHT_DAYS = 5
 # int number of days after which a client is considered broken.
 REPAIR_CLIENT_PRE_POST_DIFF_DAYS = 7
 
-INSTALL_RESULT_FAILED = 'FAILED with return code'
-INSTALL_RESULT_SUCCESSFUL = 'SUCCESSFUL'
+# int maximum number of reports accepted in one /reports/batch request.
+MAX_BATCH_REPORTS = 50
 
-# InstallResults legacy string matching regex.
-LEGACY_INSTALL_RESULTS_STRING_REGEX = re.compile(
-    r'^Install of (.*)-(\d+.*): (%s|%s: (\-?\d+))$' % (
-        INSTALL_RESULT_SUCCESSFUL, INSTALL_RESULT_FAILED))
+INSTALL_RESULT_FAILED = common.INSTALL_RESULT_FAILED
+INSTALL_RESULT_SUCCESSFUL = common.INSTALL_RESULT_SUCCESSFUL
 
 
 def IsExitFeedbackIpAddress(ip_address):
@@ -68,6 +67,42 @@ def IsExitFeedbackIpAddress(ip_address):
 class Reports(handlers.AuthenticationHandler):
   """Handler for /reports/."""
 
+  # list of entities to put together at the end of a batch, or None to put
+  # entities as soon as each report is processed.
+  _pending_puts = None
+  # list of InstallLog entities to roll up once _pending_puts are put.
+  _pending_installs = None
+
+  def _PutEntities(self, entities):
+    """Puts entities now, or queues them if a report batch is in progress.
+
+    Args:
+      entities: list of db.Model entities.
+    """
+    if self._pending_puts is None:
+      gae_util.BatchDatastoreOp(models.db.put, entities)
+    else:
+      self._pending_puts.extend(entities)
+
+  def _AddInstallRollups(self, installs):
+    """Rolls up installs now, or once a report batch in progress is put.
+
+    Args:
+      installs: list of InstallLog entities, already put or queued by
+        _PutEntities().
+    """
+    if self._pending_installs is not None:
+      self._pending_installs.extend(installs)
+      return
+
+    # rollups only feed reports, so don't fail the report over them.
+    try:
+      models.InstallRollup.AddInstalls(installs)
+    except (models.db.Error, apiproxy_errors.Error) as e:
+      logging.warning(
+          'InstallRollup.AddInstalls() error %s: %s',
+          e.__class__.__name__, str(e))
+
   def GetReportFeedback(self, uuid, report_type, **kwargs):
     """Inspect a report and provide a feedback status/command.
 
@@ -151,73 +186,14 @@ class Reports(handlers.AuthenticationHandler):
       on_corp = None
 
     to_put = []
-    for install in installs:
-      if install.startswith('Install of'):
-        d = {
-            'applesus': 'false',
-            'duration_seconds': None,
-            'download_kbytes_per_sec': None,
-            'name': install,
-            'status': 'UNKNOWN',
-            'version': '',
-            'unattended': 'false',
-        }
-        # support for old 'Install of FooPkg-1.0: SUCCESSFUL' style strings.
-        try:
-          m = LEGACY_INSTALL_RESULTS_STRING_REGEX.search(install)
-          if not m:
-            raise ValueError
-          elif m.group(3) == INSTALL_RESULT_SUCCESSFUL:
-            d['status'] = 0
-          else:
-            d['status'] = m.group(4)
-          d['name'] = m.group(1)
-          d['version'] = m.group(2)
-        except (IndexError, AttributeError, ValueError):
-          logging.warning('Unknown install string format: %s', install)
-      else:
-        # support for new 'name=pkg|version=foo|...' style strings.
-        d = common.KeyValueStringToDict(install)
-
-      name = d.get('display_name', '') or d.get('name', '')
-      version = d.get('version', '')
-      status = str(d.get('status', ''))
-      applesus = common.GetBoolValueFromString(d.get('applesus', '0'))
-      unattended = common.GetBoolValueFromString(d.get('unattended', '0'))
-      try:
-        duration_seconds = int(d.get('duration_seconds', None))
-      except (TypeError, ValueError):
-        duration_seconds = None
-      try:
-        dl_kbytes_per_sec = int(d.get('download_kbytes_per_sec', None))
-        # Ignore zero KB/s download speeds, as that's how Munki reports
-        # unknown speed.
-        if dl_kbytes_per_sec == 0:
-          dl_kbytes_per_sec = None
-      except (TypeError, ValueError):
-        dl_kbytes_per_sec = None
-
-      try:
-        install_datetime = util.Datetime.utcfromtimestamp(d.get('time', None))
-      except ValueError, e:
-        logging.warning('Ignoring invalid install_datetime; %s', str(e))
-        install_datetime = datetime.datetime.utcnow()
-      except util.EpochExtremeFutureValueError, e:
-        logging.warning('Ignoring future install_datetime; %s', str(e))
-        install_datetime = datetime.datetime.utcnow()
-      except util.EpochValueError, e:
-        install_datetime = datetime.datetime.utcnow()
-
-      pkg = '%s-%s' % (name, version)
+    for row in common.ParseInstallResults(installs):
       entity = models.InstallLog(
-          uuid=computer.uuid, computer=computer, package=pkg, status=status,
-          on_corp=on_corp, applesus=applesus, unattended=unattended,
-          duration_seconds=duration_seconds, mtime=install_datetime,
-          dl_kbytes_per_sec=dl_kbytes_per_sec)
+          uuid=computer.uuid, computer=computer, on_corp=on_corp, **row)
       entity.success = entity.IsSuccess()
       to_put.append(entity)
 
-    gae_util.BatchDatastoreOp(models.db.put, to_put)
+    self._PutEntities(to_put)
+    self._AddInstallRollups(to_put)
 
   def post(self):
     """Reports get handler.
@@ -226,7 +202,14 @@ class Reports(handlers.AuthenticationHandler):
       A webapp.Response() response.
     """
     session = gaeserver.DoMunkiAuth()
-    uuid = main_common.SanitizeUUID(session.uuid)
+    self._PostReport(main_common.SanitizeUUID(session.uuid))
+
+  def _PostReport(self, uuid):
+    """Processes the report in self.request for an authenticated client.
+
+    Args:
+      uuid: str, sanitized uuid of the authenticated client.
+    """
     report_type = self.request.get('_report_type')
     feedback_requested = self.request.get('_feedback')
     message = None
@@ -333,3 +316,78 @@ class Reports(handlers.AuthenticationHandler):
               uuid, report_type,
               message=message, details=details, computer=computer,
           ))
+
+
+class ReportsBatch(Reports):
+  """Handler for /reports/batch.
+
+  The request body is a serialized list of reports, each a dict of the same
+  parameters a single /reports POST takes, including _report_type and
+  optionally _feedback.  Values may be str or a list of str for repeated
+  parameters.  The response is a serialized list with the feedback for each
+  report, or an empty str where no feedback was requested.
+  """
+
+  def _GetReportRequest(self, report):
+    """Returns a webapp2.Request for a single report in a batch.
+
+    Args:
+      report: dict, report parameters.
+    Returns:
+      webapp2.Request instance with report as its urlencoded POST body.
+    """
+    params = {}
+    for k, v in report.iteritems():
+      if type(v) not in (list, tuple):
+        v = [v]
+      params[unicode(k).encode('utf-8')] = [
+          unicode(i).encode('utf-8') for i in v if i is not None]
+    body = urllib.urlencode(params, doseq=True)
+    return webapp2.Request.blank('/reports', POST=body)
+
+  def _PutBatch(self):
+    """Puts and rolls up the entities queued by the reports of a batch."""
+    to_put, self._pending_puts = self._pending_puts, None
+    installs, self._pending_installs = self._pending_installs, None
+    self._PutEntities(to_put)
+    self._AddInstallRollups(installs)
+
+  def post(self):
+    """Reports batch post handler."""
+    session = gaeserver.DoMunkiAuth()
+    uuid = main_common.SanitizeUUID(session.uuid)
+
+    try:
+      batch = util.Deserialize(self.request.body)
+    except util.DeserializeError:
+      batch = None
+    if (type(batch) is not list or len(batch) > MAX_BATCH_REPORTS or
+        [r for r in batch if type(r) is not dict or '_report_type' not in r]):
+      logging.warning('Invalid report batch from %s', uuid)
+      self.response.set_status(400)
+      return
+
+    request, response = self.request, self.response
+    feedback = []
+    self._pending_puts = []
+    self._pending_installs = []
+    try:
+      for report in batch:
+        self.request = self._GetReportRequest(report)
+        self.response = webapp2.Response()
+        self._PostReport(uuid)
+        feedback.append(self.response.body)
+    except:
+      exc_type, exc_value, exc_tb = sys.exc_info()
+      self.request, self.response = request, response
+      # the other writes of reports before a failed one are committed, so
+      # their queued entities are put too, but the report failure is raised.
+      try:
+        self._PutBatch()
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('Report batch from %s failed to put.', uuid)
+      raise exc_type, exc_value, exc_tb
+    self.request, self.response = request, response
+    self._PutBatch()
+
+    self.response.out.write(util.Serialize(feedback))
@@ -155,8 +155,8 @@ class UploadPackage(
       return
 
     # Obtain a lock on the PackageInfo entity for this package.
-    lock = 'pkgsinfo_%s' % filename
-    if not gae_util.ObtainLock(lock, timeout=5.0):
+    lock = gae_util.Lock('pkgsinfo', filename)
+    if not lock.Acquire(timeout=5.0):
       gae_util.SafeBlobDel(blobstore_key)
       self.redirect('/uploadpkg?mode=error&msg=Could%20not%20lock%20pkgsinfo')
       return
@@ -164,7 +164,7 @@ class UploadPackage(
     old_blobstore_key = None
     pkg = models.PackageInfo.get_or_insert(filename)
     if not pkg.IsSafeToModify():
-      gae_util.ReleaseLock(lock)
+      lock.Release()
       gae_util.SafeBlobDel(blobstore_key)
       self.redirect('/uploadpkg?mode=error&msg=Package%20is%20not%20modifiable')
       return
@@ -198,7 +198,7 @@ class UploadPackage(
       # if this is a new entity (get_or_insert puts), attempt to delete it.
       if not old_blobstore_key:
         gae_util.SafeEntityDel(pkg)
-      gae_util.ReleaseLock(lock)
+      lock.Release()
       self.redirect('/uploadpkg?mode=error')
       return
 
@@ -207,7 +207,7 @@ class UploadPackage(
     if old_blobstore_key:
       gae_util.SafeBlobDel(old_blobstore_key)
 
-    gae_util.ReleaseLock(lock)
+    lock.Release()
 
     # Generate catalogs for newly uploaded pkginfo plist.
     for catalog in pkg.catalogs:
@@ -64,6 +64,8 @@ app = webapp2.WSGIApplication([
     (r'/uploadpkg$', uploadpkg.UploadPackage),
     # POST reports from munki.
     (r'/reports$', reports.Reports),
+    # POST a batch of reports from munki.
+    (r'/reports/batch$', reports.ReportsBatch),
     # PUT uploadfile from munki.
     (r'/uploadfile/([\w\-]+)/([\w\-\.]+)$', uploadfile.UploadFile),
     # GET or POST user auth.
@@ -848,7 +848,8 @@ class DatastoreSettings(SimianDictSettings):
       pass  # Not a problem, keep trying.
 
     if hasattr(self._module, 'models') and self._module.models:
-      item, unused_mtime = self._module.models.Settings.GetItem(k)
+      # one snapshot of all settings per instance, refreshed when any changes.
+      item, unused_mtime = self._module.models.Settings.GetSnapshotItem(k)
       if item is None:
         raise AttributeError(k)
       return item
@@ -379,12 +379,8 @@ class Auth1ServerDatastoreSessionTest(DatastoreModelTest):
 
     ads.model = mock_model
     sessions = [1, 2, 3]
-    cursor = 'cursor'
     mock_model.all().AndReturn(mock_query)
-    mock_query.fetch(500).AndReturn(sessions)
-    mock_query.cursor().AndReturn(cursor)
-    mock_query.with_cursor(cursor).AndReturn(None)
-    mock_query.fetch(500).AndReturn([])
+    mock_query.run(limit=500, batch_size=100).AndReturn(iter(sessions))
 
     self.mox.ReplayAll()
     output = []
@@ -404,7 +400,6 @@ class Auth1ServerDatastoreSessionTest(DatastoreModelTest):
 
     ads.model = mock_model
     sessions = [1, 2, 3]
-    cursor = 'cursor'
     # stub out datetime.* calls with simple int returns.
     min_seconds = 120
     now_seconds = 220
@@ -414,10 +409,7 @@ class Auth1ServerDatastoreSessionTest(DatastoreModelTest):
     mock_model.all().AndReturn(mock_query)
 
     mock_query.filter('mtime <', date_seconds).AndReturn(mock_query)
-    mock_query.fetch(500).AndReturn(sessions)
-    mock_query.cursor().AndReturn(cursor)
-    mock_query.with_cursor(cursor).AndReturn(None)
-    mock_query.fetch(500).AndReturn([])
+    mock_query.run(limit=500, batch_size=100).AndReturn(iter(sessions))
 
     self.mox.ReplayAll()
     output = []
@@ -1511,6 +1511,35 @@ class SimianClientTest(mox.MoxTestBase):
         self.client.PostReportBody, [body, True],
         '_SimianRequest', 'POST', url, body_with_feedback)
 
+  def testPostReportBatch(self):
+    """Test PostReportBatch()."""
+    batch = client.ReportBatch()
+    batch.Add('preflight', {'client_id': 'foo'}, feedback=True)
+    batch.Add('install_report', {'installs': ['a', 'b']})
+    self.assertEqual(2, len(batch))
+
+    self.mox.StubOutWithMock(self.client, '_SimianRequest')
+    self.client._SimianRequest(
+        'POST', '/reports/batch', batch.GetBody()).AndReturn('["OK", ""]')
+
+    self.mox.ReplayAll()
+    self.assertEqual(['OK', ''], self.client.PostReportBatch(batch))
+    self.mox.VerifyAll()
+
+  def testPostReportBatchWhenInvalidResponse(self):
+    """Test PostReportBatch() with a response that cannot be parsed."""
+    batch = client.ReportBatch()
+    batch.Add('preflight', {})
+
+    self.mox.StubOutWithMock(self.client, '_SimianRequest')
+    self.client._SimianRequest(
+        'POST', '/reports/batch', batch.GetBody()).AndReturn('OK')
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        client.SimianServerError, self.client.PostReportBatch, batch)
+    self.mox.VerifyAll()
+
   def testUploadFile(self):
     """Test UploadFile()."""
     self.mox.StubOutWithMock(client.os.path, 'isfile')
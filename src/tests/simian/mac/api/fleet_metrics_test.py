@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""fleet_metrics module tests."""
+
+
+
+import datetime
+import json
+
+import tests.appenginesdk
+from google.apputils import app
+from google.apputils import basetest
+import mox
+import stubout
+from simian.mac.api import fleet_metrics
+
+
+class FleetMetricsModuleTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.stubs.Set(fleet_metrics, 'API_INFO_KEY', 'apikey')
+    self.handler = fleet_metrics.FleetMetrics()
+    self.handler.request = self.mox.CreateMockAnything()
+    self.handler.response = self.mox.CreateMockAnything()
+    self.handler.response.headers = {}
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _MockRequest(self, metrics, start='', end='', points=None):
+    """Records request parameter lookups."""
+    self.handler.request.get('key').AndReturn('apikey')
+    self.handler.request.get_all('metric').AndReturn(metrics)
+    self.handler.request.get('end').AndReturn(end)
+    self.handler.request.get('start').AndReturn(start)
+    self.handler.request.get(
+        'points', fleet_metrics.DEFAULT_MAX_POINTS).AndReturn(
+            points or fleet_metrics.DEFAULT_MAX_POINTS)
+
+  def testDownsample(self):
+    """Test Downsample()."""
+    points = [('d%d' % i, i) for i in xrange(5)]
+    self.assertEqual(points, fleet_metrics.Downsample(points, 5))
+    self.assertEqual(
+        [('d0', 0.5), ('d2', 2.5), ('d4', 4.0)],
+        fleet_metrics.Downsample(points, 3))
+    self.assertEqual([('d0', 2.0)], fleet_metrics.Downsample(points, 1))
+
+  def testGet(self):
+    """Test get()."""
+    self._MockRequest(
+        ['active_30d', 'os_version:10.7.4'], start='2012-01-01',
+        end='2012-01-04', points='2')
+    self.mox.StubOutWithMock(fleet_metrics.models.FleetMetric, 'GetRange')
+    start = datetime.date(2012, 1, 1)
+    end = datetime.date(2012, 1, 4)
+    fleet_metrics.models.FleetMetric.GetRange(
+        'active_30d', start, end).AndReturn(
+            [('2012-01-01', 1), ('2012-01-02', 2), ('2012-01-03', 4)])
+    fleet_metrics.models.FleetMetric.GetRange(
+        'os_version:10.7.4', start, end).AndReturn([('2012-01-01', 3)])
+    self.handler.response.out = self.mox.CreateMockAnything()
+    self.handler.response.out.write(mox.IsA(str))
+
+    self.mox.ReplayAll()
+    self.handler.get()
+    self.assertEqual(
+        'application/json', self.handler.response.headers['Content-Type'])
+    self.mox.VerifyAll()
+
+  def testGetDefaultRange(self):
+    """Test get() defaults to the last DEFAULT_DAYS days."""
+    self._MockRequest(['active_30d'])
+    self.mox.StubOutWithMock(fleet_metrics.models.FleetMetric, 'GetRange')
+    end = datetime.datetime.utcnow().date()
+    start = end - datetime.timedelta(days=fleet_metrics.DEFAULT_DAYS - 1)
+    fleet_metrics.models.FleetMetric.GetRange(
+        'active_30d', start, end).AndReturn([('2012-01-01', 1)])
+    self.handler.response.out = self.mox.CreateMockAnything()
+    self.handler.response.out.write(
+        json.dumps({'active_30d': [('2012-01-01', 1)]}))
+
+    self.mox.ReplayAll()
+    self.handler.get()
+    self.mox.VerifyAll()
+
+  def testGetInvalid(self):
+    """Test get() with invalid parameters."""
+    self._MockRequest(['active_30d'], points='many')
+    self.handler.response.set_status(400)
+    self._MockRequest([])
+    self.handler.response.set_status(400)
+
+    self.mox.ReplayAll()
+    self.handler.get()
+    self.handler.get()
+    self.mox.VerifyAll()
+
+  def testGetUnauthorized(self):
+    """Test get() with a bad API key."""
+    self.handler.request.get('key').AndReturn('wrong')
+    self.handler.response.set_status(401)
+
+    self.mox.ReplayAll()
+    self.handler.get()
+    self.mox.VerifyAll()
+
+
+def main(unused_argv):
+  basetest.main()
+
+
+if __name__ == '__main__':
+  app.run()
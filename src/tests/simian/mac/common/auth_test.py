@@ -41,6 +41,18 @@ class AuthModuleTest(mox.MoxTestBase):
     self.mox.UnsetStubs()
     self.stubs.UnsetAll()
 
+  def _StubOutAclIndex(self, **groups):
+    """Stubs out the ACL index with groups of members, by group name."""
+    roles = {}
+    for group_name, members in groups.iteritems():
+      for email in members:
+        roles.setdefault(email, set()).add(group_name)
+    acl_index = {
+        'roles': dict((e, frozenset(r)) for e, r in roles.iteritems()),
+        'groups': frozenset(g for g in groups if groups[g]),
+    }
+    self.stubs.Set(auth, '_GetAclIndex', lambda: acl_index)
+
   def testDoUserAuthWithNoUser(self):
     self.stubs.Set(auth, 'users', self.mox.CreateMock(auth.users))
     auth.users.get_current_user().AndReturn(None)
@@ -92,20 +104,12 @@ class AuthModuleTest(mox.MoxTestBase):
   def testDoUserAuthWithAllDomainUsersOff(self):
     self.stubs.Set(auth.settings, 'ALLOW_ALL_DOMAIN_USERS_READ_ACCESS', False)
     self.stubs.Set(auth, 'users', self.mox.CreateMock(auth.users))
-    self.mox.StubOutWithMock(auth, 'IsAdminUser')
-    self.mox.StubOutWithMock(auth, 'IsSupportUser')
-    self.mox.StubOutWithMock(auth, 'IsSecurityUser')
-    self.mox.StubOutWithMock(auth, 'IsPhysicalSecurityUser')
-
     mock_user = self.mox.CreateMockAnything()
     email = 'foouser@example.com'
     auth.users.get_current_user().AndReturn(mock_user)
     mock_user.email().AndReturn(email)
-
-    auth.IsAdminUser(email).AndReturn(False)
-    auth.IsSupportUser(email).AndReturn(False)
-    auth.IsSecurityUser(email).AndReturn(False)
-    auth.IsPhysicalSecurityUser(email).AndReturn(True)
+    self._StubOutAclIndex(
+        admins=['admin@example.com'], physical_security_users=[email])
 
     self.mox.ReplayAll()
     self.assertEqual(mock_user, auth.DoUserAuth())
@@ -114,20 +118,12 @@ class AuthModuleTest(mox.MoxTestBase):
   def testDoUserAuthWithAllDomainUsersOffFailure(self):
     self.stubs.Set(auth.settings, 'ALLOW_ALL_DOMAIN_USERS_READ_ACCESS', False)
     self.stubs.Set(auth, 'users', self.mox.CreateMock(auth.users))
-    self.mox.StubOutWithMock(auth, 'IsAdminUser')
-    self.mox.StubOutWithMock(auth, 'IsSupportUser')
-    self.mox.StubOutWithMock(auth, 'IsSecurityUser')
-    self.mox.StubOutWithMock(auth, 'IsPhysicalSecurityUser')
-
     mock_user = self.mox.CreateMockAnything()
     email = 'foouser@example.com'
     auth.users.get_current_user().AndReturn(mock_user)
     mock_user.email().AndReturn(email)
-
-    auth.IsAdminUser(email).AndReturn(False)
-    auth.IsSupportUser(email).AndReturn(False)
-    auth.IsSecurityUser(email).AndReturn(False)
-    auth.IsPhysicalSecurityUser(email).AndReturn(False)
+    self._StubOutAclIndex(
+        admins=['admin@example.com'], oauth_users=[email])
 
     self.mox.ReplayAll()
     self.assertRaises(auth.NotAuthenticated, auth.DoUserAuth)
@@ -136,15 +132,10 @@ class AuthModuleTest(mox.MoxTestBase):
   def testDoOAuthAuthSuccessSettings(self):
     """Test DoOAuthAuth() with success, where user is in settings file."""
     self.mox.StubOutWithMock(auth.oauth, 'get_current_user')
-    self.mox.StubOutWithMock(auth.models.KeyValueCache, 'MemcacheWrappedGet')
 
     mock_user = self.mox.CreateMockAnything()
-    mock_oauth_users = self.mox.CreateMockAnything()
     email = 'foouser@example.com'
-    auth.settings.OAUTH_USERS = [email]
-
-    auth.models.KeyValueCache.MemcacheWrappedGet(
-        'oauth_users', 'text_value').AndReturn(None)
+    self._StubOutAclIndex(oauth_users=[email])
 
     auth.oauth.get_current_user().AndReturn(mock_user)
     mock_user.email().AndReturn(email)
@@ -157,20 +148,14 @@ class AuthModuleTest(mox.MoxTestBase):
     """Test DoOAuthAuth() with success, where user is in KeyValueCache."""
     self.mox.StubOutWithMock(auth.oauth, 'get_current_user')
     self.mox.StubOutWithMock(auth, 'IsAdminUser')
-    self.mox.StubOutWithMock(auth.models.KeyValueCache, 'MemcacheWrappedGet')
-    self.mox.StubOutWithMock(auth.util, 'Deserialize')
 
     mock_user = self.mox.CreateMockAnything()
     email = 'foouser@example.com'
-    auth.settings.OAUTH_USERS = []
-    oauth_users = [email]
+    self._StubOutAclIndex(oauth_users=[email])
 
     auth.oauth.get_current_user().AndReturn(mock_user)
     mock_user.email().AndReturn(email)
     auth.IsAdminUser(email).AndReturn(True)
-    auth.models.KeyValueCache.MemcacheWrappedGet(
-        'oauth_users', 'text_value').AndReturn(oauth_users)
-    auth.util.Deserialize(oauth_users).AndReturn(oauth_users)
 
     self.mox.ReplayAll()
     auth.DoOAuthAuth(is_admin=True)
@@ -205,16 +190,13 @@ class AuthModuleTest(mox.MoxTestBase):
   def testDoOAuthAuthWhereNotValidOAuthUser(self):
     """Test DoOAuthAuth() where oauth user is not authorized."""
     self.mox.StubOutWithMock(auth.oauth, 'get_current_user')
-    self.mox.StubOutWithMock(auth.models.KeyValueCache, 'MemcacheWrappedGet')
 
     mock_user = self.mox.CreateMockAnything()
     email = 'foouser@example.com'
-    auth.settings.OAUTH_USERS = []
+    self._StubOutAclIndex(oauth_users=['other@example.com'])
 
     auth.oauth.get_current_user().AndReturn(mock_user)
     mock_user.email().AndReturn(email)
-    auth.models.KeyValueCache.MemcacheWrappedGet(
-        'oauth_users', 'text_value').AndReturn(None)
 
     self.mox.ReplayAll()
     self.assertRaises(auth.NotAuthenticated, auth.DoOAuthAuth)
@@ -260,10 +242,8 @@ class AuthModuleTest(mox.MoxTestBase):
 
   def testIsAdminUserTrue(self):
     """Test IsAdminUser() with a passed email address that is an admin."""
-    self.mox.StubOutWithMock(auth, '_GetGroupMembers')
-
     admin_email = 'admin4@example.com'
-    auth._GetGroupMembers('admins').AndReturn([admin_email])
+    self._StubOutAclIndex(admins=[admin_email])
 
     self.mox.ReplayAll()
     self.assertTrue(auth.IsAdminUser(admin_email))
@@ -271,10 +251,9 @@ class AuthModuleTest(mox.MoxTestBase):
 
   def testIsAdminUserFalse(self):
     """Test IsAdminUser() with a passed email address that is not an admin."""
-    self.mox.StubOutWithMock(auth, '_GetGroupMembers')
-
     admin_email = 'admin4@example.com'
-    auth._GetGroupMembers('admins').AndReturn(['foo@example.com'])
+    self._StubOutAclIndex(
+        admins=['foo@example.com'], support_users=[admin_email])
 
     self.mox.ReplayAll()
     self.assertFalse(auth.IsAdminUser(admin_email))
@@ -283,14 +262,12 @@ class AuthModuleTest(mox.MoxTestBase):
   def testIsAdminUserWithNoPassedEmail(self):
     """Test IsAdminUser() with no passed email address."""
     self.mox.StubOutWithMock(auth.users, 'get_current_user')
-    self.mox.StubOutWithMock(auth, '_GetGroupMembers')
-
     admin_email = 'admin5@example.com'
+    self._StubOutAclIndex(admins=['foo@example.com'])
 
     mock_user = self.mox.CreateMockAnything()
     auth.users.get_current_user().AndReturn(mock_user)
     mock_user.email().AndReturn(admin_email)
-    auth._GetGroupMembers('admins').AndReturn(['foo@example.com'])
 
     self.mox.ReplayAll()
     self.assertFalse(auth.IsAdminUser())
@@ -299,10 +276,8 @@ class AuthModuleTest(mox.MoxTestBase):
   def testIsAdminUserBootstrap(self):
     """Test IsAdminUser() where no admins are defined."""
     self.mox.StubOutWithMock(auth.users, 'is_current_user_admin')
-    self.mox.StubOutWithMock(auth, '_GetGroupMembers')
-
     admin_email = 'admin4@example.com'
-    auth._GetGroupMembers('admins').AndReturn([])
+    self._StubOutAclIndex(admins=[], support_users=[admin_email])
 
     self.mox.StubOutWithMock(auth, 'users')
     auth.users.is_current_user_admin().AndReturn(True)
@@ -314,10 +289,8 @@ class AuthModuleTest(mox.MoxTestBase):
   def testIsAdminUserBootstrapFalse(self):
     """Test IsAdminUser() where no admins are defined, but user not admin."""
     self.mox.StubOutWithMock(auth.users, 'is_current_user_admin')
-    self.mox.StubOutWithMock(auth, '_GetGroupMembers')
-
     admin_email = 'admin4@example.com'
-    auth._GetGroupMembers('admins').AndReturn([])
+    self._StubOutAclIndex(admins=[], support_users=[admin_email])
 
     self.mox.StubOutWithMock(auth, 'users')
     auth.users.is_current_user_admin().AndReturn(False)
@@ -380,15 +353,57 @@ class AuthModuleTest(mox.MoxTestBase):
     email = 'support5@example.com'
     group_members = ['support1@example.com', 'support2@example.com']
     group_name = 'support_users'
+    self._StubOutAclIndex(support_users=group_members, admins=[email])
+
+    self.mox.ReplayAll()
+    self.assertFalse(auth.IsGroupMember(email, group_name=group_name))
+    self.assertTrue(auth.IsGroupMember(group_members[0], group_name=group_name))
+    self.mox.VerifyAll()
 
+  def testGetGroupMembersDoesNotModifySettings(self):
+    """Test _GetGroupMembers() leaves the settings list as it was."""
+    group_members = ['support1@example.com']
+    auth.settings.FOO_GROUP = group_members
     self.mox.StubOutWithMock(auth.models.KeyValueCache, 'MemcacheWrappedGet')
-    self.mox.StubOutWithMock(auth.util, 'Deserialize')
     auth.models.KeyValueCache.MemcacheWrappedGet(
-        group_name, 'text_value').AndReturn('serialized group')
-    auth.util.Deserialize('serialized group').AndReturn(group_members)
+        'foo_group', 'text_value').AndReturn('["support2@example.com"]')
 
     self.mox.ReplayAll()
-    self.assertFalse(auth.IsGroupMember(email, group_name=group_name))
+    self.assertEqual(
+        ['support1@example.com', 'support2@example.com'],
+        auth._GetGroupMembers('foo_group'))
+    self.assertEqual(['support1@example.com'], group_members)
+    self.mox.VerifyAll()
+
+  def testBuildAclIndex(self):
+    """Test _BuildAclIndex()."""
+    auth.settings.ADMINS = ['admin1@example.com']
+    auth.settings.SUPPORT_USERS = []
+    auth.settings.SECURITY_USERS = []
+    auth.settings.PHYSICAL_SECURITY_USERS = []
+    auth.settings.OAUTH_USERS = []
+    entities = []
+    for text_value in ['["admin2@example.com"]', 'not json',
+                       '["admin2@example.com", "sec@example.com"]']:
+      entity = self.mox.CreateMockAnything()
+      entity.text_value = text_value
+      entities.append(entity)
+    self.mox.StubOutWithMock(auth.models.KeyValueCache, 'get_by_key_name')
+    auth.models.KeyValueCache.get_by_key_name(auth.ACL_INDEX_GROUPS).AndReturn(
+        [entities[0], None, entities[1], entities[2], None])
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        ['admins', 'oauth_users', 'physical_security_users', 'security_users',
+         'support_users'], auth.ACL_INDEX_GROUPS)
+    acl_index = auth._BuildAclIndex()
+    self.assertEqual({
+        'admin1@example.com': frozenset(['admins']),
+        'admin2@example.com': frozenset(['admins', 'security_users']),
+        'sec@example.com': frozenset(['security_users']),
+    }, acl_index['roles'])
+    self.assertEqual(
+        frozenset(['admins', 'security_users']), acl_index['groups'])
     self.mox.VerifyAll()
 
 
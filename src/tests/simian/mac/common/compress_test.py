@@ -21,6 +21,11 @@
 
 
 import hashlib
+import logging
+import os
+import time
+import zlib
+
 from google.apputils import app
 from google.apputils import basetest
 import mox
@@ -40,6 +45,144 @@ class ZipModuleTest(mox.MoxTestBase):
     self.stubs.UnsetAll()
 
 
+PKGINFO_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple Computer//DTD PLIST 1.0//EN" \
+"http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+  <dict>
+    <key>autoremove</key>
+    <false/>
+    <key>catalogs</key>
+    <array>
+      <string>unstable</string>
+      <string>testing</string>
+    </array>
+    <key>description</key>
+    <string>%(name)s installs the %(name)s application.</string>
+    <key>display_name</key>
+    <string>%(name)s</string>
+    <key>installed_size</key>
+    <integer>%(size)d</integer>
+    <key>installer_item_hash</key>
+    <string>%(hash)s</string>
+    <key>installer_item_location</key>
+    <string>%(name)s-%(version)s.dmg</string>
+    <key>installer_item_size</key>
+    <integer>%(size)d</integer>
+    <key>installs</key>
+    <array>
+      <dict>
+        <key>CFBundleIdentifier</key>
+        <string>com.example.%(name)s</string>
+        <key>CFBundleShortVersionString</key>
+        <string>%(version)s</string>
+        <key>path</key>
+        <string>/Applications/%(name)s.app</string>
+        <key>type</key>
+        <string>application</string>
+      </dict>
+    </array>
+    <key>minimum_os_version</key>
+    <string>10.5.0</string>
+    <key>name</key>
+    <string>%(name)s</string>
+    <key>receipts</key>
+    <array>
+      <dict>
+        <key>installed_size</key>
+        <integer>%(size)d</integer>
+        <key>packageid</key>
+        <string>com.example.%(name)s.pkg</string>
+        <key>version</key>
+        <string>%(version)s</string>
+      </dict>
+    </array>
+    <key>uninstall_method</key>
+    <string>removepackages</string>
+    <key>uninstallable</key>
+    <true/>
+    <key>unattended_install</key>
+    <true/>
+    <key>version</key>
+    <string>%(version)s</string>
+  </dict>
+</plist>
+'''
+
+
+def GetPkginfoXml(i):
+  """Returns a typical pkginfo plist XML str, varied by int i."""
+  return PKGINFO_XML % {
+      'name': 'FooApp%d' % i, 'version': '%d.%d.%d' % (i % 9, i % 7, i),
+      'size': i * 7919, 'hash': hashlib.sha256(str(i)).hexdigest()}
+
+
+class DictionaryCompressTest(mox.MoxTestBase):
+  """Test DictionaryCompress() and DictionaryDecompress()."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testDictionaryCompress(self):
+    """Test DictionaryCompress() round trips with the dictionary id."""
+    data = GetPkginfoXml(1)
+    compressed = compress.DictionaryCompress(data, compress.PLIST_DICTIONARY_ID)
+    self.assertEqual(
+        compress.DICT_MAGIC + chr(compress.PLIST_DICTIONARY_ID),
+        compressed[:compress.DICT_MAGIC_LEN + 1])
+    self.assertTrue(len(compressed) < len(zlib.compress(data, 9)))
+    self.assertEqual(data, compress.DictionaryDecompress(compressed))
+    # primed streams are copied, so are reusable.
+    self.assertEqual(
+        compressed,
+        compress.DictionaryCompress(data, compress.PLIST_DICTIONARY_ID))
+    self.assertEqual('', compress.DictionaryDecompress(
+        compress.DictionaryCompress('', compress.PLIST_DICTIONARY_ID)))
+
+  def testDictionaryRotation(self):
+    """Test values of each dictionary decompress after a rotation."""
+    self.stubs.Set(compress, 'DICTIONARIES', {1: 'foo', 2: 'bar'})
+    self.stubs.Set(compress, '_primed', {})
+    data = 'foobar' * 10
+    compressed = [compress.DictionaryCompress(data, i) for i in [1, 2]]
+    self.assertNotEqual(compressed[0], compressed[1])
+    for c in compressed:
+      self.assertEqual(data, compress.DictionaryDecompress(c))
+
+  def testDictionaryDecompressUnknown(self):
+    """Test DictionaryDecompress() with an unknown dictionary id."""
+    self.assertRaises(
+        compress.UnknownDictionaryError, compress.DictionaryDecompress,
+        compress.DICT_MAGIC + chr(255) + 'data')
+
+  def testDictionaryCompressBenchmark(self):
+    """Benchmarks storage size and read time of 500 pkginfo plists."""
+    plists = [GetPkginfoXml(i) for i in xrange(500)]
+    sizes = {'none': sum(len(p) for p in plists)}
+    for name, threshold, dictionary_id in [
+        ('zlib', 0, None), ('dictionary', 0, compress.PLIST_DICTIONARY_ID)]:
+      stored = [compress.CompressedText(
+          p, compression_threshold=threshold,
+          dictionary_id=dictionary_id).Compressed() for p in plists]
+      start = time.time()
+      for c in stored:
+        self.assertTrue(unicode(compress.CompressedText(c)))
+      logging.info(
+          'pkginfo plists %s: %d bytes, read in %.2fms each', name,
+          sum(len(c) for c in stored),
+          (time.time() - start) * 1000 / len(plists))
+      sizes[name] = sum(len(c) for c in stored)
+    logging.info('pkginfo plists uncompressed: %d bytes', sizes['none'])
+
+    self.assertTrue(sizes['dictionary'] * 5 < sizes['zlib'] * 3)
+    self.assertTrue(sizes['zlib'] < sizes['none'])
+
+
 class CompressedTextTest(mox.MoxTestBase):
   """Test the CompressedText object."""
 
@@ -69,6 +212,20 @@ class CompressedTextTest(mox.MoxTestBase):
     self.assertTrue(ct._IsCompressed('%shello' % ct.MAGIC))
     self.assertFalse(ct._IsCompressed('hello'))
 
+  def testCompressWithDictionary(self):
+    """Test _Compress() and _decompress() with a dictionary id."""
+    ct = self._GetInstance(dictionary_id=compress.PLIST_DICTIONARY_ID)
+    xml = GetPkginfoXml(1)
+    compressed = ct._Compress(xml)
+    self.assertTrue(compressed.startswith(compress.DICT_MAGIC))
+    self.assertTrue(ct._IsCompressed(compressed))
+    self.assertEqual(compressed, ct._Compress(compressed))
+    self.assertEqual(xml, ct._decompress(compressed))
+    # short or incompressible data is left as is.
+    self.assertEqual('hello', ct._Compress('hello'))
+    random_data = os.urandom(96)
+    self.assertEqual(random_data, ct._Compress(random_data))
+
   def testCompress(self):
     """Test _Compress()."""
     input_data = self.decomp_str
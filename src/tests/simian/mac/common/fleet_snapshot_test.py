@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""fleet_snapshot module tests."""
+
+
+
+import datetime
+import StringIO
+
+import tests.appenginesdk
+from google.apputils import app
+from google.apputils import basetest
+import mox
+import stubout
+from simian.mac.common import fleet_snapshot
+
+
+class FleetSnapshotModuleTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    fleet_snapshot._cache.clear()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _GetComputer(self, uuid, track='stable', site='NYC', active=True,
+                   preflight_datetime=None):
+    """Returns a mock Computer with all snapshot properties set."""
+    c = self.mox.CreateMockAnything()
+    c.uuid = uuid
+    c.hostname = 'host-%s' % uuid
+    c.serial = 'serial-%s' % uuid
+    c.owner = u'own\xe9r'
+    c.track = track
+    c.site = site
+    c.office = None
+    c.os_version = '10.7.4'
+    c.client_version = '2.0'
+    c.preflight_datetime = preflight_datetime
+    c.postflight_datetime = None
+    c.connections_on_corp = 3
+    c.connections_off_corp = None
+    c.active = active
+    c.all_pkgs_installed = True
+    c.all_apple_updates_installed = False
+    return c
+
+  def _GetSnapshot(self):
+    """Returns a Snapshot of 3 Computers in 2 row groups."""
+    dt = datetime.datetime(2012, 6, 1, 12, 30)
+    data = (
+        fleet_snapshot.MAGIC +
+        fleet_snapshot.GetRowGroup([
+            self._GetComputer('u1', preflight_datetime=dt),
+            self._GetComputer('u2', track='unstable', active=False)]) +
+        fleet_snapshot.GetRowGroup([
+            self._GetComputer('u3', site=None)]))
+    return fleet_snapshot.Snapshot.Parse(data, mtime=dt)
+
+  def testParse(self):
+    """Test GetRowGroup() and Snapshot.Parse()."""
+    self.mox.ReplayAll()
+    snapshot = self._GetSnapshot()
+    self.assertEqual(3, len(snapshot))
+    self.assertEqual(['u1', 'u2', 'u3'], snapshot.columns['uuid'])
+    self.assertEqual([u'own\xe9r'] * 3, snapshot.columns['owner'])
+    self.assertEqual([1, 0, 1], list(snapshot.columns['active']))
+    self.assertEqual([3, 3, 3], list(snapshot.columns['connections_on_corp']))
+    self.assertEqual([0, 0, 0], list(snapshot.columns['connections_off_corp']))
+    self.assertEqual(
+        [1338553800, 0, 0], list(snapshot.columns['preflight_epoch']))
+    self.mox.VerifyAll()
+
+  def testParseWhenRowGroupWrittenAgain(self):
+    """Test Snapshot.Parse() skipping a row group written by a retry."""
+    group = fleet_snapshot.GetRowGroup([self._GetComputer('u1')], 0)
+    data = (
+        fleet_snapshot.MAGIC + group + group +
+        fleet_snapshot.GetRowGroup([self._GetComputer('u2')], 1))
+
+    self.mox.ReplayAll()
+    snapshot = fleet_snapshot.Snapshot.Parse(data)
+    self.assertEqual(['u1', 'u2'], snapshot.columns['uuid'])
+    self.mox.VerifyAll()
+
+  def testParseWhenNotSnapshot(self):
+    """Test Snapshot.Parse() with data that is not a snapshot."""
+    self.assertRaises(ValueError, fleet_snapshot.Snapshot.Parse, 'foo')
+
+  def testFilterCountSum(self):
+    """Test Filter(), Count() and Sum()."""
+    self.mox.ReplayAll()
+    snapshot = self._GetSnapshot()
+    self.assertEqual([0, 2], snapshot.Filter(active=True))
+    self.assertEqual([1], snapshot.Filter(track='unstable'))
+    self.assertEqual([2], snapshot.Filter(site=None))
+    self.assertEqual(
+        [0], snapshot.Filter(rows=[0, 1], preflight_epoch=lambda e: e > 0))
+    self.assertEqual({'stable': 2, 'unstable': 1}, snapshot.Count('track'))
+    self.assertEqual({'stable': 2}, snapshot.Count('track', rows=[0, 2]))
+    self.assertEqual(2, snapshot.Sum('active'))
+    self.assertEqual(6, snapshot.Sum('connections_on_corp', rows=[0, 1]))
+    self.mox.VerifyAll()
+
+  def testGetComputers(self):
+    """Test GetComputers()."""
+    self.mox.ReplayAll()
+    computers = self._GetSnapshot().GetComputers(rows=[0])
+    self.assertEqual(1, len(computers))
+    self.assertEqual('u1', computers[0].uuid)
+    self.assertEqual('stable', computers[0].track)
+    self.assertEqual(
+        datetime.datetime(2012, 6, 1, 12, 30), computers[0].preflight_datetime)
+    self.assertEqual(None, computers[0].postflight_datetime)
+    self.mox.VerifyAll()
+
+  def testWriteCsv(self):
+    """Test WriteCsv()."""
+    self.mox.ReplayAll()
+    f = StringIO.StringIO()
+    self._GetSnapshot().WriteCsv(f, rows=[0, 2], columns=['uuid', 'owner'])
+    self.assertEqual(
+        'uuid,owner\r\nu1,own\xc3\xa9r\r\nu3,own\xc3\xa9r\r\n', f.getvalue())
+    self.mox.VerifyAll()
+
+  def testLoad(self):
+    """Test Load() reads and caches the latest snapshot."""
+    data = fleet_snapshot.MAGIC + fleet_snapshot.GetRowGroup([
+        self._GetComputer('u1')])
+    reader = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(fleet_snapshot.models.KeyValueCache, 'GetItem')
+    self.mox.StubOutWithMock(fleet_snapshot.blobstore, 'BlobReader')
+
+    fleet_snapshot.models.KeyValueCache.GetItem(
+        fleet_snapshot.BLOB_KEY_NAME).AndReturn(('blobkey1', 'mtime'))
+    fleet_snapshot.blobstore.BlobReader('blobkey1').AndReturn(reader)
+    reader.read().AndReturn(data)
+    fleet_snapshot.models.KeyValueCache.GetItem(
+        fleet_snapshot.BLOB_KEY_NAME).AndReturn(('blobkey1', 'mtime'))
+
+    self.mox.ReplayAll()
+    snapshot = fleet_snapshot.Load()
+    self.assertEqual(['u1'], snapshot.columns['uuid'])
+    self.assertEqual('mtime', snapshot.mtime)
+    self.assertTrue(snapshot is fleet_snapshot.Load())
+    self.mox.VerifyAll()
+
+  def testLoadWhenNotBuilt(self):
+    """Test Load() before any snapshot was built."""
+    self.mox.StubOutWithMock(fleet_snapshot.models.KeyValueCache, 'GetItem')
+    fleet_snapshot.models.KeyValueCache.GetItem(
+        fleet_snapshot.BLOB_KEY_NAME).AndReturn((None, None))
+
+    self.mox.ReplayAll()
+    self.assertEqual(None, fleet_snapshot.Load())
+    self.mox.VerifyAll()
+
+  def _StubOutLock(self, token=None):
+    """Stubs out gae_util.Lock; returns the mock lock of the build."""
+    lock = self.mox.CreateMockAnything()
+    lock.token = 'token1'
+    self.mox.StubOutWithMock(
+        fleet_snapshot.gae_util, 'Lock', use_mock_anything=True)
+    fleet_snapshot.gae_util.Lock(
+        fleet_snapshot.LOCK_KIND, ttl=fleet_snapshot.LOCK_SECS,
+        token=token).AndReturn(lock)
+    return lock
+
+  def testBuild(self):
+    """Test Build() writes row groups and swaps in the new blob."""
+    self.stubs.Set(fleet_snapshot, 'ROW_GROUP_SIZE', 1)
+    self.stubs.Set(
+        fleet_snapshot, 'GetRowGroup', lambda c, i: 'group%d_%d' % (len(c), i))
+    f = self.mox.CreateMockAnything()
+    query = self.mox.CreateMockAnything()
+    lock = self._StubOutLock()
+    self.mox.StubOutWithMock(fleet_snapshot.gae_util, 'SafeBlobDel')
+    self.mox.StubOutWithMock(fleet_snapshot.files.blobstore, 'create')
+    self.mox.StubOutWithMock(fleet_snapshot.files.blobstore, 'get_blob_key')
+    self.mox.StubOutWithMock(fleet_snapshot.files, 'open')
+    self.mox.StubOutWithMock(fleet_snapshot.files, 'finalize')
+    self.mox.StubOutWithMock(fleet_snapshot.models.Computer, 'all')
+    self.mox.StubOutWithMock(fleet_snapshot.models.KeyValueCache, 'GetItem')
+    self.mox.StubOutWithMock(fleet_snapshot.models.KeyValueCache, 'SetItem')
+    self.mox.StubOutWithMock(fleet_snapshot, '_SetCheckpoint')
+
+    lock.Acquire().AndReturn(True)
+    fleet_snapshot.files.blobstore.create(
+        mime_type=mox.IsA(str),
+        _blobinfo_uploaded_filename=mox.IsA(str)).AndReturn('file1')
+    fleet_snapshot.files.open('file1', 'a').AndReturn(f)
+    f.__enter__().AndReturn(f)
+    f.write(fleet_snapshot.MAGIC)
+    f.__exit__(None, None, None)
+    fleet_snapshot.models.Computer.all().AndReturn(query)
+    query.fetch(1).AndReturn(['c1'])
+    lock.Extend().AndReturn(True)
+    fleet_snapshot._SetCheckpoint('file1', None, 0)
+    fleet_snapshot.files.open('file1', 'a').AndReturn(f)
+    f.__enter__().AndReturn(f)
+    f.write('group1_0')
+    f.__exit__(None, None, None)
+    query.cursor().AndReturn('cursor1')
+    fleet_snapshot.models.Computer.all().AndReturn(query)
+    query.with_cursor('cursor1')
+    query.fetch(1).AndReturn([])
+    lock.Extend().AndReturn(True)
+    fleet_snapshot.files.finalize('file1')
+    fleet_snapshot.files.blobstore.get_blob_key('file1').AndReturn('blobkey2')
+    fleet_snapshot.models.KeyValueCache.GetItem(
+        fleet_snapshot.BLOB_KEY_NAME).AndReturn(('blobkey1', 'mtime'))
+    fleet_snapshot.models.KeyValueCache.SetItem(
+        fleet_snapshot.BLOB_KEY_NAME, 'blobkey2')
+    fleet_snapshot.gae_util.SafeBlobDel('blobkey1')
+    lock.Release().AndReturn(True)
+
+    self.mox.ReplayAll()
+    fleet_snapshot.Build()
+    self.mox.VerifyAll()
+
+  def testBuildWhenLocked(self):
+    """Test Build() while another build is running."""
+    lock = self._StubOutLock()
+    lock.Acquire().AndReturn(False)
+
+    self.mox.ReplayAll()
+    fleet_snapshot.Build()
+    self.mox.VerifyAll()
+
+  def testBuildWhenFailed(self):
+    """Test Build() releasing the lock when starting a build fails."""
+    lock = self._StubOutLock()
+    self.mox.StubOutWithMock(fleet_snapshot.files.blobstore, 'create')
+
+    lock.Acquire().AndReturn(True)
+    fleet_snapshot.files.blobstore.create(
+        mime_type=mox.IsA(str),
+        _blobinfo_uploaded_filename=mox.IsA(str)).AndRaise(
+            fleet_snapshot.files.Error)
+    lock.Release().AndReturn(True)
+
+    self.mox.ReplayAll()
+    self.assertRaises(fleet_snapshot.files.Error, fleet_snapshot.Build)
+    self.mox.VerifyAll()
+
+  def testBuildWhenRetried(self):
+    """Test Build() retried continuing from its checkpoint."""
+    self.stubs.Set(fleet_snapshot, 'ROW_GROUP_SIZE', 1)
+    self.stubs.Set(fleet_snapshot, 'RUNTIME_MAX_SECS', -1)
+    self.stubs.Set(
+        fleet_snapshot, 'GetRowGroup', lambda c, i: 'group%d_%d' % (len(c), i))
+    f = self.mox.CreateMockAnything()
+    query = self.mox.CreateMockAnything()
+    lock = self._StubOutLock(token='token1')
+    self.mox.StubOutWithMock(fleet_snapshot.files, 'open')
+    self.mox.StubOutWithMock(fleet_snapshot.models.Computer, 'all')
+    self.mox.StubOutWithMock(fleet_snapshot.deferred, 'defer')
+    self.mox.StubOutWithMock(fleet_snapshot, '_GetCheckpoint')
+    self.mox.StubOutWithMock(fleet_snapshot, '_SetCheckpoint')
+
+    fleet_snapshot._GetCheckpoint('file1').AndReturn(('cursor3', 3))
+    fleet_snapshot.models.Computer.all().AndReturn(query)
+    query.with_cursor('cursor3')
+    query.fetch(1).AndReturn(['c1'])
+    lock.Extend().AndReturn(True)
+    fleet_snapshot._SetCheckpoint('file1', 'cursor3', 3)
+    fleet_snapshot.files.open('file1', 'a').AndReturn(f)
+    f.__enter__().AndReturn(f)
+    f.write('group1_3')
+    f.__exit__(None, None, None)
+    query.cursor().AndReturn('cursor4')
+    fleet_snapshot.deferred.defer(
+        fleet_snapshot.Build, filename='file1', cursor='cursor4',
+        lock_token='token1', groups=4)
+
+    self.mox.ReplayAll()
+    fleet_snapshot.Build(
+        filename='file1', cursor='cursor1', lock_token='token1', groups=1)
+    self.mox.VerifyAll()
+
+  def testBuildWhenLockLost(self):
+    """Test Build() continued after its lock expired."""
+    query = self.mox.CreateMockAnything()
+    lock = self._StubOutLock(token='token1')
+    self.mox.StubOutWithMock(fleet_snapshot.files, 'open')
+    self.mox.StubOutWithMock(fleet_snapshot.models.Computer, 'all')
+    self.mox.StubOutWithMock(fleet_snapshot, '_GetCheckpoint')
+
+    fleet_snapshot._GetCheckpoint('file1').AndReturn(None)
+    fleet_snapshot.models.Computer.all().AndReturn(query)
+    query.with_cursor('cursor1')
+    query.fetch(fleet_snapshot.ROW_GROUP_SIZE).AndReturn(['c1'])
+    lock.Extend().AndReturn(False)
+
+    self.mox.ReplayAll()
+    fleet_snapshot.Build(
+        filename='file1', cursor='cursor1', lock_token='token1')
+    self.mox.VerifyAll()
+
+
+def main(unused_argv):
+  basetest.main()
+
+
+if __name__ == '__main__':
+  app.run()
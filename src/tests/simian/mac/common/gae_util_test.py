@@ -88,98 +88,424 @@ class GaeUtilModuleTest(mox.MoxTestBase):
     self.mox.ReplayAll()
     self.assertEqual(blob_str, gae_util.GetBlobAndDel(blobstore_key))
     self.mox.VerifyAll()
-    
-  def testObtainLock(self):
-    """Test ObtainLock()."""
-    lock = 'foo'
+
+
+class QueryIteratorTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testIteration(self):
+    """Test iteration runs the query in segments resumed from cursors."""
+    mock_query = self.mox.CreateMockAnything()
+
+    mock_query.run(limit=2, batch_size=2).AndReturn(iter([1, 2]))
+    mock_query.cursor().AndReturn('cursor1')
+    mock_query.with_cursor('cursor1')
+    mock_query.run(limit=2, batch_size=2).AndReturn(iter([3, 4]))
+    mock_query.cursor().AndReturn('cursor2')
+    mock_query.with_cursor('cursor2')
+    mock_query.run(limit=2, batch_size=2).AndReturn(iter([]))
+
+    self.mox.ReplayAll()
+    iterator = gae_util.QueryIterator(mock_query, step=2)
+    self.assertEqual([1, 2, 3, 4], list(iterator))
+    self.assertEqual(None, iterator.cursor)
+    self.mox.VerifyAll()
+
+  def testIterationWithTimeBudget(self):
+    """Test iteration stops with a cursor once its time budget is spent."""
+    mock_query = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(gae_util.time, 'time')
+
+    gae_util.time.time().AndReturn(100)
+    mock_query.with_cursor('cursor1')
+    mock_query.run(limit=1000, batch_size=100).AndReturn(iter([1, 2, 3]))
+    gae_util.time.time().AndReturn(105)
+    gae_util.time.time().AndReturn(111)
+    mock_query.cursor().AndReturn('cursor2')
+
+    self.mox.ReplayAll()
+    iterator = gae_util.QueryIterator(
+        mock_query, time_budget=10, cursor='cursor1')
+    self.assertEqual([1, 2], list(iterator))
+    self.assertEqual('cursor2', iterator.cursor)
+    self.mox.VerifyAll()
+
+
+class InstanceSnapshotTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
     self.mox.StubOutWithMock(gae_util, 'memcache')
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(1)
+    self.mox.StubOutWithMock(gae_util.time, 'time')
+    self.loader = self.mox.CreateMockAnything()
+    self.memcache_key = 'snapshot_gen_foo'
+    self.snapshot = gae_util.InstanceSnapshot('foo', self.loader, ttl=10)
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testGet(self):
+    """Test Get() only reloads when the generation changes."""
+    gae_util.time.time().AndReturn(100)
+    gae_util.memcache.get(self.memcache_key).AndReturn(5)
+    self.loader().AndReturn('value1')
+    # within ttl, no RPCs.
+    gae_util.time.time().AndReturn(105)
+    # ttl expired, same generation.
+    gae_util.time.time().AndReturn(111)
+    gae_util.memcache.get(self.memcache_key).AndReturn(5)
+    # ttl expired, new generation.
+    gae_util.time.time().AndReturn(122)
+    gae_util.memcache.get(self.memcache_key).AndReturn(6)
+    self.loader().AndReturn('value2')
+
     self.mox.ReplayAll()
-    self.assertTrue(gae_util.ObtainLock(lock))
+    self.assertEqual('value1', self.snapshot.Get())
+    self.assertEqual('value1', self.snapshot.Get())
+    self.assertEqual('value1', self.snapshot.Get())
+    self.assertEqual('value2', self.snapshot.Get())
     self.mox.VerifyAll()
 
-  def testObtainLockWhenTimeoutTrue(self):
-    """Test ObtainLock()."""
-    lock = 'foo'
+  def testGetWhenGenerationMissing(self):
+    """Test Get() when the generation counter is not in memcache."""
+    gae_util.time.time().AndReturn(100)
+    gae_util.memcache.get(self.memcache_key).AndReturn(None)
+    gae_util.time.time().AndReturn(100.5)
+    gae_util.memcache.add(self.memcache_key, 100).AndReturn(False)
+    gae_util.memcache.get(self.memcache_key).AndReturn(7)
+    self.loader().AndReturn('value')
+
+    self.mox.ReplayAll()
+    self.assertEqual('value', self.snapshot.Get())
+    self.mox.VerifyAll()
+
+  def testInvalidate(self):
+    """Test Invalidate() bumps the generation and drops the local value."""
+    gae_util.time.time().AndReturn(100)
+    gae_util.memcache.get(self.memcache_key).AndReturn(5)
+    self.loader().AndReturn('value1')
+    gae_util.time.time().AndReturn(101)
+    gae_util.memcache.incr(self.memcache_key, initial_value=101)
+    gae_util.time.time().AndReturn(102)
+    gae_util.memcache.get(self.memcache_key).AndReturn(6)
+    self.loader().AndReturn('value2')
+
+    self.mox.ReplayAll()
+    self.assertEqual('value1', self.snapshot.Get())
+    self.snapshot.Invalidate()
+    self.assertEqual('value2', self.snapshot.Get())
+    self.mox.VerifyAll()
+
+
+class InstanceCacheTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
     self.mox.StubOutWithMock(gae_util, 'memcache')
-    self.mox.StubOutWithMock(gae_util.time, 'sleep')
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
-    gae_util.time.sleep(1).AndReturn(None)
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(1)
+    self.mox.StubOutWithMock(gae_util.time, 'time')
+    self.memcache_key = 'instance_cache_gen_Kind'
+    self.cache = gae_util.InstanceCache()
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testGetSet(self):
+    """Test Get() and Set() with ttls and generation checks."""
+    gae_util.time.time().AndReturn(100)
+    gae_util.memcache.get(self.memcache_key).AndReturn(5)
+    gae_util.time.time().AndReturn(101)
+    # within GENERATION_CHECK_SECS, no RPCs.
+    gae_util.time.time().AndReturn(102)
+    # generation unchanged.
+    gae_util.time.time().AndReturn(106)
+    gae_util.memcache.get(self.memcache_key).AndReturn(5)
+    # ttl expired.
+    gae_util.time.time().AndReturn(110)
+
+    self.mox.ReplayAll()
+    self.assertEqual(None, self.cache.Get('Kind', 'k'))
+    self.cache.Set('Kind', 'k', 'value', 5, 8, 100)
+    self.assertEqual('value', self.cache.Get('Kind', 'k'))
+    self.assertEqual('value', self.cache.Get('Kind', 'k'))
+    self.assertEqual(None, self.cache.Get('Kind', 'k'))
+    self.assertEqual(
+        {'Kind': {'entries': 0, 'bytes': 0, 'hits': 2, 'misses': 2,
+                  'hit_ratio': 0.5}},
+        self.cache.GetStats())
+    self.mox.VerifyAll()
+
+  def testSetEvictsLeastRecentlyUsed(self):
+    """Test Set() evicts the least recently used values over max_bytes."""
+    gae_util.time.time().MultipleTimes().AndReturn(100)
+    gae_util.memcache.get(self.memcache_key).AndReturn(None)
+
     self.mox.ReplayAll()
-    self.assertTrue(gae_util.ObtainLock(lock, timeout=1))
+    self.cache.Set('Kind', 'a', 'a', 4, 60, 10)
+    self.cache.Set('Kind', 'b', 'b', 4, 60, 10)
+    self.assertEqual('a', self.cache.Get('Kind', 'a'))
+    self.cache.Set('Kind', 'c', 'c', 4, 60, 10)
+    self.cache.Set('Kind', 'd', 'd', 11, 60, 10)  # larger than max_bytes.
+    self.assertEqual('a', self.cache.Get('Kind', 'a'))
+    self.assertEqual(None, self.cache.Get('Kind', 'b'))
+    self.assertEqual('c', self.cache.Get('Kind', 'c'))
+    self.assertEqual(None, self.cache.Get('Kind', 'd'))
+    self.assertEqual(8, self.cache.GetStats()['Kind']['bytes'])
     self.mox.VerifyAll()
 
-  def testObtainLockWhenTimeoutFalse(self):
-    """Test ObtainLock()."""
-    lock = 'foo'
+  def testGenerationChange(self):
+    """Test values are dropped when the generation changes or Invalidate()."""
+    gae_util.time.time().AndReturn(100)
+    gae_util.memcache.get(self.memcache_key).AndReturn(5)
+    # another instance invalidated the namespace.
+    gae_util.time.time().AndReturn(106)
+    gae_util.memcache.get(self.memcache_key).AndReturn(6)
+    gae_util.time.time().AndReturn(107)
+    gae_util.time.time().AndReturn(108)
+    gae_util.memcache.incr(self.memcache_key, initial_value=108)
+    gae_util.time.time().AndReturn(109)
+    gae_util.memcache.get(self.memcache_key).AndReturn(7)
+
+    self.mox.ReplayAll()
+    self.cache.Set('Kind', 'k', 'value', 5, 60, 100)
+    self.assertEqual(None, self.cache.Get('Kind', 'k'))
+    self.cache.Set('Kind', 'k', 'value', 5, 60, 100)
+    self.cache.Invalidate('Kind')
+    self.assertEqual(None, self.cache.Get('Kind', 'k'))
+    self.assertEqual(2, self.cache.GetStats()['Kind']['misses'])
+    self.mox.VerifyAll()
+
+
+class LeasedCacheTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
     self.mox.StubOutWithMock(gae_util, 'memcache')
+    self.mox.StubOutWithMock(gae_util.time, 'time')
     self.mox.StubOutWithMock(gae_util.time, 'sleep')
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
-    gae_util.time.sleep(1).AndReturn(None)
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
-    gae_util.time.sleep(1).AndReturn(None)
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
-    gae_util.time.sleep(1).AndReturn(None)
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
+    self.mox.StubOutWithMock(gae_util.random, 'random')
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testWrapCacheValue(self):
+    """Test WrapCacheValue() and UnwrapCacheValue()."""
+    gae_util.time.time().AndReturn(100)
+
     self.mox.ReplayAll()
-    self.assertFalse(gae_util.ObtainLock(lock, timeout=3))
+    cached, secs = gae_util.WrapCacheValue('value', 300, delta=0.5)
+    self.assertEqual(300 + gae_util.STALE_SECS, secs)
+    self.assertEqual((gae_util.CACHE_VALUE_TAG, 'value', 400, 0.5), cached)
+    self.assertEqual('value', gae_util.UnwrapCacheValue(cached))
+    self.assertEqual('legacy', gae_util.UnwrapCacheValue('legacy'))
     self.mox.VerifyAll()
 
-  def testObtainLockWhenFail(self):
-    """Test ObtainLock()."""
-    lock = 'foo'
-    self.mox.StubOutWithMock(gae_util, 'memcache')
-    gae_util.memcache.incr('lock_%s' % lock, initial_value=0).AndReturn(2)
+  def testLeasedCacheGet(self):
+    """Test LeasedCacheGet() with fresh, early refreshed and stale values."""
+    cached = (gae_util.CACHE_VALUE_TAG, 'value', 400, 1.0)
+    # fresh.
+    gae_util.memcache.get('k').AndReturn(cached)
+    gae_util.random.random().AndReturn(0.5)
+    gae_util.time.time().AndReturn(100)
+    # refreshed early, as time plus its random share of delta passes 400.
+    gae_util.memcache.get('k').AndReturn(cached)
+    gae_util.random.random().AndReturn(0.99)
+    gae_util.time.time().AndReturn(399)
+    gae_util.memcache.add('lease_k', 1, gae_util.LEASE_SECS).AndReturn(True)
+    # due, but another caller holds the lease so the stale copy is served.
+    gae_util.memcache.get('k').AndReturn(cached)
+    gae_util.random.random().AndReturn(0.5)
+    gae_util.time.time().AndReturn(401)
+    gae_util.memcache.add('lease_k', 1, gae_util.LEASE_SECS).AndReturn(False)
+    # values not wrapped by WrapCacheValue are never refreshed.
+    gae_util.memcache.get('k').AndReturn('legacy')
+
     self.mox.ReplayAll()
-    self.assertFalse(gae_util.ObtainLock(lock))
+    self.assertEqual(('value', False), gae_util.LeasedCacheGet('k'))
+    self.assertEqual(('value', True), gae_util.LeasedCacheGet('k'))
+    self.assertEqual(('value', False), gae_util.LeasedCacheGet('k'))
+    self.assertEqual(('legacy', False), gae_util.LeasedCacheGet('k'))
     self.mox.VerifyAll()
 
-  def testReleaseLock(self):
-    """Test ReleaseLock()."""
-    lock = 'foo'
-    self.mox.StubOutWithMock(gae_util, 'memcache')
-    gae_util.memcache.delete('lock_%s' % lock)
+  def testLeasedCacheGetWhenMissing(self):
+    """Test LeasedCacheGet() takes the lease or waits on its holder."""
+    self.mox.StubOutWithMock(gae_util.logging, 'warning')
+    cached = (gae_util.CACHE_VALUE_TAG, 'value', 400, 1.0)
+    gae_util.memcache.get('k').AndReturn(None)
+    gae_util.memcache.add('lease_k', 1, gae_util.LEASE_SECS).AndReturn(True)
+    # another caller holds the lease and refills the value.
+    gae_util.memcache.get('k').AndReturn(None)
+    gae_util.memcache.add('lease_k', 1, gae_util.LEASE_SECS).AndReturn(False)
+    gae_util.time.time().AndReturn(100)
+    gae_util.time.time().AndReturn(100)
+    gae_util.time.sleep(gae_util.LEASE_POLL_SECS)
+    gae_util.memcache.get('k').AndReturn(None)
+    gae_util.time.time().AndReturn(100.5)
+    gae_util.time.sleep(gae_util.LEASE_POLL_SECS)
+    gae_util.memcache.get('k').AndReturn(cached)
+    # the lease holder does not refill the value in time.
+    gae_util.memcache.get('k').AndReturn(None)
+    gae_util.memcache.add('lease_k', 1, gae_util.LEASE_SECS).AndReturn(False)
+    gae_util.time.time().AndReturn(100)
+    gae_util.time.time().AndReturn(100 + gae_util.LEASE_WAIT_SECS)
+    gae_util.logging.warning(mox.IsA(str), 'k')
+    # the lease holder failed, so its lease expired.
+    gae_util.memcache.add('lease_k', 1, gae_util.LEASE_SECS).AndReturn(True)
+
     self.mox.ReplayAll()
-    gae_util.ReleaseLock(lock)
+    self.assertEqual((None, True), gae_util.LeasedCacheGet('k'))
+    self.assertEqual(('value', False), gae_util.LeasedCacheGet('k'))
+    self.assertEqual((None, True), gae_util.LeasedCacheGet('k'))
     self.mox.VerifyAll()
-    
 
-class QueryIteratorTest(mox.MoxTestBase):
+  def testLeasedCacheGetWhenLeaseHolderSlow(self):
+    """Test LeasedCacheGet() timing out while the lease holder still runs."""
+    self.mox.StubOutWithMock(gae_util.logging, 'warning')
+    gae_util.memcache.get('k').AndReturn(None)
+    gae_util.memcache.add('lease_k', 1, gae_util.LEASE_SECS).AndReturn(False)
+    gae_util.time.time().AndReturn(100)
+    gae_util.time.time().AndReturn(100)
+    gae_util.time.sleep(gae_util.LEASE_POLL_SECS)
+    gae_util.memcache.get('k').AndReturn(None)
+    gae_util.time.time().AndReturn(100 + gae_util.LEASE_WAIT_SECS)
+    gae_util.logging.warning(mox.IsA(str), 'k')
+    gae_util.memcache.add('lease_k', 1, gae_util.LEASE_SECS).AndReturn(False)
+
+    self.mox.ReplayAll()
+    # the caller reads the value, but leaves the refill to the lease holder.
+    self.assertEqual((None, False), gae_util.LeasedCacheGet('k'))
+    self.mox.VerifyAll()
+
+  def testLeasedCacheSet(self):
+    """Test LeasedCacheSet() releases the lease even when set fails."""
+    gae_util.time.time().AndReturn(100)
+    gae_util.memcache.set(
+        'k', (gae_util.CACHE_VALUE_TAG, 'value', 400, 0.5),
+        300 + gae_util.STALE_SECS)
+    gae_util.memcache.delete('lease_k')
+    gae_util.time.time().AndReturn(100)
+    gae_util.memcache.set(
+        'k', mox.IsA(tuple), 300 + gae_util.STALE_SECS).AndRaise(ValueError)
+    gae_util.memcache.delete('lease_k')
+
+    self.mox.ReplayAll()
+    gae_util.LeasedCacheSet('k', 'value', 300, delta=0.5)
+    self.assertRaises(
+        ValueError, gae_util.LeasedCacheSet, 'k', 'value', 300)
+    self.mox.VerifyAll()
+
+
+
+class LockTest(mox.MoxTestBase):
 
   def setUp(self):
     mox.MoxTestBase.setUp(self)
     self.stubs = stubout.StubOutForTesting()
+    self.client = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(gae_util.memcache, 'Client')
+    gae_util.memcache.Client().MultipleTimes().AndReturn(self.client)
+    self.mox.StubOutWithMock(gae_util.time, 'sleep')
+    self.stubs.Set(gae_util.random, 'uniform', lambda a, b: b)
+    self.metrics = []
+    self.stubs.Set(
+        gae_util.instrumentation, 'Record',
+        lambda name, value=1: self.metrics.append(name))
+    self.lock = gae_util.Lock('pkgsinfo', 'foo.dmg', token='token1')
 
   def tearDown(self):
     self.mox.UnsetStubs()
     self.stubs.UnsetAll()
 
-  def testIteration(self):
-    """."""
-    mock_query = self.mox.CreateMockAnything()
-    step = 2
+  def testAcquire(self):
+    """Test Acquire() of a free lock."""
+    self.client.get('lock_queue_pkgsinfo_foo.dmg').AndReturn(None)
+    self.client.gets('lock_pkgsinfo_foo.dmg').AndReturn(None)
+    self.client.add(
+        'lock_pkgsinfo_foo.dmg', 'token1', time=gae_util.LOCK_SECS).AndReturn(
+            True)
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.lock.Acquire())
+    self.assertEqual(
+        ['Lock.pkgsinfo.obtained', 'Lock.pkgsinfo.wait_ms'], self.metrics)
+    self.mox.VerifyAll()
 
-    first_iteration = [1, 2]
-    second_iteration = [3, 4]
+  def testAcquireWhenReleased(self):
+    """Test Acquire() waits in the queue, then takes over a released lock."""
+    self.client.get('lock_queue_pkgsinfo_foo.dmg').AndReturn(None)
+    self.client.gets('lock_pkgsinfo_foo.dmg').AndReturn('token2')
+    self.client.add(
+        'lock_queue_pkgsinfo_foo.dmg', 'token1',
+        time=gae_util.LOCK_QUEUE_SECS).AndReturn(True)
+    gae_util.time.sleep(gae_util.LOCK_BACKOFF_MIN_SECS)
+    self.client.get('lock_queue_pkgsinfo_foo.dmg').AndReturn('token1')
+    self.client.gets('lock_pkgsinfo_foo.dmg').AndReturn(
+        gae_util.LOCK_RELEASED)
+    self.client.cas(
+        'lock_pkgsinfo_foo.dmg', 'token1', time=gae_util.LOCK_SECS).AndReturn(
+            True)
+    self.client.get('lock_queue_pkgsinfo_foo.dmg').AndReturn('token1')
+    self.client.delete('lock_queue_pkgsinfo_foo.dmg')
 
-    entities = first_iteration + second_iteration
+    self.mox.ReplayAll()
+    self.assertTrue(self.lock.Acquire(timeout=5.0))
+    self.mox.VerifyAll()
 
-    mock_query.fetch(step).AndReturn(first_iteration)
-    mock_query.cursor().AndReturn('cursor1')
-    mock_query.with_cursor('cursor1')
-    mock_query.fetch(step).AndReturn(second_iteration)
-    mock_query.cursor().AndReturn('cursor2')
-    mock_query.with_cursor('cursor2')
-    mock_query.fetch(step).AndReturn([])
+  def testAcquireWhenQueued(self):
+    """Test Acquire() does not take a lock another waiter is queued for."""
+    self.mox.StubOutWithMock(gae_util.time, 'time')
+    gae_util.time.time().AndReturn(100)
+    self.client.get('lock_queue_pkgsinfo_foo.dmg').AndReturn('token2')
+    gae_util.time.time().AndReturn(100.5)
+    gae_util.time.sleep(gae_util.LOCK_BACKOFF_MIN_SECS)
+    self.client.get('lock_queue_pkgsinfo_foo.dmg').AndReturn('token2')
+    gae_util.time.time().AndReturn(101)
+    # gives up the head of the queue only if it holds it.
+    self.client.get('lock_queue_pkgsinfo_foo.dmg').AndReturn('token2')
 
     self.mox.ReplayAll()
-    out = []
-    for entity in gae_util.QueryIterator(mock_query, step=step):
-      out.append(entity)
-    self.assertEqual(out, entities)
+    self.assertFalse(self.lock.Acquire(timeout=1))
+    self.assertEqual(['Lock.pkgsinfo.failed'], self.metrics)
     self.mox.VerifyAll()
 
+  def testExtend(self):
+    """Test Extend() only renews the lease of its owner."""
+    self.client.gets('lock_pkgsinfo_foo.dmg').AndReturn('token1')
+    self.client.cas(
+        'lock_pkgsinfo_foo.dmg', 'token1', time=gae_util.LOCK_SECS).AndReturn(
+            True)
+    self.client.gets('lock_pkgsinfo_foo.dmg').AndReturn('token2')
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.lock.Extend())
+    self.assertFalse(self.lock.Extend())
+    self.assertEqual(['Lock.pkgsinfo.lost'], self.metrics)
+    self.mox.VerifyAll()
+
+  def testRelease(self):
+    """Test Release() only releases the lock of its owner."""
+    self.client.gets('lock_pkgsinfo_foo.dmg').AndReturn('token1')
+    self.client.cas(
+        'lock_pkgsinfo_foo.dmg', gae_util.LOCK_RELEASED,
+        time=gae_util.LOCK_SECS).AndReturn(True)
+    self.client.gets('lock_pkgsinfo_foo.dmg').AndReturn('token2')
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.lock.Release())
+    self.assertFalse(self.lock.Release())
+    self.mox.VerifyAll()
 
 
 def main(unused_argv):
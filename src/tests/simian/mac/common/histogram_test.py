@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""histogram module tests."""
+
+
+
+from google.apputils import app
+from google.apputils import basetest
+from simian.mac.common import histogram
+
+
+class HistogramModuleTest(basetest.TestCase):
+
+  def testGetBucket(self):
+    """Test GetBucket()."""
+    self.assertEqual('0', histogram.GetBucket(0))
+    self.assertEqual('0', histogram.GetBucket(0.5))
+    self.assertEqual('1', histogram.GetBucket(1))
+    self.assertEqual('2', histogram.GetBucket(1.25))
+    self.assertEqual(histogram.GetBucket(1010), histogram.GetBucket(1100))
+    self.assertNotEqual(histogram.GetBucket(1010), histogram.GetBucket(1300))
+
+  def testGetBucketValue(self):
+    """Test GetBucketValue() is within the bucket of the value."""
+    self.assertEqual(0, histogram.GetBucketValue('0'))
+    for value in [1, 10, 100, 1234, 98765]:
+      estimate = histogram.GetBucketValue(histogram.GetBucket(value))
+      self.assertTrue(abs(estimate - value) <= value * 0.12 + 1)
+
+  def testAddAndMerge(self):
+    """Test Add() and Merge()."""
+    h1 = {}
+    histogram.Add(h1, 10)
+    histogram.Add(h1, 10, count=2)
+    h2 = {}
+    histogram.Add(h2, 10)
+    histogram.Add(h2, 0)
+    self.assertEqual(
+        {'0': 1, histogram.GetBucket(10): 4}, histogram.Merge(h1, h2))
+
+  def testGetPercentiles(self):
+    """Test GetPercentiles()."""
+    h = {}
+    for value in xrange(1, 101):
+      histogram.Add(h, value)
+    histogram.Add(h, 10000)
+    percentiles = histogram.GetPercentiles(h)
+    self.assertTrue(45 <= percentiles[50] <= 56)
+    self.assertTrue(80 <= percentiles[90] <= 101)
+    self.assertTrue(90 <= percentiles[99] <= 112)
+    self.assertEqual(
+        histogram.GetBucketValue(histogram.GetBucket(10000)),
+        histogram.GetPercentile(h, 100))
+
+  def testGetPercentilesEmpty(self):
+    """Test GetPercentiles() of an empty histogram."""
+    self.assertEqual({50: None, 90: None, 99: None},
+                     histogram.GetPercentiles({}))
+
+
+def main(unused_argv):
+  basetest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""instrumentation module tests."""
+
+
+
+import tests.appenginesdk
+from google.apputils import app
+from google.apputils import basetest
+import mox
+import stubout
+from simian.mac.common import instrumentation
+
+
+class InstrumentationModuleTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.pending = {}
+    self.stubs.Set(instrumentation, '_pending', self.pending)
+    self.stubs.Set(instrumentation, '_next_flush', 1000)
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testGetHandlerName(self):
+    """Test _GetHandlerName()."""
+    request = self.mox.CreateMockAnything()
+    request.route = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(instrumentation.webapp2, 'get_request')
+    instrumentation.webapp2.get_request().AndRaise(AssertionError)
+    instrumentation.webapp2.get_request().AndReturn(request)
+    instrumentation.webapp2.get_request().AndReturn(request)
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        instrumentation.NO_HANDLER, instrumentation._GetHandlerName())
+    request.route.handler = 'simian.mac.admin.tags.Tags'
+    self.assertEqual('tags.Tags', instrumentation._GetHandlerName())
+    request.route.handler = instrumentation.Timer
+    self.assertEqual('instrumentation.Timer', instrumentation._GetHandlerName())
+    self.mox.VerifyAll()
+
+  def testRecord(self):
+    """Test Record() aggregates, and flushes once FLUSH_SECS have passed."""
+    self.mox.StubOutWithMock(instrumentation, '_GetHandlerName')
+    self.mox.StubOutWithMock(instrumentation.time, 'time')
+    self.mox.StubOutWithMock(instrumentation, 'Flush')
+    instrumentation._GetHandlerName().AndReturn('tags.Tags')
+    instrumentation.time.time().AndReturn(900)
+    instrumentation._GetHandlerName().AndReturn('tags.Tags')
+    instrumentation.time.time().AndReturn(1001)
+    instrumentation.Flush({('tags.Tags', 'x.ms'): [2, 15]})
+
+    self.mox.ReplayAll()
+    instrumentation.Record('x.ms', 5)
+    self.assertEqual({('tags.Tags', 'x.ms'): [1, 5]}, self.pending)
+    instrumentation.Record('x.ms', 10)
+    self.assertEqual({}, self.pending)
+    self.assertEqual(
+        1001 + instrumentation.FLUSH_SECS, instrumentation._next_flush)
+    self.mox.VerifyAll()
+
+  def testFlush(self):
+    """Test Flush()."""
+    self.mox.StubOutWithMock(instrumentation.memcache, 'offset_multi')
+    self.mox.StubOutWithMock(instrumentation, '_AddNames')
+    pending = {('tags.Tags', 'x.ms'): [2, 15.5]}
+    instrumentation.memcache.offset_multi({
+        'instrumentation_tags.Tags_x.ms_count': 2,
+        'instrumentation_tags.Tags_x.ms_total': 15,
+    }, initial_value=0)
+    instrumentation._AddNames(pending)
+
+    self.mox.ReplayAll()
+    instrumentation.Flush({})
+    instrumentation.Flush(pending)
+    self.mox.VerifyAll()
+
+  def testAddNames(self):
+    """Test _AddNames() retries when another instance added names."""
+    client = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(instrumentation.memcache, 'Client')
+    instrumentation.memcache.Client().MultipleTimes().AndReturn(client)
+    names = set([('tags.Tags', 'x.ms')])
+    key = instrumentation.NAMES_KEY
+    secs = instrumentation.MEMCACHE_SECS
+
+    # first flush of any instance, raced by another one.
+    client.gets(key).AndReturn(None)
+    client.add(key, names, time=secs).AndReturn(False)
+    client.gets(key).AndReturn(set([('none', 'y')]))
+    client.cas(
+        key, set([('none', 'y'), ('tags.Tags', 'x.ms')]),
+        time=secs).AndReturn(True)
+    # names which are already known.
+    client.gets(key).AndReturn(set([('none', 'y'), ('tags.Tags', 'x.ms')]))
+
+    self.mox.ReplayAll()
+    instrumentation._AddNames(names)
+    instrumentation._AddNames(names)
+    self.mox.VerifyAll()
+
+  def testGetStats(self):
+    """Test GetStats()."""
+    self.mox.StubOutWithMock(instrumentation.memcache, 'get')
+    self.mox.StubOutWithMock(instrumentation.memcache, 'get_multi')
+    instrumentation.memcache.get(instrumentation.NAMES_KEY).AndReturn(
+        set([('tags.Tags', 'x.ms'), ('none', 'y')]))
+    instrumentation.memcache.get_multi(mox.SameElementsAs([
+        'instrumentation_tags.Tags_x.ms_count',
+        'instrumentation_tags.Tags_x.ms_total',
+        'instrumentation_none_y_count', 'instrumentation_none_y_total',
+    ])).AndReturn({
+        'instrumentation_tags.Tags_x.ms_count': 4,
+        'instrumentation_tags.Tags_x.ms_total': 10,
+    })
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        {'tags.Tags': {'x.ms': {'count': 4, 'total': 10, 'avg': 2.5}}},
+        instrumentation.GetStats())
+    self.mox.VerifyAll()
+
+
+def main(unused_argv):
+  basetest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -121,6 +121,78 @@ class IpModuleTest(mox.MoxTestBase):
           expected, ipcalc.IpMaskMatch(ip, ip_mask),
           '%s %s expected %s' % (ip, ip_mask, expected))
 
+  def testIpv6ToInt(self):
+    """Test Ipv6ToInt()."""
+    ip_tests = [
+        ['::', 0],
+        ['::1', 1],
+        ['2620::1003', (0x2620 << 112) + 0x1003],
+        ['2620:0:1003:1007:216:36ff:feee:f090',
+         0x2620000010031007021636fffeeef090],
+        ['::ffff:10.0.0.5', (0xffff << 32) + 167772165],
+    ]
+
+    for ip_str, ip_int_expected in ip_tests:
+      self.assertEqual(ip_int_expected, ipcalc.Ipv6ToInt(ip_str))
+
+  def testIpv6ToIntWhenInvalid(self):
+    """Test Ipv6ToInt() with invalid addresses."""
+    for ip_str in ['1::2::3', '1:2:3', '1:2:3:4:5:6:7:8:9', '12345::',
+                   '1:2:3:4::5:6:7:8', 'g::1']:
+      self.assertRaises(ValueError, ipcalc.Ipv6ToInt, ip_str)
+
+  def testIpToIntAndBitsWhenInvalid(self):
+    """Test IpToIntAndBits() with invalid IPv4 addresses."""
+    for ip_str in ['1.2.3', '1.2.3.256', '1.2.3.x', '']:
+      self.assertRaises(ValueError, ipcalc.IpToIntAndBits, ip_str)
+
+  def testIpPrefixTrie(self):
+    """Test IpPrefixTrie()."""
+    trie = ipcalc.IpPrefixTrie(
+        ['192.168.0.0/22', '10.0.0.0/8', '10.1.0.0/16', '172.16.0.1',
+         '2620:0:1003::/48', '::1'])
+
+    ip_tests = [
+        ['192.168.3.255', True],
+        ['192.168.4.0', False],
+        ['10.255.255.255', True],
+        ['10.1.2.3', True],
+        ['11.0.0.0', False],
+        ['172.16.0.1', True],
+        ['172.16.0.2', False],
+        ['2620:0:1003:1007:216:36ff:feee:f090', True],
+        ['2620:0:1004::1', False],
+        ['::1', True],
+        ['::2', False],
+        ['::ffff:10.0.0.1', False],
+    ]
+
+    for ip, expected in ip_tests:
+      self.assertEqual(
+          expected, trie.Contains(ip), '%s expected %s' % (ip, expected))
+
+  def testIpPrefixTrieMatchesIpMaskMatch(self):
+    """Test IpPrefixTrie() agrees with IpMaskMatch() for IPv4."""
+    ip_masks = ['192.168.0.0/25', '192.168.1.0/24', '10.0.0.0/8']
+    trie = ipcalc.IpPrefixTrie(ip_masks)
+    for i in xrange(0, 2 ** 10):
+      ip = '192.168.%d.%d' % (i >> 8, i & 0xff)
+      expected = any(ipcalc.IpMaskMatch(ip, m) for m in ip_masks)
+      self.assertEqual(expected, trie.Contains(ip), ip)
+
+  def testIpPrefixTrieWhenZeroPrefix(self):
+    """Test IpPrefixTrie() with a network covering all addresses."""
+    trie = ipcalc.IpPrefixTrie(['0.0.0.0/0'])
+    self.assertTrue(trie.Contains('1.2.3.4'))
+    self.assertFalse(trie.Contains('::1'))
+
+  def testIpPrefixTrieAddWhenInvalid(self):
+    """Test IpPrefixTrie.Add() with invalid networks."""
+    trie = ipcalc.IpPrefixTrie()
+    for ip_mask in ['1.2.3.4/33', '1.2.3.4/x', '::/129', 'foo', '1.2.3/8']:
+      self.assertRaises(ValueError, trie.Add, ip_mask)
+    self.assertRaises(ValueError, trie.Contains, 'foo')
+
 
 
 
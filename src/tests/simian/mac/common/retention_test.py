@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""retention module tests."""
+
+
+
+import datetime
+
+import tests.appenginesdk
+from google.apputils import app
+from google.apputils import basetest
+import mox
+import stubout
+from simian.mac.common import retention
+
+
+class RetentionModuleTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.states = {}
+    self.stubs.Set(retention, 'GetState', self.states.get)
+    self.stubs.Set(retention, '_SetState', self.states.__setitem__)
+    self.stubs.Set(retention, 'ROLLUP_BATCH_SIZE', 2)
+    self.stubs.Set(retention, 'DELETE_BATCH_SIZE', 2)
+    self.stubs.Set(retention, 'DELETE_BATCHES', 2)
+    self.kind = 'ClientLog'
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _NewState(self, **kwargs):
+    state = {
+        'run': 'run1', 'started': '2012-06-09 00:00', 'cutoff': '2011-12-12',
+        'phase': retention.ROLLUP, 'cursor': None, 'counts': {},
+        'rolled_up': 0, 'deleted': 0, 'entity_bytes': 100, 'lock': 'token1',
+    }
+    state.update(kwargs)
+    return state
+
+  def _StubOutLock(self, **kwargs):
+    """Stubs out gae_util.Lock; returns the mock lock of ClientLog runs."""
+    lock = self.mox.CreateMockAnything()
+    lock.token = 'token1'
+    self.mox.StubOutWithMock(
+        retention.gae_util, 'Lock', use_mock_anything=True)
+    retention.gae_util.Lock(
+        'retention', self.kind, ttl=retention.LOCK_SECS,
+        **kwargs).MultipleTimes().AndReturn(lock)
+    return lock
+
+  def _GetLog(self, action, mtime):
+    log = self.mox.CreateMockAnything()
+    log.action = action
+    log.mtime = mtime
+    return log
+
+  def testPolicies(self):
+    """Test every policy has a kind, days, and counters if it rolls up."""
+    self.assertEqual(
+        ['ClientLog', 'ClientLogFile', 'ComputerMSULog', 'InstallLog',
+         'PreflightExitLog'], sorted(retention.POLICIES))
+    log = self.mox.CreateMockAnything()
+    log.exit_reason = 'x' * 500
+    self.assertEqual(
+        ['exit_reason:' + 'x' * retention.MAX_COUNTER_LENGTH],
+        retention.POLICIES['PreflightExitLog'].GetCounters(log))
+
+  def testStart(self):
+    """Test Start()."""
+    now = datetime.datetime(2012, 6, 9, 10, 30)
+    lock = self._StubOutLock()
+    self.mox.StubOutWithMock(retention, '_GetEntityBytes')
+    self.mox.StubOutWithMock(retention.deferred, 'defer')
+
+    lock.Acquire().AndReturn(True)
+    retention._GetEntityBytes('ClientLog').AndReturn(None)
+    retention.deferred.defer(
+        retention.Run, 'ClientLog', '2012-06-09-10-30-00-000000')
+    lock.Acquire().AndReturn(False)
+
+    self.mox.ReplayAll()
+    run = retention.Start('ClientLog', now=now)
+    state = self.states['ClientLog']
+    self.assertEqual(run, state['run'])
+    self.assertEqual('2011-12-12', state['cutoff'])
+    self.assertEqual(retention.ROLLUP, state['phase'])
+    self.assertEqual('token1', state['lock'])
+    self.assertEqual(None, retention.Start('ClientLog', now=now))
+    self.mox.VerifyAll()
+
+  def testRun(self):
+    """Test Run() rolls up, deletes in parallel batches, and finishes."""
+    self.states[self.kind] = self._NewState()
+    query = self.mox.CreateMockAnything()
+    rpc = self.mox.CreateMockAnything()
+    dt = datetime.datetime(2011, 1, 2, 3, 4)
+    self.mox.StubOutWithMock(retention, '_GetQuery')
+    self.mox.StubOutWithMock(retention.models.LogRollup, 'SetCounts')
+    self.mox.StubOutWithMock(retention.db, 'delete_async')
+    self.mox.StubOutWithMock(
+        retention.models.KeyValueCache, 'GetSerializedItem')
+    self.mox.StubOutWithMock(
+        retention.models.KeyValueCache, 'SetSerializedItem')
+    lock = self._StubOutLock(token='token1')
+    policy = retention.POLICIES[self.kind]
+
+    # rollup phase.
+    retention._GetQuery(policy, mox.IsA(dict)).AndReturn(query)
+    query.fetch(2).AndReturn(
+        [self._GetLog('removal', dt), self._GetLog('removal', dt)])
+    query.cursor().AndReturn('cursor1')
+    lock.Extend().AndReturn(True)
+    retention._GetQuery(policy, mox.IsA(dict)).AndReturn(query)
+    query.fetch(2).AndReturn([self._GetLog('install_problem', dt)])
+    retention.models.LogRollup.SetCounts(
+        self.kind, 'run1',
+        {'2011-01-02': {'action:removal': 2, 'action:install_problem': 1}})
+    lock.Extend().AndReturn(True)
+    # delete phase.
+    retention._GetQuery(policy, mox.IsA(dict), keys_only=True).AndReturn(query)
+    query.fetch(4).AndReturn(['k1', 'k2', 'k3'])
+    retention.db.delete_async(['k1', 'k2']).AndReturn(rpc)
+    retention.db.delete_async(['k3']).AndReturn(rpc)
+    rpc.get_result()
+    rpc.get_result()
+    # finish.
+    retention.models.KeyValueCache.GetSerializedItem(
+        'retention_runs_ClientLog').AndReturn(([{'run': 'run0'}], None))
+    retention.models.KeyValueCache.SetSerializedItem(
+        'retention_runs_ClientLog', mox.IsA(list))
+    lock.Release().AndReturn(True)
+
+    self.mox.ReplayAll()
+    retention.Run(self.kind, 'run1')
+    state = self.states[self.kind]
+    self.assertEqual(3, state['rolled_up'])
+    self.assertEqual(3, state['deleted'])
+    self.assertEqual(300, state['bytes_reclaimed'])
+    self.assertEqual({}, state['counts'])
+    self.assertTrue(state['finished'])
+    self.mox.VerifyAll()
+
+  def testRunWhenOutOfTime(self):
+    """Test Run() continues in a new task after RUNTIME_MAX_SECS."""
+    self.stubs.Set(retention, 'RUNTIME_MAX_SECS', -1)
+    self.states[self.kind] = self._NewState(phase=retention.DELETE)
+    query = self.mox.CreateMockAnything()
+    rpc = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(retention, '_GetQuery')
+    self.mox.StubOutWithMock(retention.db, 'delete_async')
+    self.mox.StubOutWithMock(retention.deferred, 'defer')
+    lock = self._StubOutLock(token='token1')
+
+    retention._GetQuery(
+        retention.POLICIES[self.kind], mox.IsA(dict),
+        keys_only=True).AndReturn(query)
+    query.fetch(4).AndReturn(['k1', 'k2', 'k3', 'k4'])
+    retention.db.delete_async(['k1', 'k2']).AndReturn(rpc)
+    retention.db.delete_async(['k3', 'k4']).AndReturn(rpc)
+    rpc.get_result()
+    rpc.get_result()
+    query.cursor().AndReturn('cursor1')
+    lock.Extend().AndReturn(True)
+    retention.deferred.defer(retention.Run, self.kind, 'run1')
+
+    self.mox.ReplayAll()
+    retention.Run(self.kind, 'run1')
+    self.assertEqual('cursor1', self.states[self.kind]['cursor'])
+    self.assertEqual(4, self.states[self.kind]['deleted'])
+    self.mox.VerifyAll()
+
+  def testRunWhenLockLost(self):
+    """Test Run() stops without a checkpoint once its lock is lost."""
+    self.states[self.kind] = self._NewState(phase=retention.DELETE)
+    query = self.mox.CreateMockAnything()
+    rpc = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(retention, '_GetQuery')
+    self.mox.StubOutWithMock(retention.db, 'delete_async')
+    lock = self._StubOutLock(token='token1')
+
+    retention._GetQuery(
+        retention.POLICIES[self.kind], mox.IsA(dict),
+        keys_only=True).AndReturn(query)
+    query.fetch(4).AndReturn(['k1', 'k2', 'k3', 'k4'])
+    retention.db.delete_async(['k1', 'k2']).AndReturn(rpc)
+    retention.db.delete_async(['k3', 'k4']).AndReturn(rpc)
+    rpc.get_result()
+    rpc.get_result()
+    query.cursor().AndReturn('cursor1')
+    lock.Extend().AndReturn(False)
+
+    self.mox.ReplayAll()
+    retention.Run(self.kind, 'run1')
+    self.assertFalse(self.states[self.kind].get('finished'))
+    self.mox.VerifyAll()
+
+  def testRunWhenStale(self):
+    """Test Run() with a task of an older or finished run."""
+    self.states[self.kind] = self._NewState(run='run2')
+    self.states['InstallLog'] = self._NewState(finished='2012-06-09 01:00')
+
+    self.mox.ReplayAll()
+    retention.Run(self.kind, 'run1')
+    retention.Run('InstallLog', 'run1')
+    self.assertEqual(0, self.states[self.kind]['rolled_up'])
+    self.mox.VerifyAll()
+
+  def testGetQuery(self):
+    """Test _GetQuery()."""
+    policy = self.mox.CreateMockAnything()
+    policy.model = self.mox.CreateMockAnything()
+    policy.date_property = 'mtime'
+    query = self.mox.CreateMockAnything()
+    policy.model.all(keys_only=True).AndReturn(query)
+    query.filter('mtime <', datetime.datetime(2011, 12, 12))
+    query.with_cursor('cursor1')
+
+    self.mox.ReplayAll()
+    self.assertEqual(query, retention._GetQuery(
+        policy, self._NewState(cursor='cursor1'), keys_only=True))
+    self.mox.VerifyAll()
+
+
+def main(unused_argv):
+  basetest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# #
+
+"""scatter_gather module tests."""
+
+
+
+import tests.appenginesdk
+from google.apputils import app
+from google.apputils import basetest
+import mox
+import stubout
+from simian.mac.common import scatter_gather
+
+
+class CountJob(scatter_gather.Job):
+  """Job counting entities by their name."""
+
+  name = 'count'
+  shards = 2
+  batch_size = 2
+
+  def __init__(self, model):
+    self.model = model
+
+  def Map(self, partial, entity):
+    partial[entity] = partial.get(entity, 0) + 1
+
+  def Finish(self, result):
+    if result.get('fail'):
+      raise scatter_gather.db.Error
+    self.result = result
+
+
+class ScatterGatherModuleTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.model = self.mox.CreateMockAnything()
+    self.job = CountJob(self.model)
+    self.states = {}
+    self.stubs.Set(
+        scatter_gather, '_GetShardState',
+        lambda job, shard: self.states.get(shard))
+    self.stubs.Set(
+        scatter_gather, '_SetShardState',
+        lambda job, shard, state: self.states.__setitem__(shard, state))
+    self.finished = {}
+    self.stubs.Set(
+        scatter_gather, '_GetFinishedRun',
+        lambda job: self.finished.get(job.name))
+    self.stubs.Set(
+        scatter_gather, '_SetFinishedRun',
+        lambda job, run: self.finished.__setitem__(job.name, run))
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _NewState(self, **kwargs):
+    state = {
+        'run': 'run1', 'shards': 2, 'start': None, 'end': None,
+        'cursor': None, 'partial': {}, 'done': False, 'lock': 'token1',
+    }
+    state.update(kwargs)
+    return state
+
+  def _StubOutLock(self):
+    """Stubs out gae_util.Lock; returns the mock lock of the count job."""
+    lock = self.mox.CreateMockAnything()
+    lock.token = 'token1'
+    self.mox.StubOutWithMock(
+        scatter_gather.gae_util, 'Lock', use_mock_anything=True)
+    return lock
+
+  def testGetSplitKeys(self):
+    """Test GetSplitKeys()."""
+    query = self.mox.CreateMockAnything()
+    self.model.all(keys_only=True).AndReturn(query)
+    query.order('__scatter__').AndReturn(query)
+    query.fetch(2 * scatter_gather.OVERSAMPLING).AndReturn(
+        ['d', 'b', 'a', 'c', 'b'])
+
+    self.mox.ReplayAll()
+    self.assertEqual(['c'], scatter_gather.GetSplitKeys(self.job))
+    self.mox.VerifyAll()
+
+  def testGetSplitKeysByProperty(self):
+    """Test GetSplitKeys() with split_property."""
+    self.job.split_property = 'user'
+    query = self.mox.CreateMockAnything()
+    entities = []
+    for user in ['d', 'b', None, 'a', 'c', 'b']:
+      entity = self.mox.CreateMockAnything()
+      entity.user = user
+      entities.append(entity)
+    self.model.all().AndReturn(query)
+    query.order('__scatter__').AndReturn(query)
+    query.fetch(2 * scatter_gather.OVERSAMPLING).AndReturn(entities)
+
+    self.mox.ReplayAll()
+    self.assertEqual(['c'], scatter_gather.GetSplitKeys(self.job))
+    self.mox.VerifyAll()
+
+  def testGetShardQueryByProperty(self):
+    """Test _GetShardQuery() with split_property."""
+    self.job.split_property = 'user'
+    query = self.mox.CreateMockAnything()
+    self.model.all().AndReturn(query)
+    query.filter('user >=', '')
+    query.filter('user <', 'b')
+    query.order('user')
+    query.with_cursor('cursor1')
+
+    self.mox.ReplayAll()
+    self.assertEqual(query, scatter_gather._GetShardQuery(
+        self.job, self._NewState(start='', end='b', cursor='cursor1')))
+    self.mox.VerifyAll()
+
+  def testGetSetShardState(self):
+    """Test _GetShardState() and _SetShardState()."""
+    self.stubs.UnsetAll()
+    kvc = self.mox.CreateMockAnything()
+    entity = self.mox.CreateMockAnything()
+    self.stubs.Set(scatter_gather.models, 'KeyValueCache', kvc)
+    state = self._NewState(partial={'a': 1})
+
+    kvc(key_name='scatter_gather_count_1',
+        blob_value=mox.IsA(scatter_gather.db.Blob)).AndReturn(entity)
+    entity.put()
+    kvc.get_by_key_name('scatter_gather_count_1').AndReturn(entity)
+    kvc.get_by_key_name('scatter_gather_count_2').AndReturn(None)
+
+    self.mox.ReplayAll()
+    scatter_gather._SetShardState(self.job, 1, state)
+    entity.blob_value = scatter_gather.zlib.compress(
+        scatter_gather.util.Serialize(state))
+    self.assertEqual(state, scatter_gather._GetShardState(self.job, 1))
+    self.assertEqual(None, scatter_gather._GetShardState(self.job, 2))
+    self.mox.VerifyAll()
+
+  def testStart(self):
+    """Test Start()."""
+    self.job.start_delay_secs = 60
+    lock = self._StubOutLock()
+    self.mox.StubOutWithMock(scatter_gather, 'GetSplitKeys')
+    self.mox.StubOutWithMock(scatter_gather.deferred, 'defer')
+
+    scatter_gather.gae_util.Lock(
+        'scatter_gather', 'count', ttl=scatter_gather.LOCK_SECS).AndReturn(lock)
+    lock.Acquire().AndReturn(True)
+    scatter_gather.GetSplitKeys(self.job).AndReturn(['key1'])
+    scatter_gather.deferred.defer(
+        scatter_gather.RunShard, self.job, mox.IsA(str), 0, _countdown=60)
+    scatter_gather.deferred.defer(
+        scatter_gather.RunShard, self.job, mox.IsA(str), 1, _countdown=60)
+    scatter_gather.gae_util.Lock(
+        'scatter_gather', 'count', ttl=scatter_gather.LOCK_SECS).AndReturn(lock)
+    lock.Acquire().AndReturn(False)
+
+    self.mox.ReplayAll()
+    run = scatter_gather.Start(self.job)
+    self.assertEqual(None, self.states[0]['start'])
+    self.assertEqual('key1', self.states[0]['end'])
+    self.assertEqual('key1', self.states[1]['start'])
+    self.assertEqual(None, self.states[1]['end'])
+    self.assertEqual(run, self.states[1]['run'])
+    self.assertEqual('token1', self.states[1]['lock'])
+    self.assertEqual(None, scatter_gather.Start(self.job))
+    self.mox.VerifyAll()
+
+  def testRunShard(self):
+    """Test RunShard() checkpoints and gathers after the last shard."""
+    self.states[0] = self._NewState(done=True, partial={'a': 1})
+    self.states[1] = self._NewState(start='key1')
+    query = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(scatter_gather, '_GetShardQuery')
+    self.mox.StubOutWithMock(scatter_gather.memcache, 'add')
+    lock = self._StubOutLock()
+
+    scatter_gather.gae_util.Lock(
+        'scatter_gather', 'count', ttl=scatter_gather.LOCK_SECS,
+        token='token1').AndReturn(lock)
+    scatter_gather._GetShardQuery(self.job, self.states[1]).AndReturn(query)
+    query.fetch(2).AndReturn(['a', 'b'])
+    lock.Extend().AndReturn(True)
+    query.cursor().AndReturn('cursor1')
+    scatter_gather._GetShardQuery(self.job, self.states[1]).AndReturn(query)
+    query.fetch(2).AndReturn(['b'])
+    lock.Extend().AndReturn(True)
+    scatter_gather.memcache.add(
+        'scatter_gather_gather_count_run1', 1,
+        time=scatter_gather.GATHER_SECS).AndReturn(True)
+    lock.Release().AndReturn(True)
+
+    self.mox.ReplayAll()
+    scatter_gather.RunShard(self.job, 'run1', 1)
+    self.assertEqual('cursor1', self.states[1]['cursor'])
+    self.assertTrue(self.states[1]['done'])
+    self.assertEqual({'a': 2, 'b': 2}, self.job.result)
+    self.assertEqual('run1', self.finished['count'])
+    self.mox.VerifyAll()
+
+  def testRunShardWhenGatherFails(self):
+    """Test a failed gather is retried by the task of a done shard."""
+    self.states[0] = self._NewState(done=True, partial={'fail': 1})
+    self.states[1] = self._NewState(done=True)
+    self.mox.StubOutWithMock(scatter_gather.memcache, 'add')
+    self.mox.StubOutWithMock(scatter_gather.memcache, 'delete')
+    lock = self._StubOutLock()
+
+    scatter_gather.gae_util.Lock(
+        'scatter_gather', 'count', ttl=scatter_gather.LOCK_SECS,
+        token='token1').MultipleTimes().AndReturn(lock)
+    scatter_gather.memcache.add(
+        'scatter_gather_gather_count_run1', 1,
+        time=scatter_gather.GATHER_SECS).AndReturn(True)
+    scatter_gather.memcache.delete('scatter_gather_gather_count_run1')
+    scatter_gather.memcache.add(
+        'scatter_gather_gather_count_run1', 1,
+        time=scatter_gather.GATHER_SECS).AndReturn(True)
+    lock.Release().AndReturn(True)
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        scatter_gather.db.Error, scatter_gather.RunShard, self.job, 'run1', 1)
+    self.assertEqual({}, self.finished)
+    self.states[0]['partial'] = {'a': 1}
+    scatter_gather.RunShard(self.job, 'run1', 1)
+    self.assertEqual({'a': 1}, self.job.result)
+    self.assertEqual('run1', self.finished['count'])
+    self.mox.VerifyAll()
+
+  def testRunShardWhenGathering(self):
+    """Test a task is retried while another task holds the gather guard."""
+    self.states[0] = self._NewState(done=True, partial={'a': 1})
+    self.states[1] = self._NewState(done=True)
+    self.mox.StubOutWithMock(scatter_gather.memcache, 'add')
+    lock = self._StubOutLock()
+
+    scatter_gather.gae_util.Lock(
+        'scatter_gather', 'count', ttl=scatter_gather.LOCK_SECS,
+        token='token1').AndReturn(lock)
+    scatter_gather.memcache.add(
+        'scatter_gather_gather_count_run1', 1,
+        time=scatter_gather.GATHER_SECS).AndReturn(False)
+
+    self.mox.ReplayAll()
+    self.assertRaises(
+        scatter_gather.deferred.SingularTaskFailure,
+        scatter_gather.RunShard, self.job, 'run1', 1)
+    self.assertEqual({}, self.finished)
+    self.mox.VerifyAll()
+
+  def testRunShardWhenFinished(self):
+    """Test a retried task of a finished run only releases the lock."""
+    self.states[0] = self._NewState(done=True)
+    self.states[1] = self._NewState(done=True)
+    self.finished['count'] = 'run1'
+    lock = self._StubOutLock()
+
+    scatter_gather.gae_util.Lock(
+        'scatter_gather', 'count', ttl=scatter_gather.LOCK_SECS,
+        token='token1').AndReturn(lock)
+    lock.Release().AndReturn(False)
+
+    self.mox.ReplayAll()
+    scatter_gather.RunShard(self.job, 'run1', 0)
+    self.assertFalse(hasattr(self.job, 'result'))
+    self.mox.VerifyAll()
+
+  def testRunShardWhenOutOfTime(self):
+    """Test RunShard() continues in a new task after runtime_max_secs."""
+    self.states[0] = self._NewState()
+    self.job.runtime_max_secs = -1
+    query = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(scatter_gather, '_GetShardQuery')
+    self.mox.StubOutWithMock(scatter_gather.deferred, 'defer')
+    lock = self._StubOutLock()
+
+    scatter_gather.gae_util.Lock(
+        'scatter_gather', 'count', ttl=scatter_gather.LOCK_SECS,
+        token='token1').AndReturn(lock)
+    scatter_gather._GetShardQuery(self.job, self.states[0]).AndReturn(query)
+    query.fetch(2).AndReturn(['a', 'b'])
+    lock.Extend().AndReturn(True)
+    query.cursor().AndReturn('cursor1')
+    scatter_gather.deferred.defer(
+        scatter_gather.RunShard, self.job, 'run1', 0)
+
+    self.mox.ReplayAll()
+    scatter_gather.RunShard(self.job, 'run1', 0)
+    self.assertEqual('cursor1', self.states[0]['cursor'])
+    self.assertEqual({'a': 1, 'b': 1}, self.states[0]['partial'])
+    self.assertFalse(self.states[0]['done'])
+    self.mox.VerifyAll()
+
+  def testRunShardWhenNotLast(self):
+    """Test RunShard() does not gather while other shards are running."""
+    self.states[0] = self._NewState()
+    self.states[1] = self._NewState()
+    query = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(scatter_gather, '_GetShardQuery')
+    lock = self._StubOutLock()
+
+    scatter_gather.gae_util.Lock(
+        'scatter_gather', 'count', ttl=scatter_gather.LOCK_SECS,
+        token='token1').AndReturn(lock)
+    scatter_gather._GetShardQuery(self.job, self.states[0]).AndReturn(query)
+    query.fetch(2).AndReturn([])
+    lock.Extend().AndReturn(True)
+
+    self.mox.ReplayAll()
+    scatter_gather.RunShard(self.job, 'run1', 0)
+    self.assertTrue(self.states[0]['done'])
+    self.assertFalse(hasattr(self.job, 'result'))
+    self.mox.VerifyAll()
+
+  def testRunShardWhenLockLost(self):
+    """Test RunShard() stops without a checkpoint once its lock is lost."""
+    self.states[0] = self._NewState()
+    query = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(scatter_gather, '_GetShardQuery')
+    lock = self._StubOutLock()
+
+    scatter_gather.gae_util.Lock(
+        'scatter_gather', 'count', ttl=scatter_gather.LOCK_SECS,
+        token='token1').AndReturn(lock)
+    scatter_gather._GetShardQuery(self.job, self.states[0]).AndReturn(query)
+    query.fetch(2).AndReturn(['a', 'b'])
+    lock.Extend().AndReturn(False)
+
+    self.mox.ReplayAll()
+    scatter_gather.RunShard(self.job, 'run1', 0)
+    self.assertEqual(None, self.states[0]['cursor'])
+    self.assertFalse(self.states[0]['done'])
+    self.mox.VerifyAll()
+
+  def testRunShardWhenStale(self):
+    """Test RunShard() with a task from an older run."""
+    self.states[0] = self._NewState(run='run2')
+
+    self.mox.ReplayAll()
+    scatter_gather.RunShard(self.job, 'run1', 0)
+    self.assertFalse(self.states[0]['done'])
+    self.mox.VerifyAll()
+
+
+def main(unused_argv):
+  basetest.main()
+
+
+if __name__ == '__main__':
+  app.run()
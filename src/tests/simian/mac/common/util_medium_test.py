@@ -19,6 +19,9 @@
 
 
 
+import logging
+import time
+
 from google.apputils import app
 from google.apputils import basetest
 import mox
@@ -143,6 +146,95 @@ class UtilModuleTest(mox.MoxTestBase):
         output,
         util.Deserialize(input))
 
+  def testEncodeDecode(self):
+    """Test Encode() and Decode() round trips."""
+    values = [
+        None, 'foo', u'Hello there\u2014', {'foo': [1, 2.5, True]},
+        [1, -2, 2 ** 63 - 1, -2 ** 63], [2 ** 63], [1, 'foo'], [True], [],
+        {'foo': 'x' * 2000}, range(1000),
+    ]
+    for value in values:
+      for binary in [True, False]:
+        encoded = util.Encode(value, binary=binary)
+        self.assertEqual(value, util.Decode(encoded))
+
+  def testEncode(self):
+    """Test Encode() tags, int arrays and compression."""
+    self.assertEqual('\x10{"foo":[1,2]}', util.Encode({'foo': [1, 2]}))
+    self.assertEqual('\x11\x01' + '\x00' * 7, util.Encode([1]))
+    self.assertEqual('\x10[1]', util.Encode([1], binary=False))
+    self.assertEqual('\x10[true]', util.Encode([True]))
+
+    encoded = util.Encode(range(1000))
+    self.assertEqual('\x19', encoded[0])
+    self.assertTrue(len(encoded) < 8000)
+    self.assertEqual(
+        '\x10"%s"' % ('x' * 2000),
+        util.Encode('x' * 2000, binary=False))
+    self.assertEqual('\x18', util.Encode('x' * 2000)[0])
+    # compression is skipped if it does not make the value smaller.
+    self.assertEqual('\x10"abc"', util.Encode('abc', compress_min_bytes=0))
+
+  def testDecodeLegacy(self):
+    """Test Decode() of Serialize() output."""
+    for value in [{'foo': 1}, [1, 2], 'foo', 1, None, True]:
+      self.assertEqual(value, util.Decode(util.Serialize(value)))
+    self.assertEqual({'foo': 1}, util.Decode(u' {"foo": 1}'))
+
+  def testDecodeInvalid(self):
+    """Test Decode() of invalid values."""
+    for s in [None, '', '\x12[]', '\x18not zlib', '\x11\x01', '\x10{']:
+      self.assertRaises(util.DeserializeError, util.Decode, s)
+
+  def _GetInstallCounts(self, packages=2000):
+    """Returns install counts shaped like ReportsCache.GetInstallCounts()."""
+    pkgs = {}
+    for i in xrange(packages):
+      pkg = {
+          'applesus': i % 5 == 0,
+          'install_count': i * 37 % 100000,
+          'install_fail_count': i % 91,
+          'duration_count': i * 31 % 90000,
+          'duration_total_seconds': i * 977 % 10000000,
+          'duration_seconds_avg': i % 600,
+          'duration_histogram': dict(
+              (str(b), (i * b) % 5000) for b in xrange(i % 40)),
+          'dl_kbytes_per_sec_histogram': dict(
+              (str(b), (i + b) % 3000) for b in xrange(i % 50)),
+      }
+      for name in ['duration', 'dl_kbytes_per_sec']:
+        for percentile in [50, 90, 99]:
+          pkg['%s_p%d' % (name, percentile)] = i * percentile % 4000
+      pkgs['Package%d-%d.%d.%d' % (i, i % 7, i % 13, i % 3)] = pkg
+    return pkgs
+
+  def testEncodeDecodeBenchmark(self):
+    """Benchmarks Serialize() and Encode() on 2,000 packages' install counts.
+
+    The payload has the shape of the install counts ReportsCache entity, which
+    is read on every installs admin page view.
+    """
+    pkgs = self._GetInstallCounts()
+    results = {}
+    for name, encode, decode in [
+        ('json', util.Serialize, util.Deserialize),
+        ('codec', util.Encode, util.Decode)]:
+      start = time.time()
+      serialized = encode(pkgs)
+      encode_secs = time.time() - start
+      start = time.time()
+      for _ in xrange(5):
+        decoded = decode(serialized)
+      decode_secs = (time.time() - start) / 5
+      self.assertEqual(pkgs, decoded)
+      results[name] = len(serialized)
+      logging.info(
+          'Install counts %s: %d bytes, encode %.4fs, decode %.4fs',
+          name, len(serialized), encode_secs, decode_secs)
+
+    # the install counts entity must stay well under the 1MB entity limit.
+    self.assertTrue(results['codec'] * 4 < results['json'])
+
 
 def main(unused_argv):
   basetest.main()
@@ -48,6 +48,25 @@ class AuthSessionCleanupTest(test.RequestHandlerTest):
     self.mox.VerifyAll()
 
 
+class LogRetentionTest(test.RequestHandlerTest):
+
+  def GetTestClassInstance(self):
+    return maint.LogRetention()
+
+  def GetTestClassModule(self):
+    return maint
+
+  def testGet(self):
+    """Test get() starts a retention run of every policy."""
+    self.mox.StubOutWithMock(maint.retention, 'Start')
+    for kind_name in sorted(maint.retention.POLICIES):
+      maint.retention.Start(kind_name)
+
+    self.mox.ReplayAll()
+    self.c.get()
+    self.mox.VerifyAll()
+
+
 class UpdateAverageInstallDurationsTest(test.RequestHandlerTest):
 
   def GetTestClassInstance(self):
@@ -95,7 +114,7 @@ class UpdateAverageInstallDurationsTest(test.RequestHandlerTest):
     pkginfo1.version = '1.2.3'
     pkg1_munki_name = '%s-%s' % (pkginfo1.name, pkginfo1.version)
     pkginfo1.munki_name = pkg1_munki_name
-    pkg1_lock = 'pkgsinfo_%s' % pkginfo1.filename
+    lock = self.mox.CreateMockAnything()
     mock_pl1 = self.mox.CreateMockAnything()
     pkginfo1.plist = mock_pl1
 
@@ -122,19 +141,19 @@ class UpdateAverageInstallDurationsTest(test.RequestHandlerTest):
 
     self.mox.StubOutWithMock(maint.models.ReportsCache, 'GetInstallCounts')
     self.mox.StubOutWithMock(maint.models.PackageInfo, 'all')
-    self.mox.StubOutWithMock(maint.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(maint.gae_util, 'ReleaseLock')
+    self.mox.StubOutWithMock(maint.gae_util, 'Lock', use_mock_anything=True)
     self.mox.StubOutWithMock(maint.models.Catalog, 'all')
     self.mox.StubOutWithMock(maint.models.Catalog, 'Generate')
 
     maint.models.ReportsCache.GetInstallCounts().AndReturn(
         (install_counts, None))
     maint.models.PackageInfo.all().AndReturn(pkginfos)
-    maint.gae_util.ObtainLock(pkg1_lock, timeout=5.0).AndReturn(True)
+    maint.gae_util.Lock('pkgsinfo', pkginfo1.filename).AndReturn(lock)
+    lock.Acquire(timeout=5.0).AndReturn(True)
     mock_pl1.__getitem__('description').AndReturn(pkg1_desc)
     mock_pl1.__getitem__('description').AndReturn(pkg1_desc_updated)
     pkginfo1.put().AndReturn(None)
-    maint.gae_util.ReleaseLock(pkg1_lock).AndReturn(None)
+    lock.Release().AndReturn(True)
 
     delay = 0
     for track in maint.common.TRACKS:
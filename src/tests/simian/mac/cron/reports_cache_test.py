@@ -23,6 +23,8 @@ import datetime
 import logging
 logging.basicConfig(filename='/dev/null')
 import random
+import time
+import zlib
 
 from django.conf import settings
 settings.configure()
@@ -30,6 +32,7 @@ from google.apputils import app
 from google.apputils import basetest
 import mox
 import stubout
+from simian.mac.common import util
 from simian.mac.cron import reports_cache
 
 
@@ -151,653 +154,629 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
       summary_output['total_users_%d_events' % users[user]] += 1
     return reports
 
-  def testGenerateMsuUserSummaryWhenNoData(self):
+  def _RunMsuUserSummaryJob(self, job, shards):
+    """Runs MsuUserSummaryJob over shards of reports, and returns the result.
+
+    Args:
+      job: MsuUserSummaryJob instance.
+      shards: list of lists of reports, in key order.
+    Returns:
+      merged result of the shards.
+    """
+    result = job.NewPartial()
+    for reports in shards:
+      partial = job.NewPartial()
+      for report in reports:
+        job.Map(partial, report)
+      job.FinishShard(partial)
+      result = job.Merge(result, partial)
+    return result
+
+  def testGenerateMsuUserSummary(self):
     """Test _GenerateMsuUserSummary()."""
     rc = reports_cache.ReportsCache()
-
-    reports = None
-    cursor = None
-    summary = None
-    summary_output = self._GenBaseSummaryOutput(rc)
-
-    lquery = self.mox.CreateMockAnything()
-    self.mox.StubOutWithMock(reports_cache.models, 'ComputerMSULog')
-    self.mox.StubOutWithMock(reports_cache.models, 'KeyValueCache')
-    self.mox.StubOutWithMock(reports_cache.models, 'ReportsCache')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
-
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    reports_cache.models.KeyValueCache.MemcacheWrappedGet(
-        'msu_user_summary_cursor', 'text_value').AndReturn(cursor)
-    reports_cache.models.ReportsCache.GetMsuUserSummary(
-        since=None, tmp=True).AndReturn((summary, None))
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_output, since=None, tmp=True).AndReturn(None)
-
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(reports)
-
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_output, since=None).AndReturn(None)
-    reports_cache.models.KeyValueCache.DeleteMemcacheWrap(
-        'msu_user_summary_cursor', prop_name='text_value')
-    reports_cache.models.ReportsCache.DeleteMsuUserSummary(
-        since=None, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
+    self.mox.StubOutWithMock(reports_cache.scatter_gather, 'Start')
+    reports_cache.scatter_gather.Start(
+        mox.IsA(reports_cache.MsuUserSummaryJob))
 
     self.mox.ReplayAll()
-    rc._GenerateMsuUserSummary()
+    rc._GenerateMsuUserSummary(since_days=7)
     self.mox.VerifyAll()
 
-  def testGenerateMsuUserSummaryWhenData(self):
-    """Test _GenerateMsuUserSummary()."""
+  def testMsuUserSummaryJob(self):
+    """Test MsuUserSummaryJob."""
     rc = reports_cache.ReportsCache()
+    job = reports_cache.MsuUserSummaryJob(rc.USER_EVENTS)
+    self.assertEqual('msu_user_summary', job.name)
 
     (dt_a1, dt_a2) = self._GenDatetimes(10)
     reports_raw = [
-        {
-            'uuid': 'u1', 'mtime': dt_a1,
-            'event': 'launched', 'user': 'a'
-        },
-        {
-            'uuid': 'u1', 'mtime': dt_a2,
-            'event': 'exit_later_clicked', 'user': 'a'
-        },
+        {'uuid': 'u1', 'mtime': dt_a1, 'event': 'launched', 'user': 'a'},
+        {'uuid': 'u1', 'mtime': dt_a2, 'event': 'exit_later_clicked',
+         'user': 'a'},
+        {'uuid': 'u2', 'mtime': dt_a1, 'event': 'launched', 'user': 'b'},
+        {'uuid': 'u3', 'mtime': dt_a1, 'event': 'launched', 'user': 'a'},
     ]
-
-    reports = []
-    cursor = None
-    summary = None
     summary_output = self._GenBaseSummaryOutput(rc)
-    summary_empty = summary_output.copy()
     reports = self._GenReportsAndSummary(summary_output, reports_raw)
+    # events of a uuid without a launched event are skipped.
+    skipped = self.mox.CreateMockAnything()
+    skipped.uuid = 'u4'
+    skipped.mtime = dt_a1
+    skipped.event = 'cancelled'
+    skipped.user = 'c'
 
-    lquery = self.mox.CreateMockAnything()
-    mock_summary = self.mox.CreateMockAnything()
-    self.mox.StubOutWithMock(reports_cache.models, 'ComputerMSULog')
-    self.mox.StubOutWithMock(reports_cache.models, 'KeyValueCache')
     self.mox.StubOutWithMock(reports_cache.models, 'ReportsCache')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
-
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    reports_cache.models.KeyValueCache.MemcacheWrappedGet(
-        'msu_user_summary_cursor', 'text_value').AndReturn(cursor)
-    reports_cache.models.ReportsCache.GetMsuUserSummary(
-        since=None, tmp=True).AndReturn((summary, None))
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_empty, since=None, tmp=True).AndReturn(None)
-
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(reports)
-    i = 0
-    last_user = None
-    for report in reports:
-      if last_user != report.user:
-        lquery.cursor().AndReturn('cursor%d' % i)
-        i +=1
-      last_user = report.user
-
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    lquery.with_cursor('cursor%d' % (i-1)).AndReturn(None)
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(None)
-
     reports_cache.models.ReportsCache.SetMsuUserSummary(
         summary_output, since=None).AndReturn(None)
-    reports_cache.models.KeyValueCache.DeleteMemcacheWrap(
-        'msu_user_summary_cursor', prop_name='text_value')
-    reports_cache.models.ReportsCache.DeleteMsuUserSummary(
-        since=None, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
 
     self.mox.ReplayAll()
-    rc._GenerateMsuUserSummary()
+    # shards are in user order.
+    result = self._RunMsuUserSummaryJob(
+        job, [reports[:2] + [reports[3]], [reports[2], skipped]])
+    job.Finish(result)
     self.mox.VerifyAll()
 
-  def testGenerateMsuUserSummaryWhenDataFetchBoundary(self):
-    """Test _GenerateMsuUserSummary()."""
+  def testMsuUserSummaryJobSinceOneDay(self):
+    """Test MsuUserSummaryJob with since_days."""
     rc = reports_cache.ReportsCache()
+    now = datetime.datetime(2012, 3, 9, 12, 0, 0)
+    job = reports_cache.MsuUserSummaryJob(rc.USER_EVENTS, since_days=1, now=now)
+    self.assertEqual('msu_user_summary_1D', job.name)
 
-    (dt_a1, dt_a2) = self._GenDatetimes(10)
     reports_raw = [
-        {
-            'uuid': 'u1', 'mtime': dt_a1,
-            'event': 'launched', 'user': 'a'
-        },
-        {
-            'uuid': 'u1', 'mtime': dt_a2,
-            'event': 'exit_later_clicked', 'user': 'a'
-        },
-        {
-            'uuid': 'u2', 'mtime': dt_a1,
-            'event': 'launched', 'user': 'b'
-        },
-        {
-            'uuid': 'u2', 'mtime': dt_a2,
-            'event': 'exit_later_clicked', 'user': 'b'
-        },
+        {'uuid': 'u1', 'mtime': now - datetime.timedelta(hours=1),
+         'event': 'launched', 'user': 'a'},
+        {'uuid': 'u2', 'mtime': now - datetime.timedelta(hours=1),
+         'event': 'launched', 'user': 'b'},
     ]
-
-    rc.FETCH_LIMIT = len(reports_raw)
-
-    reports = []
-    cursor = None
-    summary = None
     summary_output = self._GenBaseSummaryOutput(rc)
-    summary_empty = summary_output.copy()
     reports = self._GenReportsAndSummary(summary_output, reports_raw)
+    # u1 also launched MSU too long ago, which is not counted.
+    too_old = self.mox.CreateMockAnything()
+    too_old.uuid = 'u1'
+    too_old.mtime = now - datetime.timedelta(days=2)
+    too_old.event = 'cancelled'
+    too_old.user = 'a'
 
-    # adjust for intentional buffer boundary dropping user 'b'
-    for report_raw in reports_raw:
-      if report_raw['user'] == 'b':
-        summary_output[report_raw['event']] -= 1
-        summary_output['total_events'] -= 1
-    summary_output['total_users'] -= 1
-    summary_output['total_uuids'] -= 1
-    summary_output['total_users_2_events'] -= 1
-
-    lquery = self.mox.CreateMockAnything()
-    mock_summary = self.mox.CreateMockAnything()
-    self.mox.StubOutWithMock(reports_cache.models, 'ComputerMSULog')
-    self.mox.StubOutWithMock(reports_cache.models, 'KeyValueCache')
     self.mox.StubOutWithMock(reports_cache.models, 'ReportsCache')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
-
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    reports_cache.models.KeyValueCache.MemcacheWrappedGet(
-        'msu_user_summary_cursor', 'text_value').AndReturn(cursor)
-    reports_cache.models.ReportsCache.GetMsuUserSummary(
-        since=None, tmp=True).AndReturn((summary, None))
     reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_empty, since=None, tmp=True).AndReturn(None)
-
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(reports)
-    i = 0
-    last_user = None
-    for report in reports:
-      if last_user != report.user:
-        lquery.cursor().AndReturn('cursor%d' % i)
-        i += 1
-      last_user = report.user
-
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    lquery.with_cursor('cursor%d' % (i-2)).AndReturn(None)  # prev cursor
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(None)  # stop test
-
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_output, since=None).AndReturn(None)
-    reports_cache.models.KeyValueCache.DeleteMemcacheWrap(
-        'msu_user_summary_cursor', prop_name='text_value')
-    reports_cache.models.ReportsCache.DeleteMsuUserSummary(
-        since=None, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
+        summary_output, since='1D').AndReturn(None)
 
     self.mox.ReplayAll()
-    rc._GenerateMsuUserSummary()
+    result = self._RunMsuUserSummaryJob(
+        job, [[reports[0], too_old, reports[1]]])
+    job.Finish(result)
     self.mox.VerifyAll()
 
-  def testGenerateMsuUserSummaryWhenDataSinceOneDay(self):
-    """Test _GenerateMsuUserSummary()."""
-    rc = reports_cache.ReportsCache()
-    since_days = 1
-
-    (now, dt_a1, dt_a2) = self._GenDatetimes(10, 20)
-    reports_raw = [
-        {
-            'uuid': 'u1', 'mtime': dt_a1,
-            'event': 'launched', 'user': 'a'
-        },
-        {
-            'uuid': 'u1', 'mtime': dt_a2,
-            'event': 'exit_later_clicked', 'user': 'a'
-        },
-    ]
-
-    reports = []
-    cursor = None
-    lock_name = 'msu_user_summary_lock_%dD' % since_days
-    summary = None
-    summary_output = self._GenBaseSummaryOutput(rc)
-    summary_empty = summary_output.copy()
-    reports = self._GenReportsAndSummary(summary_output, reports_raw)
+  def testMsuUserSummaryJobBenchmark(self):
+    """Benchmark MsuUserSummaryJob over a synthetic 1M row log.
 
-    lquery = self.mox.CreateMockAnything()
-    mock_summary = self.mox.CreateMockAnything()
-    self.mox.StubOutWithMock(reports_cache.models, 'ComputerMSULog')
-    self.mox.StubOutWithMock(reports_cache.models, 'KeyValueCache')
+    Runs one shard through scatter_gather.RunShard(), checkpointing every
+    batch, and checks each row is fetched once and checkpoints stay small.
+    """
+    rows = 1000000
+    events = [
+        'launched', 'install_with_logout', 'cancelled', 'exit_later_clicked']
+    users = rows / 40  # 10 uuids of 4 events each per user.
+    now = datetime.datetime(2012, 3, 9, 12, 0, 0)
+
+    class Report(object):
+      __slots__ = ('user', 'uuid', 'event', 'mtime')
+
+      def __init__(self, i):
+        self.user = 'user%07d' % (i / 40)
+        self.uuid = 'uuid%08d' % (i / 4)
+        self.event = events[i % 4]
+        self.mtime = now
+
+    class Query(object):
+      """Fake user ordered query over rows, with int offset cursors."""
+
+      def __init__(self, state):
+        self.offset = int(state['cursor'] or 0)
+
+      def fetch(self, limit):
+        end = min(self.offset + limit, rows)
+        fetched.append(end - self.offset)
+        reports = [Report(i) for i in xrange(self.offset, end)]
+        self.offset = end
+        return reports
+
+      def cursor(self):
+        return str(self.offset)
+
+    class Lock(object):
+
+      def __init__(self, *unused_args, **unused_kwargs):
+        pass
+
+      def Extend(self):
+        return True
+
+      def Release(self):
+        return True
+
+    job = reports_cache.MsuUserSummaryJob(events, since_days=1, now=now)
+    job.shards = 1
+    fetched = []
+    checkpoints = []
+    states = {0: {
+        'run': 'run1', 'shards': 1, 'start': None, 'end': None,
+        'cursor': None, 'partial': job.NewPartial(), 'done': False,
+    }}
+
+    def SetShardState(unused_job, shard, state):
+      data = zlib.compress(util.Serialize(state))
+      checkpoints.append(len(data))
+      states[shard] = util.Deserialize(zlib.decompress(data))
+
+    self.stubs.Set(
+        reports_cache.scatter_gather, '_GetShardState',
+        lambda unused_job, shard: states[shard])
+    self.stubs.Set(
+        reports_cache.scatter_gather, '_SetShardState', SetShardState)
+    self.stubs.Set(
+        reports_cache.scatter_gather, '_GetShardQuery',
+        lambda unused_job, state: Query(state))
+    self.stubs.Set(
+        reports_cache.scatter_gather.memcache, 'add', lambda *a, **kw: True)
+    self.stubs.Set(reports_cache.scatter_gather.gae_util, 'Lock', Lock)
+    finished = {}
+    self.stubs.Set(
+        reports_cache.scatter_gather, '_GetFinishedRun',
+        lambda job: finished.get(job.name))
+    self.stubs.Set(
+        reports_cache.scatter_gather, '_SetFinishedRun',
+        lambda job, run: finished.__setitem__(job.name, run))
     self.mox.StubOutWithMock(reports_cache.models, 'ReportsCache')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
-
-    reports_cache.gae_util.ObtainLock(lock_name).AndReturn(True)
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    reports_cache.models.KeyValueCache.MemcacheWrappedGet(
-        'msu_user_summary_cursor_%dD' % since_days, 'text_value').AndReturn(cursor)
-    reports_cache.models.ReportsCache.GetMsuUserSummary(
-        since='%dD' % since_days, tmp=True).AndReturn((summary, None))
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_empty, since='%dD' % since_days, tmp=True).AndReturn(None)
-
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(reports)
-    i = 0
-    last_user = None
-    for report in reports:
-      if last_user != report.user:
-        lquery.cursor().AndReturn('cursor%d' % i)
-        i +=1
-      last_user = report.user
+    summary = dict((event, users * 10) for event in events)
+    summary.update({
+        'total_events': rows, 'total_uuids': rows / 4,
+        'total_users': users, 'total_users_40_events': users,
+    })
+    reports_cache.models.ReportsCache.SetMsuUserSummary(summary, since='1D')
 
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    lquery.with_cursor('cursor%d' % (i-1)).AndReturn(None)
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(None)
+    self.mox.ReplayAll()
+    begin = time.time()
+    reports_cache.scatter_gather.RunShard(job, 'run1', 0)
+    logging.info(
+        'MsuUserSummaryJob: %d rows in %.1fs, %d checkpoints of <= %d bytes',
+        rows, time.time() - begin, len(checkpoints), max(checkpoints))
+    self.assertEqual(rows, sum(fetched))
+    self.assertTrue(max(checkpoints) < 1024)
+    self.assertEqual('run1', finished[job.name])
+    self.mox.VerifyAll()
 
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_output, since='%dD' % since_days).AndReturn(None)
-    reports_cache.models.KeyValueCache.DeleteMemcacheWrap(
-        'msu_user_summary_cursor_%dD' % since_days, prop_name='text_value')
-    reports_cache.models.ReportsCache.DeleteMsuUserSummary(
-        since='%dD' % since_days, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock(lock_name).AndReturn(True)
+  def testRecordFleetMetrics(self):
+    """Test _RecordFleetMetrics()."""
+    summary = {
+        'active': {30: 10, 14: 8, 7: 6, 1: 2},
+        'all_pkgs_installed_percent': {30: 33.3333, 14: 0, 7: 0, 1: 0},
+        'all_apple_updates_installed_percent': {30: 50.0, 14: 0, 7: 0, 1: 0},
+        'conns_on_corp_percent': 66.6666,
+        'tracks': {'stable': {30: 9, 1: 2}, 'testing': {1: 0}},
+        'os_versions': [('10.7.4', 7), ('10.6.8', 3)],
+        'client_versions': [('2.0', 10)],
+    }
+    today = datetime.date(2012, 3, 9)
+    self.mox.StubOutWithMock(reports_cache.models.FleetMetric, 'SetDay')
+    reports_cache.models.FleetMetric.SetDay(today, {
+        'active_30d': 10, 'active_14d': 8, 'active_7d': 6, 'active_1d': 2,
+        'all_pkgs_installed_percent': 33.33,
+        'all_apple_updates_installed_percent': 50.0,
+        'conns_on_corp_percent': 66.67,
+        'track:stable': 9, 'track:testing': 0,
+        'os_version:10.7.4': 7, 'os_version:10.6.8': 3,
+        'client_version:2.0': 10,
+    })
 
     self.mox.ReplayAll()
-    rc._GenerateMsuUserSummary(since_days=since_days, now=now)
+    reports_cache._RecordFleetMetrics(summary, today=today)
     self.mox.VerifyAll()
 
-  def testGenerateMsuUserSummaryWhenDataSinceOneDayTooOld(self):
-    """Test _GenerateMsuUserSummary()."""
-    rc = reports_cache.ReportsCache()
-    since_days = 1
+  def testRecordFleetMetricsWhenEmpty(self):
+    """Test _RecordFleetMetrics() of a summary without active computers."""
+    today = datetime.date(2012, 3, 9)
+    self.mox.StubOutWithMock(reports_cache.models.FleetMetric, 'SetDay')
+    reports_cache.models.FleetMetric.SetDay(today, {
+        'active_30d': 0, 'active_14d': 0, 'active_7d': 0, 'active_1d': 0})
 
-    (now, dt_a1, dt_a2) = self._GenDatetimes(86500, 86550)
-    reports_raw = [
-        {
-            'uuid': 'u1', 'mtime': dt_a1,
-            'event': 'launched', 'user': 'a'
-        },
-        {
-            'uuid': 'u1', 'mtime': dt_a2,
-            'event': 'exit_later_clicked', 'user': 'a'
-        },
-    ]
-
-    reports = []
-    cursor = None
-    cursor_name = 'msu_user_summary_cursor_%dD' % since_days
-    lock_name = 'msu_user_summary_lock_%dD' % since_days
-    summary = None
-    summary_output = self._GenBaseSummaryOutput(rc)
-    summary_empty = summary_output.copy()
-    reports = self._GenReportsAndSummary(summary_output, reports_raw)
+    self.mox.ReplayAll()
+    reports_cache._RecordFleetMetrics({}, today=today)
+    self.mox.VerifyAll()
 
-    lquery = self.mox.CreateMockAnything()
-    mock_summary = self.mox.CreateMockAnything()
-    self.mox.StubOutWithMock(reports_cache.models, 'ComputerMSULog')
-    self.mox.StubOutWithMock(reports_cache.models, 'KeyValueCache')
+  def testGeneratePendingCounts(self):
+    """Test _GeneratePendingCounts()."""
+    daily_counts = {
+        datetime.date(2012, 3, 8): {'active': 2, 'pending:foo': 2},
+        datetime.date(2012, 3, 9): {
+            'active': 1, 'pending:foo': 1, 'pending:bar': 1,
+            'pending:AppleSUS: 041-1234': 1},
+    }
+    packages = []
+    for munki_name in ['foo', 'bar', 'zoo']:
+      package = self.mox.CreateMockAnything()
+      package.munki_name = munki_name
+      packages.append(package)
+
+    self.mox.StubOutWithMock(reports_cache.models, 'ComputerSummaryShard')
+    self.mox.StubOutWithMock(reports_cache.models, 'PackageInfo')
     self.mox.StubOutWithMock(reports_cache.models, 'ReportsCache')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
-
-    reports_cache.gae_util.ObtainLock(lock_name).AndReturn(True)
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    reports_cache.models.KeyValueCache.MemcacheWrappedGet(
-        cursor_name, 'text_value').AndReturn(cursor)
-    reports_cache.models.ReportsCache.GetMsuUserSummary(
-        since='%dD' % since_days, tmp=True).AndReturn((summary, None))
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_empty, since='%dD' % since_days, tmp=True).AndReturn(None)
+    reports_cache.models.ComputerSummaryShard.GetDailyCounts().AndReturn(
+        daily_counts)
+    reports_cache.models.PackageInfo.all().AndReturn(packages)
+    reports_cache.models.ReportsCache.SetPendingCounts(
+        {'foo': 3, 'bar': 1, 'zoo': 0, 'AppleSUS: 041-1234': 1})
 
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(reports)
-    i = 0
-    last_user = None
-    for report in reports:
-      if last_user != report.user:
-        lquery.cursor().AndReturn('cursor%d' % i)
-        i +=1
-      last_user = report.user
-
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    lquery.with_cursor('cursor%d' % (i-1)).AndReturn(None)
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(None)
+    self.mox.ReplayAll()
+    reports_cache._GeneratePendingCounts()
+    self.mox.VerifyAll()
 
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_empty, since='%dD' % since_days).AndReturn(None)
-    reports_cache.models.KeyValueCache.DeleteMemcacheWrap(
-        cursor_name, prop_name='text_value')
-    reports_cache.models.ReportsCache.DeleteMsuUserSummary(
-        since='%dD' % since_days, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock(lock_name).AndReturn(True)
+  def testComputerSummaryJob(self):
+    """Test ComputerSummaryJob."""
+    job = reports_cache.ComputerSummaryJob()
+    date = datetime.date(2012, 3, 9)
+    self.mox.StubOutWithMock(
+        reports_cache.models.ComputerSummaryShard, 'BeginReconcile')
+    self.mox.StubOutWithMock(
+        reports_cache.models.ComputerSummaryShard, 'GetReconcileCounts')
+    self.mox.StubOutWithMock(
+        reports_cache.models.ComputerSummaryShard, 'SetDailyCounts')
+    self.mox.StubOutWithMock(
+        reports_cache.summary_module, 'GetComputerSummaryFromCounters')
+    self.mox.StubOutWithMock(
+        reports_cache.models.ReportsCache, 'SetStatsSummary')
+    self.mox.StubOutWithMock(reports_cache, '_GeneratePendingCounts')
+
+    reports_cache.models.ComputerSummaryShard.BeginReconcile().AndReturn(4)
+    reports_cache.models.ComputerSummaryShard.GetReconcileCounts(
+        'c1', 4).AndReturn((date, {'active': 1, 'track:stable': 1}))
+    reports_cache.models.ComputerSummaryShard.GetReconcileCounts(
+        'c2', 4).AndReturn(None)
+    reports_cache.models.ComputerSummaryShard.GetReconcileCounts(
+        'c3', 4).AndReturn((date, {'active': 1, 'track:testing': 1}))
+    daily_counts = {date: {'active': 2, 'track:stable': 1, 'track:testing': 1}}
+    reports_cache.models.ComputerSummaryShard.SetDailyCounts(
+        daily_counts, 4).AndReturn(True)
+    reports_cache.summary_module.GetComputerSummaryFromCounters().AndReturn(
+        'summary')
+    reports_cache.models.ReportsCache.SetStatsSummary('summary')
+    reports_cache._GeneratePendingCounts()
 
     self.mox.ReplayAll()
-    rc._GenerateMsuUserSummary(since_days=since_days, now=now)
+    job.Begin()
+    partials = [job.NewPartial(), job.NewPartial()]
+    job.Map(partials[0], 'c1')
+    job.Map(partials[0], 'c2')
+    job.Map(partials[1], 'c3')
+    result = job.NewPartial()
+    for partial in partials:
+      result = job.Merge(result, partial)
+    job.Finish(result)
     self.mox.VerifyAll()
 
-  def testGenerateMsuUserSummaryWhenLotsData(self):
-    """Test _GenerateMsuUserSummary()."""
-    rc = reports_cache.ReportsCache()
+  def testComputerSummaryJobWhenReplaced(self):
+    """Test ComputerSummaryJob.Finish() once a newer reconcile began."""
+    job = reports_cache.ComputerSummaryJob()
+    job.generation = 4
+    self.mox.StubOutWithMock(
+        reports_cache.models.ComputerSummaryShard, 'SetDailyCounts')
+    reports_cache.models.ComputerSummaryShard.SetDailyCounts(
+        {}, 4).AndReturn(False)
 
-    reports_raw = []
-    user_id = 0
-    uuid_id = 0
-    while len(reports_raw) < 501:
-      uuid = 'uuid%d' % uuid_id
-      user = 'user%d' % user_id
-      (dt_a1, dt_a2) = self._GenDatetimes(10)
-      reports_raw.extend([
-          {
-              'uuid': uuid, 'mtime': dt_a1,
-              'event': 'launched', 'user': user
-          },
-          {
-              'uuid': uuid, 'mtime': dt_a2,
-              'event': 'exit_later_clicked', 'user': user
-          },
-      ])
-      uuid_id += 1
-      user_id += 1
+    self.mox.ReplayAll()
+    job.Finish({})
+    self.mox.VerifyAll()
 
-    reports = []
-    cursor = None
-    summary = None
-    summary_output = self._GenBaseSummaryOutput(rc)
-    summary_empty = summary_output.copy()
-    reports = self._GenReportsAndSummary(summary_output, reports_raw)
+  def testStatsViewsJob(self):
+    """Test StatsViewsJob."""
+    today = datetime.date(2012, 3, 9)
+    job = reports_cache.StatsViewsJob(
+        'site', now=datetime.datetime(2012, 3, 9, 10))
+    self.assertEqual('stats_views_site', job.name)
+    computers = []
+    for site in ['NYC', 'NYC', 'MTV', None]:
+      computer = self.mox.CreateMockAnything()
+      computer.site = site
+      computers.append(computer)
+    self.mox.StubOutWithMock(
+        reports_cache.models.ComputerSummaryShard, 'GetComputerCounts')
+    self.mox.StubOutWithMock(
+        reports_cache.summary_module, 'GetComputerSummaryFromCounters')
+    self.mox.StubOutWithMock(
+        reports_cache.models.ReportsCache, 'SetStatsViews')
+
+    reports_cache.models.ComputerSummaryShard.GetComputerCounts(
+        computers[0], connections=True).AndReturn(
+            (today, {'active': 1, 'pending:foo': 1}))
+    reports_cache.models.ComputerSummaryShard.GetComputerCounts(
+        computers[1], connections=True).AndReturn(
+            (today - datetime.timedelta(days=3), {'active': 1}))
+    reports_cache.models.ComputerSummaryShard.GetComputerCounts(
+        computers[2], connections=True).AndReturn(
+            (today - datetime.timedelta(days=20), {'active': 1}))
+    reports_cache.models.ComputerSummaryShard.GetComputerCounts(
+        computers[3], connections=True).AndReturn(None)
+    reports_cache.summary_module.GetComputerSummaryFromCounters(
+        {today: {'active': 1},
+         today - datetime.timedelta(days=1): {'active': 1}},
+        today=today).AndReturn('nyc summary')
+    reports_cache.summary_module.GetComputerSummaryFromCounters(
+        {today - datetime.timedelta(days=14): {'active': 1}},
+        today=today).AndReturn('mtv summary')
+    reports_cache.models.ReportsCache.SetStatsViews(
+        'site', {'NYC': 'nyc summary', 'MTV': 'mtv summary'})
 
-    lquery = self.mox.CreateMockAnything()
-    mock_summary = self.mox.CreateMockAnything()
-    self.mox.StubOutWithMock(reports_cache.models, 'ComputerMSULog')
-    self.mox.StubOutWithMock(reports_cache.models, 'KeyValueCache')
-    self.mox.StubOutWithMock(reports_cache.models, 'ReportsCache')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
-
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    reports_cache.models.KeyValueCache.MemcacheWrappedGet(
-        'msu_user_summary_cursor', 'text_value').AndReturn(cursor)
-    reports_cache.models.ReportsCache.GetMsuUserSummary(
-        since=None, tmp=True).AndReturn((summary, None))
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_empty, since=None, tmp=True).AndReturn(None)
+    self.mox.ReplayAll()
+    partials = [job.NewPartial(), job.NewPartial()]
+    job.Map(partials[0], computers[0])
+    job.Map(partials[1], computers[1])
+    job.Map(partials[1], computers[2])
+    job.Map(partials[1], computers[3])
+    result = job.NewPartial()
+    for partial in partials:
+      result = job.Merge(result, partial)
+    job.Finish(result)
+    self.mox.VerifyAll()
 
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(reports)
-    i = 0
-    last_user = None
-    for report in reports:
-      if last_user != report.user:
-        lquery.cursor().AndReturn('cursor%d' % i)
-        i +=1
-      last_user = report.user
+  def _Counts(self, install_count, install_fail_count, duration_count=0,
+              duration_total_seconds=0, applesus=False, durations=(),
+              dl_kbytes_per_secs=()):
+    """Returns a dict of install counts of a package."""
+    duration_histogram = {}
+    for duration in durations:
+      reports_cache.histogram.Add(duration_histogram, duration)
+    dl_kbytes_per_sec_histogram = {}
+    for dl_kbytes_per_sec in dl_kbytes_per_secs:
+      reports_cache.histogram.Add(
+          dl_kbytes_per_sec_histogram, dl_kbytes_per_sec)
+    return {
+        'install_count': install_count,
+        'install_fail_count': install_fail_count,
+        'duration_count': duration_count,
+        'duration_total_seconds': duration_total_seconds,
+        'applesus': applesus,
+        'duration_histogram': duration_histogram,
+        'dl_kbytes_per_sec_histogram': dl_kbytes_per_sec_histogram,
+    }
 
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    lquery.with_cursor('cursor%d' % (i-1)).AndReturn(None)
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(None)
+  def _WithAverages(self, counts):
+    """Replaces the histograms of install counts with percentiles; returns it.
 
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_output, since=None).AndReturn(None)
-    reports_cache.models.KeyValueCache.DeleteMemcacheWrap(
-        'msu_user_summary_cursor', prop_name='text_value')
-    reports_cache.models.ReportsCache.DeleteMsuUserSummary(
-        since=None, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
+    Averages are added too, as in the cached install counts.
+    """
+    if counts['duration_count']:
+      counts['duration_seconds_avg'] = (
+          counts['duration_total_seconds'] / counts['duration_count'])
+    else:
+      counts['duration_seconds_avg'] = None
+    for name in ['duration', 'dl_kbytes_per_sec']:
+      percentiles = reports_cache.histogram.GetPercentiles(
+          counts.pop('%s_histogram' % name))
+      for percentile, value in percentiles.iteritems():
+        counts['%s_p%d' % (name, percentile)] = value
+    return counts
+
+  def _StubOutLock(self):
+    """Stubs out gae_util.Lock; returns the mock install counts lock."""
+    lock = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(
+        reports_cache.gae_util, 'Lock', use_mock_anything=True)
+    reports_cache.gae_util.Lock(
+        'pkgs_list_cron_lock',
+        ttl=reports_cache.gae_util.LOCK_TASK_SECS).AndReturn(lock)
+    return lock
+
+  def testGenerateInstallCounts(self):
+    """Tests _GenerateInstallCounts() folding completed hours."""
+    now = datetime.datetime(2012, 3, 9, 10, 30)
+    fold_until = datetime.datetime(2012, 3, 9, 9)
+    folded = {
+        'hour': '2012-03-09 07:00',
+        'pkgs': {'foo': self._Counts(2, 1, 1, 30, applesus=True)},
+    }
+    lock = self._StubOutLock()
+    self.mox.StubOutWithMock(reports_cache.models, 'ReportsCache')
+    self.mox.StubOutWithMock(
+        reports_cache.models.InstallRollup, 'GetInstallCounts')
+    self.mox.StubOutWithMock(
+        reports_cache.models.InstallRollupBatch, 'DeleteOld')
+
+    lock.Acquire().AndReturn(True)
+    reports_cache.models.ReportsCache.GetInstallCountsFolded().AndReturn(
+        (folded, None))
+    reports_cache.models.InstallRollup.GetInstallCounts(
+        since=datetime.datetime(2012, 3, 9, 7), until=fold_until).AndReturn(
+            {'bar': self._Counts(1, 0, 1, 10, durations=[10])})
+    reports_cache.models.ReportsCache.SetInstallCountsFolded({
+        'hour': '2012-03-09 09:00',
+        'pkgs': {
+            'foo': self._Counts(2, 1, 1, 30, applesus=True),
+            'bar': self._Counts(1, 0, 1, 10, durations=[10]),
+        },
+    })
+    reports_cache.models.InstallRollup.GetInstallCounts(
+        since=fold_until).AndReturn({
+            'bar': self._Counts(
+                2, 1, 1, 20, durations=[20], dl_kbytes_per_secs=[800]),
+            'zzz': self._Counts(1, 0),
+        })
+    expected = {
+        'foo': self._WithAverages(self._Counts(2, 1, 1, 30, applesus=True)),
+        'bar': self._WithAverages(self._Counts(
+            3, 1, 2, 30, durations=[10, 20], dl_kbytes_per_secs=[800])),
+        'zzz': self._WithAverages(self._Counts(1, 0)),
+    }
+    self.assertEqual(20, expected['bar']['duration_p90'])
+    self.assertEqual(None, expected['zzz']['duration_p50'])
+    self.assertFalse('duration_histogram' in expected['bar'])
+    reports_cache.models.ReportsCache.SetInstallCounts(expected)
+    reports_cache.models.InstallRollupBatch.DeleteOld(now)
+    lock.Release().AndReturn(True)
 
     self.mox.ReplayAll()
-    rc._GenerateMsuUserSummary()
+    reports_cache._GenerateInstallCounts(now=now)
     self.mox.VerifyAll()
 
-  def testGenerateMsuUserSummaryWhenLotsDataSlow(self):
-    """Test _GenerateMsuUserSummary()."""
-    rc = reports_cache.ReportsCache()
+  def testGenerateInstallCountsFirstRun(self):
+    """Tests _GenerateInstallCounts() keeping counts from before rollups."""
+    now = datetime.datetime(2012, 3, 9, 10, 30)
+    fold_until = datetime.datetime(2012, 3, 9, 9)
+    legacy = {'foo': self._Counts(2, 1)}
+    lock = self._StubOutLock()
+    self.mox.StubOutWithMock(reports_cache.models, 'ReportsCache')
+    self.mox.StubOutWithMock(
+        reports_cache.models.InstallRollup, 'GetInstallCounts')
+    self.mox.StubOutWithMock(
+        reports_cache.models.InstallRollupBatch, 'DeleteOld')
 
-    reports_raw = []
-    user_id = 0
-    uuid_id = 0
-    while len(reports_raw) < 501:
-      uuid = 'uuid%d' % uuid_id
-      user = 'user%d' % user_id
-      (dt_a1, dt_a2) = self._GenDatetimes(10)
-      reports_raw.extend([
-          {
-              'uuid': uuid, 'mtime': dt_a1,
-              'event': 'launched', 'user': user
-          },
-          {
-              'uuid': uuid, 'mtime': dt_a2,
-              'event': 'exit_later_clicked', 'user': user
-          },
-      ])
-      uuid_id += 1
-      user_id += 1
+    lock.Acquire().AndReturn(True)
+    reports_cache.models.ReportsCache.GetInstallCountsFolded().AndReturn(
+        ({}, None))
+    reports_cache.models.ReportsCache.GetInstallCounts().AndReturn(
+        (legacy, None))
+    reports_cache.models.InstallRollup.GetInstallCounts(
+        since=None, until=fold_until).AndReturn({})
+    reports_cache.models.ReportsCache.SetInstallCountsFolded(
+        {'hour': '2012-03-09 09:00', 'pkgs': {'foo': self._Counts(2, 1)}})
+    reports_cache.models.InstallRollup.GetInstallCounts(
+        since=fold_until).AndReturn({'foo': self._Counts(1, 0)})
+    expected = {'foo': self._WithAverages(self._Counts(3, 1))}
+    reports_cache.models.ReportsCache.SetInstallCounts(expected)
+    reports_cache.models.InstallRollupBatch.DeleteOld(now)
+    lock.Release().AndReturn(True)
 
-    reports = []
-    cursor = None
-    summary = None
-    summary_output = self._GenBaseSummaryOutput(rc)
-    summary_empty = summary_output.copy()
-    reports = self._GenReportsAndSummary(summary_output, reports_raw)
+    self.mox.ReplayAll()
+    reports_cache._GenerateInstallCounts(now=now)
+    self.mox.VerifyAll()
 
-    lquery = self.mox.CreateMockAnything()
-    mock_summary = self.mox.CreateMockAnything()
-    self.mox.StubOutWithMock(reports_cache.models, 'ComputerMSULog')
-    self.mox.StubOutWithMock(reports_cache.models, 'KeyValueCache')
+  def testGenerateInstallCountsWhileBackfilling(self):
+    """Tests _GenerateInstallCounts() not folding during a backfill."""
+    now = datetime.datetime(2012, 3, 9, 10, 30)
+    folded = {
+        'hour': None, 'pkgs': {}, 'backfill_until': '2012-03-09 10:00:00'}
+    lock = self._StubOutLock()
     self.mox.StubOutWithMock(reports_cache.models, 'ReportsCache')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
-
-    self.mox.StubOutWithMock(reports_cache.time, 'time')
-    self.mox.StubOutWithMock(reports_cache, 'taskqueue')
-
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    reports_cache.models.KeyValueCache.MemcacheWrappedGet(
-        'msu_user_summary_cursor', 'text_value').AndReturn(cursor)
-    reports_cache.models.ReportsCache.GetMsuUserSummary(
-        since=None, tmp=True).AndReturn((summary, None))
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_empty, since=None, tmp=True).AndReturn(None)
-
-    reports_cache.time.time().AndReturn(0)
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(reports)
-    i = 0
-    last_user = None
-    for report in reports:
-      if last_user != report.user:
-        lquery.cursor().AndReturn('cursor%d' % i)
-        i +=1
-      last_user = report.user
-
-    last_user_cursor = 'cursor%d' % (i-1)
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    lquery.with_cursor(last_user_cursor).AndReturn(None)
-
-    reports_cache.time.time().AndReturn(reports_cache.RUNTIME_MAX_SECS + 1)
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_output, since=None, tmp=True).AndReturn(None)
-    reports_cache.models.KeyValueCache.MemcacheWrappedSet(
-        'msu_user_summary_cursor',
-        'text_value', last_user_cursor).AndReturn(None)
-    reports_cache.taskqueue.add(
-        url='/cron/reports_cache/msu_user_summary',
-        method='GET',
-        countdown=5).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
-
-    # second run
-    reports_cache.gae_util.ObtainLock('msu_user_summary_lock').AndReturn(True)
-    reports_cache.models.ComputerMSULog.all().AndReturn(lquery)
-    reports_cache.models.KeyValueCache.MemcacheWrappedGet(
-        'msu_user_summary_cursor', 'text_value').AndReturn(last_user_cursor)
-    reports_cache.models.ReportsCache.GetMsuUserSummary(
-        since=None, tmp=True).AndReturn([summary_output, 'mtime'])
-    lquery.with_cursor(last_user_cursor)
-
-    reports_cache.time.time().AndReturn(0)
-    lquery.fetch(rc.FETCH_LIMIT).AndReturn(None)
-    reports_cache.models.ReportsCache.SetMsuUserSummary(
-        summary_output, since=None)
-    reports_cache.models.KeyValueCache.DeleteMemcacheWrap(
-        'msu_user_summary_cursor', prop_name='text_value')
-    reports_cache.models.ReportsCache.DeleteMsuUserSummary(
-        since=None, tmp=True).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock('msu_user_summary_lock').AndReturn(True)
+    self.mox.StubOutWithMock(
+        reports_cache.models.InstallRollup, 'GetInstallCounts')
+    self.mox.StubOutWithMock(
+        reports_cache.models.InstallRollupBatch, 'DeleteOld')
+
+    lock.Acquire().AndReturn(True)
+    reports_cache.models.ReportsCache.GetInstallCountsFolded().AndReturn(
+        (folded, None))
+    reports_cache.models.InstallRollup.GetInstallCounts(
+        since=None).AndReturn({'foo': self._Counts(3, 1)})
+    expected = {'foo': self._WithAverages(self._Counts(3, 1))}
+    reports_cache.models.ReportsCache.SetInstallCounts(expected)
+    reports_cache.models.InstallRollupBatch.DeleteOld(now)
+    lock.Release().AndReturn(True)
 
     self.mox.ReplayAll()
-    rc._GenerateMsuUserSummary()
-    rc._GenerateMsuUserSummary()
+    reports_cache._GenerateInstallCounts(now=now)
     self.mox.VerifyAll()
 
-  def testGenerateInstallCounts(self):
-    """Test _GenerateInstallCounts()."""
-    install_counts = {
-        'foo': {
-            'install_count': 2,
-            'applesus': True,
-            'duration_count': 1,
-            'duration_total_seconds': 30,
-            'duration_seconds_avg': 30},
-        'bar': {'install_count': 2, 'install_fail_count': 1, 'applesus': False},
-    }
+  def testGenerateInstallCountsWhenLocked(self):
+    """Tests _GenerateInstallCounts() while another run holds the lock."""
+    lock = self._StubOutLock()
+    lock.Acquire().AndReturn(False)
 
-    new_foo = self.mox.CreateMockAnything()
-    new_foo.package = 'foo'
-    new_foo.applesus = True
-    new_foo.duration_seconds = 20
-    new_bar = self.mox.CreateMockAnything()
-    new_bar.package = 'bar'
-    new_bar.applesus = False
-    new_bar.duration_seconds = 10
-    new_bar_success = self.mox.CreateMockAnything()
-    new_bar_success.package = 'bar'
-    new_bar_success.applesus = False
-    new_bar_success.duration_seconds = 10
-    new_bar_success2 = self.mox.CreateMockAnything()
-    new_bar_success2.package = 'bar'
-    new_bar_success2.applesus = False
-    new_bar_success2.duration_seconds = 20
-    new_zzz = self.mox.CreateMockAnything()
-    new_zzz.package = 'zzz'
-    new_zzz.applesus = False
-    new_zzz.duration_seconds = None
-
-    new_installs = [
-        new_foo, new_bar, new_bar_success, new_zzz, new_bar_success2]
-
-    new_install_counts = {
-        'foo': {
-            'install_count': 2,
-            'install_fail_count': 1,
-            'applesus': True,
-            'duration_count': 1,
-            'duration_total_seconds': 30,
-            'duration_seconds_avg': 30,
-         },
-        'bar': {
-            'install_count': 4,
-            'install_fail_count': 2,
-            'applesus': False,
-            'duration_count': 2,
-            'duration_total_seconds': 30,
-            'duration_seconds_avg': 30 / 2,
-         },
-        'zzz': {
-            'install_count': 1,
-            'install_fail_count': 0,
-            'applesus': False,
-            'duration_count': 0,
-            'duration_total_seconds': 0,
-            'duration_seconds_avg': None,
-        },
-    }
-    new_foo.IsSuccess().AndReturn(False)
-    new_bar.IsSuccess().AndReturn(False)
-    new_bar_success.IsSuccess().AndReturn(True)
-    new_zzz.IsSuccess().AndReturn(True)
-    new_bar_success2.IsSuccess().AndReturn(True)
-
-    self.mox.StubOutWithMock(reports_cache.models, 'KeyValueCache')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'ReleaseLock')
-    self.mox.StubOutWithMock(
-        reports_cache.models.KeyValueCache, 'get_by_key_name')
+    self.mox.ReplayAll()
+    reports_cache._GenerateInstallCounts()
+    self.mox.VerifyAll()
+
+  def _StubOutBackfill(self, until, cursor, installs):
+    """Stubs out one _BackfillInstallRollups() hop."""
+    self.mox.StubOutWithMock(reports_cache.models, 'ReportsCache')
     self.mox.StubOutWithMock(reports_cache.models.InstallLog, 'all')
     self.mox.StubOutWithMock(
-        reports_cache.models.ReportsCache, 'GetInstallCounts')
-    self.mox.StubOutWithMock(
-        reports_cache.models.ReportsCache, 'SetInstallCounts')
+        reports_cache.models.InstallRollup, 'AddInstalls')
 
-    lock_name = 'pkgs_list_cron_lock'
-    reports_cache.gae_util.ObtainLock(lock_name).AndReturn(True)
-
-    reports_cache.models.ReportsCache.GetInstallCounts().AndReturn(
-        (install_counts, None))
+    reports_cache.models.ReportsCache.GetInstallCountsFolded().AndReturn(
+        ({'hour': None, 'pkgs': {}, 'backfill_until': str(until)}, None))
     mock_query = self.mox.CreateMockAnything()
     reports_cache.models.InstallLog.all().AndReturn(mock_query)
+    mock_query.filter('server_datetime <', until).AndReturn(mock_query)
     mock_query.order('server_datetime').AndReturn(mock_query)
-    mock_cursor_obj = self.mox.CreateMockAnything()
-    mock_cursor_obj.text_value = 'foocursor'
-    reports_cache.models.KeyValueCache.get_by_key_name(
-        'pkgs_list_cursor').AndReturn(mock_cursor_obj)
-    mock_query.with_cursor(mock_cursor_obj.text_value)
-    mock_query.fetch(1000).AndReturn(new_installs)
-
-    reports_cache.models.ReportsCache.SetInstallCounts(new_install_counts)
-    mock_query.cursor().AndReturn(None)
-    mock_cursor_obj.put().AndReturn(None)
-
+    if cursor:
+      mock_query.with_cursor(cursor)
+    mock_query.fetch(reports_cache.BACKFILL_FETCH_LIMIT).AndReturn(installs)
+    reports_cache.models.InstallRollup.AddInstalls(
+        installs,
+        batch=reports_cache.hashlib.sha1('%s_%s' % (until, cursor)).hexdigest())
+    return mock_query
+
+  def testBackfillInstallRollups(self):
+    """Tests _BackfillInstallRollups()."""
+    until = datetime.datetime(2012, 3, 9, 10, 30)
+    installs = ['install'] * reports_cache.BACKFILL_FETCH_LIMIT
     self.mox.StubOutWithMock(reports_cache.deferred, 'defer')
+    mock_query = self._StubOutBackfill(until, 'cursor1', installs)
+    mock_query.cursor().AndReturn('cursor2')
     reports_cache.deferred.defer(
-        reports_cache._GenerateInstallCounts).AndReturn(None)
-    reports_cache.gae_util.ReleaseLock(lock_name).AndReturn(True)
+        reports_cache._BackfillInstallRollups, until, 'cursor2')
 
     self.mox.ReplayAll()
-    reports_cache._GenerateInstallCounts()
+    reports_cache._BackfillInstallRollups(until, cursor='cursor1')
+    self.mox.VerifyAll()
+
+  def testBackfillInstallRollupsLastHop(self):
+    """Tests _BackfillInstallRollups() clearing backfill_until when done."""
+    until = datetime.datetime(2012, 3, 9, 10, 30)
+    self._StubOutBackfill(until, 'cursor1', ['install'])
+    lock = self._StubOutLock()
+    lock.Acquire(timeout=reports_cache.BACKFILL_LOCK_SECS).AndReturn(True)
+    reports_cache.models.ReportsCache.GetInstallCountsFolded().AndReturn(
+        ({'hour': None, 'pkgs': {}, 'backfill_until': str(until)}, None))
+    reports_cache.models.ReportsCache.SetInstallCountsFolded(
+        {'hour': None, 'pkgs': {}})
+    lock.Release().AndReturn(True)
+
+    self.mox.ReplayAll()
+    reports_cache._BackfillInstallRollups(until, cursor='cursor1')
+    self.mox.VerifyAll()
+
+  def testBackfillInstallRollupsWhenStale(self):
+    """Tests _BackfillInstallRollups() of a backfill replaced by a rebuild."""
+    until = datetime.datetime(2012, 3, 9, 10, 30)
+    self.mox.StubOutWithMock(reports_cache.models, 'ReportsCache')
+    self.mox.StubOutWithMock(reports_cache.models.InstallLog, 'all')
+    reports_cache.models.ReportsCache.GetInstallCountsFolded().AndReturn(
+        ({'hour': None, 'pkgs': {}, 'backfill_until': 'other'}, None))
+
+    self.mox.ReplayAll()
+    reports_cache._BackfillInstallRollups(until)
     self.mox.VerifyAll()
 
   def testGenerateTrendingInstallsCache(self):
     """Tests _GenerateTrendingInstallsCache."""
-    self.mox.StubOutWithMock(reports_cache.models.InstallLog, 'all')
-    self.mox.StubOutWithMock(reports_cache.gae_util, 'QueryIterator')
+    now = datetime.datetime(2012, 3, 9, 10, 30)
+    self.mox.StubOutWithMock(
+        reports_cache.models.InstallRollup, 'GetInstallCounts')
     self.mox.StubOutWithMock(
         reports_cache.models.ReportsCache, 'SetTrendingInstalls')
 
-    install_one = self.mox.CreateMockAnything()
-    install_one.package = 'package_one'
-    install_two = self.mox.CreateMockAnything()
-    install_two.package = 'package_two'
-    install_three = self.mox.CreateMockAnything()
-    install_three.package = 'package_three'
-    install_four = self.mox.CreateMockAnything()
-    install_four.package = 'package_four'
-    installs = [
-        install_one, install_one, install_two, install_three, install_four]
-
-    mock_query = self.mox.CreateMockAnything()
-    reports_cache.models.InstallLog.all().AndReturn(mock_query)
-    mock_query.filter(
-        'mtime >', mox.IsA(reports_cache.datetime.datetime)).AndReturn(
-            mock_query)
-    reports_cache.gae_util.QueryIterator(mock_query).AndReturn(installs)
-
-    install_one.IsSuccess().AndReturn(True)
-    install_one.IsSuccess().AndReturn(True)
-    install_two.IsSuccess().AndReturn(False)
-    install_three.IsSuccess().AndReturn(False)
-    install_four.IsSuccess().AndReturn(True)
+    reports_cache.models.InstallRollup.GetInstallCounts(
+        since=datetime.datetime(2012, 3, 9, 9)).AndReturn({
+            'package_one': self._Counts(2, 0),
+            'package_two': self._Counts(0, 1),
+            'package_three': self._Counts(0, 1),
+            'package_four': self._Counts(1, 0),
+        })
 
     expected_trending = {
         'success': {
             'packages': [
-                 (install_one.package, 2, 66.666666666666657),
-                 (install_four.package, 1, 33.333333333333329),
+                 ('package_one', 2, 66.666666666666657),
+                 ('package_four', 1, 33.333333333333329),
              ],
              'total': 3,
         },
         'failure': {
             'packages': [
-                 (install_two.package, 1, 50.0),
-                 (install_three.package, 1, 50.0),
+                 ('package_two', 1, 50.0),
+                 ('package_three', 1, 50.0),
              ],
              'total': 2,
          },
@@ -806,7 +785,7 @@ class ReportsCacheCleanupTest(mox.MoxTestBase):
         1, mox.SameElementsAs(expected_trending))
 
     self.mox.ReplayAll()
-    reports_cache._GenerateTrendingInstallsCache(1)
+    reports_cache._GenerateTrendingInstallsCache(1, now=now)
     self.mox.VerifyAll()
 
 
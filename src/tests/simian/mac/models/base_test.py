@@ -21,6 +21,8 @@
 
 
 
+import datetime
+
 import tests.appenginesdk
 from google.apputils import app
 from google.apputils import basetest
@@ -40,6 +42,17 @@ class ModelsModuleTest(mox.MoxTestBase):
     self.mox.UnsetStubs()
     self.stubs.UnsetAll()
 
+  def _StubOutWrapCacheValue(self):
+    """Stubs out gae_util.WrapCacheValue with a predictable wrapping."""
+    self.stubs.Set(
+        models.gae_util, 'WrapCacheValue',
+        lambda value, secs, delta=0: (('wrapped', value), secs + 60))
+
+  def _StubOutLeasedCache(self):
+    """Stubs out the gae_util leased memcache functions."""
+    for name in ['LeasedCacheGet', 'LeasedCacheSet', 'ReleaseLease']:
+      self.mox.StubOutWithMock(models.gae_util, name)
+
   def testBaseModelMemcacheAddAutoUpdateTask(self):
     """Test BaseModel.MemcacheAddAutoUpdateTask()."""
 
@@ -176,16 +189,19 @@ class ModelsModuleTest(mox.MoxTestBase):
     memcache_key_name = 'mwg_%s_%s' % (models.BaseModel.kind(), key_name)
 
     self.mox.StubOutWithMock(models, 'memcache', True)
+    self._StubOutLeasedCache()
     self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
     self.mox.StubOutWithMock(models.db, 'model_to_protobuf', True)
     mock_entity = self.mox.CreateMockAnything()
 
     models.db.model_to_protobuf(mock_entity).AndReturn(mock_entity)  # cheat
     mock_entity.SerializeToString().AndReturn('serialized')
-    models.memcache.get(memcache_key_name).AndReturn(None)
+    models.gae_util.LeasedCacheGet(memcache_key_name).AndReturn(
+        (None, True))
     models.BaseModel.get_by_key_name(key_name).AndReturn(mock_entity)
-    models.memcache.set(
-        memcache_key_name, 'serialized', models.MEMCACHE_SECS).AndReturn(None)
+    models.gae_util.LeasedCacheSet(
+        memcache_key_name, 'serialized', models.MEMCACHE_SECS,
+        delta=mox.IsA(float)).AndReturn(None)
 
     self.mox.ReplayAll()
     self.assertEqual(
@@ -198,17 +214,19 @@ class ModelsModuleTest(mox.MoxTestBase):
     memcache_key_name = 'mwg_%s_%s' % (models.BaseModel.kind(), key_name)
 
     self.mox.StubOutWithMock(models, 'memcache', True)
+    self._StubOutLeasedCache()
     self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
     self.mox.StubOutWithMock(models.db, 'model_to_protobuf', True)
     mock_entity = self.mox.CreateMockAnything()
 
     models.db.model_to_protobuf(mock_entity).AndReturn(mock_entity)  # cheat
     mock_entity.SerializeToString().AndReturn('serialized')
-    models.memcache.get(memcache_key_name).AndReturn(None)
+    models.gae_util.LeasedCacheGet(memcache_key_name).AndReturn(
+        (None, True))
     models.BaseModel.get_by_key_name(key_name).AndReturn(mock_entity)
-    models.memcache.set(
-        memcache_key_name, 'serialized',
-        models.MEMCACHE_SECS).AndRaise(ValueError)
+    models.gae_util.LeasedCacheSet(
+        memcache_key_name, 'serialized', models.MEMCACHE_SECS,
+        delta=mox.IsA(float)).AndRaise(ValueError)
 
     self.mox.ReplayAll()
     self.assertEqual(
@@ -221,11 +239,13 @@ class ModelsModuleTest(mox.MoxTestBase):
     memcache_key_name = 'mwg_%s_%s' % (models.BaseModel.kind(), key_name)
 
     self.mox.StubOutWithMock(models, 'memcache', True)
+    self._StubOutLeasedCache()
     self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
     self.mox.StubOutWithMock(models.db, 'model_from_protobuf', True)
     mock_entity = self.mox.CreateMockAnything()
 
-    models.memcache.get(memcache_key_name).AndReturn('serialized')
+    models.gae_util.LeasedCacheGet(memcache_key_name).AndReturn(
+        ('serialized', False))
     models.db.model_from_protobuf('serialized').AndReturn(mock_entity)
 
     self.mox.ReplayAll()
@@ -233,19 +253,49 @@ class ModelsModuleTest(mox.MoxTestBase):
         mock_entity, models.BaseModel.MemcacheWrappedGet(key_name))
     self.mox.VerifyAll()
 
+  def testBaseModelMemcacheWrappedGetWhenCachedAndLeased(self):
+    """Test BaseModel.MemcacheWrappedGet() refills a leased stale copy."""
+    key_name = 'foo_key_name'
+    memcache_key = 'mwg_%s_%s' % (models.BaseModel.kind(), key_name)
+
+    self.mox.StubOutWithMock(models, 'memcache', True)
+    self._StubOutLeasedCache()
+    self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
+    self.mox.StubOutWithMock(models.db, 'model_from_protobuf', True)
+    self.mox.StubOutWithMock(models.db, 'model_to_protobuf', True)
+    stale_entity = self.mox.CreateMockAnything()
+    mock_entity = self.mox.CreateMockAnything()
+
+    models.gae_util.LeasedCacheGet(memcache_key).AndReturn(
+        ('serialized', True))
+    models.db.model_from_protobuf('serialized').AndReturn(stale_entity)
+    models.BaseModel.get_by_key_name(key_name).AndReturn(mock_entity)
+    models.db.model_to_protobuf(mock_entity).AndReturn(mock_entity)  # cheat
+    mock_entity.SerializeToString().AndReturn('serialized2')
+    models.gae_util.LeasedCacheSet(
+        memcache_key, 'serialized2', models.MEMCACHE_SECS,
+        delta=mox.IsA(float))
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        mock_entity, models.BaseModel.MemcacheWrappedGet(key_name))
+    self.mox.VerifyAll()
+
   def testBaseModelMemcacheWrappedGetWhenCachedBadSerialization(self):
     """Test BaseModel.MemcacheWrappedGet() when cached."""
     key_name = 'foo_key_name'
     memcache_key = 'mwg_%s_%s' % (models.BaseModel.kind(), key_name)
 
     self.mox.StubOutWithMock(models, 'memcache', True)
+    self._StubOutLeasedCache()
     self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
     self.mox.StubOutWithMock(models.db, 'model_from_protobuf', True)
 
     class ProtocolBufferDecodeError(Exception):
       pass
 
-    models.memcache.get(memcache_key).AndReturn('serialized')
+    models.gae_util.LeasedCacheGet(memcache_key).AndReturn(
+        ('serialized', False))
     models.db.model_from_protobuf('serialized').AndRaise(
         ProtocolBufferDecodeError)
     models.memcache.delete(memcache_key).AndReturn(None)
@@ -262,10 +312,12 @@ class ModelsModuleTest(mox.MoxTestBase):
     memcache_key = 'mwg_%s_%s' % (models.BaseModel.kind(), key_name)
 
     self.mox.StubOutWithMock(models, 'memcache', True)
+    self._StubOutLeasedCache()
     self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
     self.mox.StubOutWithMock(models.db, 'model_from_protobuf', True)
 
-    models.memcache.get(memcache_key).AndReturn('serialized')
+    models.gae_util.LeasedCacheGet(memcache_key).AndReturn(
+        ('serialized', False))
     models.db.model_from_protobuf('serialized').AndRaise(Exception)
     models.memcache.delete(memcache_key).AndReturn(None)
     models.BaseModel.get_by_key_name(key_name).AndReturn(None)
@@ -283,10 +335,12 @@ class ModelsModuleTest(mox.MoxTestBase):
         models.BaseModel.kind(), key_name, prop_name)
 
     self.mox.StubOutWithMock(models, 'memcache', True)
+    self._StubOutLeasedCache()
     self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
     self.mox.StubOutWithMock(models.db, 'model_from_protobuf', True)
 
-    models.memcache.get(memcache_key).AndReturn('value')
+    models.gae_util.LeasedCacheGet(memcache_key).AndReturn(
+        ('value', False))
 
     self.mox.ReplayAll()
     self.assertEqual(
@@ -299,16 +353,39 @@ class ModelsModuleTest(mox.MoxTestBase):
     memcache_key = 'mwg_%s_%s' % (models.BaseModel.kind(), key_name)
 
     self.mox.StubOutWithMock(models, 'memcache', self.mox.CreateMockAnything())
+    self._StubOutLeasedCache()
     self.mox.StubOutWithMock(
         models.BaseModel, 'get_by_key_name', self.mox.CreateMockAnything())
 
-    models.memcache.get(memcache_key).AndReturn(None)
+    models.gae_util.LeasedCacheGet(memcache_key).AndReturn((None, True))
     models.BaseModel.get_by_key_name(key_name).AndReturn(None)
+    models.gae_util.ReleaseLease(memcache_key)
     self.mox.ReplayAll()
     self.assertEqual(
         None, models.BaseModel.MemcacheWrappedGet(key_name))
     self.mox.VerifyAll()
 
+  def testBaseModelMemcacheWrappedGetWithoutLease(self):
+    """Test BaseModel.MemcacheWrappedGet() of a miss another caller refills."""
+    key_name = 'foo_key_name'
+    memcache_key = 'mwg_%s_%s' % (models.BaseModel.kind(), key_name)
+    mock_entity = self.mox.CreateMockAnything()
+
+    self.mox.StubOutWithMock(models, 'memcache', self.mox.CreateMockAnything())
+    self._StubOutLeasedCache()
+    self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
+    self.mox.StubOutWithMock(models.db, 'model_to_protobuf', True)
+
+    models.gae_util.LeasedCacheGet(memcache_key).AndReturn((None, False))
+    models.BaseModel.get_by_key_name(key_name).AndReturn(mock_entity)
+    mock_pb = self.mox.CreateMockAnything()
+    models.db.model_to_protobuf(mock_entity).AndReturn(mock_pb)
+    mock_pb.SerializeToString().AndReturn('serialized')
+    self.mox.ReplayAll()
+    self.assertEqual(
+        mock_entity, models.BaseModel.MemcacheWrappedGet(key_name))
+    self.mox.VerifyAll()
+
   def testBaseModelMemcacheWrappedGetWithPropName(self):
     """Test BaseModel.MemcacheWrappedGet() for particular property."""
     value = 'good value'
@@ -318,16 +395,18 @@ class ModelsModuleTest(mox.MoxTestBase):
         models.BaseModel.kind(), key_name, prop_name)
 
     self.mox.StubOutWithMock(models, 'memcache', True)
+    self._StubOutLeasedCache()
     self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
     self.mox.StubOutWithMock(models.db, 'model_to_protobuf', True)
     mock_entity = self.mox.CreateMockAnything()
 
     setattr(mock_entity, prop_name, value)
 
-    models.memcache.get(memcache_key).AndReturn(None)
+    models.gae_util.LeasedCacheGet(memcache_key).AndReturn((None, True))
     models.BaseModel.get_by_key_name(key_name).AndReturn(mock_entity)
-    models.memcache.set(
-        memcache_key, value, models.MEMCACHE_SECS).AndReturn(None)
+    models.gae_util.LeasedCacheSet(
+        memcache_key, value, models.MEMCACHE_SECS,
+        delta=mox.IsA(float)).AndReturn(None)
     self.mox.ReplayAll()
     self.assertEqual(
         value, models.BaseModel.MemcacheWrappedGet(key_name, prop_name))
@@ -341,18 +420,117 @@ class ModelsModuleTest(mox.MoxTestBase):
         models.BaseModel.kind(), key_name, prop_name)
 
     self.mox.StubOutWithMock(models, 'memcache', True)
+    self._StubOutLeasedCache()
     self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
     mock_entity = object()
 
     self.assertFalse(hasattr(mock_entity, prop_name))
-    models.memcache.get(memcache_key).AndReturn(None)
+    models.gae_util.LeasedCacheGet(memcache_key).AndReturn((None, True))
     models.BaseModel.get_by_key_name(key_name).AndReturn(mock_entity)
+    models.gae_util.ReleaseLease(memcache_key)
 
     self.mox.ReplayAll()
     self.assertEqual(
         None, models.BaseModel.MemcacheWrappedGet(key_name, prop_name))
     self.mox.VerifyAll()
 
+  def testBaseModelMemcacheWrappedGetInstanceCache(self):
+    """Test BaseModel.MemcacheWrappedGet() with the instance tier enabled."""
+    key_name = 'foo_key_name'
+    memcache_key = 'mwg_%s_%s' % (models.BaseModel.kind(), key_name)
+    self.stubs.Set(models.BaseModel, 'INSTANCE_CACHE_SECS', 30)
+    self.mox.StubOutWithMock(models, 'INSTANCE_CACHE')
+    self.mox.StubOutWithMock(models, 'memcache', True)
+    self._StubOutLeasedCache()
+    self.mox.StubOutWithMock(models.db, 'model_from_protobuf', True)
+    mock_entity = self.mox.CreateMockAnything()
+
+    # miss in the tier, hit in memcache.
+    models.INSTANCE_CACHE.Get('BaseModel', memcache_key).AndReturn(None)
+    models.gae_util.LeasedCacheGet(memcache_key).AndReturn(
+        ('serialized', False))
+    models.db.model_from_protobuf('serialized').AndReturn(mock_entity)
+    models.INSTANCE_CACHE.Set(
+        'BaseModel', memcache_key, mock_entity, len('serialized'), 30,
+        models.BaseModel.INSTANCE_CACHE_BYTES)
+    # hit in the tier.
+    models.INSTANCE_CACHE.Get('BaseModel', memcache_key).AndReturn(
+        mock_entity)
+    # DeleteMemcacheWrap invalidates the tier.
+    models.memcache.delete(memcache_key)
+    models.INSTANCE_CACHE.Invalidate('BaseModel')
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        mock_entity, models.BaseModel.MemcacheWrappedGet(key_name))
+    self.assertEqual(
+        mock_entity, models.BaseModel.MemcacheWrappedGet(key_name))
+    models.BaseModel.DeleteMemcacheWrap(key_name)
+    self.mox.VerifyAll()
+
+  def testBaseModelMemcacheWrappedGetMulti(self):
+    """Test BaseModel.MemcacheWrappedGetMulti()."""
+    key_names = ['cached', 'corrupt', 'missing', 'none']
+    memcache_keys = ['mwg_BaseModel_%s' % k for k in key_names]
+    self.mox.StubOutWithMock(models, 'memcache', True)
+    self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
+    self.mox.StubOutWithMock(models.db, 'model_from_protobuf', True)
+    self.mox.StubOutWithMock(models.db, 'model_to_protobuf', True)
+    cached_entity = self.mox.CreateMockAnything()
+    missing_entity = self.mox.CreateMockAnything()
+
+    class ProtocolBufferDecodeError(Exception):
+      pass
+
+    self._StubOutWrapCacheValue()
+    wrapped = (models.gae_util.CACHE_VALUE_TAG, 'serialized', 0, 0)
+    models.memcache.get_multi(memcache_keys).AndReturn({
+        memcache_keys[0]: wrapped, memcache_keys[1]: 'corrupt'})
+    models.db.model_from_protobuf('serialized').InAnyOrder().AndReturn(
+        cached_entity)
+    models.db.model_from_protobuf('corrupt').InAnyOrder().AndRaise(
+        ProtocolBufferDecodeError)
+    models.memcache.delete_multi([memcache_keys[1]])
+    models.BaseModel.get_by_key_name(
+        ['corrupt', 'missing', 'none']).AndReturn(
+            [missing_entity, missing_entity, None])
+    models.db.model_to_protobuf(missing_entity).AndReturn(missing_entity)
+    missing_entity.SerializeToString().AndReturn('serialized2')
+    models.db.model_to_protobuf(missing_entity).AndReturn(missing_entity)
+    missing_entity.SerializeToString().AndReturn('serialized3')
+    models.memcache.set_multi(
+        {memcache_keys[1]: ('wrapped', 'serialized2'),
+         memcache_keys[2]: ('wrapped', 'serialized3')},
+        time=models.MEMCACHE_SECS + 60)
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        [cached_entity, missing_entity, missing_entity, None],
+        models.BaseModel.MemcacheWrappedGetMulti(key_names))
+    self.mox.VerifyAll()
+
+  def testBaseModelMemcacheWrappedGetMultiWithPropName(self):
+    """Test BaseModel.MemcacheWrappedGetMulti() for a particular property."""
+    self.mox.StubOutWithMock(models, 'memcache', True)
+    self.mox.StubOutWithMock(models.BaseModel, 'get_by_key_name', True)
+    self._StubOutWrapCacheValue()
+    entity = self.mox.CreateMockAnything()
+    entity.prop = 'value2'
+
+    models.memcache.get_multi(
+        ['mwgpn_BaseModel_k1_prop', 'mwgpn_BaseModel_k2_prop']).AndReturn(
+            {'mwgpn_BaseModel_k1_prop': 'value1'})
+    models.BaseModel.get_by_key_name(['k2']).AndReturn([entity])
+    models.memcache.set_multi(
+        {'mwgpn_BaseModel_k2_prop': ('wrapped', 'value2')},
+        time=models.MEMCACHE_SECS + 60).AndRaise(ValueError)
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        ['value1', 'value2'],
+        models.BaseModel.MemcacheWrappedGetMulti(['k1', 'k2'], 'prop'))
+    self.mox.VerifyAll()
+
   def testMemcacheWrappedSet(self):
     """Test BaseModel.MemcacheWrappedSet()."""
     self.mox.StubOutWithMock(models, 'memcache', True)
@@ -361,6 +539,7 @@ class ModelsModuleTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(models.db, 'model_to_protobuf', True)
     mock_entity = self.mox.CreateMockAnything()
 
+    self._StubOutWrapCacheValue()
     memcache_entity_key = 'mwg_kind_key'
     memcache_key = 'mwgpn_kind_key_prop'
     models.BaseModel.kind().AndReturn('kind')
@@ -370,10 +549,11 @@ class ModelsModuleTest(mox.MoxTestBase):
     models.db.model_to_protobuf(mock_entity).AndReturn(mock_entity)  # cheat
     mock_entity.SerializeToString().AndReturn('serialized')
     models.memcache.set(
-        memcache_key, 'value', models.MEMCACHE_SECS).AndReturn(None)
+        memcache_key, ('wrapped', 'value'),
+        models.MEMCACHE_SECS + 60).AndReturn(None)
     models.memcache.set(
-        memcache_entity_key, 'serialized',
-        models.MEMCACHE_SECS).AndReturn(None)
+        memcache_entity_key, ('wrapped', 'serialized'),
+        models.MEMCACHE_SECS + 60).AndReturn(None)
 
     self.mox.ReplayAll()
     models.BaseModel.MemcacheWrappedSet('key', 'prop', 'value')
@@ -422,18 +602,23 @@ class ModelsModuleTest(mox.MoxTestBase):
     entities = ['the', 'entities']
 
     self.mox.StubOutWithMock(models, 'memcache', self.mox.CreateMockAnything())
+    self._StubOutLeasedCache()
     self.mox.StubOutWithMock(models.BaseModel, 'all')
     mock_query = self.mox.CreateMockAnything()
 
-    models.memcache.get(memcache_key).AndReturn(None)
+    models.gae_util.LeasedCacheGet(memcache_key).AndReturn((None, True))
     models.BaseModel.all().AndReturn(mock_query)
     for filt, value in filters:
       mock_query.filter(filt, value).AndReturn(mock_query)
     mock_query.fetch(1000).AndReturn(entities)
-    models.memcache.set(
-        memcache_key, entities, models.MEMCACHE_SECS).AndReturn(None)
+    models.gae_util.LeasedCacheSet(
+        memcache_key, entities, models.MEMCACHE_SECS, delta=mox.IsA(float))
+    # a stale copy due for a refill which another caller is refilling.
+    models.gae_util.LeasedCacheGet(memcache_key).AndReturn((entities, False))
 
     self.mox.ReplayAll()
+    self.assertEqual(
+        entities, models.BaseModel.MemcacheWrappedGetAllFilter(filters))
     self.assertEqual(
         entities, models.BaseModel.MemcacheWrappedGetAllFilter(filters))
     self.mox.VerifyAll()
@@ -525,6 +710,645 @@ class BaseManifestModificationTest(mox.MoxTestBase):
     self.mox.VerifyAll()
 
 
+class ComputerTest(mox.MoxTestBase):
+  """Test Computer class."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.cls = models.Computer
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testMarkInactive(self):
+    """Tests MarkInactive() continues in a task when out of time."""
+    earliest = datetime.datetime(2012, 3, 1)
+    query = self.mox.CreateMockAnything()
+    computers = self.mox.CreateMockAnything()
+    computer = self.mox.CreateMockAnything()
+    computers.cursor = 'cursor2'
+    self.mox.StubOutWithMock(self.cls, 'AllActive')
+    self.mox.StubOutWithMock(models.gae_util, 'QueryIterator')
+    self.mox.StubOutWithMock(models.deferred, 'defer')
+    self.mox.StubOutWithMock(models.ComputerSummaryShard, 'PutInactive')
+
+    self.cls.AllActive().AndReturn(query)
+    query.filter('preflight_datetime <', earliest).AndReturn(query)
+    models.gae_util.QueryIterator(
+        query, step=500, time_budget=models.MARK_INACTIVE_SECS,
+        cursor='cursor1').AndReturn(computers)
+    computers.__iter__().AndReturn(iter([computer]))
+    models.ComputerSummaryShard.PutInactive([computer])
+    models.deferred.defer(
+        self.cls.MarkInactive, earliest_active_date=earliest,
+        cursor='cursor2')
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        1, self.cls.MarkInactive(
+            earliest_active_date=earliest, cursor='cursor1'))
+    self.mox.VerifyAll()
+
+
+class ComputerLostStolenTest(mox.MoxTestBase):
+  """Test ComputerLostStolen class."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.cls = models.ComputerLostStolen
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testIsLostStolen(self):
+    """Tests IsLostStolen() uses the instance snapshot."""
+    self.mox.StubOutWithMock(models.LOST_STOLEN_SNAPSHOT, 'Get')
+    models.LOST_STOLEN_SNAPSHOT.Get().MultipleTimes().AndReturn(
+        frozenset(['uuid1']))
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.cls.IsLostStolen('uuid1'))
+    self.assertFalse(self.cls.IsLostStolen('uuid2'))
+    self.mox.VerifyAll()
+
+  def testRemoveUuid(self):
+    """Tests RemoveUuid() invalidates the instance snapshot."""
+    self.mox.StubOutWithMock(self.cls, 'get_by_key_name')
+    self.mox.StubOutWithMock(self.cls, '_GetUuids')
+    self.mox.StubOutWithMock(models.LOST_STOLEN_SNAPSHOT, 'Invalidate')
+    entity = self.mox.CreateMockAnything()
+
+    self.cls.get_by_key_name('uuid1').AndReturn(entity)
+    entity.delete()
+    self.cls._GetUuids(force_refresh=True)
+    models.LOST_STOLEN_SNAPSHOT.Invalidate()
+
+    self.mox.ReplayAll()
+    self.cls.RemoveUuid('uuid1')
+    self.mox.VerifyAll()
+
+
+class ComputerSummaryShardTest(mox.MoxTestBase):
+  """Test ComputerSummaryShard class."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.cls = models.ComputerSummaryShard
+    self.snapshot = self.mox.CreateMockAnything()
+    self.stubs.Set(models, 'GENERATIONS_SNAPSHOT', self.snapshot)
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _GetComputer(self, **kwargs):
+    """Returns a mock Computer with default summary properties."""
+    c = self.mox.CreateMockAnything()
+    c.preflight_datetime = datetime.datetime(2012, 3, 9, 10, 0, 0)
+    c.track = 'stable'
+    c.os_version = '10.7.3'
+    c.client_version = '2.0'
+    c.site = 'NYC'
+    c.connections_on_corp = 3
+    c.connections_off_corp = 1
+    c.all_pkgs_installed = True
+    c.all_apple_updates_installed = False
+    c.pkgs_to_install = []
+    c.active = True
+    for k, v in kwargs.iteritems():
+      setattr(c, k, v)
+    return c
+
+  def testGetComputerCounts(self):
+    """Tests GetComputerCounts()."""
+    expected = (datetime.date(2012, 3, 9), {
+        'active': 1,
+        'track:stable': 1,
+        'os_version:10.7.3': 1,
+        'client_version:2.0': 1,
+        'site:NYC': 1,
+        'off_corp_bucket: 20-29': 1,
+        'all_pkgs_installed': 1,
+    })
+    self.assertEqual(expected, self.cls.GetComputerCounts(self._GetComputer()))
+    expected[1].update({'conns_on_corp': 3, 'conns_off_corp': 1})
+    self.assertEqual(expected, self.cls.GetComputerCounts(
+        self._GetComputer(), connections=True))
+
+  def testGetComputerCountsBuckets(self):
+    """Tests GetComputerCounts() off corp buckets."""
+    c = self._GetComputer(connections_on_corp=0, connections_off_corp=4)
+    self.assertEqual(
+        1, self.cls.GetComputerCounts(c)[1]['off_corp_bucket:100'])
+    c = self._GetComputer(connections_on_corp=None, connections_off_corp=0)
+    self.assertEqual(
+        1, self.cls.GetComputerCounts(c)[1]['off_corp_bucket: -never-'])
+    c = self._GetComputer(preflight_datetime=None)
+    self.assertEqual(None, self.cls.GetComputerCounts(c))
+    c = self._GetComputer(active=False)
+    self.assertEqual(None, self.cls.GetComputerCounts(c))
+
+  def testGetComputerCountsPending(self):
+    """Tests GetComputerCounts() pending install counters."""
+    c = self._GetComputer(
+        pkgs_to_install=['foo-1.0', 'foo-1.0', 'AppleSUS: 041-1234'])
+    counts = self.cls.GetComputerCounts(c)[1]
+    self.assertEqual(1, counts['pending:foo-1.0'])
+    self.assertEqual(1, counts['pending:AppleSUS: 041-1234'])
+
+  def testPrepareUpdate(self):
+    """Tests PrepareUpdate() saves counts once per pending generation."""
+    generations = {'current': 3, 'pending': 4}
+    self.snapshot.Get().MultipleTimes().AndReturn(generations)
+    c = self._GetComputer(summary_base=None)
+    old = (datetime.date(2012, 3, 9), {'active': 1})
+
+    self.mox.ReplayAll()
+    self.assertEqual(generations, self.cls.PrepareUpdate(c, old))
+    base = {'generation': 4, 'counts': ['2012-03-09', {'active': 1}]}
+    self.assertEqual(base, models.util.Deserialize(c.summary_base))
+    # later changes in the same generation keep the first counts.
+    self.cls.PrepareUpdate(c, (datetime.date(2012, 3, 10), {'active': 1}))
+    self.assertEqual(base, models.util.Deserialize(c.summary_base))
+    self.mox.VerifyAll()
+
+  def testPrepareUpdateWithoutReconcile(self):
+    """Tests PrepareUpdate() while no reconcile is running."""
+    generations = {'current': 3, 'pending': None}
+    self.snapshot.Get().AndReturn(generations)
+    c = self._GetComputer(summary_base=None)
+
+    self.mox.ReplayAll()
+    self.assertEqual(generations, self.cls.PrepareUpdate(c, None))
+    self.assertEqual(None, c.summary_base)
+    self.mox.VerifyAll()
+
+  def testUpdateCounts(self):
+    """Tests UpdateCounts()."""
+    self.mox.StubOutWithMock(self.cls, '_AddToShards')
+    today = datetime.datetime.utcnow().date()
+    yesterday = today - datetime.timedelta(days=1)
+    too_old = today - datetime.timedelta(days=models.COMPUTER_ACTIVE_DAYS + 1)
+    gens = {'current': 3, 'pending': None}
+
+    # same date, only changed counters are updated.
+    self.cls._AddToShards(
+        gens, today, {'track:stable': -1, 'track:testing': 1})
+    # moved dates.
+    self.cls._AddToShards(gens, yesterday, {'active': -1, 'track:stable': -1})
+    self.cls._AddToShards(gens, today, {'active': 1, 'track:stable': 1})
+    # new computer, without generations of a transaction.
+    self.snapshot.Get().AndReturn(gens)
+    self.cls._AddToShards(gens, today, {'active': 1})
+
+    self.mox.ReplayAll()
+    self.cls.UpdateCounts(
+        (today, {'active': 1}), (today, {'active': 1}), gens)
+    self.cls.UpdateCounts(
+        (today, {'active': 1, 'track:stable': 1}),
+        (today, {'active': 1, 'track:testing': 1}), gens)
+    self.cls.UpdateCounts(
+        (yesterday, {'active': 1, 'track:stable': 1}),
+        (today, {'active': 1, 'track:stable': 1}), gens)
+    self.cls.UpdateCounts(None, (today, {'active': 1}))
+    # old dates are outside the summary window and skipped.
+    self.cls.UpdateCounts((too_old, {'active': 1}), None, gens)
+    self.mox.VerifyAll()
+
+  def testAddToShards(self):
+    """Tests _AddToShards() adds to the current and pending generations."""
+    self.stubs.Set(
+        models.db, 'run_in_transaction_options',
+        lambda unused_options, fn, *args: fn(*args))
+    self.mox.StubOutWithMock(models.random, 'randrange')
+    self.mox.StubOutWithMock(self.cls, 'get_by_key_name')
+    self.mox.StubOutWithMock(models.db, 'put')
+    date = datetime.date(2012, 3, 9)
+    shard = self.mox.CreateMockAnything()
+    shard.counts = models.util.Serialize({'active': 2, 'track:stable': 1})
+
+    models.random.randrange(models.COMPUTER_SUMMARY_SHARDS).AndReturn(7)
+    self.cls.get_by_key_name(
+        ['3_2012-03-09_7', '4_2012-03-09_7']).AndReturn([shard, None])
+    models.db.put(mox.Func(lambda entities: len(entities) == 2))
+
+    self.mox.ReplayAll()
+    self.cls._AddToShards(
+        {'current': 3, 'pending': 4}, date,
+        {'active': 1, 'track:stable': -1})
+    self.assertEqual({'active': 3}, models.util.Deserialize(shard.counts))
+    self.mox.VerifyAll()
+
+  def testAddToShardsWithoutReconcile(self):
+    """Tests _AddToShards() while no reconcile is running."""
+    self.stubs.Set(models.db, 'run_in_transaction', lambda fn: fn())
+    self.mox.StubOutWithMock(models.random, 'randrange')
+    self.mox.StubOutWithMock(self.cls, 'get_by_key_name')
+    self.mox.StubOutWithMock(models.db, 'put')
+    shard = self.mox.CreateMockAnything()
+    shard.counts = models.util.Serialize({'active': 2})
+
+    models.random.randrange(models.COMPUTER_SUMMARY_SHARDS).AndReturn(7)
+    self.cls.get_by_key_name(['3_2012-03-09_7']).AndReturn([shard])
+    models.db.put([shard])
+
+    self.mox.ReplayAll()
+    self.cls._AddToShards(
+        {'current': 3, 'pending': None}, datetime.date(2012, 3, 9),
+        {'active': -1})
+    self.assertEqual({'active': 1}, models.util.Deserialize(shard.counts))
+    self.mox.VerifyAll()
+
+  def testPutInactive(self):
+    """Tests PutInactive() removes Computers from the current counters."""
+    self.mox.StubOutWithMock(models.gae_util, 'BatchDatastoreOp')
+    self.mox.StubOutWithMock(self.cls, 'UpdateCounts')
+    c1 = self._GetComputer()
+    c2 = self._GetComputer(preflight_datetime=None)
+    old = self.cls.GetComputerCounts(c1)
+
+    models.gae_util.BatchDatastoreOp(models.db.put, [c1, c2])
+    self.snapshot.Get().AndReturn({'current': 3, 'pending': 4})
+    gens = {'current': 3, 'pending': None}
+    self.cls.UpdateCounts(old, None, gens).AndRaise(models.db.Timeout)
+    self.cls.UpdateCounts(None, None, gens)
+
+    self.mox.ReplayAll()
+    self.cls.PutInactive([c1, c2])
+    self.assertFalse(c1.active)
+    self.assertFalse(c2.active)
+    self.mox.VerifyAll()
+
+  def testBeginReconcile(self):
+    """Tests BeginReconcile() skips a generation of an unfinished one."""
+    self.stubs.Set(models.db, 'run_in_transaction', lambda fn: fn())
+    self.mox.StubOutWithMock(self.cls, '_GetGenerations')
+    self.mox.StubOutWithMock(self.cls, '_SetGenerations')
+    self.cls._GetGenerations().AndReturn({'current': 3, 'pending': None})
+    self.cls._SetGenerations({'current': 3, 'pending': 4})
+    self.snapshot.Invalidate()
+    self.cls._GetGenerations().AndReturn({'current': 3, 'pending': 4})
+    self.cls._SetGenerations({'current': 3, 'pending': 5})
+    self.snapshot.Invalidate()
+
+    self.mox.ReplayAll()
+    self.assertEqual(4, self.cls.BeginReconcile())
+    self.assertEqual(5, self.cls.BeginReconcile())
+    self.mox.VerifyAll()
+
+  def testGetReconcileCounts(self):
+    """Tests GetReconcileCounts() of changed and unchanged Computers."""
+    base = models.util.Serialize(
+        {'generation': 4, 'counts': ['2012-03-08', {'active': 1}]})
+    c = self._GetComputer(summary_base=base)
+    self.assertEqual(
+        (datetime.date(2012, 3, 8),
+         {'active': 1, 'conns_on_corp': 3, 'conns_off_corp': 1}),
+        self.cls.GetReconcileCounts(c, 4))
+    # a base of an older generation is ignored.
+    self.assertEqual(
+        self.cls.GetComputerCounts(c, connections=True),
+        self.cls.GetReconcileCounts(c, 5))
+    # a Computer first seen while the reconcile ran.
+    c.summary_base = models.util.Serialize({'generation': 4, 'counts': None})
+    self.assertEqual(None, self.cls.GetReconcileCounts(c, 4))
+
+  def testSetDailyCounts(self):
+    """Tests SetDailyCounts() puts counts and switches generations."""
+    self.stubs.Set(models.db, 'run_in_transaction', lambda fn: fn())
+    self.mox.StubOutWithMock(self.cls, '_GetGenerations')
+    self.mox.StubOutWithMock(self.cls, '_SetGenerations')
+    self.mox.StubOutWithMock(self.cls, 'all')
+    self.mox.StubOutWithMock(models.gae_util, 'BatchDatastoreOp')
+    date = datetime.date(2012, 3, 9)
+    keys = []
+    for name in ['3_2012-03-09_1', '4_2012-03-09_0', '2012-03-09_2']:
+      key = self.mox.CreateMockAnything()
+      key.name().AndReturn(name)
+      keys.append(key)
+
+    def _CheckShards(shards):
+      self.assertEqual(4, shards[0].generation)
+      self.assertEqual(date, shards[0].date)
+      self.assertEqual(
+          {'active': 2}, models.util.Deserialize(shards[0].counts))
+      return True
+
+    models.gae_util.BatchDatastoreOp(models.db.put, mox.Func(_CheckShards))
+    self.cls._GetGenerations().AndReturn({'current': 3, 'pending': 4})
+    self.cls._SetGenerations({'current': 4, 'pending': None})
+    self.snapshot.Invalidate()
+    self.cls.all(keys_only=True).AndReturn(keys)
+    models.gae_util.BatchDatastoreOp(
+        models.db.delete, [keys[0], keys[2]])
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.cls.SetDailyCounts({date: {'active': 2}}, 4))
+    self.mox.VerifyAll()
+
+  def testSetDailyCountsWhenRetried(self):
+    """Tests SetDailyCounts() of a generation which is already current."""
+    self.stubs.Set(models.db, 'run_in_transaction', lambda fn: fn())
+    self.mox.StubOutWithMock(self.cls, '_GetGenerations')
+    self.mox.StubOutWithMock(self.cls, 'all')
+    self.mox.StubOutWithMock(models.gae_util, 'BatchDatastoreOp')
+    models.gae_util.BatchDatastoreOp(models.db.put, [])
+    self.cls._GetGenerations().AndReturn({'current': 4, 'pending': None})
+    self.snapshot.Invalidate()
+    self.cls.all(keys_only=True).AndReturn([])
+    models.gae_util.BatchDatastoreOp(models.db.delete, [])
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.cls.SetDailyCounts({}, 4))
+    self.mox.VerifyAll()
+
+  def testSetDailyCountsWhenReplaced(self):
+    """Tests SetDailyCounts() once a newer reconcile began."""
+    self.stubs.Set(models.db, 'run_in_transaction', lambda fn: fn())
+    self.mox.StubOutWithMock(self.cls, '_GetGenerations')
+    self.mox.StubOutWithMock(models.gae_util, 'BatchDatastoreOp')
+    models.gae_util.BatchDatastoreOp(models.db.put, [])
+    self.cls._GetGenerations().AndReturn({'current': 3, 'pending': 5})
+
+    self.mox.ReplayAll()
+    self.assertFalse(self.cls.SetDailyCounts({}, 4))
+    self.mox.VerifyAll()
+
+
+class FleetMetricTest(mox.MoxTestBase):
+  """Test FleetMetric class."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.cls = models.FleetMetric
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _GetEntity(self, values):
+    """Returns a mock FleetMetric entity of a dict of values."""
+    entity = self.mox.CreateMockAnything()
+    entity.values = models.util.Serialize(values)
+    return entity
+
+  def testSetDay(self):
+    """Tests SetDay() puts only changed metrics."""
+    unchanged = self._GetEntity({'2012-03-09': 5})
+    changed = self._GetEntity({'2012-03-08': 9, '2012-03-09': 8})
+    self.mox.StubOutWithMock(self.cls, 'get_by_key_name')
+    self.mox.StubOutWithMock(models.db, 'put')
+
+    self.cls.get_by_key_name(
+        ['active_1d_2012', 'active_30d_2012', 'track:stable_2012']).AndReturn(
+            [unchanged, changed, None])
+    models.db.put([changed, mox.IsA(self.cls)])
+
+    self.mox.ReplayAll()
+    self.cls.SetDay(
+        datetime.date(2012, 3, 9),
+        {'active_1d': 5, 'active_30d': 10, 'track:stable': 7})
+    self.assertEqual(
+        {'2012-03-08': 9, '2012-03-09': 10},
+        models.util.Deserialize(changed.values))
+    self.mox.VerifyAll()
+
+  def testGetRange(self):
+    """Tests GetRange() across years."""
+    self.mox.StubOutWithMock(self.cls, 'get_by_key_name')
+    self.cls.get_by_key_name(
+        ['active_30d_2011', 'active_30d_2012']).AndReturn([
+            self._GetEntity({'2011-12-30': 1, '2011-12-31': 2}),
+            self._GetEntity({'2012-01-02': 4, '2012-01-01': 3,
+                             '2012-01-03': 5}),
+        ])
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        [('2011-12-31', 2), ('2012-01-01', 3), ('2012-01-02', 4)],
+        self.cls.GetRange(
+            'active_30d', datetime.date(2011, 12, 31),
+            datetime.date(2012, 1, 2)))
+    self.mox.VerifyAll()
+
+
+class InstallRollupTest(mox.MoxTestBase):
+  """Test InstallRollup class."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.cls = models.InstallRollup
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def _GetInstall(self, package, success, duration_seconds=None,
+                  server_datetime=None, dl_kbytes_per_sec=None):
+    """Returns a mock InstallLog."""
+    install = self.mox.CreateMockAnything()
+    install.package = package
+    install.applesus = False
+    install.duration_seconds = duration_seconds
+    install.dl_kbytes_per_sec = dl_kbytes_per_sec
+    install.server_datetime = server_datetime
+    install.IsSuccess().AndReturn(success)
+    return install
+
+  def testAddInstalls(self):
+    """Tests AddInstalls()."""
+    hour = datetime.datetime(2012, 3, 9, 10)
+    installs = [
+        self._GetInstall('foo', True, 10, datetime.datetime(2012, 3, 9, 10, 5),
+                         dl_kbytes_per_sec=500),
+        self._GetInstall('foo', False, 20, datetime.datetime(2012, 3, 9, 10)),
+        self._GetInstall('bar', True, None, datetime.datetime(2012, 3, 9, 10)),
+    ]
+    stored_bar = self.cls(
+        key_name='2012-03-09-10_bar_2', hour=hour, package='bar',
+        install_count=5, duration_count=1, duration_total_seconds=30,
+        duration_histogram=models.util.Serialize(
+            {models.histogram.GetBucket(30): 1}))
+    # keys need an app id, so key rollups of this hour by package instead.
+    self.stubs.Set(self.cls, 'key', lambda rollup: rollup.package)
+    stored = {'bar': stored_bar}
+    put = []
+    self.mox.StubOutWithMock(models.random, 'randrange')
+    self.stubs.Set(
+        models.db, 'run_in_transaction_options',
+        lambda options, func, *args: func(*args))
+    self.stubs.Set(models.db, 'get', lambda keys: [stored.get(k) for k in keys])
+    self.stubs.Set(models.db, 'put', put.extend)
+    self.mox.StubOutWithMock(models.InstallRollupBatch, 'get_by_key_name')
+
+    models.random.randrange(models.INSTALL_ROLLUP_SHARDS).AndReturn(2)
+    models.InstallRollupBatch.get_by_key_name('batch1_0').AndReturn(None)
+
+    self.mox.ReplayAll()
+    self.cls.AddInstalls(installs, batch='batch1')
+    self.mox.VerifyAll()
+    markers = [e for e in put if isinstance(e, models.InstallRollupBatch)]
+    self.assertEqual(1, len(markers))
+    put = dict((rollup.package, rollup) for rollup in put
+               if rollup not in markers)
+    self.assertEqual(['bar', 'foo'], sorted(put))
+    self.assertTrue(put['bar'] is stored_bar)
+    self.assertEqual(6, stored_bar.install_count)
+    self.assertEqual(1, stored_bar.duration_count)
+    self.assertEqual(
+        {models.histogram.GetBucket(30): 1},
+        stored_bar.GetHistogram('duration_histogram'))
+    foo = put['foo']
+    self.assertEqual(hour, foo.hour)
+    self.assertEqual(1, foo.install_count)
+    self.assertEqual(1, foo.install_fail_count)
+    self.assertEqual(1, foo.duration_count)
+    self.assertEqual(10, foo.duration_total_seconds)
+    self.assertEqual(
+        {models.histogram.GetBucket(10): 1},
+        foo.GetHistogram('duration_histogram'))
+    self.assertEqual(
+        {models.histogram.GetBucket(500): 1},
+        foo.GetHistogram('dl_kbytes_per_sec_histogram'))
+
+  def testAddInstallsWhenAdded(self):
+    """Tests AddInstalls() of a batch which was added already."""
+    self.stubs.Set(
+        models.db, 'run_in_transaction_options',
+        lambda options, func, *args: func(*args))
+    self.mox.StubOutWithMock(models.InstallRollupBatch, 'get_by_key_name')
+    self.mox.StubOutWithMock(models.db, 'put')
+    install = self._GetInstall(
+        'foo', True, server_datetime=datetime.datetime(2012, 3, 9, 10))
+    models.InstallRollupBatch.get_by_key_name('batch1_0').AndReturn('marker')
+
+    self.mox.ReplayAll()
+    self.cls.AddInstalls([install], batch='batch1')
+    self.mox.VerifyAll()
+
+  def testAddInstallsWhenFailed(self):
+    """Tests AddInstalls() defers rollups of failed transactions."""
+    self.stubs.Set(models, 'MAX_XG_ENTITY_GROUPS', 2)
+    self.mox.StubOutWithMock(self.cls, '_AddRollups')
+    self.mox.StubOutWithMock(models.deferred, 'defer')
+    dt = datetime.datetime(2012, 3, 9, 10)
+    installs = [self._GetInstall('foo', True, server_datetime=dt),
+                self._GetInstall('bar', True, server_datetime=dt)]
+
+    self.cls._AddRollups(mox.IsA(list), 'batch1_0').AndRaise(
+        models.db.TransactionFailedError)
+    models.deferred.defer(
+        self.cls._AddRollups, mox.IsA(list), 'batch1_0', _countdown=10)
+    self.cls._AddRollups(mox.IsA(list), 'batch1_1')
+
+    self.mox.ReplayAll()
+    self.cls.AddInstalls(installs, batch='batch1')
+    self.mox.VerifyAll()
+
+  def testGetInstallCounts(self):
+    """Tests GetInstallCounts()."""
+    since = datetime.datetime(2012, 3, 9, 9)
+    until = datetime.datetime(2012, 3, 9, 11)
+    rollups = [
+        self.cls(package='foo', install_count=1, duration_count=1,
+                 duration_total_seconds=10,
+                 duration_histogram=models.util.Serialize({'11': 1})),
+        self.cls(package='foo', install_count=2, install_fail_count=1),
+        self.cls(package='bar', applesus=True, install_fail_count=1),
+    ]
+    query = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(self.cls, 'all')
+    self.mox.StubOutWithMock(models.gae_util, 'QueryIterator')
+    self.cls.all().AndReturn(query)
+    query.filter('hour >=', since)
+    query.filter('hour <', until)
+    models.gae_util.QueryIterator(query).AndReturn(rollups)
+
+    self.mox.ReplayAll()
+    self.assertEqual({
+        'foo': {'applesus': False, 'install_count': 3,
+                'install_fail_count': 1, 'duration_count': 1,
+                'duration_total_seconds': 10,
+                'duration_histogram': {'11': 1},
+                'dl_kbytes_per_sec_histogram': {}},
+        'bar': {'applesus': True, 'install_count': 0,
+                'install_fail_count': 1, 'duration_count': 0,
+                'duration_total_seconds': 0, 'duration_histogram': {},
+                'dl_kbytes_per_sec_histogram': {}},
+    }, self.cls.GetInstallCounts(since=since, until=until))
+    self.mox.VerifyAll()
+
+
+class InstallRollupBatchTest(mox.MoxTestBase):
+  """Test InstallRollupBatch class."""
+
+  def testDeleteOld(self):
+    """Tests DeleteOld()."""
+    cls = models.InstallRollupBatch
+    query = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(cls, 'all')
+    self.mox.StubOutWithMock(models.gae_util, 'QueryIterator')
+    self.mox.StubOutWithMock(models.gae_util, 'BatchDatastoreOp')
+    cls.all(keys_only=True).AndReturn(query)
+    query.filter('mtime <', datetime.datetime(2012, 3, 2, 10)).AndReturn(query)
+    models.gae_util.QueryIterator(query).AndReturn(iter(['k1', 'k2']))
+    models.gae_util.BatchDatastoreOp(models.db.delete, ['k1', 'k2'])
+
+    self.mox.ReplayAll()
+    cls.DeleteOld(now=datetime.datetime(2012, 3, 9, 10))
+    self.mox.VerifyAll()
+
+
+class LogRollupTest(mox.MoxTestBase):
+  """Test LogRollup class."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.cls = models.LogRollup
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testSetCounts(self):
+    """Tests SetCounts()."""
+    self.mox.StubOutWithMock(models.db, 'put')
+    models.db.put(mox.IsA(list))
+
+    self.mox.ReplayAll()
+    self.cls.SetCounts('ClientLog', 'run1', {'2012-03-09': {'action:foo': 2}})
+    self.mox.VerifyAll()
+
+  def testGetCounts(self):
+    """Tests GetCounts() sums the counts of all runs."""
+    query = self.mox.CreateMockAnything()
+    rollups = []
+    for counts in [{'a': 1, 'b': 2}, {'a': 3}]:
+      rollup = self.mox.CreateMockAnything()
+      rollup.date = datetime.date(2012, 3, 9)
+      rollup.counts = models.util.Serialize(counts)
+      rollups.append(rollup)
+    self.mox.StubOutWithMock(self.cls, 'all')
+    self.mox.StubOutWithMock(models.gae_util, 'QueryIterator')
+    self.cls.all().AndReturn(query)
+    query.filter('kind_name =', 'ClientLog').AndReturn(query)
+    models.gae_util.QueryIterator(query).AndReturn(rollups)
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        {datetime.date(2012, 3, 9): {'a': 4, 'b': 2}},
+        self.cls.GetCounts('ClientLog'))
+    self.mox.VerifyAll()
+
+
 class KeyValueCacheTest(mox.MoxTestBase):
   """Test KeyValueCache class."""
 
@@ -533,6 +1357,7 @@ class KeyValueCacheTest(mox.MoxTestBase):
     self.stubs = stubout.StubOutForTesting()
     self.cls = models.KeyValueCache
     self.key = 'example_ip_blocks'
+    self.stubs.Set(self.cls, '_ip_prefix_tries', {})
 
   def tearDown(self):
     self.mox.UnsetStubs()
@@ -543,73 +1368,137 @@ class KeyValueCacheTest(mox.MoxTestBase):
     self.assertEqual(False, self.cls.IpInList(self.key, ''))
     self.assertEqual(False, self.cls.IpInList(self.key, None))
 
+  def _MockIpList(self, ip_blocks, mtime=1):
+    """Mock the KeyValueCache entity fetched by IpInList().
+
+    Args:
+      ip_blocks: list of str networks, or None for no entity.
+      mtime: value of the entity mtime.
+    """
+    if ip_blocks is None:
+      entity = None
+    else:
+      entity = self.mox.CreateMockAnything()
+      entity.text_value = models.util.Serialize(ip_blocks)
+      entity.mtime = mtime
+    self.cls.MemcacheWrappedGet(self.key).AndReturn(entity)
+
   def testIpInListWhenIpNotInEmptyList(self):
     """Tests IpInList() with an IP that will not match an empty list."""
-    self.mox.StubOutWithMock(models.util, 'Deserialize')
     self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
+    self._MockIpList([])
 
-    ip = '1.2.3.4'
-    deserialized = []
+    self.mox.ReplayAll()
+    self.assertFalse(self.cls.IpInList(self.key, '1.2.3.4'))
+    self.mox.VerifyAll()
 
-    self.cls.MemcacheWrappedGet(
-        self.key, 'text_value').AndReturn('serialized')
-    models.util.Deserialize('serialized').AndReturn(deserialized)
+  def testIpInListWhenEntityMissing(self):
+    """Tests IpInList() when there is no list entity."""
+    self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
+    self._MockIpList(None)
 
     self.mox.ReplayAll()
-    self.assertFalse(self.cls.IpInList(self.key, ip))
+    self.assertFalse(self.cls.IpInList(self.key, '1.2.3.4'))
     self.mox.VerifyAll()
 
   def testIpInListWhenPropertyValueIsEmpty(self):
     """Tests IpInList() with null/empty property text_value for list."""
-    self.mox.StubOutWithMock(models.util, 'Deserialize')
     self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
-
-    ip = '1.2.3.4'
-
-    self.cls.MemcacheWrappedGet(self.key, 'text_value').AndReturn('')
+    entity = self.mox.CreateMockAnything()
+    entity.text_value = ''
+    self.cls.MemcacheWrappedGet(self.key).AndReturn(entity)
 
     self.mox.ReplayAll()
-    self.assertFalse(self.cls.IpInList(self.key, ip))
+    self.assertFalse(self.cls.IpInList(self.key, '1.2.3.4'))
     self.mox.VerifyAll()
 
   def testIpInListWhenIpNotInList(self):
     """Tests IpInList() with an IP not in the lists."""
-    self.mox.StubOutWithMock(models.util, 'Deserialize')
     self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
-
-    ip = '1.2.3.4'
-    deserialized = ['192.168.0.0/16']
-
-    self.cls.MemcacheWrappedGet(
-        self.key, 'text_value').AndReturn('serialized')
-    models.util.Deserialize('serialized').AndReturn(deserialized)
+    self._MockIpList(['192.168.0.0/16'])
 
     self.mox.ReplayAll()
-    self.assertFalse(self.cls.IpInList(self.key, ip))
+    self.assertFalse(self.cls.IpInList(self.key, '1.2.3.4'))
     self.mox.VerifyAll()
 
   def testIpInListWhenTrue(self):
     """Tests IpInList() with an IP that is found in the list."""
-    self.mox.StubOutWithMock(models.util, 'Deserialize')
     self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
-
-    ip = '1.2.3.4'
-    deserialized = ['192.168.0.0/16', '1.0.0.0/8']
-
-    self.cls.MemcacheWrappedGet(
-        self.key, 'text_value').AndReturn('serialized')
-    models.util.Deserialize('serialized').AndReturn(deserialized)
+    self._MockIpList(['192.168.0.0/16', '1.0.0.0/8'])
 
     self.mox.ReplayAll()
-    self.assertTrue(self.cls.IpInList(self.key, ip))
+    self.assertTrue(self.cls.IpInList(self.key, '1.2.3.4'))
     self.mox.VerifyAll()
 
   def testIpInListWhenIpv6(self):
     """Tests IpInList() with an IPv6 IP."""
-    ip = '2620:0:1003:1007:216:36ff:feee:f090'
+    self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
+    self._MockIpList(['1.0.0.0/8', '2620:0:1003::/48'])
+    self._MockIpList(['1.0.0.0/8', '2620:0:1003::/48'])
+
+    self.mox.ReplayAll()
+    self.assertTrue(
+        self.cls.IpInList(self.key, '2620:0:1003:1007:216:36ff:feee:f090'))
+    self.assertFalse(self.cls.IpInList(self.key, '2620:0:1004::1'))
+    self.mox.VerifyAll()
+
+  def testIpInListWhenInvalidEntries(self):
+    """Tests IpInList() skips invalid networks and ips."""
+    self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
+    self._MockIpList(['bogus', '1.0.0.0/99', '1.0.0.0/8'])
+    self._MockIpList(['bogus', '1.0.0.0/99', '1.0.0.0/8'])
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.cls.IpInList(self.key, '1.2.3.4'))
+    self.assertFalse(self.cls.IpInList(self.key, 'not-an-ip'))
+    self.mox.VerifyAll()
+
+  def testIpInListCachesTrieUntilMtimeChanges(self):
+    """Tests IpInList() reuses the compiled list until mtime changes."""
+    self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedGet')
+    self.mox.StubOutWithMock(models.util, 'Deserialize')
+    entity = self.mox.CreateMockAnything()
+    entity.text_value = 'serialized'
+    entity.mtime = 1
+    self.cls.MemcacheWrappedGet(self.key).MultipleTimes().AndReturn(entity)
+    models.util.Deserialize('serialized').AndReturn(['1.0.0.0/8'])
+    models.util.Deserialize('serialized').AndReturn(['2.0.0.0/8'])
+
+    self.mox.ReplayAll()
+    self.assertTrue(self.cls.IpInList(self.key, '1.2.3.4'))
+    self.assertTrue(self.cls.IpInList(self.key, '1.2.3.5'))
+    entity.mtime = 2
+    self.assertFalse(self.cls.IpInList(self.key, '1.2.3.4'))
+    self.assertTrue(self.cls.IpInList(self.key, '2.2.3.4'))
+    self.mox.VerifyAll()
+
+
+class ReportsCacheTest(mox.MoxTestBase):
+  """Test ReportsCache class."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.cls = models.ReportsCache
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def testSetStatsViews(self):
+    """Tests SetStatsViews() deletes views of filters no longer present."""
+    self.mox.StubOutWithMock(self.cls, 'GetSerializedItem')
+    self.mox.StubOutWithMock(self.cls, 'SetSerializedItem')
+    self.mox.StubOutWithMock(self.cls, 'MemcacheWrappedDelete')
+
+    self.cls.GetSerializedItem('stats_view_filters_site').AndReturn(
+        (['MTV', 'NYC'], None))
+    self.cls.SetSerializedItem('stats_view_site_NYC', {'active': 1})
+    self.cls.MemcacheWrappedDelete('stats_view_site_MTV')
+    self.cls.SetSerializedItem('stats_view_filters_site', ['NYC'])
 
     self.mox.ReplayAll()
-    self.assertFalse(self.cls.IpInList(self.key, ip))
+    self.cls.SetStatsViews('site', {'NYC': {'active': 1}})
     self.mox.VerifyAll()
 
 
@@ -44,17 +44,17 @@ class CatalogTest(mox.MoxTestBase):
     self.mox.UnsetStubs()
     self.stubs.UnsetAll()
 
-  def _MockObtainLock(self, name, obtain=True):
-    if not hasattr(self, '_mock_obtain_lock'):
-      self.mox.StubOutWithMock(models.gae_util, 'ObtainLock')
-      self._mock_obtain_lock = True
-    models.gae_util.ObtainLock(name).AndReturn(obtain)
-
-  def _MockReleaseLock(self, name):
-    if not hasattr(self, '_mock_release_lock'):
-      self.mox.StubOutWithMock(models.gae_util, 'ReleaseLock')
-      self._mock_release_lock = True
-    models.gae_util.ReleaseLock(name).AndReturn(None)
+  def _MockObtainLock(self, kind, key, obtain=True):
+    if not hasattr(self, '_mock_lock'):
+      self.mox.StubOutWithMock(models.gae_util, 'Lock', use_mock_anything=True)
+      self._mock_lock = self.mox.CreateMockAnything()
+    models.gae_util.Lock(
+        kind, key, ttl=models.gae_util.LOCK_TASK_SECS).AndReturn(
+            self._mock_lock)
+    self._mock_lock.Acquire().AndReturn(obtain)
+
+  def _MockReleaseLock(self):
+    self._mock_lock.Release().AndReturn(True)
 
   def testGeneratesync(self):
     """Tests calling Generate(delay=2)."""
@@ -86,7 +86,7 @@ class CatalogTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(models.Catalog, 'get_or_insert')
     self.mox.StubOutWithMock(models.Catalog, 'DeleteMemcacheWrap')
 
-    self._MockObtainLock('catalog_lock_%s' % name)
+    self._MockObtainLock('catalog_lock', name)
 
     mock_model = self.mox.CreateMockAnything()
     models.PackageInfo.all().AndReturn(mock_model)
@@ -100,8 +100,10 @@ class CatalogTest(mox.MoxTestBase):
 
     models.Catalog.DeleteMemcacheWrap(
         name, prop_name='plist_xml').AndReturn(None)
+    models.Catalog.DeleteMemcacheWrap(
+        name, prop_name='package_names').AndReturn(None)
     models.Manifest.Generate(name, delay=1).AndReturn(None)
-    self._MockReleaseLock('catalog_lock_%s' % name)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     models.Catalog.Generate(name)
@@ -115,12 +117,12 @@ class CatalogTest(mox.MoxTestBase):
   def testGenerateWithNoPkgsinfo(self):
     """Tests Generate() where no coorresponding PackageInfo exist."""
     name = 'badname'
-    self._MockObtainLock('catalog_lock_%s' % name)
+    self._MockObtainLock('catalog_lock', name)
     mock_model = self.mox.CreateMockAnything()
     self.mox.StubOutWithMock(models.PackageInfo, 'all')
     models.PackageInfo.all().AndReturn(mock_model)
     mock_model.filter('catalogs =', name).AndReturn([])
-    self._MockReleaseLock('catalog_lock_%s' % name)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     self.assertRaises(
@@ -132,13 +134,13 @@ class CatalogTest(mox.MoxTestBase):
     name = 'goodname'
     mock_plist1 = self.mox.CreateMockAnything()
     pkg1 = test.GenericContainer(plist=mock_plist1, name='foo')
-    self._MockObtainLock('catalog_lock_%s' % name)
+    self._MockObtainLock('catalog_lock', name)
     mock_model = self.mox.CreateMockAnything()
     self.mox.StubOutWithMock(models.PackageInfo, 'all')
     models.PackageInfo.all().AndReturn(mock_model)
     mock_model.filter('catalogs =', name).AndReturn([pkg1])
     mock_plist1.GetXmlContent(indent_num=1).AndRaise(models.plist_lib.Error)
-    self._MockReleaseLock('catalog_lock_%s' % name)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     self.assertRaises(
@@ -156,7 +158,7 @@ class CatalogTest(mox.MoxTestBase):
     mock_plist2 = self.mox.CreateMockAnything()
     pkg2 = test.GenericContainer(plist=mock_plist2, name='bar')
 
-    self._MockObtainLock('catalog_lock_%s' % name)
+    self._MockObtainLock('catalog_lock', name)
 
     mock_model = self.mox.CreateMockAnything()
     self.mox.StubOutWithMock(models.PackageInfo, 'all')
@@ -169,7 +171,7 @@ class CatalogTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(models.Catalog, 'get_or_insert')
     models.Catalog.get_or_insert(name).AndReturn(mock_catalog)
     mock_catalog.put().AndRaise(models.db.Error)
-    self._MockReleaseLock('catalog_lock_%s' % name)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     self.assertRaises(
@@ -179,7 +181,7 @@ class CatalogTest(mox.MoxTestBase):
   def testGenerateLocked(self):
     """Tests Generate() where name is locked."""
     name = 'lockedname'
-    self._MockObtainLock('catalog_lock_%s' % name, obtain=False)
+    self._MockObtainLock('catalog_lock', name, obtain=False)
     # here is where Generate calls itself; can't stub the method we're
     # testing, so mock the calls that happen as a result.
     utcnow = datetime.datetime(2010, 9, 2, 19, 30, 21, 377827)
@@ -207,17 +209,17 @@ class ManifestTest(mox.MoxTestBase):
     self.mox.UnsetStubs()
     self.stubs.UnsetAll()
 
-  def _MockObtainLock(self, name, obtain=True):
-    if not hasattr(self, '_mock_obtain_lock'):
-      self.mox.StubOutWithMock(models.gae_util, 'ObtainLock')
-      self._mock_obtain_lock = True
-    models.gae_util.ObtainLock(name).AndReturn(obtain)
+  def _MockObtainLock(self, kind, key, obtain=True):
+    if not hasattr(self, '_mock_lock'):
+      self.mox.StubOutWithMock(models.gae_util, 'Lock', use_mock_anything=True)
+      self._mock_lock = self.mox.CreateMockAnything()
+    models.gae_util.Lock(
+        kind, key, ttl=models.gae_util.LOCK_TASK_SECS).AndReturn(
+            self._mock_lock)
+    self._mock_lock.Acquire().AndReturn(obtain)
 
-  def _MockReleaseLock(self, name):
-    if not hasattr(self, '_mock_release_lock'):
-      self.mox.StubOutWithMock(models.gae_util, 'ReleaseLock')
-      self._mock_release_lock = True
-    models.gae_util.ReleaseLock(name).AndReturn(None)
+  def _MockReleaseLock(self):
+    self._mock_lock.Release().AndReturn(True)
 
   def testGenerateAsync(self):
     """Tests calling Manifest.Generate(delay=2)."""
@@ -245,7 +247,7 @@ class ManifestTest(mox.MoxTestBase):
         pkg1.install_types[0]: [pkg1.name, pkg2.name],
         pkg2.install_types[1]: [pkg2.name],
     }
-    self._MockObtainLock('manifest_lock_%s' % name)
+    self._MockObtainLock('manifest_lock', name)
     self.stubs.Set(
         models.plist_lib,
         'MunkiManifestPlist',
@@ -266,7 +268,7 @@ class ManifestTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(models.Manifest, 'DeleteMemcacheWrap')
     models.Manifest.DeleteMemcacheWrap(name).AndReturn(None)
 
-    self._MockReleaseLock('manifest_lock_%s' % name)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     models.Manifest.Generate(name)
@@ -275,14 +277,14 @@ class ManifestTest(mox.MoxTestBase):
   def testGenerateDbError(self):
     """Tests Manifest.Generate() with db Error."""
     name = 'goodname'
-    self._MockObtainLock('manifest_lock_%s' % name)
+    self._MockObtainLock('manifest_lock', name)
 
     mock_model = self.mox.CreateMockAnything()
     self.mox.StubOutWithMock(models.PackageInfo, 'all')
     models.PackageInfo.all().AndReturn(mock_model)
     mock_model.filter('manifests =', name).AndRaise(models.db.Error)
 
-    self._MockReleaseLock('manifest_lock_%s' % name)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     self.assertRaises(models.db.Error, models.Manifest.Generate, name)
@@ -291,14 +293,14 @@ class ManifestTest(mox.MoxTestBase):
   def testGenerateWithNoPkgsinfo(self):
     """Tests Manifest.Generate() where no coorresponding PackageInfo exist."""
     name = 'badname'
-    self._MockObtainLock('manifest_lock_%s' % name)
+    self._MockObtainLock('manifest_lock', name)
 
     mock_model = self.mox.CreateMockAnything()
     self.mox.StubOutWithMock(models.PackageInfo, 'all')
     models.PackageInfo.all().AndReturn(mock_model)
     mock_model.filter('manifests =', name).AndReturn([])
 
-    self._MockReleaseLock('manifest_lock_%s' % name)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     self.assertRaises(
@@ -308,7 +310,7 @@ class ManifestTest(mox.MoxTestBase):
   def testGenerateLocked(self):
     """Tests Manifest.Generate() where name is locked."""
     name = 'lockedname'
-    self._MockObtainLock('manifest_lock_%s' % name, obtain=False)
+    self._MockObtainLock('manifest_lock', name, obtain=False)
     # here is where Manifest.Generate calls itself; can't stub the method we're
     # testing, so mock the calls that happen as a result.
     utcnow = datetime.datetime(2010, 9, 2, 19, 30, 21, 377827)
@@ -337,17 +339,15 @@ class PackageInfoTest(mox.MoxTestBase):
     self.stubs.UnsetAll()
 
   # TODO(user): create a base test class for non-handlers.
-  def _MockObtainLock(self, name, obtain=True, timeout=0):
-    if not hasattr(self, '_mock_obtain_lock'):
-      self.mox.StubOutWithMock(models.gae_util, 'ObtainLock')
-      self._mock_obtain_lock = True
-    models.gae_util.ObtainLock(name, timeout=timeout).AndReturn(obtain)
-
-  def _MockReleaseLock(self, name):
-    if not hasattr(self, '_mock_release_lock'):
-      self.mox.StubOutWithMock(models.gae_util, 'ReleaseLock')
-      self._mock_release_lock = True
-    models.gae_util.ReleaseLock(name).AndReturn(None)
+  def _MockObtainLock(self, kind, key, obtain=True, timeout=0):
+    if not hasattr(self, '_mock_lock'):
+      self.mox.StubOutWithMock(models.gae_util, 'Lock', use_mock_anything=True)
+      self._mock_lock = self.mox.CreateMockAnything()
+    models.gae_util.Lock(kind, key).AndReturn(self._mock_lock)
+    self._mock_lock.Acquire(timeout=timeout).AndReturn(obtain)
+
+  def _MockReleaseLock(self):
+    self._mock_lock.Release().AndReturn(True)
 
   def _GetTestPackageInfoPlist(self, d=None):
     """String concatenates a description and returns test plist xml."""
@@ -373,6 +373,24 @@ class PackageInfoTest(mox.MoxTestBase):
         '<key>catalogs</key><array>%(catalogs)s</array>'
         '<key>description</key><string>%(desc)s</string></dict></plist>' % d)
 
+  def testVerifyPackageIsEligibleForNewCatalogs(self):
+    """Tests VerifyPackageIsEligibleForNewCatalogs()."""
+    p = models.PackageInfo(name='foopkg')
+    self.mox.StubOutWithMock(models.Catalog, 'MemcacheWrappedGetMulti')
+    models.Catalog.MemcacheWrappedGetMulti(
+        ['testing', 'stable'], prop_name='package_names').AndReturn(
+            [['barpkg'], None])
+    models.Catalog.MemcacheWrappedGetMulti(
+        ['testing', 'stable'], prop_name='package_names').AndReturn(
+            [['barpkg'], ['foopkg']])
+
+    self.mox.ReplayAll()
+    p.VerifyPackageIsEligibleForNewCatalogs(['testing', 'stable'])
+    self.assertRaises(
+        models.PackageInfoUpdateError,
+        p.VerifyPackageIsEligibleForNewCatalogs, ['testing', 'stable'])
+    self.mox.VerifyAll()
+
   def testGetDescription(self):
     """Tests getting PackageInfo.description property."""
     p = models.PackageInfo()
@@ -452,7 +470,7 @@ class PackageInfoTest(mox.MoxTestBase):
     """Test Update() with a failure obtaining the lock."""
     p = models.PackageInfo()
     p.filename = 'foofile.dmg'
-    self._MockObtainLock('pkgsinfo_%s' % p.filename, obtain=False, timeout=5.0)
+    self._MockObtainLock('pkgsinfo', p.filename, obtain=False, timeout=5.0)
 
     self.mox.ReplayAll()
     self.assertRaises(models.PackageInfoLockError, p.Update)
@@ -476,7 +494,7 @@ class PackageInfoTest(mox.MoxTestBase):
     maximum_os_version = kwargs.get('maximum_os_version')
     force_install_after_date = kwargs.get('force_install_after_date')
 
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0)
     self.mox.StubOutWithMock(models.PackageInfo, 'get_by_key_name')
 
     if create_new:
@@ -487,7 +505,7 @@ class PackageInfoTest(mox.MoxTestBase):
       pkginfo.manifest_mod_access = []
       if filename_exists:
         models.PackageInfo.get_by_key_name(filename).AndReturn(True)
-        self._MockReleaseLock('pkgsinfo_%s' % filename)
+        self._MockReleaseLock()
         self.mox.ReplayAll()
         models.PackageInfo.UpdateFromPlist(plist_xml, create_new=create_new)
       else:
@@ -510,7 +528,7 @@ class PackageInfoTest(mox.MoxTestBase):
       if plist_xml or unsafe_properties_changed:
         # If not safe to modify and plist_xml was passed, an exception will be
         # raised after releasing the lock.
-        self._MockReleaseLock('pkgsinfo_%s' % filename)
+        self._MockReleaseLock()
         self.mox.ReplayAll()
         if plist_xml:
           models.PackageInfo.UpdateFromPlist(plist_xml)
@@ -525,7 +543,7 @@ class PackageInfoTest(mox.MoxTestBase):
     self.mox.StubOutWithMock(pkginfo, 'put')
     pkginfo.put().AndReturn(None)
 
-    self._MockReleaseLock('pkgsinfo_%s' % filename)
+    self._MockReleaseLock()
 
     self.mox.StubOutWithMock(models.Catalog, 'Generate')
 
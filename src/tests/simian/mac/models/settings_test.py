@@ -19,6 +19,9 @@
 
 
 
+import logging
+import time
+
 from google.apputils import app
 from google.apputils import basetest
 import mox
@@ -57,6 +60,130 @@ class SettingsTest(mox.MoxTestBase):
     self.assertEqual(settings.Settings.GetType('unknown'), None)
     self.assertEqual(settings.Settings.GetType('email_reply_to'), 'string')
 
+  def _GetEntity(self, name, text_value=None, blob_value=None):
+    """Returns a mock Settings entity."""
+    entity = self.mox.CreateMockAnything()
+    entity.text_value = text_value
+    entity.blob_value = blob_value
+    entity.mtime = 'mtime_%s' % name
+    return entity
+
+  def _StubOutSnapshot(self, loader):
+    """Stubs SETTINGS_SNAPSHOT with one of loader at a fixed version."""
+    snapshot = settings.gae_util.InstanceSnapshot('settings_test', loader)
+    self.stubs.Set(snapshot, '_GetGeneration', lambda: 1)
+    self.stubs.Set(settings, 'SETTINGS_SNAPSHOT', snapshot)
+    return snapshot
+
+  def testLoadSnapshot(self):
+    """Test _LoadSnapshot()."""
+    entities = {
+        'email_reply_to': self._GetEntity(
+            'email_reply_to', text_value='foo@example.com'),
+        'apple_auto_promote_enabled': self._GetEntity(
+            'apple_auto_promote_enabled', blob_value='true'),
+        'email_on_every_change': self._GetEntity('email_on_every_change'),
+    }
+    names = sorted(settings.SETTINGS)
+    self.mox.StubOutWithMock(settings.Settings, 'get_by_key_name')
+    settings.Settings.get_by_key_name(names).AndReturn(
+        [entities.get(name) for name in names])
+
+    self.mox.ReplayAll()
+    self.assertEqual({
+        'email_reply_to': ('foo@example.com', 'mtime_email_reply_to'),
+        'apple_auto_promote_enabled': (
+            True, 'mtime_apple_auto_promote_enabled'),
+    }, settings.Settings._LoadSnapshot())
+    self.mox.VerifyAll()
+
+  def testGetSnapshotItem(self):
+    """Test GetSnapshotItem() copies values, and falls back to defaults."""
+    self._StubOutSnapshot(lambda: {'foo': (['a'], 'mtime')})
+    self.stubs.Set(settings, 'SETTINGS', {'bar': {'default': 'x'}})
+
+    value, mtime = settings.Settings.GetSnapshotItem('foo')
+    self.assertEqual((['a'], 'mtime'), (value, mtime))
+    value.append('b')
+    self.assertEqual(['a'], settings.Settings.GetSnapshotItem('foo')[0])
+    self.assertEqual(('x', None), settings.Settings.GetSnapshotItem('bar'))
+    self.assertEqual((None, None), settings.Settings.GetSnapshotItem('zoo'))
+
+  def testGetSnapshotItemWithSuffix(self):
+    """Test GetSnapshotItem() loads names of suffix settings on first use."""
+    self._StubOutSnapshot(lambda: {})
+    self.mox.StubOutWithMock(settings.Settings, 'get_by_key_name')
+    settings.Settings.get_by_key_name(['foo_ca_public_cert_pem']).AndReturn(
+        [self._GetEntity('foo_ca_public_cert_pem', text_value='pem')])
+    settings.Settings.get_by_key_name(['bar_ca_public_cert_pem']).AndReturn(
+        [None])
+
+    self.mox.ReplayAll()
+    for unused_i in xrange(2):
+      self.assertEqual(
+          ('pem', 'mtime_foo_ca_public_cert_pem'),
+          settings.Settings.GetSnapshotItem('foo_ca_public_cert_pem'))
+      self.assertEqual(
+          (None, None),
+          settings.Settings.GetSnapshotItem('bar_ca_public_cert_pem'))
+    self.mox.VerifyAll()
+
+  def testSetItem(self):
+    """Test SetItem() bumps the settings version."""
+    self.mox.StubOutWithMock(settings.base.KeyValueCache, 'SetItem')
+    self.mox.StubOutWithMock(settings.Settings, 'SetSerializedItem')
+    self.mox.StubOutWithMock(settings.SETTINGS_SNAPSHOT, 'Invalidate')
+    settings.base.KeyValueCache.SetItem('email_reply_to', 'foo@example.com')
+    settings.SETTINGS_SNAPSHOT.Invalidate()
+    settings.Settings.SetSerializedItem('apple_auto_promote_enabled', True)
+    settings.SETTINGS_SNAPSHOT.Invalidate()
+
+    self.mox.ReplayAll()
+    settings.Settings.SetItem('email_reply_to', 'foo@example.com')
+    settings.Settings.SetItem('apple_auto_promote_enabled', True)
+    self.mox.VerifyAll()
+
+  def testGetSnapshotItemBenchmark(self):
+    """Benchmarks 1,000 settings reads with GetItem and GetSnapshotItem."""
+    names = ['email_on_every_change', 'email_reply_to',
+             'apple_auto_promote_enabled', 'required_issuer']
+    fetches = []
+
+    def FakeMemcacheWrappedGet(name, *unused_args, **unused_kwargs):
+      fetches.append(name)  # a memcache round trip each, when deployed.
+      return self._GetEntity(name, text_value='v', blob_value='true')
+
+    def FakeGetByKeyName(key_names):
+      fetches.append('get_by_key_name')
+      return [self._GetEntity(name, text_value='v', blob_value='true')
+              for name in key_names]
+
+    self.stubs.Set(
+        settings.Settings, 'MemcacheWrappedGet',
+        staticmethod(FakeMemcacheWrappedGet))
+    self.stubs.Set(
+        settings.Settings, 'get_by_key_name', staticmethod(FakeGetByKeyName))
+    self._StubOutSnapshot(settings.Settings._LoadSnapshot)
+
+    start = time.time()
+    for i in xrange(1000):
+      settings.Settings.GetItem(names[i % len(names)])
+    get_item_secs = time.time() - start
+    get_item_fetches = len(fetches)
+    del fetches[:]
+
+    start = time.time()
+    for i in xrange(1000):
+      settings.Settings.GetSnapshotItem(names[i % len(names)])
+    snapshot_secs = time.time() - start
+
+    logging.info(
+        'Settings reads: GetItem %d fetches in %.4fs, GetSnapshotItem '
+        '%d fetches in %.4fs', get_item_fetches, get_item_secs,
+        len(fetches), snapshot_secs)
+    self.assertEqual(1000, get_item_fetches)
+    self.assertEqual(['get_by_key_name'], fetches)
+
 
 def main(unused_argv):
   basetest.main()
@@ -21,10 +21,12 @@
 
 import datetime
 import logging
+import time
 logging.basicConfig(filename='/dev/null')
 
 import tests.appenginesdk
 from google.apputils import app
+import mox
 from tests.simian.mac.common import test
 from simian.mac.munki import common
 
@@ -39,78 +41,169 @@ class CommonModuleTest(test.RequestHandlerTest):
   def GetTestClassModule(self):
     return common
 
-  def testSaveFirstConnectionWithSkipSerial(self):
-    """Tests _SaveFirstConnection() with a serial in skip_serials = []."""
+  def _MockComputer(self, uuid, serial, preflight_datetime=None):
+    """Returns a mock Computer entity for first connection tests."""
+    c = self.mox.CreateMockAnything()
+    c.uuid = uuid
+    c.serial = serial
+    c.preflight_datetime = preflight_datetime
+    c.owner = 'owner-%s' % uuid
+    c.hostname = 'host-%s' % uuid
+    c.office = 'office-%s' % uuid
+    c.site = 'site-%s' % uuid
+    return c
+
+  def _ExpectFirstClientConnection(self, computer):
+    """Expects a FirstClientConnection for computer, and returns it."""
+    entity = 'first-%s' % computer.uuid
+    common.models.FirstClientConnection(
+        key_name=computer.uuid, computer=computer, owner=computer.owner,
+        hostname=computer.hostname, office=computer.office,
+        site=computer.site).AndReturn(entity)
+    return entity
+
+  def testSaveFirstConnectionsWithSkipSerial(self):
+    """Tests _SaveFirstConnections() with a serial in skip_serials = []."""
     self.mox.StubOutWithMock(common.models, 'FirstClientConnection')
+    self.mox.StubOutWithMock(common.gae_util, 'BatchDatastoreOp')
 
-    client_id = {
-        'uuid': 'uuid', 'owner': 'foouser', 'hostname': 'foohost',
-        'office': 'foooffice', 'site': 'foosite'
-    }
-    class MockComputer(object):
-      serial = common.DUPE_SERIAL_NUMBER_EXCEPTIONS[0]
-    mock_computer = MockComputer()
-    mock_entity = self.mox.CreateMockAnything()
-    common.models.FirstClientConnection(key_name=client_id['uuid']).AndReturn(
-        mock_entity)
-    mock_entity.put().AndReturn(None)
+    mock_computer = self._MockComputer(
+        'uuid', common.DUPE_SERIAL_NUMBER_EXCEPTIONS[0])
+    entity = self._ExpectFirstClientConnection(mock_computer)
+    common.gae_util.BatchDatastoreOp(common.db.put, [entity])
 
     self.mox.ReplayAll()
-    common._SaveFirstConnection(client_id, mock_computer)
-    self.assertEqual(mock_entity.computer, mock_computer)
-    self.assertEqual(mock_entity.owner, client_id['owner'])
-    self.assertEqual(mock_entity.hostname, client_id['hostname'])
-    self.assertEqual(mock_entity.office, client_id['office'])
-    self.assertEqual(mock_entity.site, client_id['site'])
+    common._SaveFirstConnections([mock_computer])
     self.mox.VerifyAll()
 
-  def testSaveFirstConnectionMarkingDupesInactive(self):
-    """Tests _SaveFirstConnection(), marking dupe serial numbers as inactive."""
+  def testSaveFirstConnectionsMarkingDupesInactive(self):
+    """Tests _SaveFirstConnections(), marking dupe serials as inactive."""
     self.mox.StubOutWithMock(common.models, 'FirstClientConnection')
     self.mox.StubOutWithMock(common.models.Computer, 'AllActive')
+    self.mox.StubOutWithMock(common.gae_util, 'BatchDatastoreOp')
+    self.mox.StubOutWithMock(
+        common.models.ComputerSummaryShard, 'PutInactive')
+    self.stubs.Set(common, 'MAX_IN_FILTER_VALUES', 1)
 
     now = datetime.datetime.utcnow()
     dupe_serial = 'fooserial'
 
-    client_id = {
-        'uuid': 'uuid', 'owner': 'foouser', 'hostname': 'foohost',
-        'office': 'foooffice', 'site': 'foosite'
-    }
+    mock_computer = self._MockComputer('new1', dupe_serial, now)
+    # a second new client with the same serial connected earlier.
+    mock_computer_older = self._MockComputer(
+        'new2', dupe_serial, now - datetime.timedelta(minutes=5))
+    other_computer = self._MockComputer('new3', 'otherserial', now)
+    entities = [
+        self._ExpectFirstClientConnection(mock_computer),
+        self._ExpectFirstClientConnection(mock_computer_older),
+        self._ExpectFirstClientConnection(other_computer),
+    ]
 
-    mock_computer = self.mox.CreateMockAnything()
-    mock_computer.uuid = 'this is a unique id'
-    mock_computer.preflight_datetime = now
-    mock_computer.serial = 'foobar serial'
+    dupe1 = self._MockComputer(
+        'diff', dupe_serial, now - datetime.timedelta(minutes=1))
+    dupe2 = self._MockComputer(
+        'diff again', dupe_serial, now - datetime.timedelta(days=21))
+    newer = self._MockComputer(
+        'newer', dupe_serial, now + datetime.timedelta(minutes=1))
 
-    mock_entity = self.mox.CreateMockAnything()
-    common.models.FirstClientConnection(key_name=client_id['uuid']).AndReturn(
-        mock_entity)
-    mock_entity.put().AndReturn(None)
+    # one query per serial, as MAX_IN_FILTER_VALUES is 1.
+    same_serials = [mock_computer, mock_computer_older, dupe1, dupe2, newer]
+    mock_query = self.mox.CreateMockAnything()
+    common.models.Computer.AllActive().AndReturn(mock_query)
+    mock_query.filter('serial IN', ['otherserial']).AndReturn([other_computer])
+    common.models.Computer.AllActive().AndReturn(mock_query)
+    mock_query.filter('serial IN', [dupe_serial]).AndReturn(same_serials)
 
-    dupe1 = self.mox.CreateMockAnything()
-    dupe1.uuid = 'diff'
-    dupe1.preflight_datetime = now - datetime.timedelta(days=0, minutes=1)
-    dupe1.serial = dupe_serial
+    common.gae_util.BatchDatastoreOp(common.db.put, entities)
+    common.models.ComputerSummaryShard.PutInactive(
+        [mock_computer_older, dupe1, dupe2])
 
-    dupe2 = self.mox.CreateMockAnything()
-    dupe2.uuid = 'diff again'
-    dupe2.preflight_datetime = now - datetime.timedelta(days=21)
-    dupe2.serial = dupe_serial
+    self.mox.ReplayAll()
+    common._SaveFirstConnections(
+        [mock_computer, mock_computer_older, other_computer])
+    self.mox.VerifyAll()
 
-    # same_serials contains mock_computer, but put() shouldn't be called again.
-    same_serials = [mock_computer, dupe1, dupe2]
-    mock_query = self.mox.CreateMockAnything()
-    common.models.Computer.AllActive().AndReturn(mock_query)
-    mock_query.filter('serial =', mock_computer.serial).AndReturn(same_serials)
+  def testProcessFirstConnections(self):
+    """Tests _ProcessFirstConnections()."""
+    self.mox.StubOutWithMock(common.taskqueue, 'Queue')
+    self.mox.StubOutWithMock(common.models.Computer, 'get_by_key_name')
+    self.mox.StubOutWithMock(common, '_SaveFirstConnections')
+    self.mox.StubOutWithMock(common.deferred, 'defer')
+    self.stubs.Set(common, 'FIRST_CONNECTION_BATCH_SIZE', 3)
+
+    tasks = []
+    for uuid in ['uuid1', 'uuid2', 'uuid1']:
+      task = self.mox.CreateMockAnything()
+      task.payload = uuid
+      tasks.append(task)
+    mock_queue = self.mox.CreateMockAnything()
+    common.taskqueue.Queue(common.FIRST_CONNECTION_QUEUE).AndReturn(
+        mock_queue)
+    mock_queue.lease_tasks(
+        common.FIRST_CONNECTION_LEASE_SECS, 3).AndReturn(tasks)
+    common.models.Computer.get_by_key_name(
+        mox.SameElementsAs(['uuid1', 'uuid2'])).AndReturn(['c1', None])
+    common._SaveFirstConnections(['c1'])
+    mock_queue.delete_tasks(tasks)
+    common.deferred.defer(common._ProcessFirstConnections, _queue='first')
+
+    common.taskqueue.Queue(common.FIRST_CONNECTION_QUEUE).AndReturn(
+        mock_queue)
+    mock_queue.lease_tasks(
+        common.FIRST_CONNECTION_LEASE_SECS, 3).AndReturn([])
 
-    dupe1.put(update_active=False).AndReturn(None)
-    dupe2.put(update_active=False).AndReturn(None)
+    self.mox.ReplayAll()
+    common._ProcessFirstConnections()
+    common._ProcessFirstConnections()
+    self.mox.VerifyAll()
+
+  def testProcessFirstConnectionsWhenSaveFails(self):
+    """Tests _ProcessFirstConnections() releases leases of a failed batch."""
+    self.mox.StubOutWithMock(common.taskqueue, 'Queue')
+    self.mox.StubOutWithMock(common.models.Computer, 'get_by_key_name')
+    self.mox.StubOutWithMock(common, '_SaveFirstConnections')
+
+    tasks = []
+    for uuid in ['uuid1', 'uuid2']:
+      task = self.mox.CreateMockAnything()
+      task.payload = uuid
+      task.name = 'task-%s' % uuid
+      tasks.append(task)
+    mock_queue = self.mox.CreateMockAnything()
+    common.taskqueue.Queue(common.FIRST_CONNECTION_QUEUE).AndReturn(
+        mock_queue)
+    mock_queue.lease_tasks(
+        common.FIRST_CONNECTION_LEASE_SECS,
+        common.FIRST_CONNECTION_BATCH_SIZE).AndReturn(tasks)
+    common.models.Computer.get_by_key_name(
+        mox.SameElementsAs(['uuid1', 'uuid2'])).AndReturn(['c1', 'c2'])
+    common._SaveFirstConnections(['c1', 'c2']).AndRaise(common.db.Timeout)
+    mock_queue.modify_task_lease(tasks[0], 0).AndRaise(
+        common.taskqueue.TransientError)
+    mock_queue.modify_task_lease(tasks[1], 0)
 
     self.mox.ReplayAll()
-    common._SaveFirstConnection(client_id, mock_computer)
-    self.assertTrue(mock_computer.active)
-    self.assertFalse(dupe1.active)
-    self.assertFalse(dupe2.active)
+    self.assertRaises(common.db.Timeout, common._ProcessFirstConnections)
+    self.mox.VerifyAll()
+
+  def testScheduleFirstConnections(self):
+    """Tests _ScheduleFirstConnections() schedules once per window."""
+    self.mox.StubOutWithMock(common.time, 'time')
+    self.mox.StubOutWithMock(common.deferred, 'defer')
+
+    common.time.time().AndReturn(common.FIRST_CONNECTION_DELAY * 7 + 1)
+    common.deferred.defer(
+        common._ProcessFirstConnections, _name='first-connections-7',
+        _countdown=common.FIRST_CONNECTION_DELAY, _queue='first')
+    common.time.time().AndReturn(common.FIRST_CONNECTION_DELAY * 7 + 2)
+    common.deferred.defer(
+        common._ProcessFirstConnections, _name='first-connections-7',
+        _countdown=common.FIRST_CONNECTION_DELAY, _queue='first').AndRaise(
+            common.taskqueue.TaskAlreadyExistsError)
+
+    self.mox.ReplayAll()
+    common._ScheduleFirstConnections()
+    common._ScheduleFirstConnections()
     self.mox.VerifyAll()
 
   def testLogClientConnectionWithInvalidUuid(self):
@@ -175,6 +268,19 @@ class CommonModuleTest(test.RequestHandlerTest):
     mock_computer.connections_off_corp = 2
     mock_computer.preflight_count_since_postflight = 3
     mock_computer.put().AndReturn(None)
+    self.mox.StubOutWithMock(
+        common.models.ComputerSummaryShard, 'GetComputerCounts')
+    self.mox.StubOutWithMock(common.models.ComputerSummaryShard, 'UpdateCounts')
+    self.mox.StubOutWithMock(
+        common.models.ComputerSummaryShard, 'PrepareUpdate')
+    common.models.ComputerSummaryShard.GetComputerCounts(
+        mock_computer).AndReturn('old counts')
+    common.models.ComputerSummaryShard.GetComputerCounts(
+        mock_computer).AndReturn('new counts')
+    common.models.ComputerSummaryShard.PrepareUpdate(
+        mock_computer, 'old counts').AndReturn('generations')
+    common.models.ComputerSummaryShard.UpdateCounts(
+        'old counts', 'new counts', 'generations')
 
     self.mox.ReplayAll()
     common.LogClientConnection(
@@ -252,6 +358,19 @@ class CommonModuleTest(test.RequestHandlerTest):
     mock_computer.connections_on_corp = None  # test (None or 0) + 1
     mock_computer.connections_off_corp = 0
     mock_computer.put().AndReturn(None)
+    self.mox.StubOutWithMock(
+        common.models.ComputerSummaryShard, 'GetComputerCounts')
+    self.mox.StubOutWithMock(common.models.ComputerSummaryShard, 'UpdateCounts')
+    self.mox.StubOutWithMock(
+        common.models.ComputerSummaryShard, 'PrepareUpdate')
+    common.models.ComputerSummaryShard.GetComputerCounts(
+        mock_computer).AndReturn('old counts')
+    common.models.ComputerSummaryShard.GetComputerCounts(
+        mock_computer).AndReturn('new counts')
+    common.models.ComputerSummaryShard.PrepareUpdate(
+        mock_computer, 'old counts').AndReturn('generations')
+    common.models.ComputerSummaryShard.UpdateCounts(
+        'old counts', 'new counts', 'generations')
 
     self.mox.ReplayAll()
     common.LogClientConnection(
@@ -331,7 +450,8 @@ class CommonModuleTest(test.RequestHandlerTest):
     ne_mock_computer = self.MockModelStaticNone(
         'Computer', 'get_by_key_name', uuid)
     mock_computer = self.MockModel('Computer', key_name=uuid)
-    self.mox.StubOutWithMock(common.deferred, 'defer')
+    self.mox.StubOutWithMock(common, '_QueueFirstConnection')
+    self.mox.StubOutWithMock(common, '_ScheduleFirstConnections')
 
     mock_computer.connection_datetimes = []
     mock_computer.connection_dates = []
@@ -339,10 +459,19 @@ class CommonModuleTest(test.RequestHandlerTest):
     mock_computer.connections_off_corp = None
     mock_computer.preflight_count_since_postflight = None
     mock_computer.put().AndReturn(None)
-    common.deferred.defer(
-        common._SaveFirstConnection,
-        client_id=client_id, computer=mock_computer, _countdown=300,
-        _queue='first')
+    self.mox.StubOutWithMock(
+        common.models.ComputerSummaryShard, 'GetComputerCounts')
+    self.mox.StubOutWithMock(common.models.ComputerSummaryShard, 'UpdateCounts')
+    self.mox.StubOutWithMock(
+        common.models.ComputerSummaryShard, 'PrepareUpdate')
+    common.models.ComputerSummaryShard.GetComputerCounts(
+        mock_computer).AndReturn('new counts')
+    common.models.ComputerSummaryShard.PrepareUpdate(
+        mock_computer, None).AndReturn('generations')
+    common.models.ComputerSummaryShard.UpdateCounts(
+        None, 'new counts', 'generations')
+    common._QueueFirstConnection(uuid)
+    common._ScheduleFirstConnections()
 
     self.mox.ReplayAll()
     common.LogClientConnection(event, client_id, ip_address=ip_address)
@@ -397,6 +526,57 @@ class CommonModuleTest(test.RequestHandlerTest):
     d = common.KeyValueStringToDict(s, delimiter='::')
     self.assertEqual(d, expected_d)
 
+  def testParseInstallResults(self):
+    """Tests ParseInstallResults() with new and legacy style strs."""
+    now = datetime.datetime(2014, 1, 1)
+    installs = [
+        ('name=FooApp1|version=1.0.0|applesus=0|status=0|duration_seconds=100'
+         '|download_kbytes_per_sec=225|time=1312818179.1415989'),
+        ('display_name=Foo App2|name=FooApp2|version=2.1.1|applesus=true'
+         '|unattended=1|status=2|duration_seconds=asdf|time=9999999999'
+         '|download_kbytes_per_sec=0'),
+        'name=Bar|version=1|applesus=|status=0|time=asdf',
+        'Install of Foo App3-2.1.1: %s: -5' % common.INSTALL_RESULT_FAILED,
+        'Install of broken string',
+    ]
+    expected = [
+        {'package': 'FooApp1-1.0.0', 'status': '0', 'applesus': False,
+         'unattended': False, 'duration_seconds': 100,
+         'dl_kbytes_per_sec': 225,
+         'mtime': datetime.datetime(2011, 8, 8, 15, 42, 59)},
+        {'package': 'Foo App2-2.1.1', 'status': '2', 'applesus': True,
+         'unattended': True, 'duration_seconds': None,
+         'dl_kbytes_per_sec': None, 'mtime': now},
+        {'package': 'Bar-1', 'status': '0', 'applesus': None,
+         'unattended': False, 'duration_seconds': None,
+         'dl_kbytes_per_sec': None, 'mtime': now},
+        {'package': 'Foo App3-2.1.1', 'status': '-5', 'applesus': False,
+         'unattended': False, 'duration_seconds': None,
+         'dl_kbytes_per_sec': None, 'mtime': now},
+        {'package': 'Install of broken string-', 'status': 'UNKNOWN',
+         'applesus': False, 'unattended': False, 'duration_seconds': None,
+         'dl_kbytes_per_sec': None, 'mtime': now},
+    ]
+    self.assertEqual(expected, common.ParseInstallResults(installs, now=now))
+
+  def testParseInstallResultsBenchmark(self):
+    """Benchmarks ParseInstallResults() on a 1,000 line install report."""
+    installs = []
+    for i in xrange(1000):
+      installs.append(
+          'name=FooApp%d|version=1.%d|applesus=%d|unattended=false|status=%d'
+          '|duration_seconds=%d|download_kbytes_per_sec=%d|time=%d.5' % (
+              i, i, i % 2, i % 3, i, i * 10, 1312818179 + i))
+    start = time.time()
+    rows = common.ParseInstallResults(installs)
+    elapsed = time.time() - start
+    logging.info('ParseInstallResults: 1000 lines in %.4fs', elapsed)
+    self.assertEqual(1000, len(rows))
+    self.assertEqual('FooApp999-1.999', rows[-1]['package'])
+    self.assertEqual(
+        datetime.datetime(2011, 8, 8, 15, 59, 38), rows[-1]['mtime'])
+    self.assertTrue(elapsed < 1.0)
+
   def _GetClientIdTestData(self):
     """Returns client id test data."""
     client_id_str = (
@@ -526,13 +706,11 @@ class CommonModuleTest(test.RequestHandlerTest):
   def testIsPanicMode(self):
     """Tests IsPanicMode()."""
     mode = common.PANIC_MODES[0]
-    k = '%s%s' % (common.PANIC_MODE_PREFIX, mode)
 
-    self.mox.StubOutWithMock(
-        common.models.KeyValueCache, 'MemcacheWrappedGet')
+    self.mox.StubOutWithMock(common.PANIC_MODE_SNAPSHOT, 'Get')
 
-    common.models.KeyValueCache.MemcacheWrappedGet(k).AndReturn(1)
-    common.models.KeyValueCache.MemcacheWrappedGet(k).AndReturn(None)
+    common.PANIC_MODE_SNAPSHOT.Get().AndReturn(frozenset([mode]))
+    common.PANIC_MODE_SNAPSHOT.Get().AndReturn(frozenset())
 
     self.mox.ReplayAll()
     self.assertTrue(common.IsPanicMode(mode))
@@ -540,6 +718,21 @@ class CommonModuleTest(test.RequestHandlerTest):
     self.assertRaises(ValueError, common.IsPanicMode, 'never a mode')
     self.mox.VerifyAll()
 
+  def testGetPanicModes(self):
+    """Tests _GetPanicModes()."""
+    mode = common.PANIC_MODES[0]
+    k = '%s%s' % (common.PANIC_MODE_PREFIX, mode)
+
+    self.mox.StubOutWithMock(common.models.KeyValueCache, 'get_by_key_name')
+
+    common.models.KeyValueCache.get_by_key_name([k]).AndReturn(['entity'])
+    common.models.KeyValueCache.get_by_key_name([k]).AndReturn([None])
+
+    self.mox.ReplayAll()
+    self.assertEqual(frozenset([mode]), common._GetPanicModes())
+    self.assertEqual(frozenset(), common._GetPanicModes())
+    self.mox.VerifyAll()
+
   def testSetPanicModeWhenValueError(self):
     self.mox.ReplayAll()
     self.assertRaises(ValueError, common.SetPanicMode, 'never a mode', True)
@@ -556,15 +749,18 @@ class CommonModuleTest(test.RequestHandlerTest):
         common.models.KeyValueCache, 'ResetMemcacheWrap')
     self.mox.StubOutWithMock(
         common.models, 'KeyValueCache')
+    self.mox.StubOutWithMock(common.PANIC_MODE_SNAPSHOT, 'Invalidate')
     mock_entity = self.mox.CreateMockAnything()
 
     common.models.KeyValueCache.get_by_key_name(k).AndReturn('existing')
     common.models.KeyValueCache.ResetMemcacheWrap(k).AndReturn(None)
+    common.PANIC_MODE_SNAPSHOT.Invalidate()
 
     common.models.KeyValueCache.get_by_key_name(k).AndReturn(None)
     common.models.KeyValueCache(key_name=k).AndReturn(mock_entity)
     mock_entity.put().AndReturn(None)
     common.models.KeyValueCache.ResetMemcacheWrap(k).AndReturn(None)
+    common.PANIC_MODE_SNAPSHOT.Invalidate()
 
     self.mox.ReplayAll()
     common.SetPanicMode(mode, True)
@@ -583,14 +779,17 @@ class CommonModuleTest(test.RequestHandlerTest):
         common.models.KeyValueCache, 'ResetMemcacheWrap')
     self.mox.StubOutWithMock(
         common.models, 'KeyValueCache')
+    self.mox.StubOutWithMock(common.PANIC_MODE_SNAPSHOT, 'Invalidate')
     mock_entity = self.mox.CreateMockAnything()
 
     common.models.KeyValueCache.get_by_key_name(k).AndReturn(mock_entity)
     mock_entity.delete()
     common.models.KeyValueCache.ResetMemcacheWrap(k).AndReturn(None)
+    common.PANIC_MODE_SNAPSHOT.Invalidate()
 
     common.models.KeyValueCache.get_by_key_name(k).AndReturn(None)
     common.models.KeyValueCache.ResetMemcacheWrap(k).AndReturn(None)
+    common.PANIC_MODE_SNAPSHOT.Invalidate()
 
     self.mox.ReplayAll()
     common.SetPanicMode(mode, False)
@@ -967,11 +1166,10 @@ class CommonModuleTest(test.RequestHandlerTest):
     # mock manifest creation
     common.models.Computer.get_by_key_name(uuid).AndReturn(computer)
     common.IsPanicModeNoPackages().AndReturn(False)
-    mock_plist = self.mox.CreateMockAnything()
     common.models.Manifest.MemcacheWrappedGet('track').AndReturn(
-        test.GenericContainer(enabled=True, plist=mock_plist))
+        test.GenericContainer(enabled=True, plist_xml=u'manifest_xml'))
     common.GenerateDynamicManifest(
-        mock_plist, client_id, user_settings=None).AndReturn(
+        'manifest_xml', client_id, user_settings=None).AndReturn(
         'manifest_plist')
 
     # mock manifest parsing
@@ -1062,11 +1260,10 @@ class CommonModuleTest(test.RequestHandlerTest):
     # mock manifest creation
     common.models.Computer.get_by_key_name(uuid).AndReturn(computer)
     common.IsPanicModeNoPackages().AndReturn(False)
-    mock_plist = self.mox.CreateMockAnything()
     common.models.Manifest.MemcacheWrappedGet('track').AndReturn(
-        test.GenericContainer(enabled=True, plist=mock_plist))
+        test.GenericContainer(enabled=True, plist_xml=u'manifest_xml'))
     common.GenerateDynamicManifest(
-        mock_plist, client_id, user_settings=None).AndReturn(None)
+        'manifest_xml', client_id, user_settings=None).AndReturn(None)
 
     self.mox.ReplayAll()
     self.assertRaises(
@@ -148,26 +148,27 @@ class AppleSUSCatalogsHandlersTest(test.RequestHandlerTest):
     """Test put()."""
     xml = 'xml'
     name = 'foo'
-    lock = 'applesus_%s' % name
+    lock = self.mox.CreateMockAnything()
 
     mock_plist = self.mox.CreateMockAnything()
 
     self.request.body = xml
 
     self.mox.StubOutWithMock(applesus.plist, 'AppleSoftwareCatalogPlist')
-    self.mox.StubOutWithMock(applesus.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(applesus.gae_util, 'ReleaseLock')
+    self.mox.StubOutWithMock(
+        applesus.gae_util, 'Lock', use_mock_anything=True)
 
     self.MockDoMunkiAuth(
       fail=False, require_level=applesus.gaeserver.LEVEL_UPLOADPKG)
     applesus.plist.AppleSoftwareCatalogPlist(xml).AndReturn(mock_plist)
     mock_plist.Parse().AndReturn(None)
-    applesus.gae_util.ObtainLock(lock, timeout=5.0).AndReturn(True)
+    applesus.gae_util.Lock('applesus', name).AndReturn(lock)
+    lock.Acquire(timeout=5.0).AndReturn(True)
 
     model = self.MockModelStatic('AppleSUSCatalog', 'get_or_insert', name)
     model.put().AndReturn(None)
 
-    applesus.gae_util.ReleaseLock(lock).AndReturn(None)
+    lock.Release().AndReturn(True)
 
     self.mox.ReplayAll()
     self.c.put(name)
@@ -178,7 +179,6 @@ class AppleSUSCatalogsHandlersTest(test.RequestHandlerTest):
     """Test put()."""
     xml = 'xml'
     name = 'foo'
-    lock = 'applesus_%s' % name
 
     mock_plist = self.mox.CreateMockAnything()
 
@@ -201,12 +201,13 @@ class AppleSUSCatalogsHandlersTest(test.RequestHandlerTest):
     """Test put()."""
     xml = 'xml'
     name = 'foo'
-    lock = 'applesus_%s' % name
+    lock = self.mox.CreateMockAnything()
 
     mock_plist = self.mox.CreateMockAnything()
 
     self.mox.StubOutWithMock(applesus.plist, 'AppleSoftwareCatalogPlist')
-    self.mox.StubOutWithMock(applesus.gae_util, 'ObtainLock')
+    self.mox.StubOutWithMock(
+        applesus.gae_util, 'Lock', use_mock_anything=True)
 
     self.request.body = xml
 
@@ -214,7 +215,8 @@ class AppleSUSCatalogsHandlersTest(test.RequestHandlerTest):
       fail=False, require_level=applesus.gaeserver.LEVEL_UPLOADPKG)
     applesus.plist.AppleSoftwareCatalogPlist(xml).AndReturn(mock_plist)
     mock_plist.Parse().AndReturn(None)
-    applesus.gae_util.ObtainLock(lock, timeout=5.0).AndReturn(False)
+    applesus.gae_util.Lock('applesus', name).AndReturn(lock)
+    lock.Acquire(timeout=5.0).AndReturn(False)
     self.response.set_status(403)
     self.response.out.write('Could not lock applesus')
 
@@ -226,13 +228,13 @@ class AppleSUSCatalogsHandlersTest(test.RequestHandlerTest):
     """Test put()."""
     xml = 'xml'
     name = 'foo'
-    lock = 'applesus_%s' % name
+    lock = self.mox.CreateMockAnything()
 
     mock_plist = self.mox.CreateMockAnything()
 
     self.mox.StubOutWithMock(applesus.plist, 'AppleSoftwareCatalogPlist')
-    self.mox.StubOutWithMock(applesus.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(applesus.gae_util, 'ReleaseLock')
+    self.mox.StubOutWithMock(
+        applesus.gae_util, 'Lock', use_mock_anything=True)
 
     self.request.body = xml
 
@@ -240,14 +242,15 @@ class AppleSUSCatalogsHandlersTest(test.RequestHandlerTest):
       fail=False, require_level=applesus.gaeserver.LEVEL_UPLOADPKG)
     applesus.plist.AppleSoftwareCatalogPlist(xml).AndReturn(mock_plist)
     mock_plist.Parse().AndReturn(None)
-    applesus.gae_util.ObtainLock(lock, timeout=5.0).AndReturn(True)
+    applesus.gae_util.Lock('applesus', name).AndReturn(lock)
+    lock.Acquire(timeout=5.0).AndReturn(True)
 
     model = self.MockModelStatic('AppleSUSCatalog', 'get_or_insert', name)
     model.put().AndRaise(applesus.models.db.Error)
 
     self.response.set_status(500)
     self.response.out.write('')
-    applesus.gae_util.ReleaseLock(lock).AndReturn(None)
+    lock.Release().AndReturn(True)
 
     self.mox.ReplayAll()
     self.c.put(name)
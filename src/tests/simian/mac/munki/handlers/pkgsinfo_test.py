@@ -72,32 +72,28 @@ class PackagesInfoTest(test.RequestHandlerTest):
   def GetTestClassModule(self):
     return pkgsinfo
 
-  def _MockObtainLock(self, lock, obtain=True, timeout=None):
-    """Mock ObtainLock().
+  def _MockObtainLock(self, kind, key, obtain=True, timeout=None):
+    """Mock Lock() and Lock.Acquire().
 
     Args:
-      lock: str, lock name
+      kind: str, lock kind
+      key: str, lock key
       obtain: bool, default True, whether to obtain it or not
-      timeout: int, timeout value to ObtainLock with
+      timeout: int, timeout value to Acquire with
     """
-    if not hasattr(self, '_mock_obtainlock'):
-      self.mox.StubOutWithMock(pkgsinfo.gae_util, 'ObtainLock')
-      self._mock_obtainlock = True
+    if not hasattr(self, '_mock_lock'):
+      self.mox.StubOutWithMock(
+          pkgsinfo.gae_util, 'Lock', use_mock_anything=True)
+      self._mock_lock = self.mox.CreateMockAnything()
+    pkgsinfo.gae_util.Lock(kind, key).AndReturn(self._mock_lock)
     if timeout is not None:
-      pkgsinfo.gae_util.ObtainLock(lock, timeout=timeout).AndReturn(obtain)
+      self._mock_lock.Acquire(timeout=timeout).AndReturn(obtain)
     else:
-      pkgsinfo.gae_util.ObtainLock(lock).AndReturn(obtain)
+      self._mock_lock.Acquire().AndReturn(obtain)
 
-  def _MockReleaseLock(self, lock):
-    """Mock ReleaseLock().
-
-    Args:
-      lock: str, lock name
-    """
-    if not hasattr(self, '_mock_releaselock'):
-      self.mox.StubOutWithMock(pkgsinfo.gae_util, 'ReleaseLock')
-      self._mock_releaselock = True
-    pkgsinfo.gae_util.ReleaseLock(lock).AndReturn(None)
+  def _MockReleaseLock(self):
+    """Mock Lock.Release()."""
+    self._mock_lock.Release().AndReturn(True)
 
   def testHash(self):
     """Test _Hash()."""
@@ -133,7 +129,7 @@ class PackagesInfoTest(test.RequestHandlerTest):
     filename_quoted = 'pkg%20name.dmg'
     self.MockDoAnyAuth()
     self.request.get('hash').AndReturn('1')
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0)
     pkginfo = self.MockModelStatic('PackageInfo', 'get_by_key_name', filename)
     pkginfo.plist = 'plist'
     self.mox.StubOutWithMock(self.c, '_Hash')
@@ -141,7 +137,7 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.response.headers['Content-Type'] = 'text/xml; charset=utf-8'
     self.response.headers['X-Pkgsinfo-Hash'] = 'hash'
     self.response.out.write(pkginfo.plist).AndReturn(None)
-    self._MockReleaseLock('pkgsinfo_%s' % filename)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     self.c.get(filename_quoted)
@@ -153,7 +149,7 @@ class PackagesInfoTest(test.RequestHandlerTest):
     filename_quoted = 'pkg%20name.dmg'
     self.MockDoAnyAuth()
     self.request.get('hash').AndReturn('1')
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0, obtain=False)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0, obtain=False)
     self.response.set_status(403).AndReturn(None)
     self.response.out.write('Could not lock pkgsinfo').AndReturn(None)
 
@@ -189,11 +185,11 @@ class PackagesInfoTest(test.RequestHandlerTest):
     """Test get() with failure."""
     filename = 'pkgnamenotfound.dmg'
     self.MockDoAnyAuth()
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0, obtain=True)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0, obtain=True)
     self.MockModelStaticBase(
         'PackageInfo', 'get_by_key_name', filename).AndReturn(None)
     self.request.get('hash').AndReturn('1')
-    self._MockReleaseLock('pkgsinfo_%s' % filename)
+    self._MockReleaseLock()
     self.response.set_status(404).AndReturn(None)
 
     self.mox.ReplayAll()
@@ -347,13 +343,13 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(pkgsinfo, 'MunkiPackageInfoPlistStrict')
     pkgsinfo.MunkiPackageInfoPlistStrict(body).AndReturn(mock_mpl)
     mock_mpl.Parse().AndReturn(None)
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0)
     self.MockModelStaticBase(
         'PackageInfo', 'get_by_key_name', filename).AndReturn(None)
 
     self.response.set_status(403).AndReturn(None)
     self.response.out.write('Only updates supported')
-    self._MockReleaseLock('pkgsinfo_%s' % filename)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     self.c.put(filename)
@@ -385,13 +381,13 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(pkgsinfo, 'MunkiPackageInfoPlistStrict')
     pkgsinfo.MunkiPackageInfoPlistStrict(body).AndReturn(mock_mpl)
     mock_mpl.Parse().AndReturn(None)
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0)
     pkginfo = self.MockModelStatic('PackageInfo', 'get_by_key_name', filename)
 
     pkginfo.IsSafeToModify().AndReturn(True)
     pkginfo.name = mock_mpl.GetPackageName().AndReturn(name)
     pkginfo.put()
-    self._MockReleaseLock('pkgsinfo_%s' % filename)
+    self._MockReleaseLock()
 
     self.mox.StubOutWithMock(pkgsinfo.models.Catalog, 'Generate')
     for catalog in catalogs:
@@ -439,13 +435,13 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(pkgsinfo, 'MunkiPackageInfoPlistStrict')
     pkgsinfo.MunkiPackageInfoPlistStrict(body).AndReturn(mock_mpl)
     mock_mpl.Parse().AndReturn(None)
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0)
     pkginfo = self.MockModelStatic('PackageInfo', 'get_by_key_name', filename)
 
     pkginfo.IsSafeToModify().AndReturn(True)
     pkginfo.name = mock_mpl.GetPackageName().AndReturn(name)
     pkginfo.put()
-    self._MockReleaseLock('pkgsinfo_%s' % filename)
+    self._MockReleaseLock()
 
     self.mox.StubOutWithMock(pkgsinfo.models.Catalog, 'Generate')
     for catalog in catalogs:
@@ -493,13 +489,13 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(pkgsinfo, 'MunkiPackageInfoPlistStrict')
     pkgsinfo.MunkiPackageInfoPlistStrict(body).AndReturn(mock_mpl)
     mock_mpl.Parse().AndReturn(None)
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0)
     pkginfo = self.MockModelStatic('PackageInfo', 'get_by_key_name', filename)
 
     pkginfo.IsSafeToModify().AndReturn(True)
     pkginfo.name = mock_mpl.GetPackageName().AndReturn(name)
     pkginfo.put()
-    self._MockReleaseLock('pkgsinfo_%s' % filename)
+    self._MockReleaseLock()
 
     self.mox.StubOutWithMock(pkgsinfo.models.Catalog, 'Generate')
     for catalog in catalogs:
@@ -549,14 +545,14 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(pkgsinfo, 'MunkiPackageInfoPlistStrict')
     pkgsinfo.MunkiPackageInfoPlistStrict(body).AndReturn(mock_mpl)
     mock_mpl.Parse().AndReturn(None)
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0)
     pkginfo = self.MockModelStatic('PackageInfo', 'get_by_key_name', filename)
     pkginfo.IsSafeToModify().AndReturn(True)
     self.mox.StubOutWithMock(self.c, '_Hash')
     self.c._Hash(pkginfo.plist).AndReturn('goodhash')
     pkginfo.name = mock_mpl.GetPackageName().AndReturn(name)
     pkginfo.put()
-    self._MockReleaseLock('pkgsinfo_%s' % filename)
+    self._MockReleaseLock()
 
     self.mox.StubOutWithMock(pkgsinfo.models.Catalog, 'Generate')
     for catalog in catalogs:
@@ -600,7 +596,7 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(pkgsinfo, 'MunkiPackageInfoPlistStrict')
     pkgsinfo.MunkiPackageInfoPlistStrict(body).AndReturn(mock_mpl)
     mock_mpl.Parse().AndReturn(None)
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0)
     pkginfo = self.MockModelStatic('PackageInfo', 'get_by_key_name', filename)
     pkginfo.IsSafeToModify().AndReturn(True)
     self.mox.StubOutWithMock(self.c, '_Hash')
@@ -608,7 +604,7 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.c._Hash(pkginfo.plist).AndReturn('otherhash')
     self.response.set_status(409).AndReturn(None)
     self.response.out.write('Update hash does not match').AndReturn(None)
-    self._MockReleaseLock('pkgsinfo_%s' % filename)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     self.c.put(filename_quoted)
@@ -636,7 +632,7 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(pkgsinfo, 'MunkiPackageInfoPlistStrict')
     pkgsinfo.MunkiPackageInfoPlistStrict(body).AndReturn(mock_mpl)
     mock_mpl.Parse().AndReturn(None)
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0)
     pkginfo = self.MockModelStatic('PackageInfo', 'get_by_key_name', filename)
     pkginfo.plist = 'foo'
 
@@ -646,7 +642,7 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.response.set_status(403).AndReturn(None)
     self.response.out.write('Changes to pkginfo not allowed').AndReturn(
         None)
-    self._MockReleaseLock('pkgsinfo_%s' % filename)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     self.c.put(filename_quoted)
@@ -674,7 +670,7 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.mox.StubOutWithMock(pkgsinfo, 'MunkiPackageInfoPlistStrict')
     pkgsinfo.MunkiPackageInfoPlistStrict(body).AndReturn(mock_mpl)
     mock_mpl.Parse().AndReturn(None)
-    self._MockObtainLock('pkgsinfo_%s' % filename, timeout=5.0)
+    self._MockObtainLock('pkgsinfo', filename, timeout=5.0)
     pkginfo = self.MockModelStatic('PackageInfo', 'get_by_key_name', filename)
     pkginfo.plist = 'foo'
 
@@ -687,7 +683,7 @@ class PackagesInfoTest(test.RequestHandlerTest):
     self.c._Hash(pkginfo.plist).AndReturn('otherhash')
     self.response.set_status(409).AndReturn(None)
     self.response.out.write('Update hash does not match').AndReturn(None)
-    self._MockReleaseLock('pkgsinfo_%s' % filename)
+    self._MockReleaseLock()
 
     self.mox.ReplayAll()
     self.c.put(filename_quoted)
@@ -421,6 +421,8 @@ class HandlersTest(test.RequestHandlerTest):
 
     self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOp')
     reports.gae_util.BatchDatastoreOp(reports.models.db.put, test.mox.IsA(list))
+    self.mox.StubOutWithMock(reports.models.InstallRollup, 'AddInstalls')
+    reports.models.InstallRollup.AddInstalls(test.mox.IsA(list))
 
     self.request.get_all('removals').AndReturn([])
     self.request.get_all('problem_installs').AndReturn([])
@@ -509,6 +511,8 @@ class HandlersTest(test.RequestHandlerTest):
 
     self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOp')
     reports.gae_util.BatchDatastoreOp(reports.models.db.put, test.mox.IsA(list))
+    self.mox.StubOutWithMock(reports.models.InstallRollup, 'AddInstalls')
+    reports.models.InstallRollup.AddInstalls(test.mox.IsA(list))
 
     self.request.get_all('removals').AndReturn([])
     self.request.get_all('problem_installs').AndReturn([])
@@ -639,6 +643,144 @@ class HandlersTest(test.RequestHandlerTest):
 
 
 
+class ReportsBatchTest(test.RequestHandlerTest):
+
+  def GetTestClassInstance(self):
+    return reports.ReportsBatch()
+
+  def GetTestClassModule(self):
+    return reports
+
+  def testPost(self):
+    """Tests post() with a valid batch of reports."""
+    uuid = 'foouuid'
+    session = self.mox.CreateMockAnything()
+    session.uuid = uuid
+    self.MockDoMunkiAuth(and_return=session)
+    batch = [
+        {'_report_type': 'preflight', '_feedback': '1', 'client_id': 'foo'},
+        {'_report_type': 'install_report', 'installs': ['a', u'b\xe9']},
+    ]
+    self.request.body = reports.util.Serialize(batch)
+    entity = self.mox.CreateMockAnything()
+    report_types = []
+
+    def _PostReport(unused_uuid):
+      report_type = self.c.request.get('_report_type')
+      report_types.append(report_type)
+      if report_type == 'preflight':
+        self.assertEqual('foo', self.c.request.get('client_id'))
+        self.c.response.out.write('OK')
+      else:
+        self.assertEqual(
+            ['a', u'b\xe9'], self.c.request.get_all('installs'))
+        self.c._PutEntities([entity])
+        self.c._AddInstallRollups([entity])
+
+    self.mox.StubOutWithMock(self.c, '_PostReport')
+    self.c._PostReport(uuid).WithSideEffects(_PostReport)
+    self.c._PostReport(uuid).WithSideEffects(_PostReport)
+    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOp')
+    reports.gae_util.BatchDatastoreOp(reports.models.db.put, [entity])
+    self.mox.StubOutWithMock(reports.models.InstallRollup, 'AddInstalls')
+    reports.models.InstallRollup.AddInstalls([entity])
+    self.response.out.write('["OK", ""]')
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.assertEqual(['preflight', 'install_report'], report_types)
+    self.assertEqual(self.request, self.c.request)
+    self.assertEqual(None, self.c._pending_puts)
+    self.assertEqual(None, self.c._pending_installs)
+    self.mox.VerifyAll()
+
+  def testPostWhenReportFails(self):
+    """Tests post() puts and rolls up earlier reports when one fails."""
+    session = self.mox.CreateMockAnything()
+    session.uuid = 'foouuid'
+    self.MockDoMunkiAuth(and_return=session)
+    batch = [
+        {'_report_type': 'install_report', 'installs': ['a']},
+        {'_report_type': 'install_report', 'installs': ['b']},
+    ]
+    self.request.body = reports.util.Serialize(batch)
+    entity = self.mox.CreateMockAnything()
+
+    def _PostReport(unused_uuid):
+      if self.c.request.get('installs') == 'b':
+        raise reports.models.db.Error
+      self.c._PutEntities([entity])
+      self.c._AddInstallRollups([entity])
+
+    self.mox.StubOutWithMock(self.c, '_PostReport')
+    self.c._PostReport('foouuid').WithSideEffects(_PostReport)
+    self.c._PostReport('foouuid').WithSideEffects(_PostReport)
+    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOp')
+    reports.gae_util.BatchDatastoreOp(reports.models.db.put, [entity])
+    self.mox.StubOutWithMock(reports.models.InstallRollup, 'AddInstalls')
+    reports.models.InstallRollup.AddInstalls([entity])
+
+    self.mox.ReplayAll()
+    self.assertRaises(reports.models.db.Error, self.c.post)
+    self.assertEqual(None, self.c._pending_puts)
+    self.mox.VerifyAll()
+
+  def testPostWhenReportAndPutFail(self):
+    """Tests post() raises the report failure, not that of the put."""
+    session = self.mox.CreateMockAnything()
+    session.uuid = 'foouuid'
+    self.MockDoMunkiAuth(and_return=session)
+    batch = [
+        {'_report_type': 'install_report', 'installs': ['a']},
+        {'_report_type': 'install_report', 'installs': ['b']},
+    ]
+    self.request.body = reports.util.Serialize(batch)
+    entity = self.mox.CreateMockAnything()
+
+    def _PostReport(unused_uuid):
+      if self.c.request.get('installs') == 'b':
+        raise reports.models.db.BadValueError
+      self.c._PutEntities([entity])
+
+    self.mox.StubOutWithMock(self.c, '_PostReport')
+    self.c._PostReport('foouuid').WithSideEffects(_PostReport)
+    self.c._PostReport('foouuid').WithSideEffects(_PostReport)
+    self.mox.StubOutWithMock(reports.gae_util, 'BatchDatastoreOp')
+    reports.gae_util.BatchDatastoreOp(
+        reports.models.db.put, [entity]).AndRaise(reports.models.db.Timeout)
+
+    self.mox.ReplayAll()
+    self.assertRaises(reports.models.db.BadValueError, self.c.post)
+    self.assertEqual(self.request, self.c.request)
+    self.assertEqual(None, self.c._pending_puts)
+    self.mox.VerifyAll()
+
+  def testPostInvalidBatch(self):
+    """Tests post() with a batch missing a _report_type."""
+    session = self.mox.CreateMockAnything()
+    session.uuid = 'foouuid'
+    self.MockDoMunkiAuth(and_return=session)
+    self.request.body = reports.util.Serialize([{'foo': 'bar'}])
+    self.MockSetStatus(400)
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
+
+  def testPostTooManyReports(self):
+    """Tests post() with a batch over MAX_BATCH_REPORTS."""
+    session = self.mox.CreateMockAnything()
+    session.uuid = 'foouuid'
+    self.MockDoMunkiAuth(and_return=session)
+    self.request.body = reports.util.Serialize(
+        [{'_report_type': 'msu_log'}] * (reports.MAX_BATCH_REPORTS + 1))
+    self.MockSetStatus(400)
+
+    self.mox.ReplayAll()
+    self.c.post()
+    self.mox.VerifyAll()
+
+
 def main(unused_argv):
   test.main(unused_argv)
 
@@ -230,9 +230,11 @@ class UploadPackageTest(test.RequestHandlerTest):
     mock_plist.__getitem__('installer_item_hash').AndReturn('hash')
     uploadpkg.blobstore.BlobInfo.get(blobstore_key).AndReturn(True)
 
-    self.mox.StubOutWithMock(uploadpkg.gae_util, 'ObtainLock')
-    uploadpkg.gae_util.ObtainLock(
-        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn(True)
+    lock = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(
+        uploadpkg.gae_util, 'Lock', use_mock_anything=True)
+    uploadpkg.gae_util.Lock('pkgsinfo', filename).AndReturn(lock)
+    lock.Acquire(timeout=5.0).AndReturn(True)
 
     pkg = self.MockModelStatic('PackageInfo', 'get_or_insert', filename)
     pkg.IsSafeToModify().AndReturn(True)
@@ -246,8 +248,7 @@ class UploadPackageTest(test.RequestHandlerTest):
     uploadpkg.models.Catalog.Generate(catalogs[0], delay=1)
 
 
-    self.mox.StubOutWithMock(uploadpkg.gae_util, 'ReleaseLock')
-    uploadpkg.gae_util.ReleaseLock('pkgsinfo_%s' % filename).AndReturn(True)
+    lock.Release().AndReturn(True)
 
     mock_plist.GetXml().AndReturn(pkginfo_str)
     mock_log = self.MockModel(
@@ -316,9 +317,11 @@ class UploadPackageTest(test.RequestHandlerTest):
     mock_plist.__getitem__('installer_item_hash').AndReturn('hash')
     uploadpkg.blobstore.BlobInfo.get(blobstore_key).AndReturn(True)
 
-    self.mox.StubOutWithMock(uploadpkg.gae_util, 'ObtainLock')
-    uploadpkg.gae_util.ObtainLock(
-        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn(True)
+    lock = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(
+        uploadpkg.gae_util, 'Lock', use_mock_anything=True)
+    uploadpkg.gae_util.Lock('pkgsinfo', filename).AndReturn(lock)
+    lock.Acquire(timeout=5.0).AndReturn(True)
 
     pkg = self.MockModelStatic('PackageInfo', 'get_or_insert', filename)
     pkg.IsSafeToModify().AndReturn(True)
@@ -328,8 +331,7 @@ class UploadPackageTest(test.RequestHandlerTest):
 
     self.mox.StubOutWithMock(uploadpkg.models.Catalog, 'Generate')
     uploadpkg.models.Catalog.Generate(catalogs[0], delay=1)
-    self.mox.StubOutWithMock(uploadpkg.gae_util, 'ReleaseLock')
-    uploadpkg.gae_util.ReleaseLock('pkgsinfo_%s' % filename).AndReturn(True)
+    lock.Release().AndReturn(True)
 
     mock_plist.GetXml().AndReturn(pkginfo_str)
     mock_log = self.MockModel(
@@ -392,9 +394,11 @@ class UploadPackageTest(test.RequestHandlerTest):
     mock_plist.__getitem__('installer_item_hash').AndReturn('hash')
     uploadpkg.blobstore.BlobInfo.get(blobstore_key).AndReturn(True)
 
-    self.mox.StubOutWithMock(uploadpkg.gae_util, 'ObtainLock')
-    uploadpkg.gae_util.ObtainLock(
-        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn(False)
+    lock = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(
+        uploadpkg.gae_util, 'Lock', use_mock_anything=True)
+    uploadpkg.gae_util.Lock('pkgsinfo', filename).AndReturn(lock)
+    lock.Acquire(timeout=5.0).AndReturn(False)
 
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'SafeBlobDel')
     uploadpkg.gae_util.SafeBlobDel(blobstore_key)
@@ -445,14 +449,15 @@ class UploadPackageTest(test.RequestHandlerTest):
     mock_plist.__getitem__('installer_item_hash').AndReturn('hash')
     uploadpkg.blobstore.BlobInfo.get(blobstore_key).AndReturn(True)
 
-    self.mox.StubOutWithMock(uploadpkg.gae_util, 'ObtainLock')
-    self.mox.StubOutWithMock(uploadpkg.gae_util, 'ReleaseLock')
-    uploadpkg.gae_util.ObtainLock(
-        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn(True)
+    lock = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(
+        uploadpkg.gae_util, 'Lock', use_mock_anything=True)
+    uploadpkg.gae_util.Lock('pkgsinfo', filename).AndReturn(lock)
+    lock.Acquire(timeout=5.0).AndReturn(True)
 
     pkg = self.MockModelStatic('PackageInfo', 'get_or_insert', filename)
     pkg.IsSafeToModify().AndReturn(False)
-    uploadpkg.gae_util.ReleaseLock('pkgsinfo_%s' % filename).AndReturn(None)
+    lock.Release().AndReturn(True)
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'SafeBlobDel')
     uploadpkg.gae_util.SafeBlobDel(blobstore_key).AndReturn(None)
     self.MockRedirect(
@@ -503,9 +508,11 @@ class UploadPackageTest(test.RequestHandlerTest):
     mock_plist.__getitem__('installer_item_hash').AndReturn('hash')
     uploadpkg.blobstore.BlobInfo.get(blobstore_key).AndReturn(True)
 
-    self.mox.StubOutWithMock(uploadpkg.gae_util, 'ObtainLock')
-    uploadpkg.gae_util.ObtainLock(
-        'pkgsinfo_%s' % filename, timeout=5.0).AndReturn(True)
+    lock = self.mox.CreateMockAnything()
+    self.mox.StubOutWithMock(
+        uploadpkg.gae_util, 'Lock', use_mock_anything=True)
+    uploadpkg.gae_util.Lock('pkgsinfo', filename).AndReturn(lock)
+    lock.Acquire(timeout=5.0).AndReturn(True)
 
     pkg = self.MockModelStatic('PackageInfo', 'get_or_insert', filename)
     pkg.IsSafeToModify().AndReturn(True)
@@ -521,8 +528,7 @@ class UploadPackageTest(test.RequestHandlerTest):
     uploadpkg.gae_util.SafeBlobDel(blobstore_key).AndReturn(None)
     self.mox.StubOutWithMock(uploadpkg.gae_util, 'SafeEntityDel')
     uploadpkg.gae_util.SafeEntityDel(pkg)
-    self.mox.StubOutWithMock(uploadpkg.gae_util, 'ReleaseLock')
-    uploadpkg.gae_util.ReleaseLock('pkgsinfo_%s' % filename).AndReturn(True)
+    lock.Release().AndReturn(True)
     self.MockRedirect('/uploadpkg?mode=error')
 
     self.mox.ReplayAll()
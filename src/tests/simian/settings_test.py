@@ -781,7 +781,7 @@ class DatastoreSettingsTest(BaseSettingsTestBase):
     mock_settings = self.mox.CreateMockAnything()
     self.settings._module.models = mock_models
     mock_models.Settings = mock_settings
-    mock_settings.GetItem(k).AndReturn([v, mtime])
+    mock_settings.GetSnapshotItem(k).AndReturn([v, mtime])
 
     self.mox.ReplayAll()
     self.assertEqual(self.settings._Get(k), v)
@@ -794,7 +794,7 @@ class DatastoreSettingsTest(BaseSettingsTestBase):
     mock_settings = self.mox.CreateMockAnything()
     self.settings._module.models = mock_models
     mock_models.Settings = mock_settings
-    mock_settings.GetItem(k).AndReturn((None, None))
+    mock_settings.GetSnapshotItem(k).AndReturn((None, None))
 
     self.mox.ReplayAll()
     self.assertRaises(AttributeError, self.settings._Get, k)